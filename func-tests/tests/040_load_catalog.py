@@ -0,0 +1,65 @@
+import requests
+import threading
+import time
+
+import lib.logger as logger
+
+threads_count = 32
+requests_per_thread = 50
+
+# Catalog reads, each takes a pooled database connection
+paths = ["/catalog/roles", "/catalog/assets", "/admin/data/roles"]
+
+
+def _percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, int(round(pct / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+
+def _worker(api_base, n, results, lock):
+    session = requests.Session()
+    local = []
+    for k in xrange(requests_per_thread):
+        url = api_base + paths[(n + k) % len(paths)]
+        beg = time.time()
+        try:
+            code = session.get(url, timeout=60).status_code
+        except requests.RequestException:
+            code = -1
+        local.append((code, time.time() - beg))
+    with lock:
+        results.extend(local)
+
+
+def main(cfg):
+    logger.log("load: %d threads x %d catalog requests", threads_count, requests_per_thread)
+    results = []
+    lock = threading.Lock()
+    workers = [threading.Thread(target=_worker, args=(cfg.api_base, n, results, lock)) for n in xrange(threads_count)]
+
+    beg = time.time()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    elapsed = time.time() - beg
+
+    codes = {}
+    for code, _ in results:
+        codes[code] = codes.get(code, 0) + 1
+    latencies = sorted(secs for code, secs in results if code == 200)
+    logger.log("%d requests in %.1f sec, %.0f/sec; codes: %s", len(results), elapsed, len(results) / elapsed, codes)
+    logger.log("latency of 200s: p50 %.1f msec, p99 %.1f msec, max %.1f msec",
+               _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000, _percentile(latencies, 100) * 1000)
+
+    pool = requests.get(cfg.api_base + "/admin/dbPool")
+    if pool.ok:
+        logger.log("db pool: %s", pool.text)
+
+    # Under the burst, requests either succeed or are rejected fast with 503. Nothing else.
+    unexpected = dict((code, cnt) for code, cnt in codes.items() if code not in (200, 503))
+    if unexpected:
+        return logger.failed("unexpected response codes", unexpected)
+    if not latencies:
+        return logger.failed("no request succeeded")
+    return logger.passed()
@@ -48,6 +48,9 @@ create table tasks(
   , source_template_id binary(16) comment 'for tasks generated from a template, id of the template'
 );
 
+-- the task dispatcher claims due Ready tasks in scheduled_run_ts order
+create index if not exists tasks_ix1 on tasks(task_status, scheduled_run_ts);
+
 /*
 create table task_templates(
     template_id binary(16) not null
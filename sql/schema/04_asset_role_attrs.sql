@@ -0,0 +1,22 @@
+/**
+  Index of asset attribute values.
+
+  Role schemas mark searchable attributes with the '^' flag. Values of such attributes are copied
+  here whenever asset_role_values is written, one row per value (array attributes produce several rows).
+  Searching /catalog/assets by role attributes goes through this table instead of parsing asset_vals.
+
+  * attr_name is the attribute path as in the compiled schema, e.g. '$.hostname' or '$.nics[].ip'
+  * attr_val  the value as a string, truncated to 255 characters
+*/
+
+create table if not exists asset_role_attrs(
+    asset_id     binary(16) not null
+  , role_name    varchar(100) not null
+  ,   constraint asset_role_attrs_fk1 foreign key(asset_id, role_name)
+                 references asset_role_values(asset_id, role_name) on delete cascade
+  , attr_name    varchar(255) not null
+  , attr_val     varchar(255) not null
+  ,   constraint asset_role_attrs_pk primary key(asset_id, role_name, attr_name, attr_val)
+);
+
+create index if not exists asset_role_attrs_ix1 on asset_role_attrs(role_name, attr_name, attr_val);
@@ -0,0 +1,312 @@
+package com.amcentral365.service
+
+import com.google.common.hash.Hashing
+import com.google.common.hash.HashingInputStream
+import mu.KotlinLogging
+
+import java.io.File
+import java.io.FileInputStream
+import java.io.InputStream
+import java.net.HttpURLConnection
+import java.net.URL
+import java.net.URLConnection
+import java.util.Properties
+import java.util.concurrent.CompletableFuture
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.ExecutionException
+import java.util.concurrent.atomic.AtomicLong
+import java.util.concurrent.locks.ReentrantLock
+import kotlin.concurrent.withLock
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * On-disk cache of downloaded script files.
+ *
+ * An entry is keyed by the URL and an optional version (a Nexus version, a git blob sha) and points to a blob
+ * named by the SHA-256 of its content, so identical files downloaded from different places are stored once.
+ * Blobs live in `dir/blobs`, entries in `dir/entries`; both survive restarts.
+ *
+ * A cached entry is served without a network round trip for [revalidateMsec] after it was last validated, and
+ * always when it was opened as immutable. Past that, it is revalidated with a conditional GET
+ * (If-None-Match/If-Modified-Since), so an unchanged file isn't downloaded again. Concurrent requests for the
+ * same entry share one download. When the blobs outgrow [maxBytes], the least recently used entries are evicted.
+ */
+class ArtifactCache(
+        private val dir: File,
+        private val maxBytes: Long,
+        private val revalidateMsec: Long,
+        private val connectTimeoutMsec: Int,
+        private val readTimeoutMsec: Int,
+        private val maxRedirects: Int
+) {
+    private class Entry(
+            val key: String,
+            val url: String,
+            val version: String?,
+            val hash: String,
+            val size: Long,
+            val etag: String?,
+            val lastModified: String?,
+            @Volatile var validatedTs: Long
+    )
+
+    private val blobDir  = File(this.dir, "blobs")
+    private val entryDir = File(this.dir, "entries")
+
+    private val lock = ReentrantLock()
+    private val entries = LinkedHashMap<String, Entry>(16, 0.75f, true)   // access order: eldest is the LRU
+    private val inFlight = ConcurrentHashMap<String, CompletableFuture<Entry>>()
+
+    private val hitCount         = AtomicLong()
+    private val revalidatedCount = AtomicLong()
+    private val downloadCount    = AtomicLong()
+    private val sharedCount      = AtomicLong()
+    private val evictedCount     = AtomicLong()
+
+    init {
+        this.blobDir.mkdirs()
+        this.entryDir.mkdirs()
+        this.load()
+    }
+
+    private fun keyOf(url: String, version: String?): String =
+        Hashing.sha256().hashString("$url\u0000${version ?: ""}", Charsets.UTF_8).toString()
+
+    private fun blobFile(hash: String) = File(this.blobDir, hash)
+    private fun entryFile(key: String) = File(this.entryDir, "$key.properties")
+
+    /**
+     * Open the content of [url].
+     *
+     * @param version identifies the content when the URL alone doesn't, e.g. the git blob sha
+     * @param immutable the content of this url and version never changes, a cached copy is served without revalidation
+     */
+    fun open(url: String, version: String? = null, immutable: Boolean = false): InputStream {
+        val key = this.keyOf(url, version)
+
+        this.lock.withLock {
+            val entry = this.entries[key]
+            if( entry != null && (immutable || System.currentTimeMillis() - entry.validatedTs < this.revalidateMsec) ) {
+                val stream = this.openBlob(entry)
+                if( stream != null ) {
+                    this.hitCount.incrementAndGet()
+                    return stream
+                }
+            }
+        }
+
+        val entry = this.currentEntry(key, url, version, immutable)
+        return this.lock.withLock { this.openBlob(entry) }
+            ?: throw StatusException(500, "the cached copy of $url was evicted while being opened")
+    }
+
+    /**
+     * The SHA-256 of the content of [url], as [open] would return it. Identifies the content without reading it:
+     * the file is only downloaded, to the cache, when it isn't cached or has changed.
+     */
+    fun contentHash(url: String, version: String? = null, immutable: Boolean = false): String {
+        val key = this.keyOf(url, version)
+
+        this.lock.withLock {
+            val entry = this.entries[key]
+            if( entry != null && (immutable || System.currentTimeMillis() - entry.validatedTs < this.revalidateMsec)
+                              && this.blobFile(entry.hash).exists() ) {
+                this.hitCount.incrementAndGet()
+                return entry.hash
+            }
+        }
+
+        return this.currentEntry(key, url, version, immutable).hash
+    }
+
+    /** Revalidate or download the entry. Concurrent requests for the same entry share the work. */
+    private fun currentEntry(key: String, url: String, version: String?, immutable: Boolean): Entry {
+        val mine = CompletableFuture<Entry>()
+        val theirs = this.inFlight.putIfAbsent(key, mine)
+        if( theirs != null ) {
+            this.sharedCount.incrementAndGet()
+            try {
+                return theirs.get()
+            } catch(x: ExecutionException) {
+                throw x.cause ?: x
+            }
+        }
+
+        try {
+            return this.fetch(key, url, version, immutable).also { mine.complete(it) }
+        } catch(x: Exception) {
+            mine.completeExceptionally(x)
+            throw x
+        } finally {
+            this.inFlight.remove(key)
+        }
+    }
+
+    /** Must be called under the lock. Returns null if the blob went missing. */
+    private fun openBlob(entry: Entry): InputStream? {
+        this.entries[entry.key]    // touch
+        val file = this.blobFile(entry.hash)
+        if( !file.exists() ) {
+            logger.warn { "artifact cache: blob ${entry.hash} of ${entry.url} is missing, dropping the entry" }
+            this.entries.remove(entry.key)
+            this.entryFile(entry.key).delete()
+            return null
+        }
+        return FileInputStream(file)
+    }
+
+    private fun fetch(key: String, url: String, version: String?, immutable: Boolean): Entry {
+        val cached = this.lock.withLock { this.entries[key]?.takeIf { this.blobFile(it.hash).exists() } }
+        if( cached != null && immutable )
+            return cached
+
+        val conn = this.connectFollowingRedirects(URL(url), cached)
+        if( cached != null && conn is HttpURLConnection && conn.responseCode == HttpURLConnection.HTTP_NOT_MODIFIED ) {
+            conn.disconnect()
+            logger.debug { "artifact cache: $url is not modified" }
+            this.revalidatedCount.incrementAndGet()
+            cached.validatedTs = System.currentTimeMillis()
+            this.lock.withLock { this.save(cached) }
+            return cached
+        }
+
+        val etag = conn.getHeaderField("ETag")
+        val lastModified = conn.getHeaderField("Last-Modified")
+        val (hash, size) = conn.getInputStream().use { this.storeBlob(it) }
+        this.downloadCount.incrementAndGet()
+        logger.info { "artifact cache: downloaded $size bytes from $url" + (if( cached?.hash == hash ) ", unchanged" else "") }
+
+        val entry = Entry(key, url, version, hash, size, etag, lastModified, System.currentTimeMillis())
+        this.lock.withLock {
+            this.entries[key] = entry
+            this.save(entry)
+            if( cached != null && cached.hash != hash )
+                this.deleteBlobIfUnused(cached.hash)
+            this.evict(keep = key)
+        }
+        return entry
+    }
+
+    private fun storeBlob(input: InputStream): Pair<String, Long> {
+        val tmp = File.createTempFile("download-", ".tmp", this.blobDir)
+        try {
+            val hin = HashingInputStream(Hashing.sha256(), input)
+            val size = tmp.outputStream().use { hin.copyTo(it) }
+            val hash = hin.hash().toString()
+
+            val blob = this.blobFile(hash)
+            if( !blob.exists() && !tmp.renameTo(blob) && !blob.exists() )
+                throw StatusException(500, "artifact cache: failed to rename ${tmp.path} to ${blob.path}")
+            return Pair(hash, size)
+        } finally {
+            tmp.delete()
+        }
+    }
+
+    private val redirectCodes = listOf(307, HttpURLConnection.HTTP_MOVED_PERM, HttpURLConnection.HTTP_MOVED_TEMP, HttpURLConnection.HTTP_SEE_OTHER)
+
+    private fun connectFollowingRedirects(url: URL, cached: Entry?): URLConnection {
+        var currUrl = url
+        var cookies: String? = null
+        for(unused in 0..this.maxRedirects) {
+            val conn = currUrl.openConnection()
+            conn.connectTimeout = this.connectTimeoutMsec
+            conn.readTimeout    = this.readTimeoutMsec
+            (conn as? HttpURLConnection)?.instanceFollowRedirects = false
+            if( cookies != null )
+                conn.setRequestProperty("Cookie", cookies)
+            if( cached?.etag != null )
+                conn.setRequestProperty("If-None-Match", cached.etag)
+            if( cached?.lastModified != null )
+                conn.setRequestProperty("If-Modified-Since", cached.lastModified)
+
+            if(conn is HttpURLConnection && conn.responseCode in this.redirectCodes) {
+                cookies = conn.getHeaderField("Set-Cookie")
+                val loc = conn.getHeaderField("Location")
+                conn.disconnect()
+                currUrl = URL(currUrl, loc)
+                logger.info { "redirecting to $currUrl" }
+                continue
+            }
+
+            logger.info { "streaming from $currUrl" }
+            return conn
+        }
+
+        throw StatusException(417, "the URL redirects more than --http-max-redirects (${this.maxRedirects}) times: $url")
+    }
+
+    /** Must be called under the lock */
+    private fun evict(keep: String) {
+        var total = this.entries.values.distinctBy { it.hash }.map { it.size }.sum()
+        val iter = this.entries.values.iterator()
+        while( total > this.maxBytes && iter.hasNext() ) {
+            val entry = iter.next()
+            if( entry.key == keep )
+                continue
+            iter.remove()
+            this.entryFile(entry.key).delete()
+            if( this.deleteBlobIfUnused(entry.hash) )
+                total -= entry.size
+            this.evictedCount.incrementAndGet()
+            logger.debug { "artifact cache: evicted ${entry.url}" }
+        }
+    }
+
+    /** Must be called under the lock */
+    private fun deleteBlobIfUnused(hash: String): Boolean {
+        if( this.entries.values.any { it.hash == hash } )
+            return false
+        this.blobFile(hash).delete()
+        return true
+    }
+
+    /** Must be called under the lock */
+    private fun save(entry: Entry) {
+        val props = Properties()
+        props["url"] = entry.url
+        props["hash"] = entry.hash
+        props["size"] = entry.size.toString()
+        props["validatedTs"] = entry.validatedTs.toString()
+        entry.version?.let      { props["version"] = it }
+        entry.etag?.let         { props["etag"] = it }
+        entry.lastModified?.let { props["lastModified"] = it }
+        this.entryFile(entry.key).outputStream().use { props.store(it, null) }
+    }
+
+    private fun load() {
+        val loaded = this.entryDir.listFiles { f -> f.name.endsWith(".properties") }.orEmpty().mapNotNull { file ->
+            try {
+                val props = Properties()
+                file.inputStream().use { props.load(it) }
+                Entry(file.name.removeSuffix(".properties"), props.getProperty("url"), props.getProperty("version"),
+                      props.getProperty("hash"), props.getProperty("size").toLong(), props.getProperty("etag"),
+                      props.getProperty("lastModified"), props.getProperty("validatedTs").toLong())
+                    .takeIf { this.blobFile(it.hash).exists() }
+            } catch(x: Exception) {
+                logger.warn { "artifact cache: ignoring unreadable entry ${file.name}: ${x.message}" }
+                null
+            }
+        }
+
+        this.lock.withLock {
+            loaded.sortedBy { it.validatedTs }.forEach { this.entries[it.key] = it }
+        }
+        logger.info { "artifact cache: loaded ${loaded.size} entries from ${this.dir.path}" }
+    }
+
+    fun stats(): Map<String, Any> = this.lock.withLock {
+        linkedMapOf(
+              "entries"          to this.entries.size
+            , "bytes"            to this.entries.values.distinctBy { it.hash }.map { it.size }.sum()
+            , "maxBytes"         to this.maxBytes
+            , "hitCount"         to this.hitCount.get()
+            , "revalidatedCount" to this.revalidatedCount.get()
+            , "downloadCount"    to this.downloadCount.get()
+            , "sharedCount"      to this.sharedCount.get()
+            , "evictedCount"     to this.evictedCount.get()
+        )
+    }
+}
@@ -1,6 +1,7 @@
 package com.amcentral365.service
 
 import com.github.ajalt.clikt.core.CliktCommand
+import com.github.ajalt.clikt.core.UsageError
 import com.github.ajalt.clikt.parameters.options.option
 import com.github.ajalt.clikt.parameters.options.default
 import com.github.ajalt.clikt.parameters.options.validate
@@ -8,11 +9,14 @@ import com.github.ajalt.clikt.parameters.options.flag
 import com.github.ajalt.clikt.parameters.options.convert
 import com.github.ajalt.clikt.parameters.options.multiple
 import com.github.ajalt.clikt.parameters.options.versionOption
+import com.github.ajalt.clikt.parameters.types.choice
 import com.github.ajalt.clikt.parameters.types.int
 import com.github.ajalt.clikt.parameters.types.long
 
 import mu.KotlinLogging
+import java.io.File
 import java.lang.Math.max
+import java.net.InetAddress
 import java.nio.charset.Charset
 
 
@@ -49,6 +53,75 @@ class Configuration(val args: Array<String>): CliktCommand(name = "amcentral365-
             .convert { if( it.matches(Regex("^jdbc:[^/@]+:?(//|@).+")) ) it else "jdbc:mariadb://$it" }
             .default("jdbc:mariadb://127.0.0.1:3365/amcentral365?useSSL=false&minPoolSize=10")
 
+    val dbPoolMinSize: Int by option("--db-pool-min-size",
+            help = "How many database connections the pool keeps open when idle. 0 keeps minPoolSize of --conn or the driver default")
+            .int()
+            .default(0)
+            .validate {
+                if( it < 0 )
+                    fail("db-pool-min-size can't be negative")
+            }
+
+    val dbPoolMaxSize: Int by option("--db-pool-max-size",
+            help = "How many database connections may be open. 0 keeps maxPoolSize of --conn or the driver default")
+            .int()
+            .default(0)
+            .validate {
+                if( it < 0 )
+                    fail("db-pool-max-size can't be negative")
+            }
+
+    val dbPoolMaxIdleSec: Int by option("--db-pool-max-idle-sec",
+            help = "Idle database connections above --db-pool-min-size are closed after this many seconds. 0 keeps the driver default")
+            .int()
+            .default(0)
+            .validate {
+                if( it < 0 )
+                    fail("db-pool-max-idle-sec can't be negative")
+            }
+
+    val dbPoolValidMinDelayMsec: Int by option("--db-pool-valid-min-delay-msec",
+            help = "A pooled connection idle for this long is validated before it is handed out. 0 keeps the driver default")
+            .int()
+            .default(0)
+            .validate {
+                if( it < 0 )
+                    fail("db-pool-valid-min-delay-msec can't be negative")
+            }
+
+    val dbPoolAcquireTimeoutMsec: Long by option("--db-pool-acquire-timeout-msec",
+            help = "How long a request waits for a database connection before it is rejected with 503. 0 waits indefinitely")
+            .long()
+            .default(10_000)
+            .validate {
+                if( it < 0 )
+                    fail("db-pool-acquire-timeout-msec can't be negative")
+            }
+
+    val dbLeakWatchMode: LeakWatcher.Mode by option("--db-leak-watch",
+            help = "Tracking of unreleased database connections: off, sampled (call stacks of one in --db-leak-sample-every " +
+                   "connections are captured), or full (call stacks of all connections are captured)")
+            .choice("off" to LeakWatcher.Mode.OFF, "sampled" to LeakWatcher.Mode.SAMPLED, "full" to LeakWatcher.Mode.FULL)
+            .default(LeakWatcher.Mode.SAMPLED)
+
+    val dbLeakSampleEvery: Int by option("--db-leak-sample-every",
+            help = "With --db-leak-watch=sampled, capture the call stack of one in this many connections")
+            .int()
+            .default(100)
+            .validate {
+                if( it < 1 )
+                    fail("db-leak-sample-every must be at least 1, got $it")
+            }
+
+    val dbLeakReportSec: Long by option("--db-leak-report-sec",
+            help = "Connections held for this many seconds are reported as possible leaks, with their age histogram. 0 disables the reports")
+            .long()
+            .default(300)
+            .validate {
+                if( it < 0 )
+                    fail("db-leak-report-sec can't be negative")
+            }
+
     val clusterNodeNames: MutableList<Pair<String, Short>> = mutableListOf()
     private val rawClusterNodeNames: List<String> by option("-n", "--node", "--nodes",
             help = """
@@ -82,6 +155,46 @@ class Configuration(val args: Array<String>): CliktCommand(name = "amcentral365-
             fail("schema-cache-size-in-nodes must be 100 or greater")
     }
 
+    val schemaCacheCheckIntervalSec: Long by option("--schema-cache-check-interval-sec",
+            help = "How often, in seconds, cached role schemas are checked against the roles modification time. " +
+                   "Stale schemas, e.g. updated by other cluster nodes, are dropped. 0 disables the checks")
+            .long()
+            .default(30)
+            .validate {
+                if( it < 0 )
+                    fail("schema-cache-check-interval-sec can't be negative")
+            }
+
+    val schemaCacheWarmUp: Boolean by option("--schema-cache-warm-up", help="Preload all role schemas into the cache on startup")
+                              .flag("--no-schema-cache-warm-up", default = true)
+
+    val catalogCacheSize: Long by option("--catalog-cache-size",
+            help = "How many assets and asset role values are cached for script executions. 0 disables the cache")
+            .long()
+            .default(10000)
+            .validate {
+                if( it < 0 )
+                    fail("catalog-cache-size can't be negative")
+            }
+
+    val catalogCacheTtlSec: Long by option("--catalog-cache-ttl-sec",
+            help = "After how many seconds a cached asset or role value is checked against its modification time in the database")
+            .long()
+            .default(60)
+            .validate {
+                if( it < 1 )
+                    fail("catalog-cache-ttl-sec must be positive")
+            }
+
+    val importBatchSize: Int by option("--import-batch-size",
+            help = "Bulk asset import: how many assets are written with one JDBC batch and committed together")
+            .int()
+            .default(500)
+            .validate {
+                if( it < 1 )
+                    fail("import-batch-size must be positive")
+            }
+
     val localScriptExecBaseDir: String by option("--local-script-exec-base--dir",
             help = "Base directory for running scripts meant to be executed on the am-centrral worker machine")
             .default("/tmp")
@@ -97,10 +210,146 @@ class Configuration(val args: Array<String>): CliktCommand(name = "amcentral365-
             .default(0)
 
     val scriptOutputPollIntervalMsec: Long by option("--script-output-poll-interval-msec",
-            help = "How frequent do we check for script output, in milliseconds")
+            help = "Deprecated and ignored: script output is streamed as it arrives")
             .long()
             .default(200)
 
+    val scriptTransferArchive: Boolean by option("--script-transfer-archive",
+            help = "Send script files to SSH targets as one tar stream, unpacked with a single command. " +
+                   "Targets without tar get the files one by one over SFTP.")
+            .flag("--no-script-transfer-archive", default = true)
+
+    val scriptStaging: Boolean by option("--script-staging",
+            help = "Transfer each version of a script to a target once and reuse it in later executions, " +
+                   "instead of a new work directory per execution. Only for scripts that don't modify their directory.")
+            .flag("--no-script-staging", default = false)
+
+    val scriptStagingMaxAgeSec: Long by option("--script-staging-max-age-sec",
+            help = "Staged script versions not used for this many seconds are removed from the target")
+            .long()
+            .default(7 * 24 * 3600)
+            .validate {
+                if( it < 60 )
+                    fail("script-staging-max-age-sec must be at least 60, got $it")
+            }
+
+    val scriptStagingGcIntervalSec: Long by option("--script-staging-gc-interval-sec",
+            help = "How often, in seconds, a target is checked for unused staged script versions")
+            .long()
+            .default(3600)
+
+    val scriptOutputBufferBytes: Int by option("--script-output-buffer-bytes",
+            help = "Size of the buffer script output is copied with. Output is passed on as it arrives, this only caps the chunk size")
+            .int()
+            .default(65536)
+            .validate {
+                if( it < 1024 )
+                    fail("script-output-buffer-bytes must be at least 1024, got $it")
+            }
+
+    // --------------------------- Asynchronous executes
+    val executeThreads: Int by option("--execute-threads",
+            help = "How many asynchronous executes may run at the same time")
+            .int()
+            .default(8)
+            .validate {
+                if( it < 1 )
+                    fail("execute-threads must be at least 1, got $it")
+            }
+
+    val executeQueueSize: Int by option("--execute-queue-size",
+            help = "How many asynchronous executes may wait for a thread. Further requests are rejected with 503.")
+            .int()
+            .default(100)
+            .validate {
+                if( it < 1 )
+                    fail("execute-queue-size must be at least 1, got $it")
+            }
+
+    val executeOutputDir: String by option("--execute-output-dir",
+            help = "Directory where the output of asynchronous executes is spooled to")
+            .default(File(SystemTempDirName, "amc-executes").path)
+
+    val executeOutputSegmentBytes: Long by option("--execute-output-segment-bytes",
+            help = "Output of an execute is spooled to files of this size")
+            .long()
+            .default(1L shl 20)
+            .validate {
+                if( it < 4096 )
+                    fail("execute-output-segment-bytes must be at least 4096, got $it")
+            }
+
+    val executeOutputMaxSegments: Int by option("--execute-output-max-segments",
+            help = "How many output files of an execute are kept. When the output outgrows them, its beginning is dropped.")
+            .int()
+            .default(64)
+            .validate {
+                if( it < 1 )
+                    fail("execute-output-max-segments must be at least 1, got $it")
+            }
+
+    val executeRetentionSec: Long by option("--execute-retention-sec",
+            help = "How long, in seconds, a finished execute and its output are kept")
+            .long()
+            .default(3600)
+
+    val executeOutputMaxWaitSec: Int by option("--execute-output-max-wait-sec",
+            help = "Upper limit of waitSec when reading the output of a running execute")
+            .int()
+            .default(60)
+
+    val fanOutMaxParallel: Int by option("--fanout-max-parallel",
+            help = "How many targets of all fan-out executes may run at the same time. Also the default per request.")
+            .int()
+            .default(64)
+            .validate {
+                if( it < 1 )
+                    fail("fanout-max-parallel must be at least 1, got $it")
+            }
+
+    val fanOutMaxParallelPerRole: Int by option("--fanout-max-parallel-per-role",
+            help = "How many fan-out targets of the same target role may run at the same time")
+            .int()
+            .default(32)
+            .validate {
+                if( it < 1 )
+                    fail("fanout-max-parallel-per-role must be at least 1, got $it")
+            }
+
+    // --------------------------- Task dispatcher
+    val taskDispatcherEnabled: Boolean by option("--task-dispatcher",
+            help = "Run tasks submitted to the tasks table. Enabled by default.")
+            .flag("--no-task-dispatcher", default = true)
+
+    val taskThreads: Int by option("--task-threads",
+            help = "How many tasks this node runs at the same time")
+            .int()
+            .default(8)
+            .validate {
+                if( it < 1 )
+                    fail("task-threads must be at least 1, got $it")
+            }
+
+    val taskClaimBatchSize: Int by option("--task-claim-batch-size",
+            help = "At most how many due tasks are claimed with one query")
+            .int()
+            .default(10)
+            .validate {
+                if( it < 1 )
+                    fail("task-claim-batch-size must be at least 1, got $it")
+            }
+
+    val taskPollIntervalMsec: Long by option("--task-poll-interval-msec",
+            help = "How often the tasks table is checked for due tasks when there were none")
+            .long()
+            .default(1000)
+
+    private val rawWorkerName: String by option("--worker-name",
+            help = "Name of this node recorded in tasks.submit_worker and execute_worker. Must be unique in the cluster. Defaults to hostname:bind-port")
+            .default("")
+    val workerName: String get() =
+        if( this.rawWorkerName.isNotBlank() ) this.rawWorkerName else "${InetAddress.getLocalHost().hostName}:${this.bindPort}"
+
     lateinit var charSet: Charset private set
     val charSetName: String by option("--charset", help = "Character Set used for almost everything")
             .default("UTF-8")
@@ -127,12 +376,64 @@ class Configuration(val args: Array<String>): CliktCommand(name = "amcentral365-
             .long()
             .default(0)
 
+    val mergeFull: Boolean by option("--merge-full",
+            help = "Merge all files, including the ones unchanged since the last merge according to the merge manifest")
+            .flag("--no-merge-full", default = false)
+
+    val mergeManifestDir: String by option("--merge-manifest-dir",
+            help = "Directory where fingerprints of the merged files are kept, so unchanged files are skipped by the next merge")
+            .default(File(SystemTempDirName, "amc-merge").path)
+
+    val mergeChunkRecords: Int by option("--merge-chunk-records",
+            help = "Merge the assets of a file in chunks of this many records, a transaction each, in parallel with --merge-threads. "+
+                   "When 0, all assets of a file are merged in one transaction")
+            .int()
+            .default(0)
+            .validate { if( it < 0 ) fail("--merge-chunk-records must not be negative") }
+
+    val mergeBulk: Boolean by option("--merge-bulk",
+            help = "Merge assets in bulk: read the existing rows with a few queries, diff them in memory, and write the changes in batches")
+            .flag("--no-merge-bulk", default = false)
+
+    val mergeDryRun: Boolean by option("--merge-dry-run",
+            help = "Log the changes the assets merge would make without writing them. Implies --merge-bulk")
+            .flag(default = false)
+
     // --------------------------- SSH
     val sshPrivateKeyFile: String by option("--ssh-pvt-key-file", help="file storing AM Central private key for SSH authentications").default("ssh-key")
 
     lateinit var sshPublicKeyFile: String private set
     val _sshPublicKeyFile: String by option("--ssh-pub-key-file", help="file storing AM Central public key for SSH authentications. Defaults to ").default("")
 
+    val sshPoolMaxSessionsPerHost: Int by option("--ssh-pool-max-sessions-per-host",
+            help = "How many SSH sessions may be open to the same host and user. Executions wait for a free one")
+            .int()
+            .default(4)
+            .validate {
+                if( it < 1 )
+                    fail("ssh-pool-max-sessions-per-host must be positive")
+            }
+
+    val sshPoolIdleTimeoutSec: Long by option("--ssh-pool-idle-timeout-sec",
+            help = "Pooled SSH sessions unused for this many seconds are closed. 0 keeps them open")
+            .long()
+            .default(300)
+
+    val sshPoolWaitMsec: Long by option("--ssh-pool-wait-msec",
+            help = "How long to wait for a free SSH session when the host has --ssh-pool-max-sessions-per-host of them busy")
+            .long()
+            .default(30000)
+
+    val sshKeepAliveSec: Int by option("--ssh-keepalive-sec",
+            help = "Interval of SSH keepalive messages, also the idle time after which a pooled session is probed before reuse. 0 disables")
+            .int()
+            .default(30)
+
+    val sshConnectTimeoutMsec: Int by option("--ssh-connect-timeout-msec",
+            help = "Timeout in milliseconds when opening an SSH session")
+            .int()
+            .default(15000)
+
     // --------------------------- HTTP(s)
     val httpMaxRedirects: Int by option("--http-max-redirects",
                 help = "When downloading a script from HTTP(s), how many times at most we shal follow 'moved permanently/temporarily' redirects")
@@ -143,9 +444,43 @@ class Configuration(val args: Array<String>): CliktCommand(name = "amcentral365-
     val httpReadTimeoutMsec: Int by option("--http-read-timeout-msec",
                 help = "Timeout in milliseconds when reading from an HTTP(s) connection")
                 .int().default(15000)
+    val githubFetchThreads: Int by option("--github-fetch-threads",
+                help = "How many listings and files of a GitHub script directory are downloaded in parallel")
+                .int().default(8)
+                .validate {
+                    if( it < 1 )
+                        fail("github-fetch-threads must be at least 1, got $it")
+                }
+
+    // --------------------------- Script artifact cache
+    val artifactCacheDir: String by option("--artifact-cache-dir",
+            help = "Directory where script files downloaded from HTTP(s), Nexus, and GitHub are cached")
+            .default(File(SystemTempDirName, "amc-artifacts").path)
+
+    val artifactCacheMaxBytes: Long by option("--artifact-cache-max-bytes",
+            help = "When the cached script files outgrow this size, the least recently used ones are evicted")
+            .long()
+            .default(512L shl 20)
+            .validate {
+                if( it < 0 )
+                    fail("artifact-cache-max-bytes can't be negative")
+            }
+
+    val artifactCacheRevalidateSec: Long by option("--artifact-cache-revalidate-sec",
+            help = "For how long, in seconds, a cached script file is used without asking the server if it changed. " +
+                   "Files pinned to a version, like Nexus releases and GitHub blobs, are never revalidated.")
+            .long()
+            .default(60)
+            .validate {
+                if( it < 0 )
+                    fail("artifact-cache-revalidate-sec can't be negative")
+            }
 
 
     override fun run() {
+        if( dbPoolMinSize > 0 && dbPoolMaxSize > 0 && dbPoolMinSize > dbPoolMaxSize )
+            throw UsageError("db-pool-min-size can't exceed db-pool-max-size, got $dbPoolMinSize and $dbPoolMaxSize")
+
         mergeThreads = if( rawMergeThreads > 0 ) rawMergeThreads
                      else max(1, Runtime.getRuntime().availableProcessors()-1)
 
@@ -203,6 +538,9 @@ class Configuration(val args: Array<String>): CliktCommand(name = "amcentral365-
                 merge roles, assets:  $mergeRoles, $mergeAssets
                   threads to use:     $mergeThreads
                   time limit (sec):   $mergeTimeLimitSec
+                  full merge:         $mergeFull
+                  bulk, dry run:      $mergeBulk, $mergeDryRun
+                  chunk records:      $mergeChunkRecords
             """
             .trimIndent()
         }
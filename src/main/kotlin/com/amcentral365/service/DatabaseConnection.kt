@@ -17,17 +17,35 @@ import java.sql.Statement
 import java.sql.Struct
 import java.util.Properties
 import java.util.concurrent.Executor
+import java.util.concurrent.atomic.AtomicBoolean
 
 private val logger = KotlinLogging.logger {}
 
-class DatabaseConnection(var conn: Connection): Connection {
+/** A pooled connection. [onClose] is called once, when the connection is returned to the pool. */
+class DatabaseConnection(var conn: Connection, private val onClose: (() -> Unit)? = null): Connection {
 
     companion object {
-        val connectionLeakWatcher = LeakWatcher()
+        /** Replaced on startup according to the configuration. Connections are released to the watcher they were allocated with. */
+        @Volatile var connectionLeakWatcher = LeakWatcher()
+    }
+
+    private val leakWatcher = connectionLeakWatcher
+    private val closed = AtomicBoolean(false)
+
+    /**
+     * The fetch size of the statements created on this connection, zero for the driver default.
+     * With a positive fetch size the MariaDB driver streams the result set rather than reading all of it up front.
+     */
+    var fetchSize: Int = 0
+
+    private fun <T: Statement> withFetchSize(stmt: T): T {
+        if( this.fetchSize > 0 )
+            stmt.fetchSize = this.fetchSize
+        return stmt
     }
 
     init {
-        connectionLeakWatcher.allocated(conn)
+        this.leakWatcher.allocated(conn)
         logger.debug { "obtained db connection: $conn" }
     }
 
@@ -56,9 +74,15 @@ class DatabaseConnection(var conn: Connection): Connection {
     override fun isClosed(): Boolean = conn.isClosed
 
     override fun close() {
+        if( !this.closed.compareAndSet(false, true) )
+            return
         logger.debug { "releasing db connection $conn" }
-        conn.close()
-        connectionLeakWatcher.released(conn)
+        try {
+            conn.close()
+            this.leakWatcher.released(conn)
+        } finally {
+            this.onClose?.invoke()
+        }
     }
 
     override fun getNetworkTimeout(): Int = conn.networkTimeout
@@ -94,26 +118,26 @@ class DatabaseConnection(var conn: Connection): Connection {
     override fun createClob(): Clob = conn.createClob()
     override fun createSQLXML(): SQLXML = conn.createSQLXML()
 
-    override fun createStatement(): Statement = conn.createStatement()
+    override fun createStatement(): Statement = withFetchSize(conn.createStatement())
     override fun createStatement(resultSetType: Int, resultSetConcurrency: Int): Statement
-        = conn.createStatement(resultSetType, resultSetConcurrency)
+        = withFetchSize(conn.createStatement(resultSetType, resultSetConcurrency))
     override fun createStatement(resultSetType: Int, resultSetConcurrency: Int, resultSetHoldability: Int): Statement
-        = conn.createStatement(resultSetType, resultSetConcurrency, resultSetHoldability)
+        = withFetchSize(conn.createStatement(resultSetType, resultSetConcurrency, resultSetHoldability))
 
-    override fun prepareStatement(sql: String?): PreparedStatement = conn.prepareStatement(sql)
+    override fun prepareStatement(sql: String?): PreparedStatement = withFetchSize(conn.prepareStatement(sql))
     override fun prepareStatement(sql: String?, resultSetType: Int, resultSetConcurrency: Int): PreparedStatement
-        = conn.prepareStatement(sql, resultSetType, resultSetConcurrency)
+        = withFetchSize(conn.prepareStatement(sql, resultSetType, resultSetConcurrency))
     override fun prepareStatement(sql: String?, resultSetType: Int, resultSetConcurrency: Int, resultSetHoldability: Int): PreparedStatement
-        = conn.prepareStatement(sql, resultSetType, resultSetConcurrency, resultSetHoldability)
+        = withFetchSize(conn.prepareStatement(sql, resultSetType, resultSetConcurrency, resultSetHoldability))
     override fun prepareStatement(sql: String?, autoGeneratedKeys: Int): PreparedStatement
-        = conn.prepareStatement(sql, autoGeneratedKeys)
+        = withFetchSize(conn.prepareStatement(sql, autoGeneratedKeys))
     override fun prepareStatement(sql: String?, columnIndexes: IntArray?): PreparedStatement
-        = conn.prepareStatement(sql, columnIndexes)
+        = withFetchSize(conn.prepareStatement(sql, columnIndexes))
     override fun prepareStatement(sql: String?, columnNames: Array<out String>?): PreparedStatement
-        = conn.prepareStatement(sql, columnNames)
-    override fun prepareCall(sql: String?): CallableStatement = conn.prepareCall(sql)
+        = withFetchSize(conn.prepareStatement(sql, columnNames))
+    override fun prepareCall(sql: String?): CallableStatement = withFetchSize(conn.prepareCall(sql))
     override fun prepareCall(sql: String?, resultSetType: Int, resultSetConcurrency: Int): CallableStatement
-        = conn.prepareCall(sql, resultSetType, resultSetConcurrency)
+        = withFetchSize(conn.prepareCall(sql, resultSetType, resultSetConcurrency))
     override fun prepareCall(sql: String?, resultSetType: Int, resultSetConcurrency: Int, resultSetHoldability: Int): CallableStatement
-        = conn.prepareCall(sql, resultSetType, resultSetConcurrency, resultSetHoldability)
+        = withFetchSize(conn.prepareCall(sql, resultSetType, resultSetConcurrency, resultSetHoldability))
 }
@@ -2,10 +2,14 @@ package com.amcentral365.service
 
 import mu.KLogging
 
+import java.lang.management.ManagementFactory
 import java.sql.Connection
 import java.sql.SQLException
+import java.util.concurrent.Semaphore
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicLong
+import javax.management.ObjectName
 
-import javax.sql.DataSource
 import org.mariadb.jdbc.MariaDbPoolDataSource   // don't like
 
 import com.amcentral365.pl4kotlin.Entity
@@ -18,15 +22,47 @@ import java.sql.SQLTransientConnectionException
 
 const val DBERR_DUP_VAL_ON_INDEX = 1062
 
-class DatabaseStore {
-    companion object: KLogging()
-    private val pool: DataSource
+/**
+ * Database access through a MariaDB connection pool.
+ *
+ * At most maxPoolSize connections are handed out. A caller waits up to [acquireTimeoutMsec] for one to free up,
+ * or for the database to become available, and then fails with [StatusException] 503 rather than parking
+ * the request thread indefinitely. Zero [acquireTimeoutMsec] waits for as long as needed.
+ */
+class DatabaseStore(
+        private val minPoolSize: Int = config.dbPoolMinSize,
+        private val maxPoolSize: Int = config.dbPoolMaxSize,
+        private val maxIdleSec: Int = config.dbPoolMaxIdleSec,
+        private val validMinDelayMsec: Int = config.dbPoolValidMinDelayMsec,
+        private val acquireTimeoutMsec: Long = config.dbPoolAcquireTimeoutMsec
+) {
+    companion object: KLogging() {
+        private val connectionWait = metrics.histogram("amc_db_connection_wait_seconds",
+                "Time to obtain a pooled database connection, including retries")
+        private val connectionRetries = metrics.counter("amc_db_connection_retries_total",
+                "Failed attempts to obtain a pooled database connection")
+        private val connectionTimeouts = metrics.counter("amc_db_connection_timeouts_total",
+                "Requests for a database connection that timed out and were rejected with 503")
+    }
+    private val pool: MariaDbPoolDataSource
+    private val permits: Semaphore
+
+    private val acquireCount = AtomicLong()
+    private val timeoutCount = AtomicLong()
+    private val waitNanos    = AtomicLong()
+    private val maxWaitNanos = AtomicLong()
 
     init {
         pool = with(MariaDbPoolDataSource(config.dbUrl)) {
             user = config.dbUsr
             setPassword(config.dbPwd)
 
+            // zeros keep the values of the connection URL, or the driver defaults
+            if( minPoolSize > 0 )       setMinPoolSize(minPoolSize)
+            if( maxPoolSize > 0 )       setMaxPoolSize(maxPoolSize)
+            if( maxIdleSec > 0 )        setMaxIdleTime(maxIdleSec)
+            if( validMinDelayMsec > 0 ) setPoolValidMinDelay(validMinDelayMsec)
+
             logger.info {
               """Database connection pool initialized with URL ${config.dbUrl}:
                |   user:                 $user
@@ -37,39 +73,114 @@ class DatabaseStore {
                |   min/max poolSize:     $minPoolSize / $maxPoolSize
                |   maxIdleTime   (sec):  $maxIdleTime
                |   validMinDelay (msec): $poolValidMinDelay
+               |   acquireTimeout(msec): $acquireTimeoutMsec
             """.trimMargin()
             }
 
             this    // the return value
         }
+        permits = Semaphore(pool.maxPoolSize, true)
     }
 
-    private var dumped: Boolean = false
-
-    fun getGoodConnection(): Connection {
-        while( keepRunning ) {
-            try {
-                logger.debug { "getting a pooled db connection" }
-                val conn = this.pool.getConnection()
-                conn.autoCommit = false
-                conn.transactionIsolation = Connection.TRANSACTION_READ_COMMITTED
-                dumped = false
-                return DatabaseConnection(conn)
-            } catch(x: SQLException) {
-                if( x is SQLTransientConnectionException ) {
-                    logger.warn { "out of connections: allocated ${DatabaseConnection.connectionLeakWatcher.allocateCount}" }
-                    if( !dumped ) {
-                        DatabaseConnection.connectionLeakWatcher.dump(true)
-                        dumped = true
+    @Volatile private var dumped: Boolean = false
+
+    /**
+     * Get a pooled connection, waiting up to [waitMsec] for one. Zero waits for as long as needed.
+     *
+     * @throws StatusException 503 when no connection became available in time
+     */
+    fun getGoodConnection(waitMsec: Long = this.acquireTimeoutMsec): Connection {
+        val beg = System.nanoTime()
+        val deadline = if( waitMsec > 0 ) beg + waitMsec * 1_000_000 else Long.MAX_VALUE
+
+        if( !this.permits.tryAcquire(remainingMsec(deadline), TimeUnit.MILLISECONDS) )
+            throw this.timedOut(waitMsec, "all ${pool.maxPoolSize} database connections are busy")
+
+        var leased = false
+        try {
+            while( keepRunning ) {
+                try {
+                    logger.debug { "getting a pooled db connection" }
+                    val conn = this.pool.getConnection()
+                    conn.autoCommit = false
+                    conn.transactionIsolation = Connection.TRANSACTION_READ_COMMITTED
+                    dumped = false
+                    this.recordWait(System.nanoTime() - beg)
+                    leased = true
+                    return DatabaseConnection(conn) { this.permits.release() }
+                } catch(x: SQLException) {
+                    connectionRetries.inc()
+                    if( x is SQLTransientConnectionException ) {
+                        logger.warn { "out of connections: allocated ${DatabaseConnection.connectionLeakWatcher.allocateCount}" }
+                        if( !dumped ) {
+                            DatabaseConnection.connectionLeakWatcher.dump(true)
+                            dumped = true
+                        }
                     }
-                }
 
-                logger.warn { "${x.message};  retrying in ${config.DBSTORE_RECONNECT_DELAY_SEC} sec" }
-                Thread.sleep(config.DBSTORE_RECONNECT_DELAY_SEC*1000L)
+                    val delayMsec = minOf(config.DBSTORE_RECONNECT_DELAY_SEC * 1000L, remainingMsec(deadline))
+                    if( delayMsec <= 0 )
+                        throw this.timedOut(waitMsec, "couldn't connect to the database: ${x.message}")
+                    logger.warn { "${x.message};  retrying in $delayMsec msec" }
+                    Thread.sleep(delayMsec)
+                }
             }
+
+            throw StatusException(500, "the server is shutting down")
+        } finally {
+            if( !leased )
+                this.permits.release()
+        }
+    }
+
+    /**
+     * Get a pooled connection for reading a large result set: its statements fetch [fetchSize] rows at a time,
+     * rather than the whole result set up front. Running another statement while a result set is open makes
+     * the driver read the rest of it into memory.
+     */
+    fun getStreamingConnection(fetchSize: Int): Connection =
+        (this.getGoodConnection() as DatabaseConnection).also { it.fetchSize = fetchSize }
+
+    private fun remainingMsec(deadline: Long) =
+        if( deadline == Long.MAX_VALUE ) Long.MAX_VALUE else maxOf(0, (deadline - System.nanoTime()) / 1_000_000)
+
+    private fun recordWait(nanos: Long) {
+        connectionWait.observe(nanos / 1e9)
+        this.acquireCount.incrementAndGet()
+        this.waitNanos.addAndGet(nanos)
+        this.maxWaitNanos.accumulateAndGet(nanos) { a, b -> maxOf(a, b) }
+    }
+
+    private fun timedOut(waitMsec: Long, reason: String): StatusException {
+        connectionTimeouts.inc()
+        this.timeoutCount.incrementAndGet()
+        return StatusException(503, "$reason, waited $waitMsec msec")
+    }
+
+    /** Idle connections, as reported by the driver over JMX. Null if it doesn't. */
+    private fun idleConnections(): Long? =
+        try {
+            val name = ObjectName("org.mariadb.jdbc.pool:type=${this.pool.poolName}")
+            (ManagementFactory.getPlatformMBeanServer().getAttribute(name, "IdleConnections") as Number).toLong()
+        } catch(x: Exception) {
+            null
         }
 
-        throw StatusException(500, "the server is shutting down")
+    /** Pool size, connections in use and idle, callers waiting, and the connection wait times */
+    fun stats(): Map<String, Any?> {
+        val acquired = this.acquireCount.get()
+        return linkedMapOf(
+              "minPoolSize"     to this.pool.minPoolSize
+            , "maxPoolSize"     to this.pool.maxPoolSize
+            , "active"          to this.pool.maxPoolSize - this.permits.availablePermits()
+            , "idle"            to this.idleConnections()
+            , "waiters"         to this.permits.queueLength
+            , "acquireCount"    to acquired
+            , "timeoutCount"    to this.timeoutCount.get()
+            , "averageWaitMsec" to if( acquired == 0L ) 0.0 else this.waitNanos.get() / 1_000_000.0 / acquired
+            , "maxWaitMsec"     to this.maxWaitNanos.get() / 1_000_000.0
+            , "waitSecondsHistogram" to connectionWait.buckets()
+        )
     }
 
 
@@ -99,6 +210,44 @@ class DatabaseStore {
         }
     }
 
+    /**
+     * Keyset pagination: fetch keys of the page following [afterKey].
+     *
+     * Runs <code>SELECT keyCol FROM table WHERE keyCol > ? ORDER BY keyCol LIMIT ?</code>, so the cost
+     * is proportional to [limit] regardless of how deep the page is. The caller then fetches the page rows
+     * by the returned key range.
+     *
+     * @param afterKey the last key of the previous page, null for the first page.
+     * @param filterExpr optional condition ANDed to the WHERE clause, its placeholders are bound to [filterBinds].
+     * @return the page keys in ascending order, empty when there are no more rows.
+     */
+    fun fetchPageKeys(conn: Connection, tableName: String, keyColName: String, afterKey: String?, limit: Int,
+                      filterExpr: String? = null, vararg filterBinds: Any?): List<String> {
+        require(limit > 0)
+        val conditions = mutableListOf<String>()
+        if( afterKey != null )   conditions.add("$keyColName > ?")
+        if( filterExpr != null ) conditions.add(filterExpr)
+
+        val sql = "select $keyColName from $tableName" +
+                (if( conditions.isEmpty() ) "" else " where " + conditions.joinToString(" and ")) +
+                " order by $keyColName limit ?"
+
+        conn.prepareStatement(sql).use { stmt ->
+            var bindPos = 1
+            if( afterKey != null )
+                stmt.setString(bindPos++, afterKey)
+            filterBinds.forEach { stmt.setObject(bindPos++, it) }
+            stmt.setInt(bindPos, limit)
+
+            stmt.executeQuery().use { rs ->
+                val keys = mutableListOf<String>()
+                while( rs.next() )
+                    keys.add(rs.getString(1))
+                return keys
+            }
+        }
+    }
+
     /**
      * Insert or update a row in a database table, as defined by the [entity] instance.
      *
@@ -150,7 +299,12 @@ class DatabaseStore {
         }
     }
 
-    internal fun insertObjectAsRow(entity: Entity): StatusMessage {
+    /**
+     * Insert a row, as defined by the [entity] instance.
+     *
+     * @param beforeCommit runs in the same transaction after a successful insert, e.g. to maintain dependent rows.
+     */
+    internal fun insertObjectAsRow(entity: Entity, beforeCommit: (conn: Connection) -> Unit = {}): StatusMessage {
         val identityStr: String?
         val conn = this.getGoodConnection()
         try {
@@ -160,6 +314,7 @@ class DatabaseStore {
                 return StatusMessage(500, "There was no error, but the record was not inserted")
             identityStr = entity.getIdentityAsJsonStr()
 
+            beforeCommit(conn)
             conn.commit()
             logger.info { "insert succeeded, returning $identityStr" }
             return StatusMessage(201, identityStr)
@@ -175,7 +330,12 @@ class DatabaseStore {
     }
 
 
-    internal fun updateObjectAsRow(entity: Entity): StatusMessage {
+    /**
+     * Update a row, as defined by the [entity] instance, with optimistic lock.
+     *
+     * @param beforeCommit runs in the same transaction after a successful update.
+     */
+    internal fun updateObjectAsRow(entity: Entity, beforeCommit: (conn: Connection) -> Unit = {}): StatusMessage {
         val identityStr: String?
         val conn = this.getGoodConnection()
 
@@ -195,6 +355,7 @@ class DatabaseStore {
 
             identityStr = entity.getIdentityAsJsonStr()
 
+            beforeCommit(conn)
             conn.commit()
             logger.info { "update succeeded, returning $identityStr" }
             return StatusMessage(200, identityStr)
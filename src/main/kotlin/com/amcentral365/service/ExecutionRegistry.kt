@@ -0,0 +1,180 @@
+package com.amcentral365.service
+
+import mu.KotlinLogging
+
+import java.io.File
+import java.io.OutputStream
+import java.sql.Timestamp
+import java.util.UUID
+import java.util.concurrent.ArrayBlockingQueue
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.Executors
+import java.util.concurrent.RejectedExecutionException
+import java.util.concurrent.ThreadFactory
+import java.util.concurrent.ThreadPoolExecutor
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
+import kotlin.reflect.jvm.jvmName
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Asynchronous script executions: runs them on a bounded pool of [threads] and keeps their status and output.
+ *
+ * At most [queueSize] executions wait for a thread, [submit] fails with [StatusException] 503 when the queue
+ * is full. Output of each execution is spooled to its own [SegmentedOutputLog] under [outputDir]. Finished
+ * executions, with their output, are kept for [retentionSec] and then purged by a background reaper.
+ */
+class ExecutionRegistry(
+        threads: Int,
+        queueSize: Int,
+        private val outputDir: File,
+        private val segmentBytes: Long,
+        private val maxSegments: Int,
+        private val retentionSec: Long
+) {
+    enum class Status { Queued, Running, Succeeded, Failed }
+
+    class Execution(
+            val executeId: UUID,
+            val scriptName: String,
+            val targetName: String,
+            val executeMethod: String,
+            val output: SegmentedOutputLog
+    ) {
+        @Volatile var status = Status.Queued
+            internal set
+        val submittedTs = Timestamp(System.currentTimeMillis())
+        @Volatile var startedTs:  Timestamp? = null
+            internal set
+        @Volatile var finishedTs: Timestamp? = null
+            internal set
+        @Volatile var result: StatusMessage? = null
+            internal set
+
+        private val logLines = mutableListOf<String>()
+
+        val isFinished: Boolean get() = this.status == Status.Succeeded || this.status == Status.Failed
+
+        internal fun log(msg: String) = synchronized(this.logLines) {
+            this.logLines.add("${Timestamp(System.currentTimeMillis())} $msg")
+        }
+
+        /** Execution events: submitted, started, finished */
+        fun getLog(): List<String> = synchronized(this.logLines) { this.logLines.toList() }
+
+        fun info(): Map<String, Any?> =
+            linkedMapOf(
+                  "executeId"     to this.executeId.toString()
+                , "scriptName"    to this.scriptName
+                , "targetName"    to this.targetName
+                , "executeMethod" to this.executeMethod
+                , "status"        to this.status.name.toLowerCase()
+                , "submittedTs"   to this.submittedTs
+                , "startedTs"     to this.startedTs
+                , "finishedTs"    to this.finishedTs
+                , "code"          to this.result?.code
+                , "message"       to this.result?.msg
+                , "outputBytes"   to this.output.size
+            )
+    }
+
+    private val executions = ConcurrentHashMap<UUID, Execution>()
+
+    private val threadNo = AtomicInteger()
+    private val executor = ThreadPoolExecutor(threads, threads, 60, TimeUnit.SECONDS, ArrayBlockingQueue<Runnable>(queueSize),
+        ThreadFactory { r -> Thread(r, "execute-${this.threadNo.incrementAndGet()}").also { it.isDaemon = true } })
+
+    private val reaper = Executors.newSingleThreadScheduledExecutor { r ->
+        Thread(r, "execute-reaper").also { it.isDaemon = true }
+    }
+
+    init {
+        this.executor.allowCoreThreadTimeOut(true)
+        val period = (this.retentionSec / 4).coerceIn(1, 300)
+        this.reaper.scheduleWithFixedDelay({
+            try {
+                this.purgeFinished()
+            } catch(x: Exception) {
+                logger.warn { "purging finished executions failed: ${x.message}" }
+            }
+        }, period, period, TimeUnit.SECONDS)
+    }
+
+
+    /**
+     * Queue [run] for execution. It is passed the thread id to log with and the stream to write the output to.
+     * @return the queued execution
+     */
+    fun submit(scriptName: String, targetName: String, executeMethod: String,
+               run: (threadId: String, outputStream: OutputStream) -> StatusMessage): Execution {
+        val executeId = UUID.randomUUID()
+        val output = SegmentedOutputLog(this.outputDir.resolve(executeId.toString()), this.segmentBytes, this.maxSegments)
+        val execution = Execution(executeId, scriptName, targetName, executeMethod, output)
+        this.executions[executeId] = execution
+        execution.log("submitted script $scriptName to run on $targetName with $executeMethod")
+
+        try {
+            this.executor.execute { this.runExecution(execution, run) }
+        } catch(x: RejectedExecutionException) {
+            this.executions.remove(executeId)
+            output.delete()
+            throw StatusException(503, "too many executions are queued, try again later")
+        }
+
+        logger.info { "execute $executeId: queued script $scriptName on target $targetName" }
+        return execution
+    }
+
+    private fun runExecution(execution: Execution, run: (String, OutputStream) -> StatusMessage) {
+        val threadId = "${Thread.currentThread().name}/${execution.executeId}"
+        execution.startedTs = Timestamp(System.currentTimeMillis())
+        execution.status = Status.Running
+        execution.log("started")
+
+        val result = try {
+            execution.output.use { run(threadId, it) }
+        } catch(x: Exception) {
+            logger.warn { "$threadId: ${x::class.jvmName} ${x.message}" }
+            StatusMessage(x)
+        }
+
+        execution.result = result
+        execution.finishedTs = Timestamp(System.currentTimeMillis())
+        execution.log("finished with code ${result.code}: ${result.msg}")
+        execution.status = if( result.isOk ) Status.Succeeded else Status.Failed
+    }
+
+    /** Find an execution, throw [StatusException] 404 if there is no such execution or it was purged */
+    fun get(executeId: UUID): Execution =
+        this.executions[executeId] ?: throw StatusException(404, "execute '$executeId' not found")
+
+    /** All known executions, the most recently submitted first */
+    fun list(): List<Execution> = this.executions.values.sortedByDescending { it.submittedTs }
+
+    /**
+     * Drop executions finished more than [retentionSec] ago and delete their output
+     * @return the number of purged executions
+     */
+    fun purgeFinished(): Int {
+        val cutoff = System.currentTimeMillis() - this.retentionSec * 1000
+        val expired = this.executions.values.filter { it.isFinished && it.finishedTs!!.time < cutoff }
+        expired.forEach {
+            this.executions.remove(it.executeId)
+            it.output.delete()
+        }
+
+        if( expired.isNotEmpty() )
+            logger.info { "purged ${expired.size} finished execution(s)" }
+        return expired.size
+    }
+
+    fun stats(): Map<String, Any> =
+        linkedMapOf(
+              "queued"    to this.executions.values.count { it.status == Status.Queued }
+            , "running"   to this.executions.values.count { it.status == Status.Running }
+            , "finished"  to this.executions.values.count { it.isFinished }
+            , "completed" to this.executor.completedTaskCount
+        )
+}
@@ -1,6 +1,7 @@
 package com.amcentral365.service.builtins.roles
 
 import com.amcentral365.service.ReceiverHost
+import com.amcentral365.service.ScriptStaging
 import mu.KotlinLogging
 
 import com.amcentral365.service.ScriptExecutorFlow
@@ -27,6 +28,7 @@ abstract class ExecutionTarget(
     protected var targetDetails: ExecutionTargetDetails? = null
 
     protected var workDirName: String = "."
+    protected var staged = false     // workDirName is a staged script version, it is kept after the execution
 
     abstract protected fun realExec(commands: List<String>, inputStream: InputStream? = null, outputStream: OutputStream): StatusMessage
     abstract fun exists(pathStr: String): Boolean
@@ -34,6 +36,13 @@ abstract class ExecutionTarget(
     abstract fun copyFile(contentStream: InputStream, fileName: String): Long
     abstract fun copyExecutableFile(contentStream: InputStream, fileName: String): Long
 
+    /** Whether [unpackArchive] works on this target */
+    open fun canUnpackArchives(): Boolean = false
+
+    /** Unpack a tar stream into the work directory, keeping the file permissions */
+    open fun unpackArchive(archive: InputStream): Unit =
+        throw StatusException(501, "${this.javaClass.simpleName} can't unpack archives")
+
     protected fun getCmdToCreateWorkDir(): List<String> {
         val w = this.targetDetails?.workDirBase
             ?: throw StatusException(501, "the script's target role (targetRoleName) does not define 'workDirBase'")
@@ -76,6 +85,22 @@ abstract class ExecutionTarget(
             else -> StatusMessage(200, statusMsg.msg)
         }
 
+    /**
+     * Staged mode, see [ScriptStaging]: find or stage the script files under [baseDirName] and run in their directory.
+     */
+    protected fun prepareStaged(script: Script, baseDirName: String, ops: ScriptStaging.Ops, newReceiver: () -> TransferManager.Receiver): Boolean {
+        val staging = ScriptStaging(this.threadId, ops, config.scriptStagingMaxAgeSec, config.scriptStagingGcIntervalSec * 1000)
+        val dirName = staging.stage(script, script.getSender(), baseDirName) { dirName, sender ->
+            this.workDirName = dirName
+            logger.info { "$threadId: staging ${script.name} files on ${this.name}" }
+            TransferManager(this.threadId).transfer(sender, newReceiver())
+        } ?: return false
+
+        this.workDirName = dirName
+        this.staged = true
+        return true
+    }
+
     fun transferScriptContent(threadId: String, script: Script, receiver: TransferManager.Receiver): Boolean {
         val sender = script.getSender()
         if( sender == null ) {
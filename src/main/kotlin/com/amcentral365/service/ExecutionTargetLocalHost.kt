@@ -3,7 +3,6 @@ package com.amcentral365.service
 import java.io.File
 import java.io.InputStream
 import java.io.OutputStream
-import java.util.concurrent.TimeUnit
 
 import kotlin.reflect.jvm.jvmName
 import mu.KotlinLogging
@@ -12,7 +11,9 @@ import com.amcentral365.service.builtins.roles.ExecutionTarget
 import com.amcentral365.service.builtins.roles.Script
 import com.amcentral365.service.dao.Asset
 import java.io.FileOutputStream
+import java.io.IOException
 import java.nio.file.Files
+import java.nio.file.StandardCopyOption
 import java.nio.file.attribute.PosixFilePermissions
 
 
@@ -52,6 +53,8 @@ class ExecutionTargetLocalHost(threadId: String, asset: Asset): ExecutionTarget(
     }
 
     override fun cleanup(script: Script) {
+        if( this.staged )
+            return
         if( !this.workDirName.isBlank() ) {
             logger.debug { "removing work directory ${this.workDirName}" }
             File(workDirName).deleteRecursively()
@@ -61,6 +64,11 @@ class ExecutionTargetLocalHost(threadId: String, asset: Asset): ExecutionTarget(
     }
 
     override fun prepare(script: Script): Boolean {
+        if( config.scriptStaging ) {
+            val base = File(config.localScriptExecBaseDir, "amc-staged").path
+            return prepareStaged(script, base, stagingOps) { ReceiverHost(script, this) }
+        }
+
         initWorkDir()
         return transferScriptContent(this.threadId, script, ReceiverHost(script, this))
     }
@@ -68,6 +76,42 @@ class ExecutionTargetLocalHost(threadId: String, asset: Asset): ExecutionTarget(
     override fun execute(script: Script, outputStream: OutputStream, inputStream: InputStream?): StatusMessage =
         super.customizeAndExecuteCommands(script, outputStream, inputStream) { it }
 
+    companion object {
+        /** Staged script directories on this machine */
+        internal val stagingOps = object: ScriptStaging.Ops {
+            override val key = "localhost"
+
+            override fun reuse(dirName: String): Boolean {
+                val dir = File(dirName)
+                return dir.isDirectory && dir.setLastModified(System.currentTimeMillis())
+            }
+
+            override fun create(dirName: String) {
+                if( !File(dirName).mkdirs() )
+                    throw StatusException(500, "Failed to create directory path $dirName")
+            }
+
+            override fun publish(tmpDirName: String, dirName: String): Boolean {
+                try {
+                    Files.move(File(tmpDirName).toPath(), File(dirName).toPath(), StandardCopyOption.ATOMIC_MOVE)
+                } catch(x: IOException) {   // staged by another execution meanwhile
+                    File(tmpDirName).deleteRecursively()
+                }
+                return File(dirName).isDirectory
+            }
+
+            override fun remove(dirName: String) {
+                File(dirName).deleteRecursively()
+            }
+
+            override fun removeUnused(baseDirName: String, ageSec: Long): Int {
+                val oldestTs = System.currentTimeMillis() - ageSec * 1000
+                val unused = File(baseDirName).listFiles { f -> f.lastModified() < oldestTs }.orEmpty()
+                return unused.count { it.deleteRecursively() }
+            }
+        }
+    }
+
     override fun connect() = true
     override fun disconnect() {}
 
@@ -87,63 +131,28 @@ class ExecutionTargetLocalHost(threadId: String, asset: Asset): ExecutionTarget(
                     .start()
             logger.info { "${this.threadId}: started running ${commands.joinToString(" ")}" }
 
-            inputStream?.run {
-                process.outputStream.run {  // process.outputStream is the process's stdin
-                    write(inputStream.readBytes())
-                    close()
-                }
+            val pump = ScriptOutputPump(this.threadId, this.execTimeoutSec, this.idleTimeoutSec) {
+                process.destroyForcibly()
+                process.inputStream.close()   // in case the process' children keep the pipe open
+            }
+            if( inputStream != null )
+                pump.feedInput(inputStream, process.outputStream)   // process.outputStream is the process's stdin
+
+            try {
+                pump.pump(process.inputStream, outputStream)
+                process.waitFor()   // the output has ended, but the process may still run. The timers still apply.
+            } finally {
+                pump.cancelTimers()
             }
 
-            val buffer = ByteArray(1024)
-            val execStartTs = System.currentTimeMillis()
-            var idleStartTs = System.currentTimeMillis()
-
-            fun ivlText(ts: Long) = "%.1f".format((System.currentTimeMillis() - ts)/1000f)
-
-            var exitReason = "execution completed"
-            var isAlive = true
-            do {
-                if( this.execTimeoutSec > 0 && System.currentTimeMillis() - execStartTs > this.execTimeoutSec*1000L ) {
-                    exitReason = "execution time ${ivlText(execStartTs)} has exceeded timeout ${this.execTimeoutSec}"
-                    break
-                }
-
-                if( this.idleTimeoutSec > 0 && System.currentTimeMillis() - idleStartTs > this.idleTimeoutSec*1000L ) {
-                    exitReason = "idle time ${ivlText(idleStartTs)} has exceeded timeout ${this.idleTimeoutSec}"
-                    break
-                }
-
-                // cache the values to avoid race condition when process exits while we are fetching its output
-                isAlive = process.isAlive
-                var availableByteCnt = process.inputStream.available()
-
-                if( availableByteCnt == 0 && isAlive ) {
-                    TimeUnit.MILLISECONDS.sleep(config.scriptOutputPollIntervalMsec)
-                    continue
-                }
-
-                while(availableByteCnt > 0) {
-                    val readByteCnt = process.inputStream.read(buffer, 0, availableByteCnt.coerceAtMost(buffer.size))
-                    if(readByteCnt <= 0)
-                        break
-
-                    outputStream.write(buffer, 0, readByteCnt)
-                    outputStream.flush()
-                    availableByteCnt -= readByteCnt
-                    idleStartTs = System.currentTimeMillis()
-                }
-
-            } while( isAlive )
-
-            if( isAlive ) {
-                val msg = "aborted: $exitReason"
-                logger.warn { "${this.threadId}: $msg" }
+            val abortReason = pump.abortReason
+            if( abortReason != null ) {
                 process.destroyForcibly()
-                return StatusMessage(408, msg)
+                return StatusMessage(408, "aborted: $abortReason")
             }
 
             val rc = process.exitValue()
-            val msg = "completed with return code $rc in ${ivlText(execStartTs)} sec"
+            val msg = "completed with return code $rc in ${"%.1f".format(pump.elapsedMsec()/1000f)} sec"
             logger.info { "${this.threadId}: $msg" }
             return StatusMessage(rc, msg)
 
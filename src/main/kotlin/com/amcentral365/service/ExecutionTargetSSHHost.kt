@@ -6,14 +6,13 @@ import com.amcentral365.service.builtins.roles.TargetSSH
 import com.google.common.base.Preconditions
 import com.jcraft.jsch.ChannelExec
 import com.jcraft.jsch.ChannelSftp
-import com.jcraft.jsch.JSch
-import com.jcraft.jsch.JSchException
 import com.jcraft.jsch.Session
 import com.jcraft.jsch.SftpException
 import mu.KotlinLogging
 import java.io.File
 import java.io.InputStream
 import java.io.OutputStream
+import java.util.concurrent.ConcurrentHashMap
 import java.util.concurrent.TimeUnit
 import kotlin.reflect.jvm.jvmName
 
@@ -21,6 +20,11 @@ private val logger = KotlinLogging.logger {}
 
 open class ExecutionTargetSSHHost(threadId: String, private val target: TargetSSH): ExecutionTarget(threadId, target.asset) {
 
+    companion object {
+        /** Whether the hosts have tar, checked once per host, port, and user */
+        private val tarAvailable = ConcurrentHashMap<SSHSessionPool.Key, Boolean>()
+    }
+
     init {
         Preconditions.checkNotNull(target.hostname as String)
         Preconditions.checkArgument((target.hostname as String).isNotEmpty())
@@ -30,40 +34,37 @@ open class ExecutionTargetSSHHost(threadId: String, private val target: TargetSS
         Preconditions.checkArgument((target.loginUser as String).isNotEmpty())
     }
 
-    private val jsch: JSch by lazy {
-        val sshPvtKey = getFileOrResource(config.sshPrivateKeyFile)
-        val sshPubKey = getFileOrResource(config.sshPublicKeyFile)
-        JSch.setConfig("StrictHostKeyChecking", "no")
-        JSch().also {
-          it.addIdentity("internal", sshPvtKey, sshPubKey, null)
-        }
-    }
+    private val poolKey = SSHSessionPool.Key(target.hostname!!, target.port!!, target.loginUser!!)
 
-    private val sftpChannel: ChannelSftp by lazy {
-        (this.session!!.openChannel("sftp") as ChannelSftp).also {
+    private var sftp: ChannelSftp? = null
+    private val sftpChannel: ChannelSftp
+        get() = this.sftp ?: (this.session!!.openChannel("sftp") as ChannelSftp).also {
               it.connect()
               it.cd(this.workDirName)
+              this.sftp = it
         }
-    }
 
     var session: Session? = null
+    private var sessionFailed = false   // don't return the session to the pool
 
     val S_IXUSR = 1 shl 6       // "u+x" for chmod
+    private val exitStatusWaitMsec = 10_000L    // after the end of the output
+    private val exitStatusMaxPollMsec = 50L
 
     override fun connect(): Boolean {
-        try {
-            val sess = jsch.getSession(target.loginUser, target.hostname, target.port!!)
-            sess.connect()
-            sess.timeout = 0                // TODO: make it a parameter
-            this.session = sess
-            return true
-        } catch(e: JSchException) {
-            throw StatusException.from(e)
-        }
+        this.session = sshSessionPool.acquire(this.poolKey)
+        this.sessionFailed = false
+        return true
     }
 
     override fun disconnect() {
-        this.session?.disconnect()
+        try {
+            this.sftp?.disconnect()
+        } finally {
+            this.sftp = null
+            this.session?.let { sshSessionPool.release(it, reusable = !this.sessionFailed) }
+            this.session = null
+        }
     }
 
 
@@ -89,6 +90,19 @@ open class ExecutionTargetSSHHost(threadId: String, private val target: TargetSS
         this.sftpChannel.mkdir(dirPath)
     }
 
+    override fun canUnpackArchives(): Boolean =
+        tarAvailable[this.poolKey] ?: (this.realExec(listOf("command", "-v", "tar"), null, NullOutputStream()).code == 0).also {
+            logger.info { "${this.threadId}: tar is ${if( it ) "" else "not "}available on ${this.poolKey}" }
+            tarAvailable[this.poolKey] = it
+        }
+
+    override fun unpackArchive(archive: InputStream) {
+        val output = StringOutputStream()
+        val msg = this.realExec(listOf("tar", "-x", "-p", "-f", "-", "-C", "'${this.workDirName}'"), archive, output)
+        if( msg.code != 0 )
+            throw StatusException(500, "unpacking the script files failed with code ${msg.code}: ${output.getString().trim()}")
+    }
+
     override fun exists(pathStr: String): Boolean {
         Preconditions.checkArgument(pathStr.isNotBlank())
         try {
@@ -100,6 +114,8 @@ open class ExecutionTargetSSHHost(threadId: String, private val target: TargetSS
     }
 
     override fun cleanup(script: Script) {
+        if( this.staged )
+            return
         if( this.workDirName.isBlank() )
             throw StatusException(500, "workDirName is blank: '${this.workDirName}'")
 
@@ -110,8 +126,47 @@ open class ExecutionTargetSSHHost(threadId: String, private val target: TargetSS
 
     override fun prepare(script: Script): Boolean {
         initTargetDetails(script.targetRoleName!!)
+        val newReceiver = { if( config.scriptTransferArchive ) ReceiverHostArchive(script, this) else ReceiverHost(script, this) }
+
+        if( config.scriptStaging ) {
+            val base = this.targetDetails?.workDirBase
+                ?: throw StatusException(501, "the script's target role (targetRoleName) does not define 'workDirBase'")
+            return prepareStaged(script, "$base/amc-staged", this.stagingOps, newReceiver)
+        }
+
         initWorkDir()
-        return transferScriptContent(this.threadId, script, ReceiverHost(script, this))
+        return transferScriptContent(this.threadId, script, newReceiver())
+    }
+
+    private fun shell(command: String, output: OutputStream = NullOutputStream()): Int =
+        this.realExec(listOf(command), null, output).code
+
+    /** Staged script directories, managed with shell commands */
+    private val stagingOps = object: ScriptStaging.Ops {
+        override val key get() = "${poolKey}:${targetDetails?.workDirBase}"
+
+        override fun reuse(dirName: String) = shell("test -d '$dirName' && touch '$dirName'") == 0
+
+        override fun create(dirName: String) {
+            if( shell("mkdir -p '$dirName'") != 0 )
+                throw StatusException(500, "failed to create directory $dirName on $poolKey")
+        }
+
+        // mv -T isn't everywhere. In the unlikely race, the loser's copy ends up inside the winner's directory.
+        override fun publish(tmpDirName: String, dirName: String) =
+            shell("{ test -e '$dirName' || mv '$tmpDirName' '$dirName'; } && rm -rf '$tmpDirName' && test -d '$dirName'") == 0
+
+        override fun remove(dirName: String) {
+            shell("rm -rf '$dirName'")
+        }
+
+        override fun removeUnused(baseDirName: String, ageSec: Long): Int? {
+            val output = StringOutputStream()
+            val minutes = (ageSec + 59) / 60
+            if( shell("test ! -d '$baseDirName' || find '$baseDirName' -mindepth 1 -maxdepth 1 -mmin +$minutes -print -exec rm -rf {} +", output) != 0 )
+                return null
+            return output.getString().lines().count { it.isNotBlank() }
+        }
     }
 
     private fun initWorkDir() {
@@ -151,7 +206,6 @@ open class ExecutionTargetSSHHost(threadId: String, private val target: TargetSS
         try {
             val channel = session.openChannel("exec")
             with(channel as ChannelExec) {
-                setInputStream(inputStream, false)   // close on completion
                 setOutputStream(outputStream, true)
                 setErrStream(outputStream, true)
                 setCommand(command)
@@ -162,68 +216,48 @@ open class ExecutionTargetSSHHost(threadId: String, private val target: TargetSS
 
             logger.info { "${this.threadId}: started running $command" }
 
-            inputStream?.run {
-                val remoteStdin = channel.outputStream
-                val copied = this.copyTo(remoteStdin)
-                logger.debug { "$threadId: copied $copied bytes to the remote stdin" }
-                remoteStdin.close()
+            val pump = ScriptOutputPump(this.threadId, this.execTimeoutSec, this.idleTimeoutSec) {
+                channel.disconnect()   // closes remoteStdout
             }
-
-            fun ivlText(ts: Long) = "%.1f".format((System.currentTimeMillis() - ts)/1000f)
-
-            var isAlive = true
-            var exitReason = "execution completed"
-
-            val buffer = ByteArray(1024)
-            val execStartTs = System.currentTimeMillis()
-            var idleStartTs = System.currentTimeMillis()
-            do {
-                if( this.execTimeoutSec > 0 && System.currentTimeMillis() - execStartTs > this.execTimeoutSec*1000L ) {
-                    exitReason = "execution time ${ivlText(execStartTs)} has exceeded timeout ${this.execTimeoutSec}"
-                    break
-                }
-
-                if( this.idleTimeoutSec > 0 && System.currentTimeMillis() - idleStartTs > this.idleTimeoutSec*1000L ) {
-                    exitReason = "idle time ${ivlText(idleStartTs)} has exceeded timeout ${this.idleTimeoutSec}"
-                    break
-                }
-
-                // cache the values to avoid race condition when process exits while we are fetching its output
-                isAlive = !channel.isClosed
-                var availableByteCnt = remoteStdout.available()
-
-                if( availableByteCnt == 0 && isAlive ) {
-                    TimeUnit.MILLISECONDS.sleep(config.scriptOutputPollIntervalMsec)
-                    continue
-                }
-
-                while(availableByteCnt > 0) {
-                    val readByteCnt = remoteStdout.read(buffer, 0, availableByteCnt.coerceAtMost(buffer.size))
-                    if(readByteCnt <= 0)
-                        break
-
-                    outputStream.write(buffer, 0, readByteCnt)
-                    outputStream.flush()
-                    availableByteCnt -= readByteCnt
-                    idleStartTs = System.currentTimeMillis()
+            if( inputStream != null )
+                pump.feedInput(inputStream, channel.outputStream)
+
+            try {
+                pump.pump(remoteStdout, outputStream)
+                // The output has ended. JSch has no way to wait for the exit status, which comes with or
+                // right after the end of the output. Poll for it with a growing delay, for a bounded time.
+                val deadline = System.currentTimeMillis() + exitStatusWaitMsec
+                var delayMsec = 1L
+                while( !channel.isClosed && pump.abortReason == null && System.currentTimeMillis() < deadline ) {
+                    TimeUnit.MILLISECONDS.sleep(delayMsec)
+                    delayMsec = minOf(delayMsec * 2, exitStatusMaxPollMsec)
                 }
+            } finally {
+                pump.cancelTimers()
+            }
 
-            } while( isAlive )
+            val abortReason = pump.abortReason
+            if( abortReason != null ) {
+                channel.disconnect()
+                return StatusMessage(408, "aborted: $abortReason")
+            }
 
-            if( isAlive ) {
-                val msg = "aborted: $exitReason"
-                logger.warn { "${this.threadId}: $msg" }
+            if( !channel.isClosed ) {
                 channel.disconnect()
-                return StatusMessage(408, msg)
+                val msg = "the output ended, but the exit status didn't arrive in ${exitStatusWaitMsec / 1000} sec"
+                logger.warn { "${this.threadId}: $msg" }
+                return StatusMessage(500, msg)
             }
 
             val rc = channel.exitStatus
-            val msg = "completed with return code $rc in ${ivlText(execStartTs)} sec"
+            channel.disconnect()
+            val msg = "completed with return code $rc in ${"%.1f".format(pump.elapsedMsec()/1000f)} sec"
             logger.info { "${this.threadId}: $msg" }
             return StatusMessage(rc, msg)
 
         } catch(x: Exception) {
             logger.warn { "${this.threadId}: ${x::class.jvmName} ${x.message}" }
+            this.sessionFailed = true
             throw StatusException(x, 500)
         }
     }
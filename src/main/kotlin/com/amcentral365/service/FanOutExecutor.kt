@@ -0,0 +1,181 @@
+package com.amcentral365.service
+
+import mu.KotlinLogging
+
+import java.io.OutputStream
+import java.util.ArrayDeque
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.ExecutorCompletionService
+import java.util.concurrent.Executors
+import java.util.concurrent.Semaphore
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
+import java.util.concurrent.atomic.AtomicLong
+import kotlin.reflect.jvm.jvmName
+
+import com.amcentral365.service.dao.Asset
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Runs one script on many targets in parallel.
+ *
+ * Concurrency is capped three ways: by the request, at most [maxParallel] targets of all fan-outs run at the same
+ * time, and at most [maxParallelPerRole] of them run on targets of the same target role. The per-role cap keeps
+ * a large fan-out to, say, databases from using all the slots while hosts wait.
+ */
+class FanOutExecutor(private val maxParallel: Int, private val maxParallelPerRole: Int) {
+
+    class TargetResult(
+            val targetKey: String,
+            val targetName: String?,
+            val code: Int,
+            val message: String,
+            val output: String?,
+            val durationMsec: Long
+    ) {
+        val isOk: Boolean get() = this.code in 200..299
+
+        fun toMap(): Map<String, Any?> =
+            linkedMapOf(
+                  "targetKey"    to this.targetKey
+                , "targetName"   to this.targetName
+                , "code"         to this.code
+                , "message"      to this.message
+                , "durationMsec" to this.durationMsec
+                , "output"       to this.output
+            )
+    }
+
+    class Summary(val targetCount: Int, val succeededCount: Int, val elapsedMsec: Long, durations: List<Long>) {
+        val failedCount = this.targetCount - this.succeededCount
+        val minMsec: Long = durations.min() ?: 0
+        val maxMsec: Long = durations.max() ?: 0
+        val avgMsec: Double = if( durations.isEmpty() ) 0.0 else durations.average()
+        val p50Msec: Long = percentile(durations, 50)
+        val p95Msec: Long = percentile(durations, 95)
+
+        private fun percentile(values: List<Long>, p: Int): Long =
+            if( values.isEmpty() ) 0 else values.sorted()[((values.size - 1) * p + 50) / 100]
+
+        fun toMap(): Map<String, Any> =
+            linkedMapOf(
+                  "targetCount"    to this.targetCount
+                , "succeededCount" to this.succeededCount
+                , "failedCount"    to this.failedCount
+                , "elapsedMsec"    to this.elapsedMsec
+                , "minMsec"        to this.minMsec
+                , "avgMsec"        to this.avgMsec
+                , "p50Msec"        to this.p50Msec
+                , "p95Msec"        to this.p95Msec
+                , "maxMsec"        to this.maxMsec
+            )
+    }
+
+    /** A target to run on, or the reason it can't be run on */
+    class Target(val key: String, val asset: Asset?, val problem: StatusMessage? = null)
+
+    private val globalSlots = Semaphore(this.maxParallel)
+    private val roleSlots = ConcurrentHashMap<String, Semaphore>()
+
+    private val threadNo = AtomicInteger()
+    private val executor = Executors.newCachedThreadPool { r ->
+        Thread(r, "fanout-${this.threadNo.incrementAndGet()}").also { it.isDaemon = true }
+    }
+
+    private val fanOutCount  = AtomicLong()
+    private val targetCount  = AtomicLong()
+    private val failureCount = AtomicLong()
+
+    /**
+     * Run [runOne] on each target, at most [requestMaxParallel] at a time, and pass each result to [onResult]
+     * as soon as it is available. [onResult] is called on the calling thread.
+     *
+     * @param roleName the target role of the script, the per-role concurrency cap applies to it
+     */
+    fun run(roleName: String, targets: List<Target>, requestMaxParallel: Int, withOutput: Boolean,
+            runOne: (threadId: String, target: Asset, outputStream: OutputStream) -> StatusMessage,
+            onResult: (TargetResult) -> Unit): Summary {
+        val beg = System.currentTimeMillis()
+        val requestSlots = Semaphore(requestMaxParallel.coerceIn(1, this.maxParallel))
+        val roleSlots = this.roleSlots.computeIfAbsent(roleName) { Semaphore(this.maxParallelPerRole) }
+        val completion = ExecutorCompletionService<TargetResult>(this.executor)
+        val durations = mutableListOf<Long>()
+        var succeeded = 0
+
+        fun report(result: TargetResult) {
+            durations.add(result.durationMsec)
+            if( result.isOk ) succeeded++ else this.failureCount.incrementAndGet()
+            onResult(result)
+        }
+
+        this.fanOutCount.incrementAndGet()
+        this.targetCount.addAndGet(targets.size.toLong())
+
+        val pending = ArrayDeque(targets.filter { it.asset != null })
+        targets.filter { it.asset == null }.forEach {
+            report(TargetResult(it.key, null, it.problem?.code ?: 404, it.problem?.msg ?: "target not found", null, 0))
+        }
+
+        var inFlight = 0
+        while( pending.isNotEmpty() || inFlight > 0 ) {
+            // start as many as the caps allow
+            while( pending.isNotEmpty() && requestSlots.tryAcquire() ) {
+                if( !roleSlots.tryAcquire() ) {
+                    requestSlots.release()
+                    break
+                }
+                if( !this.globalSlots.tryAcquire() ) {
+                    roleSlots.release()
+                    requestSlots.release()
+                    break
+                }
+
+                val target = pending.poll()
+                inFlight++
+                completion.submit {
+                    try {
+                        this.runTarget(target, withOutput, runOne)
+                    } finally {
+                        this.globalSlots.release()
+                        roleSlots.release()
+                        requestSlots.release()
+                    }
+                }
+            }
+
+            // wait for a result. Time out to retry slots freed by other fan-outs.
+            val done = completion.poll(100, TimeUnit.MILLISECONDS) ?: continue
+            inFlight--
+            report(done.get())
+        }
+
+        val summary = Summary(targets.size, succeeded, System.currentTimeMillis() - beg, durations)
+        logger.info { "fan-out to ${targets.size} targets of $roleName: ${summary.succeededCount} succeeded in ${summary.elapsedMsec} msec" }
+        return summary
+    }
+
+    private fun runTarget(target: Target, withOutput: Boolean, runOne: (String, Asset, OutputStream) -> StatusMessage): TargetResult {
+        val threadId = "${Thread.currentThread().name}/${target.key}"
+        val output = if( withOutput ) StringOutputStream() else null
+        val beg = System.currentTimeMillis()
+        val result = try {
+            runOne(threadId, target.asset!!, output ?: NullOutputStream())
+        } catch(x: Exception) {
+            logger.warn { "$threadId: ${x::class.jvmName} ${x.message}" }
+            StatusMessage(x)
+        }
+
+        return TargetResult(target.key, target.asset!!.name, result.code, result.msg,
+                            output?.getString()?.trimEnd(), System.currentTimeMillis() - beg)
+    }
+
+    fun stats(): Map<String, Any> =
+        linkedMapOf(
+              "fanOutCount"    to this.fanOutCount.get()
+            , "targetCount"    to this.targetCount.get()
+            , "failureCount"   to this.failureCount.get()
+            , "runningTargets" to this.maxParallel - this.globalSlots.availablePermits()
+        )
+}
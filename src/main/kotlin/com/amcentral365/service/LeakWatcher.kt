@@ -2,45 +2,159 @@ package com.amcentral365.service
 
 import mu.KLogging
 
-class LeakWatcher {
-    companion object: KLogging()
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.Executors
+import java.util.concurrent.ScheduledExecutorService
+import java.util.concurrent.ThreadLocalRandom
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicLong
 
-    data class AllocRecord(val x: String? = null) {
+/**
+ * Tracks allocated resources, e.g. database connections, to find the ones never released.
+ *
+ * In [Mode.OFF] nothing is tracked. Otherwise every allocation is recorded in a concurrent map, and the call
+ * stack is captured for all of them ([Mode.FULL]) or for one in [sampleEvery] ([Mode.SAMPLED]). The stack is
+ * the expensive part, and it is only turned into text when dumped.
+ *
+ * With [startReaper], a background thread periodically reports the resources held longer than a threshold,
+ * with a histogram of their ages.
+ */
+class LeakWatcher(val mode: Mode = Mode.FULL, val sampleEvery: Int = 1) {
+    companion object: KLogging() {
+        /** Age histogram bounds, as multiples of the reaper threshold */
+        private val AGE_BUCKETS = listOf(1, 2, 5, 10, 60)
+    }
+
+    enum class Mode { OFF, SAMPLED, FULL }
+
+    class AllocRecord(captureStack: Boolean) {
         val threadName: String = Thread.currentThread().name
         val allocTs: Long = System.currentTimeMillis()
-        val callStack: Array<StackTraceElement> = Thread.currentThread().stackTrace
+        private val stack: Throwable? = if( captureStack ) Throwable() else null
+        @Volatile var reported = false
+
+        val hasCallStack: Boolean get() = this.stack != null
+        val callStack: Array<StackTraceElement> get() = this.stack?.stackTrace ?: emptyArray()
     }
 
-    private val allocations = mutableMapOf<Any, AllocRecord>()
+    init {
+        require(this.sampleEvery >= 1) { "sampleEvery must be at least 1, got ${this.sampleEvery}" }
+    }
+
+    private val allocations = ConcurrentHashMap<Any, AllocRecord>()
+    private val stackCount = AtomicLong()
+    private val reportedCount = AtomicLong()
+    private var reaper: ScheduledExecutorService? = null
 
     val allocateCount: Int get() = this.allocations.size
 
+    private fun captureStack() = when( this.mode ) {
+        Mode.FULL    -> true
+        Mode.SAMPLED -> ThreadLocalRandom.current().nextInt(this.sampleEvery) == 0
+        Mode.OFF     -> false
+    }
+
     fun allocated(resource: Any) {
-        synchronized(allocations) {
-            if(resource in allocations)
-                throw StatusException(500, "double-allocation of $resource")
-            allocations[resource] = AllocRecord()
-        }
+        if( this.mode == Mode.OFF )
+            return
+        val record = AllocRecord(this.captureStack())
+        if( this.allocations.putIfAbsent(resource, record) != null )
+            throw StatusException(500, "double-allocation of $resource")
+        if( record.hasCallStack )
+            this.stackCount.incrementAndGet()
     }
 
     fun released(resource: Any) {
-        synchronized(allocations) {
-            if(resource !in allocations)
-                throw StatusException(500, "release of unknown resource $resource")
-            allocations.remove(resource)
-        }
+        if( this.mode == Mode.OFF )
+            return
+        if( this.allocations.remove(resource) == null )
+            throw StatusException(500, "release of unknown resource $resource")
     }
 
     fun dump(withCallStacks: Boolean = false) {
-        synchronized(allocations) {
-            for(e in this.allocations.entries.sortedByDescending { e -> e.value.allocTs }) {
-                logger.info { "${e.key}:  at ${e.value.allocTs} by ${e.value.threadName}" }
-                if( withCallStacks )
-                    for(ste in e.value.callStack)
-                        with(ste) {
-                            logger.info { "  $className.$methodName ($fileName:$lineNumber)" }
-                        }
+        for(e in this.allocations.entries.sortedByDescending { e -> e.value.allocTs }) {
+            logger.info { "${e.key}:  at ${e.value.allocTs} by ${e.value.threadName}" }
+            if( withCallStacks )
+                this.logCallStack(e.value)
+        }
+    }
+
+    private fun logCallStack(record: AllocRecord) {
+        for(ste in record.callStack)
+            with(ste) {
+                logger.info { "  $className.$methodName ($fileName:$lineNumber)" }
             }
+    }
+
+    /** Resources held for [thresholdMsec] or longer, by age bucket: "<2x" means under twice the threshold */
+    fun ageHistogram(thresholdMsec: Long, now: Long = System.currentTimeMillis()): Map<String, Int> {
+        val histogram = linkedMapOf<String, Int>()
+        AGE_BUCKETS.drop(1).forEach { histogram["<${it}x"] = 0 }
+        histogram[">=${AGE_BUCKETS.last()}x"] = 0
+
+        this.allocations.values.forEach { record ->
+            val age = now - record.allocTs
+            if( age >= thresholdMsec ) {
+                val bucket = AGE_BUCKETS.drop(1).firstOrNull { age < it * thresholdMsec }
+                val key = if( bucket == null ) ">=${AGE_BUCKETS.last()}x" else "<${bucket}x"
+                histogram[key] = histogram[key]!! + 1
+            }
+        }
+        return histogram
+    }
+
+    /**
+     * Report the resources held longer than [thresholdMsec]: the count and age histogram each time, and the
+     * allocating thread and call stack, when captured, once per resource.
+     *
+     * @return the number of such resources
+     */
+    fun reap(thresholdMsec: Long): Int {
+        val now = System.currentTimeMillis()
+        val held = this.allocations.entries.filter { now - it.value.allocTs >= thresholdMsec }
+        if( held.isEmpty() )
+            return 0
+
+        logger.warn { "${held.size} resource(s) held for over $thresholdMsec msec, by age: ${this.ageHistogram(thresholdMsec, now)}" }
+        held.filter { !it.value.reported }.forEach { e ->
+            e.value.reported = true
+            this.reportedCount.incrementAndGet()
+            logger.warn { "possible leak of ${e.key}: held for ${now - e.value.allocTs} msec, allocated by ${e.value.threadName}" +
+                          if( !e.value.hasCallStack ) " (call stack wasn't sampled)" else " at" }
+            this.logCallStack(e.value)
         }
+        return held.size
     }
+
+    /** Run [reap] every [intervalMsec] on a daemon thread */
+    @Synchronized
+    fun startReaper(thresholdMsec: Long, intervalMsec: Long) {
+        if( this.mode == Mode.OFF || this.reaper != null )
+            return
+        this.reaper = Executors.newSingleThreadScheduledExecutor { r -> Thread(r, "leak-reaper-1").also { it.isDaemon = true } }
+            .also { reaper ->
+                reaper.scheduleWithFixedDelay({
+                    try {
+                        this.reap(thresholdMsec)
+                    } catch(x: Exception) {
+                        logger.warn { "leak reaper: ${x::class.qualifiedName}, ${x.message}" }
+                    }
+                }, intervalMsec, intervalMsec, TimeUnit.MILLISECONDS)
+            }
+    }
+
+    @Synchronized
+    fun stopReaper() {
+        this.reaper?.shutdownNow()
+        this.reaper = null
+    }
+
+    fun stats(): Map<String, Any> =
+        linkedMapOf(
+              "mode"          to this.mode.name.toLowerCase()
+            , "sampleEvery"   to this.sampleEvery
+            , "allocated"     to this.allocations.size
+            , "stackCount"    to this.stackCount.get()
+            , "reportedCount" to this.reportedCount.get()
+        )
 }
@@ -1,9 +1,12 @@
 package com.amcentral365.service
 
 import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.dao.CatalogCache
 import com.amcentral365.service.mergedata.MergeRoles
 import com.amcentral365.service.mergedata.MergeAssets
 import mu.KotlinLogging
+import java.io.File
+import kotlin.concurrent.thread
 
 private const val VERSION = "0.0.1"
 private val logger = KotlinLogging.logger {}
@@ -17,6 +20,12 @@ val webServer = WebServer()
 
 lateinit var schemaUtils: SchemaUtils
 lateinit var databaseStore: DatabaseStore
+lateinit var catalogCache: CatalogCache
+lateinit var sshSessionPool: SSHSessionPool
+lateinit var executionRegistry: ExecutionRegistry
+lateinit var taskDispatcher: TaskDispatcher
+lateinit var fanOutExecutor: FanOutExecutor
+lateinit var artifactCache: ArtifactCache
 
 @Volatile var keepRunning = true  /** Global 'lights out' flag */
 
@@ -29,13 +38,40 @@ fun main(args: Array<String>) {
     config = Configuration(args)
 
     logger.info { "initializing globals" }
+    DatabaseConnection.connectionLeakWatcher = LeakWatcher(config.dbLeakWatchMode, config.dbLeakSampleEvery)
+    if( config.dbLeakReportSec > 0 )
+        DatabaseConnection.connectionLeakWatcher.startReaper(config.dbLeakReportSec * 1000, minOf(config.dbLeakReportSec, 60) * 1000)
     databaseStore = DatabaseStore()
     schemaUtils = SchemaUtils(config.schemaCacheSizeInNodes)
+    catalogCache = CatalogCache(config.catalogCacheSize, config.catalogCacheTtlSec)
+    sshSessionPool = SSHSessionPool(config.sshPoolMaxSessionsPerHost, config.sshPoolIdleTimeoutSec * 1000,
+                                    config.sshKeepAliveSec * 1000, config.sshPoolWaitMsec, config.sshConnectTimeoutMsec)
+    executionRegistry = ExecutionRegistry(config.executeThreads, config.executeQueueSize, File(config.executeOutputDir),
+                                          config.executeOutputSegmentBytes, config.executeOutputMaxSegments, config.executeRetentionSec)
+    fanOutExecutor = FanOutExecutor(config.fanOutMaxParallel, config.fanOutMaxParallelPerRole)
+    artifactCache = ArtifactCache(File(config.artifactCacheDir), config.artifactCacheMaxBytes, config.artifactCacheRevalidateSec * 1000,
+                                  config.httpConnectTimeoutMsec, config.httpReadTimeoutMsec, config.httpMaxRedirects)
+    taskDispatcher = TaskDispatcher(config.workerName, config.taskThreads, config.taskClaimBatchSize, config.taskPollIntervalMsec)
+    registerStatsMetrics()
+
+    logger.info { "waiting for the database" }
+    databaseStore.getGoodConnection(waitMsec = 0).close()   // requests fail fast, the startup waits as long as needed
 
     logger.info { "merging data" }
     if( !mergeData() )
         return
 
+    if( config.schemaCacheWarmUp ) {
+        logger.info { "warming up the schema cache" }
+        schemaUtils.warmUp()
+    }
+    startSchemaVersionChecks()
+
+    if( config.taskDispatcherEnabled )
+        taskDispatcher.start()
+    else
+        logger.info { "the task dispatcher is disabled, tasks submitted to this node are run by other nodes" }
+
     logger.info { "starting the Web server" }
     webServer.start(config.bindPort)
 
@@ -44,6 +80,27 @@ fun main(args: Array<String>) {
 }
 
 
+/** Periodically drop cached role schemas modified elsewhere, e.g. by other cluster nodes */
+private fun startSchemaVersionChecks() {
+    val intervalMsec = config.schemaCacheCheckIntervalSec * 1000
+    if( intervalMsec == 0L ) {
+        logger.info { "schema cache version checks are disabled" }
+        return
+    }
+
+    thread(isDaemon = true, name = "schema-version-checker") {
+        while( keepRunning ) {
+            Thread.sleep(intervalMsec)
+            try {
+                schemaUtils.checkVersions()
+            } catch(x: Exception) {
+                logger.warn { "schema cache version check failed: ${x.message}" }
+            }
+        }
+    }
+}
+
+
 fun callMeFromJavaForHighFive(p1: Int) = p1 + 5
 
 
@@ -70,3 +127,18 @@ private fun mergeData(): Boolean {
 
     return true
 }
+
+
+/** The statistics the components already keep, exposed as gauges at /metrics */
+private fun registerStatsMetrics() {
+    metrics.stats("amc_schema_cache",     "Schema cache")          { schemaUtils.cacheStats() }
+    metrics.stats("amc_catalog_cache",    "Catalog cache")         { catalogCache.cacheStats() }
+    metrics.stats("amc_ssh_pool",         "SSH session pool")      { sshSessionPool.stats() }
+    metrics.stats("amc_executions",       "Script executions")     { executionRegistry.stats() }
+    metrics.stats("amc_fanout",           "Fan-out executions")    { fanOutExecutor.stats() }
+    metrics.stats("amc_tasks",            "Task dispatcher")       { taskDispatcher.stats() }
+    metrics.stats("amc_artifact_cache",   "Script artifact cache") { artifactCache.stats() }
+    metrics.stats("amc_script_staging",   "Script staging")        { ScriptStaging.stats() }
+    metrics.stats("amc_db_pool",          "Database connection pool") { databaseStore.stats() }
+    metrics.stats("amc_db_leak_watcher",  "Database connection leak watcher") { DatabaseConnection.connectionLeakWatcher.stats() }
+}
@@ -0,0 +1,208 @@
+package com.amcentral365.service
+
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.atomic.AtomicLongArray
+import java.util.concurrent.atomic.DoubleAdder
+import java.util.concurrent.atomic.LongAdder
+
+
+/** The metrics of this node, exposed at GET /metrics */
+val metrics = Metrics()
+
+/**
+ * Counters, histograms with fixed buckets, and gauges, rendered in the Prometheus text exposition format.
+ *
+ * Recording is an atomic add or two, there are no locks on the hot paths. Gauges are computed when rendered,
+ * so components that already keep statistics, like the caches and pools, are exposed with [stats] at no cost
+ * between scrapes.
+ *
+ * Metric names follow the Prometheus conventions: snake case, a unit suffix, and _total for counters.
+ * Registering a name again returns the existing metric.
+ */
+class Metrics {
+
+    abstract class Metric(val name: String, val help: String, val labelNames: List<String>) {
+        internal abstract fun render(out: StringBuilder)
+
+        protected fun checkLabels(labelValues: Array<out String>) =
+            require(labelValues.size == this.labelNames.size) { "$name: expected labels ${this.labelNames}, got ${labelValues.toList()}" }
+
+        protected fun labels(labelValues: List<String>, extra: Pair<String, String>? = null): String {
+            val pairs = this.labelNames.zip(labelValues) + listOfNotNull(extra)
+            return if( pairs.isEmpty() ) "" else pairs.joinToString(",", "{", "}") { (k, v) -> "$k=\"${escape(v)}\"" }
+        }
+    }
+
+    class Counter(name: String, help: String, labelNames: List<String>): Metric(name, help, labelNames) {
+        private val values = ConcurrentHashMap<List<String>, LongAdder>()
+
+        fun inc(vararg labelValues: String) = this.add(1, *labelValues)
+
+        fun add(n: Long, vararg labelValues: String) {
+            this.checkLabels(labelValues)
+            this.values.computeIfAbsent(labelValues.asList()) { LongAdder() }.add(n)
+        }
+
+        fun get(vararg labelValues: String): Long = this.values[labelValues.asList()]?.sum() ?: 0
+
+        override fun render(out: StringBuilder) {
+            out.append("# HELP $name $help\n# TYPE $name counter\n")
+            this.values.forEach { (labelValues, value) -> out.append("$name${labels(labelValues)} ${value.sum()}\n") }
+        }
+    }
+
+    class Histogram(name: String, help: String, private val buckets: DoubleArray, labelNames: List<String>): Metric(name, help, labelNames) {
+        private inner class Child {
+            val counts = AtomicLongArray(buckets.size + 1)     // the last one is +Inf
+            val sum = DoubleAdder()
+        }
+
+        private val children = ConcurrentHashMap<List<String>, Child>()
+
+        init {
+            require(this.buckets.isNotEmpty() && this.buckets.asList() == this.buckets.sorted()) { "$name: buckets must be sorted" }
+        }
+
+        fun observe(value: Double, vararg labelValues: String) {
+            this.checkLabels(labelValues)
+            val child = this.children.computeIfAbsent(labelValues.asList()) { Child() }
+            var k = 0
+            while( k < this.buckets.size && value > this.buckets[k] )
+                k++
+            child.counts.incrementAndGet(k)
+            child.sum.add(value)
+        }
+
+        /** Run [body] and observe its duration in seconds */
+        fun <T> time(vararg labelValues: String, body: () -> T): T {
+            val beg = System.nanoTime()
+            try {
+                return body()
+            } finally {
+                this.observe((System.nanoTime() - beg) / 1e9, *labelValues)
+            }
+        }
+
+        fun count(vararg labelValues: String): Long =
+            this.children[labelValues.asList()]?.let { c -> (0 until c.counts.length()).map { c.counts.get(it) }.sum() } ?: 0
+
+        /** Cumulative counts by upper bound, like the rendered _bucket lines */
+        fun buckets(vararg labelValues: String): Map<String, Long> {
+            val child = this.children[labelValues.asList()]
+            var cumulative = 0L
+            return (0..this.buckets.size).associateTo(linkedMapOf()) { k ->
+                cumulative += child?.counts?.get(k) ?: 0
+                Pair(if( k < this.buckets.size ) formatDouble(this.buckets[k]) else "+Inf", cumulative)
+            }
+        }
+
+        override fun render(out: StringBuilder) {
+            out.append("# HELP $name $help\n# TYPE $name histogram\n")
+            this.children.forEach { (labelValues, child) ->
+                var cumulative = 0L
+                for(k in 0 until child.counts.length()) {
+                    cumulative += child.counts.get(k)
+                    val le = if( k < buckets.size ) formatDouble(buckets[k]) else "+Inf"
+                    out.append("${name}_bucket${labels(labelValues, "le" to le)} $cumulative\n")
+                }
+                out.append("${name}_sum${labels(labelValues)} ${formatDouble(child.sum.sum())}\n")
+                out.append("${name}_count${labels(labelValues)} $cumulative\n")
+            }
+        }
+    }
+
+    class Gauge(name: String, help: String, private val value: () -> Number?): Metric(name, help, emptyList()) {
+        override fun render(out: StringBuilder) {
+            val v = try { this.value() } catch(x: Exception) { null } ?: return
+            out.append("# HELP $name $help\n# TYPE $name gauge\n$name ${formatDouble(v.toDouble())}\n")
+        }
+    }
+
+    /**
+     * Numeric values of a statistics map, each rendered as a gauge named prefix_key. Nested maps are flattened to
+     * prefix_key_subkey, or, when their keys aren't names, e.g. the upper bounds of a histogram, rendered as one
+     * gauge prefix_key with the subkeys in the label "key".
+     */
+    class StatsGauges(private val prefix: String, help: String, private val stats: () -> Map<String, Any?>): Metric(prefix, help, emptyList()) {
+        override fun render(out: StringBuilder) {
+            val map = try { this.stats() } catch(x: Exception) { return }   // e.g. the component isn't initialized
+            this.render(out, this.prefix, "", map)
+        }
+
+        private fun render(out: StringBuilder, prefix: String, keyPath: String, map: Map<*, *>) {
+            map.forEach { (key, value) ->
+                val name = "${prefix}_${snakeCase(key.toString())}"
+                val path = "$keyPath$key"
+                if( value is Map<*, *> ) {
+                    if( value.keys.all { keyRx.matches(it.toString()) } )
+                        this.render(out, name, "$path.", value)
+                    else {
+                        out.append("# HELP $name $help: $path\n# TYPE $name gauge\n")
+                        value.forEach { (subkey, subvalue) ->
+                            number(subvalue)?.let { out.append("$name{key=\"${escape(subkey.toString())}\"} ${formatDouble(it)}\n") }
+                        }
+                    }
+                } else
+                    number(value)?.let { out.append("# HELP $name $help: $path\n# TYPE $name gauge\n$name ${formatDouble(it)}\n") }
+            }
+        }
+
+        private fun number(value: Any?): Double? = when( value ) {
+            is Number  -> value.toDouble()
+            is Boolean -> if( value ) 1.0 else 0.0
+            else       -> null
+        }
+    }
+
+    private val registry = ConcurrentHashMap<String, Metric>()
+
+    @Suppress("UNCHECKED_CAST")
+    private fun <M: Metric> register(name: String, create: () -> M): M {
+        require(nameRx.matches(name)) { "invalid metric name: $name" }
+        return this.registry.computeIfAbsent(name) { create() } as M
+    }
+
+    fun counter(name: String, help: String, vararg labelNames: String): Counter =
+        this.register(name) { Counter(name, help, labelNames.asList()) }
+
+    fun histogram(name: String, help: String, buckets: DoubleArray = DEFAULT_SECONDS_BUCKETS, vararg labelNames: String): Histogram =
+        this.register(name) { Histogram(name, help, buckets, labelNames.asList()) }
+
+    fun gauge(name: String, help: String, value: () -> Number?): Gauge =
+        this.register(name) { Gauge(name, help, value) }
+
+    /** Expose the numeric entries of a component's statistics, e.g. <code>sshSessionPool.stats()</code> */
+    fun stats(prefix: String, help: String, stats: () -> Map<String, Any?>): StatsGauges =
+        this.register(prefix) { StatsGauges(prefix, help, stats) }
+
+    /** All metrics in the text exposition format, version 0.0.4 */
+    fun render(): String {
+        val out = StringBuilder(8192)
+        this.registry.values.sortedBy { it.name }.forEach { it.render(out) }
+        return out.toString()
+    }
+
+    companion object {
+        const val CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+        /** From 1 msec to 1 min */
+        val DEFAULT_SECONDS_BUCKETS = doubleArrayOf(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+        private val nameRx = Regex("[a-zA-Z_:][a-zA-Z0-9_:]*")
+        private val keyRx  = Regex("[a-zA-Z][a-zA-Z0-9_]*")
+
+        internal fun snakeCase(key: String): String =
+            key.replace(Regex("([a-z0-9])([A-Z])"), "$1_$2").replace(Regex("[^a-zA-Z0-9_]"), "_").toLowerCase()
+
+        private fun escape(labelValue: String) =
+            labelValue.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        private fun formatDouble(v: Double): String = when {
+            v.isNaN()             -> "NaN"
+            v == Double.POSITIVE_INFINITY -> "+Inf"
+            v == Double.NEGATIVE_INFINITY -> "-Inf"
+            v == Math.rint(v) && Math.abs(v) < 1e15 -> v.toLong().toString()
+            else -> v.toString()
+        }
+    }
+}
@@ -0,0 +1,240 @@
+package com.amcentral365.service
+
+import mu.KotlinLogging
+
+import java.util.ArrayDeque
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.Executors
+import java.util.concurrent.Semaphore
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicLong
+
+import com.jcraft.jsch.JSch
+import com.jcraft.jsch.JSchException
+import com.jcraft.jsch.Session
+
+
+private val logger = KotlinLogging.logger {}
+
+private val handshakeDuration = metrics.histogram("amc_ssh_handshake_seconds", "Time to open and authenticate SSH sessions")
+
+/**
+ * Pool of connected SSH sessions, per (host, port, login user).
+ *
+ * A session is leased to one target at a time with [acquire] and returned with [release].
+ * Idle sessions are reused most recently released first, they are likelier to be alive.
+ * Before reuse, a session idle for longer than the keepalive interval is probed with a
+ * keepalive message; broken sessions are closed and replaced.
+ *
+ * At most [maxSessionsPerHost] sessions, leased or idle, are open to a host. [acquire] waits
+ * [acquireWaitMsec] for one to free up and then fails with [StatusException] 503.
+ * Sessions idle for longer than [idleTimeoutMsec] are closed by a background reaper.
+ */
+open class SSHSessionPool(
+        private val maxSessionsPerHost: Int,
+        private val idleTimeoutMsec: Long,
+        private val keepAliveMsec: Int,
+        private val acquireWaitMsec: Long,
+        private val connectTimeoutMsec: Int
+) {
+    data class Key(val host: String, val port: Int, val user: String) {
+        override fun toString() = "$user@$host:$port"
+    }
+
+    private class PooledSession(val key: Key, val session: Session) {
+        var releasedTs = System.currentTimeMillis()
+    }
+
+    private inner class HostSessions {
+        val permits = Semaphore(maxSessionsPerHost, true)
+        val idle = ArrayDeque<PooledSession>()   // guarded by this
+    }
+
+    private val hosts  = ConcurrentHashMap<Key, HostSessions>()
+    private val leased = ConcurrentHashMap<Session, PooledSession>()
+
+    private val acquireCount     = AtomicLong()
+    private val reuseCount       = AtomicLong()
+    private val handshakeCount   = AtomicLong()
+    private val handshakeNanos   = AtomicLong()
+    private val brokenCount      = AtomicLong()
+    private val evictedCount     = AtomicLong()
+    private val waitTimeoutCount = AtomicLong()
+
+    private val jsch: JSch by lazy {
+        val sshPvtKey = getFileOrResource(config.sshPrivateKeyFile)
+        val sshPubKey = getFileOrResource(config.sshPublicKeyFile)
+        JSch.setConfig("StrictHostKeyChecking", "no")
+        JSch().also {
+            it.addIdentity("internal", sshPvtKey, sshPubKey, null)
+        }
+    }
+
+    private val reaper = Executors.newSingleThreadScheduledExecutor { r ->
+        Thread(r, "ssh-pool-reaper").also { it.isDaemon = true }
+    }
+
+    init {
+        if( this.idleTimeoutMsec > 0 ) {
+            val period = (this.idleTimeoutMsec / 2).coerceAtLeast(1000)
+            this.reaper.scheduleWithFixedDelay({
+                try {
+                    this.evictIdle()
+                } catch(x: Exception) {
+                    logger.warn { "SSH pool: evicting idle sessions failed: ${x.message}" }
+                }
+            }, period, period, TimeUnit.MILLISECONDS)
+        }
+    }
+
+
+    /** Open and authenticate a new session, the expensive part the pool saves */
+    protected open fun openSession(key: Key): Session {
+        val sess = this.jsch.getSession(key.user, key.host, key.port)
+        sess.connect(this.connectTimeoutMsec)
+        if( this.keepAliveMsec > 0 ) {
+            sess.serverAliveInterval = this.keepAliveMsec   // NB: also sets the socket read timeout
+            sess.serverAliveCountMax = 3
+        } else
+            sess.timeout = 0
+        return sess
+    }
+
+    protected open fun isHealthy(session: Session, idleMsec: Long): Boolean {
+        if( !session.isConnected )
+            return false
+        if( this.keepAliveMsec <= 0 || idleMsec < this.keepAliveMsec )
+            return true
+
+        return try {
+            session.sendKeepAliveMsg()
+            true
+        } catch(x: Exception) {
+            logger.info { "SSH pool: idle session ${session.host} failed the keepalive probe: ${x.message}" }
+            false
+        }
+    }
+
+    private fun closeQuietly(session: Session) =
+        try {
+            session.disconnect()
+        } catch(x: Exception) {
+            logger.debug { "SSH pool: ignoring failed disconnect from ${session.host}: ${x.message}" }
+        }
+
+
+    /** Lease a connected session to [key], reusing an idle one when possible */
+    fun acquire(key: Key): Session {
+        val host = this.hosts.computeIfAbsent(key) { HostSessions() }
+        if( !host.permits.tryAcquire(this.acquireWaitMsec, TimeUnit.MILLISECONDS) ) {
+            this.waitTimeoutCount.incrementAndGet()
+            throw StatusException(503, "all $maxSessionsPerHost SSH sessions to $key are busy, waited $acquireWaitMsec msec")
+        }
+
+        try {
+            this.acquireCount.incrementAndGet()
+            while( true ) {
+                val pooled = synchronized(host) { host.idle.pollLast() } ?: break
+                if( this.isHealthy(pooled.session, System.currentTimeMillis() - pooled.releasedTs) ) {
+                    this.reuseCount.incrementAndGet()
+                    this.leased[pooled.session] = pooled
+                    logger.debug { "SSH pool: reusing session to $key" }
+                    return pooled.session
+                }
+
+                this.brokenCount.incrementAndGet()
+                this.closeQuietly(pooled.session)
+            }
+
+            val beg = System.nanoTime()
+            val session = try {
+                this.openSession(key)
+            } catch(x: JSchException) {
+                throw StatusException.from(x)
+            }
+            this.handshakeCount.incrementAndGet()
+            this.handshakeNanos.addAndGet(System.nanoTime() - beg)
+            handshakeDuration.observe((System.nanoTime() - beg) / 1e9)
+            logger.info { "SSH pool: opened session to $key in ${(System.nanoTime() - beg) / 1_000_000} msec" }
+
+            this.leased[session] = PooledSession(key, session)
+            return session
+
+        } catch(x: Exception) {
+            host.permits.release()
+            throw x
+        }
+    }
+
+    /**
+     * Return a leased session. It is closed instead of pooled when [reusable] is false or it isn't connected.
+     * All channels opened on the session must be closed.
+     */
+    fun release(session: Session, reusable: Boolean = true) {
+        val pooled = this.leased.remove(session)
+        if( pooled == null ) {
+            logger.warn { "SSH pool: release of a session to ${session.host} which wasn't leased, closing it" }
+            this.closeQuietly(session)
+            return
+        }
+
+        val host = this.hosts.getValue(pooled.key)
+        if( reusable && session.isConnected ) {
+            pooled.releasedTs = System.currentTimeMillis()
+            synchronized(host) { host.idle.addLast(pooled) }
+        } else {
+            this.brokenCount.incrementAndGet()
+            this.closeQuietly(session)
+        }
+        host.permits.release()
+    }
+
+    /**
+     * Close sessions idle for longer than the idle timeout
+     * @return the number of closed sessions
+     */
+    fun evictIdle(): Int {
+        val now = System.currentTimeMillis()
+        var evicted = 0
+        this.hosts.values.forEach { host ->
+            val expired = synchronized(host) {
+                host.idle.filter { now - it.releasedTs > this.idleTimeoutMsec }.also { host.idle.removeAll(it) }
+            }
+            expired.forEach { this.closeQuietly(it.session) }
+            evicted += expired.size
+        }
+
+        if( evicted > 0 ) {
+            this.evictedCount.addAndGet(evicted.toLong())
+            logger.info { "SSH pool: closed $evicted idle session(s)" }
+        }
+        return evicted
+    }
+
+    /** Close idle sessions and stop the reaper. Leased sessions are closed on release. */
+    fun close() {
+        this.reaper.shutdownNow()
+        this.hosts.values.forEach { host ->
+            synchronized(host) { host.idle.toList().also { host.idle.clear() } }.forEach { this.closeQuietly(it.session) }
+        }
+    }
+
+    /** Reuse rate, handshake time, and session counts */
+    fun stats(): Map<String, Any> {
+        val acquires   = this.acquireCount.get()
+        val handshakes = this.handshakeCount.get()
+        return linkedMapOf(
+              "acquireCount"         to acquires
+            , "reuseCount"           to this.reuseCount.get()
+            , "reuseRate"            to if( acquires == 0L ) 0.0 else this.reuseCount.get().toDouble() / acquires
+            , "handshakeCount"       to handshakes
+            , "averageHandshakeMsec" to if( handshakes == 0L ) 0.0 else this.handshakeNanos.get() / 1_000_000.0 / handshakes
+            , "brokenCount"          to this.brokenCount.get()
+            , "evictedCount"         to this.evictedCount.get()
+            , "waitTimeoutCount"     to this.waitTimeoutCount.get()
+            , "leasedSessions"       to this.leased.size
+            , "idleSessions"         to this.hosts.values.sumBy { synchronized(it) { it.idle.size } }
+            , "hosts"                to this.hosts.size
+        )
+    }
+}
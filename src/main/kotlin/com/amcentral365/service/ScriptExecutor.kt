@@ -13,6 +13,10 @@ import kotlin.reflect.jvm.jvmName
 
 private val logger = KotlinLogging.logger {}
 
+private val phaseDuration = metrics.histogram("amc_script_phase_duration_seconds",
+        "Time spent in each step of script execution, by target type", Metrics.DEFAULT_SECONDS_BUCKETS, "target", "phase")
+private val executions = metrics.counter("amc_script_executions_total", "Script executions by target type and outcome", "target", "outcome")
+
 open class ScriptExecutor(private val threadId: String) {
 
     /**
@@ -23,10 +27,14 @@ open class ScriptExecutor(private val threadId: String) {
      * guaranteed to execute.
      */
     fun run(script: Script, target: ScriptExecutorFlow, outputStream: OutputStream, inputStream: InputStream? = null): StatusMessage {
+        val targetType = target::class.simpleName ?: "anonymous"
+        fun <T> phase(name: String, body: () -> T): T = phaseDuration.time(targetType, name, body = body)
+
+        var outcome = "failed"
         var connected = false
         try {
             logger.info { "${this.threadId}: connecting to target ${target.name}" }
-            connected = target.connect()
+            connected = phase("connect") { target.connect() }
             if( !connected ) {
                 val msg = "${this.threadId}: failed to connect to target ${target.name}"
                 logger.warn { msg }
@@ -34,7 +42,7 @@ open class ScriptExecutor(private val threadId: String) {
             }
 
             logger.info { "${this.threadId}: preparing script ${script.name} on target ${target.name}" }
-            if( !target.prepare(script) ) {
+            if( !phase("prepare") { target.prepare(script) } ) {
                 val msg = "${this.threadId}: failed to prepare script ${script.name} on target ${target.name}"
                 logger.warn { msg }
                 return StatusMessage(500, msg)
@@ -45,7 +53,9 @@ open class ScriptExecutor(private val threadId: String) {
                 var statusMessage = StatusMessage(100, "~not-defined~")
                 val w = Stopwatch.createStarted()
                 try {
-                    statusMessage = target.execute(script, outputStream, inputStream)
+                    statusMessage = phase("execute") { target.execute(script, outputStream, inputStream) }
+                    if( statusMessage.code in 200..299 )
+                        outcome = "ok"
                     return statusMessage
                 } finally {
                     w.stop()
@@ -54,7 +64,7 @@ open class ScriptExecutor(private val threadId: String) {
 
             } finally {
                 logger.info { "${this.threadId}: cleaning up after script ${script.name} on target ${target.name}" }
-                target.cleanup(script)
+                phase("cleanup") { target.cleanup(script) }
             }
 
         } catch(x: Exception) {
@@ -64,10 +74,11 @@ open class ScriptExecutor(private val threadId: String) {
             if( connected )
                 try {
                     logger.info { "${this.threadId}: disconnecting from target ${target.name}" }
-                    target.disconnect()
+                    phase("disconnect") { target.disconnect() }
                 } catch(x: Exception) {
                     logger.warn { "${this.threadId}: ignoring failed disconnect: ${x::class.jvmName} ${x.message}" }
                 }
+            executions.inc(targetType, outcome)
         }
     }
 }
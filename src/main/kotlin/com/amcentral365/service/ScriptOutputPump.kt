@@ -0,0 +1,162 @@
+package com.amcentral365.service
+
+import mu.KotlinLogging
+
+import java.io.IOException
+import java.io.InputStream
+import java.io.OutputStream
+import java.util.concurrent.Executors
+import java.util.concurrent.ScheduledFuture
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
+import kotlin.concurrent.thread
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Copies script output to the caller's stream as soon as it arrives, and enforces the execution and idle timeouts.
+ *
+ * The output is read with blocking reads on the executing thread: a chunk is written out as soon as the read
+ * returns, and a waiting thread consumes no CPU. The timeouts are enforced by [watchdog], one thread shared by
+ * all running scripts. When a timeout expires, it only records the reason and hands [abort] to [aborter]: killing
+ * a script may block, e.g. on the socket of an SSH target, and must not delay the timeouts of the other scripts.
+ * [abort] must kill the script and so close its output, ending [pump].
+ *
+ * @param execTimeoutSec, idleTimeoutSec 0 or less disables the timeout
+ */
+class ScriptOutputPump(
+        private val threadId: String,
+        private val execTimeoutSec: Int,
+        private val idleTimeoutSec: Int,
+        private val bufferSize: Int = config.scriptOutputBufferBytes,
+        private val abort: () -> Unit
+) {
+    companion object {
+        private val watchdog = Executors.newSingleThreadScheduledExecutor { r ->
+            Thread(r, "script-timeout-watchdog").also { it.isDaemon = true }
+        }
+
+        private val aborterThreadNo = AtomicInteger()
+        private val aborter = Executors.newCachedThreadPool { r ->
+            Thread(r, "script-aborter-${aborterThreadNo.incrementAndGet()}").also { it.isDaemon = true }
+        }
+
+        private fun ivlText(msec: Long) = "%.1f".format(msec / 1000f)
+    }
+
+    val execStartTs = System.currentTimeMillis()
+    @Volatile private var lastOutputTs = this.execStartTs
+
+    /** Why the script was aborted, null if it wasn't */
+    @Volatile var abortReason: String? = null
+        private set
+
+    private var execTimer: ScheduledFuture<*>? = null
+    private var idleTimer: ScheduledFuture<*>? = null
+    private var inputFeed: Pair<InputStream, OutputStream>? = null
+
+
+    private fun abortFor(reason: String) {
+        synchronized(this) {
+            if( this.abortReason != null )
+                return
+            this.abortReason = reason
+        }
+
+        logger.warn { "${this.threadId}: aborting, $reason" }
+        aborter.execute {
+            try {
+                this.abort()
+            } catch(x: Exception) {
+                logger.warn { "${this.threadId}: abort failed: ${x.message}" }
+            }
+        }
+    }
+
+    private fun scheduleIdleCheck(delayMsec: Long) {
+        this.idleTimer = watchdog.schedule({
+            val idleMsec = System.currentTimeMillis() - this.lastOutputTs
+            val leftMsec = this.idleTimeoutSec*1000L - idleMsec
+            if( leftMsec <= 0 )
+                this.abortFor("idle time ${ivlText(idleMsec)} has exceeded timeout ${this.idleTimeoutSec}")
+            else
+                synchronized(this) {
+                    if( this.abortReason == null && this.idleTimer?.isCancelled == false )
+                        this.scheduleIdleCheck(leftMsec)
+                }
+        }, delayMsec, TimeUnit.MILLISECONDS)
+    }
+
+    private fun startTimers() = synchronized(this) {
+        if( this.execTimeoutSec > 0 )
+            this.execTimer = watchdog.schedule({
+                this.abortFor("execution time ${ivlText(this.elapsedMsec())} has exceeded timeout ${this.execTimeoutSec}")
+            }, this.execTimeoutSec*1000L, TimeUnit.MILLISECONDS)
+
+        if( this.idleTimeoutSec > 0 )
+            this.scheduleIdleCheck(this.idleTimeoutSec*1000L)
+    }
+
+    /** Stop the timeout timers, e.g. when the script has completed */
+    fun cancelTimers() = synchronized(this) {
+        this.execTimer?.cancel(false)
+        this.idleTimer?.cancel(false)
+    }
+
+    fun elapsedMsec() = System.currentTimeMillis() - this.execStartTs
+
+    /**
+     * Have [pump] copy [input] to the script's [stdin], on a separate thread started with the timers. The output
+     * is read meanwhile, so a script writing output before it reads all of its input doesn't block, and the
+     * timeouts apply while the input is copied. [stdin] is closed at the end of [input].
+     */
+    fun feedInput(input: InputStream, stdin: OutputStream) {
+        this.inputFeed = Pair(input, stdin)
+    }
+
+    private fun startInputFeed(input: InputStream, stdin: OutputStream) =
+        thread(isDaemon = true, name = "${this.threadId}-stdin") {
+            try {
+                val copied = stdin.use { input.copyTo(it) }
+                logger.debug { "${this.threadId}: copied $copied bytes to the script's stdin" }
+            } catch(x: IOException) {
+                if( this.abortReason == null )     // else the script was killed
+                    logger.warn { "${this.threadId}: copying to the script's stdin failed: ${x.message}" }
+            }
+        }
+
+    /**
+     * Copy [input] to [output] until the end of the stream, or until the script is aborted.
+     * The timers keep running after the output ends, call [cancelTimers] once the script has completed.
+     *
+     * @return the number of copied bytes
+     */
+    fun pump(input: InputStream, output: OutputStream): Long {
+        this.startTimers()
+        this.inputFeed?.let { (stdinInput, stdin) -> this.startInputFeed(stdinInput, stdin) }
+
+        val buffer = ByteArray(this.bufferSize)
+        var copied = 0L
+        try {
+            while( true ) {
+                val readByteCnt = input.read(buffer)
+                if( readByteCnt < 0 )
+                    break
+
+                this.lastOutputTs = System.currentTimeMillis()
+                if( readByteCnt > 0 ) {
+                    output.write(buffer, 0, readByteCnt)
+                    output.flush()
+                    copied += readByteCnt
+                }
+            }
+        } catch(x: IOException) {
+            if( this.abortReason == null )
+                throw x
+            // the stream was closed by abort()
+        }
+
+        return copied
+    }
+}
@@ -0,0 +1,240 @@
+package com.amcentral365.service
+
+import com.google.common.hash.Hashing
+import com.google.common.hash.HashingInputStream
+import mu.KotlinLogging
+
+import java.io.Closeable
+import java.io.File
+import java.nio.file.Files
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.atomic.AtomicLong
+
+import com.amcentral365.service.builtins.roles.Script
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Staged mode of script preparation: each version of the script files is transferred to a target once, into a
+ * directory named by the version hash, and later executions of the same files run in that directory. The version
+ * comes from metadata the sender has, see [TransferManager.Sender.versionKey], so preparing an already staged script
+ * is one existence check and the files are only fetched when they need staging. Only scripts that don't modify their
+ * directory should run staged.
+ *
+ * Reuse touches the directory; directories not used for [maxAgeSec] are removed, at most once per
+ * [gcIntervalMsec] per target. A version is staged into a temporary directory first and renamed when
+ * complete, so concurrent executions never see a partially staged one.
+ */
+class ScriptStaging(
+        private val threadId: String,
+        private val ops: Ops,
+        private val maxAgeSec: Long,
+        private val gcIntervalMsec: Long
+) {
+    /** Directory operations on the target */
+    interface Ops {
+        /** Identifies the target and its staging directory, for scheduling the removal of old versions */
+        val key: String
+
+        /** If [dirName] exists, mark it used and return true */
+        fun reuse(dirName: String): Boolean
+        fun create(dirName: String)
+        /** Rename [tmpDirName] to [dirName]. If [dirName] was staged meanwhile, drop [tmpDirName]. */
+        fun publish(tmpDirName: String, dirName: String): Boolean
+        fun remove(dirName: String)
+        /** Remove entries of [baseDirName] not used for [ageSec]. Returns how many were removed, when known. */
+        fun removeUnused(baseDirName: String, ageSec: Long): Int?
+    }
+
+    /**
+     * Identifies a version of the script files by [hash]. Usually the hash is of [TransferManager.Sender.versionKey],
+     * so finding out the version reads no file content. Senders without a version key are read ahead, their files
+     * are spooled to a temporary directory and hashed.
+     */
+    internal class Bundle private constructor(
+            private val original: TransferManager.Sender,
+            private val script: Script,
+            val hash: String,
+            val hasInlineMain: Boolean,
+            private val spoolDir: File? = null,
+            private val spooled: List<Spooled> = emptyList()
+    ): Closeable {
+        /** An item read ahead, and the file its content was spooled to */
+        private class Spooled(val item: TransferManager.Item, val file: File?)
+
+        /** The items to transfer. Inline content gets a fixed name, so that its staged copy can be found. */
+        fun sender(): TransferManager.Sender =
+            if( this.spoolDir == null )
+                object: TransferManager.Sender() {
+                    override fun begin() = original.begin()
+                    override fun end(successful: Boolean) = original.end(successful)
+                    override fun getIterator() = original.getIterator().asSequence().map { renameInline(it, script) }.iterator()
+                }
+            else
+                object: TransferManager.Sender() {
+                    override fun getIterator(): Iterator<TransferManager.Item> =
+                        spooled.asSequence().map { it.item.copy(inputStream = it.file?.inputStream()) }.iterator()
+                }
+
+        override fun close() {
+            this.spoolDir?.deleteRecursively()
+        }
+
+        companion object {
+            private fun isInline(item: TransferManager.Item) = !item.isDirectory && !item.verifyPathExists && item.pathStr.isBlank()
+
+            private fun renameInline(item: TransferManager.Item, script: Script): TransferManager.Item {
+                if( !isInline(item) )
+                    return item
+                if( script.hasMain )
+                    throw StatusException(412, "Ambiguity: the script defines both main and the inline content")
+                return item.copy(pathStr = INLINE_MAIN_NAME, permissions = 0b111_100_100)
+            }
+
+            fun of(sender: TransferManager.Sender, script: Script): Bundle {
+                val versionKey = sender.versionKey()
+                if( versionKey != null ) {
+                    val hasInlineMain = sender is SenderOfInlineContent
+                    if( hasInlineMain && script.hasMain )
+                        throw StatusException(412, "Ambiguity: the script defines both main and the inline content")
+                    val hash = Hashing.sha256().newHasher()
+                            .putString(sender::class.java.name, Charsets.UTF_8).putByte(0)
+                            .putString(versionKey, Charsets.UTF_8)
+                            .hash().toString()
+                    return Bundle(sender, script, hash, hasInlineMain)
+                }
+
+                val spoolDir = Files.createTempDirectory("amc-staging-").toFile()
+                try {
+                    return spool(sender, script, spoolDir)
+                } catch(x: Exception) {
+                    spoolDir.deleteRecursively()
+                    throw x
+                }
+            }
+
+            /** Copy the files of [sender] to [spoolDir], hashing them on the way */
+            private fun spool(sender: TransferManager.Sender, script: Script, spoolDir: File): Bundle {
+                val spooled = mutableListOf<Spooled>()
+                val hasher = Hashing.sha256().newHasher()
+
+                sender.begin()
+                var ok = false
+                try {
+                    sender.getIterator().forEach { original ->
+                        val item = renameInline(original, script)
+                        val file = item.inputStream?.use { input ->
+                            val hin = HashingInputStream(Hashing.sha256(), input)
+                            val file = File(spoolDir, spooled.size.toString())
+                            val size = file.outputStream().use { hin.copyTo(it) }
+                            hasher.putLong(size).putString(hin.hash().toString(), Charsets.UTF_8)
+                            file
+                        }
+                        hasher.putString(item.pathStr, Charsets.UTF_8).putByte(0)
+                              .putBoolean(item.isDirectory).putBoolean(item.verifyPathExists)
+                              .putInt(item.permissions ?: -1).putBoolean(file != null)
+                        spooled.add(Spooled(item.copy(inputStream = null), file))
+                    }
+                    ok = true
+                } finally {
+                    sender.end(ok)
+                }
+
+                val hasInlineMain = spooled.any { it.item.pathStr == INLINE_MAIN_NAME }
+                return Bundle(sender, script, hasher.hash().toString(), hasInlineMain, spoolDir, spooled)
+            }
+        }
+    }
+
+    /**
+     * Find or stage the files of [script], as given by [sender], under [baseDirName].
+     *
+     * @param transfer copies the files from the sender to the given directory
+     * @return the staged directory, or null if the transfer failed
+     */
+    fun stage(script: Script, sender: TransferManager.Sender?, baseDirName: String,
+              transfer: (dirName: String, sender: TransferManager.Sender) -> Boolean): String? {
+        if( sender == null ) {
+            logger.warn { "${this.threadId}: script '${script.name}' has no content, nothing to do" }
+            return null
+        }
+
+        Bundle.of(sender, script).use { bundle ->
+            return this.stage(script, bundle, baseDirName, transfer)
+        }
+    }
+
+    private fun stage(script: Script, bundle: Bundle, baseDirName: String,
+                      transfer: (dirName: String, sender: TransferManager.Sender) -> Boolean): String? {
+        this.removeUnusedVersions(baseDirName)
+
+        val dirName = "$baseDirName/${bundle.hash}"
+        if( this.ops.reuse(dirName) ) {
+            reusedCount.incrementAndGet()
+            logger.info { "${this.threadId}: script '${script.name}' is already staged in $dirName" }
+        } else {
+            val tmpDirName = "$dirName.tmp-${ReceiverHost.genTempFileName("", "")}"
+            this.ops.create(tmpDirName)
+            var published = false
+            try {
+                if( !transfer(tmpDirName, bundle.sender()) )
+                    return null
+                published = this.ops.publish(tmpDirName, dirName)
+                if( !published )
+                    throw StatusException(500, "failed to rename $tmpDirName to $dirName")
+            } finally {
+                if( !published )
+                    this.safeRemove(tmpDirName)
+            }
+            stagedCount.incrementAndGet()
+            logger.info { "${this.threadId}: staged script '${script.name}' in $dirName" }
+        }
+
+        if( bundle.hasInlineMain )
+            script.assignMain(INLINE_MAIN_NAME)
+        return dirName
+    }
+
+    private fun safeRemove(dirName: String) =
+        try {
+            this.ops.remove(dirName)
+        } catch(x: Exception) {
+            logger.warn { "${this.threadId}: ignoring failed removal of $dirName: ${x.message}" }
+        }
+
+    private fun removeUnusedVersions(baseDirName: String) {
+        val now = System.currentTimeMillis()
+        val last = lastRemovalTs.put(this.ops.key, now)
+        if( last != null && now - last < this.gcIntervalMsec ) {
+            lastRemovalTs[this.ops.key] = last
+            return
+        }
+
+        try {
+            val removed = this.ops.removeUnused(baseDirName, this.maxAgeSec)
+            if( removed != null )
+                removedCount.addAndGet(removed.toLong())
+            logger.info { "${this.threadId}: removed ${removed ?: "the"} staged script versions unused for ${this.maxAgeSec} sec from ${this.ops.key}" }
+        } catch(x: Exception) {
+            logger.warn { "${this.threadId}: ignoring failed removal of unused staged scripts on ${this.ops.key}: ${x.message}" }
+        }
+    }
+
+    companion object {
+        const val INLINE_MAIN_NAME = "amc_inline_main"
+
+        private val lastRemovalTs = ConcurrentHashMap<String, Long>()
+
+        private val stagedCount  = AtomicLong()
+        private val reusedCount  = AtomicLong()
+        private val removedCount = AtomicLong()
+
+        fun stats(): Map<String, Any> =
+            linkedMapOf(
+                  "stagedCount"  to stagedCount.get()
+                , "reusedCount"  to reusedCount.get()
+                , "removedCount" to removedCount.get()
+            )
+    }
+}
@@ -0,0 +1,155 @@
+package com.amcentral365.service
+
+import java.io.File
+import java.io.FileNotFoundException
+import java.io.FileOutputStream
+import java.io.OutputStream
+import java.io.RandomAccessFile
+import java.util.ArrayDeque
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.locks.ReentrantLock
+import kotlin.concurrent.withLock
+
+
+/**
+ * Append-only script output spooled to files in [dir], [segmentBytes] per file.
+ *
+ * Only the last [maxSegments] segments are kept: when the output outgrows them, the oldest segment is deleted
+ * and its bytes can no longer be read. Offsets are absolute, counted from the beginning of the output.
+ * Readers can wait for more output to arrive, see [read].
+ */
+class SegmentedOutputLog(private val dir: File, private val segmentBytes: Long, private val maxSegments: Int): OutputStream() {
+
+    /** Bytes [offset], [offset]+[data].size of the output. [complete] when the output has ended and all of it was read. */
+    class Chunk(val offset: Long, val data: ByteArray, val complete: Boolean) {
+        val nextOffset: Long get() = this.offset + this.data.size
+    }
+
+    private class Segment(val startOffset: Long, val file: File) {
+        var length = 0L
+    }
+
+    /** What [read] reads: [length] bytes at [fileOffset] of [file] go to [dataOffset] of the chunk */
+    private class Part(val file: File, val fileOffset: Long, val dataOffset: Int, val length: Int)
+    private data class Snapshot(val start: Long, val end: Long, val complete: Boolean, val parts: List<Part>)
+
+    private val lock = ReentrantLock()
+    private val outputArrived = this.lock.newCondition()
+
+    private val segments = ArrayDeque<Segment>()   // guarded by lock
+    private var writer: FileOutputStream? = null
+    private var closed = false
+
+    /** Total bytes written, including the bytes of deleted segments */
+    @Volatile var size = 0L
+        private set
+
+    /** The first offset which still can be read */
+    val firstOffset: Long get() = this.lock.withLock { this.segments.peekFirst()?.startOffset ?: this.size }
+
+    init {
+        if( !this.dir.isDirectory && !this.dir.mkdirs() )
+            throw StatusException(500, "failed to create output directory ${this.dir.path}")
+    }
+
+
+    override fun write(b: Int) = this.write(byteArrayOf(b.toByte()), 0, 1)
+
+    override fun write(b: ByteArray, off: Int, len: Int) = this.lock.withLock {
+        if( this.closed )
+            throw StatusException(500, "output ${this.dir.path} is closed")
+
+        var pos = off
+        val end = off + len
+        while( pos < end ) {
+            var segment = this.segments.peekLast()
+            if( segment == null || segment.length >= this.segmentBytes ) {
+                segment = this.newSegment()
+            }
+
+            val n = (end - pos).toLong().coerceAtMost(this.segmentBytes - segment.length).toInt()
+            this.writer!!.write(b, pos, n)
+            segment.length += n
+            this.size += n
+            pos += n
+        }
+
+        this.outputArrived.signalAll()
+    }
+
+    private fun newSegment(): Segment {
+        this.writer?.close()
+        val segment = Segment(this.size, this.dir.resolve("%016x.out".format(this.size)))
+        this.writer = FileOutputStream(segment.file)
+        this.segments.addLast(segment)
+
+        while( this.segments.size > this.maxSegments )
+            this.segments.removeFirst().file.delete()
+
+        return segment
+    }
+
+    /** Mark the end of the output. Waiting readers get the rest of it. */
+    override fun close() = this.lock.withLock {
+        if( !this.closed ) {
+            this.closed = true
+            this.writer?.close()
+            this.writer = null
+            this.outputArrived.signalAll()
+        }
+    }
+
+    /** Close and delete the output files */
+    fun delete() {
+        this.close()
+        this.lock.withLock { this.segments.clear() }
+        this.dir.deleteRecursively()
+    }
+
+    /**
+     * Read up to [maxBytes] of the output, starting at [offset].
+     *
+     * When the output is already past [offset], the call returns right away. Otherwise it waits up to
+     * [waitMsec] for more output to arrive. The returned chunk may start after [offset] if the bytes
+     * there were already deleted, compare [Chunk.offset] to detect the gap.
+     *
+     * The segments to read are picked under the lock, the files are read outside of it, so a slow read
+     * doesn't hold up the writer. Bytes below the picked lengths don't change, only whole segments are deleted.
+     */
+    fun read(offset: Long, maxBytes: Int, waitMsec: Long = 0): Chunk {
+        val deadline = System.currentTimeMillis() + waitMsec
+        while( true ) {
+            val (start, end, complete, parts) = this.lock.withLock {
+                while( offset >= this.size && !this.closed ) {
+                    val left = deadline - System.currentTimeMillis()
+                    if( left <= 0 )
+                        break
+                    this.outputArrived.await(left, TimeUnit.MILLISECONDS)
+                }
+
+                val start = offset.coerceIn(this.firstOffset, this.size)
+                val end = (start + maxBytes).coerceAtMost(this.size)
+                val parts = this.segments.filter { it.startOffset < end && it.startOffset + it.length > start }.map { segment ->
+                    val from = maxOf(start, segment.startOffset)
+                    val to   = minOf(end, segment.startOffset + segment.length)
+                    Part(segment.file, from - segment.startOffset, (from - start).toInt(), (to - from).toInt())
+                }
+                Snapshot(start, end, this.closed && end == this.size, parts)
+            }
+
+            val data = ByteArray((end - start).toInt())
+            try {
+                parts.forEach { part ->
+                    RandomAccessFile(part.file, "r").use { raf ->
+                        raf.seek(part.fileOffset)
+                        raf.readFully(data, part.dataOffset, part.length)
+                    }
+                }
+            } catch(x: FileNotFoundException) {
+                continue    // the segment was deleted after the snapshot, read again from the new first offset
+            }
+
+            return Chunk(start, data, complete)
+        }
+    }
+}
@@ -0,0 +1,96 @@
+package com.amcentral365.service
+
+import java.io.Closeable
+import java.io.InputStream
+import java.io.OutputStream
+
+
+/**
+ * Writes a POSIX ustar archive, just enough of the format to ship script files: directories and
+ * regular files with their permissions. Paths longer than 100 characters are split into the ustar prefix.
+ *
+ * The size of a file goes into its header, so the content is passed with its length.
+ */
+class TarArchiveWriter(private val out: OutputStream): Closeable {
+    private val mtimeSec = System.currentTimeMillis() / 1000
+    private var closed = false
+
+    fun addDirectory(path: String, mode: Int = 0b111_101_101) =
+        this.writeHeader(path.trimEnd('/') + "/", mode, 0, '5')
+
+    fun addFile(path: String, size: Long, content: InputStream, mode: Int = 0b110_100_100) {
+        this.writeHeader(path, mode, size, '0')
+        val copied = content.copyTo(this.out)
+        if( copied != size )
+            throw StatusException(500, "tar: $path has $copied bytes, expected $size")
+        this.pad(size)
+    }
+
+    /** Write the end-of-archive marker. The underlying stream is not closed. */
+    override fun close() {
+        if( this.closed )
+            return
+        this.out.write(ByteArray(2 * BLOCK))
+        this.out.flush()
+        this.closed = true
+    }
+
+    private fun pad(size: Long) {
+        val rem = (size % BLOCK).toInt()
+        if( rem != 0 )
+            this.out.write(ByteArray(BLOCK - rem))
+    }
+
+    private fun writeHeader(path: String, mode: Int, size: Long, type: Char) {
+        val (prefix, name) = splitPath(path)
+        val hdr = ByteArray(BLOCK)
+
+        fun put(offset: Int, len: Int, value: String) {
+            val bytes = value.toByteArray(Charsets.UTF_8)
+            require(bytes.size <= len)
+            System.arraycopy(bytes, 0, hdr, offset, bytes.size)
+        }
+        fun putOctal(offset: Int, len: Int, value: Long) =
+            put(offset, len, java.lang.Long.toOctalString(value).padStart(len - 1, '0'))
+
+        put(0, 100, name)
+        putOctal(100, 8, (mode and 0b111_111_111).toLong())
+        putOctal(108, 8, 0)                     // uid: the files belong to the user unpacking them
+        putOctal(116, 8, 0)                     // gid
+        putOctal(124, 12, size)
+        putOctal(136, 12, this.mtimeSec)
+        put(148, 8, "        ")                 // the checksum is computed with blanks in its place
+        hdr[156] = type.toByte()
+        put(257, 6, "ustar")
+        put(263, 2, "00")
+        put(345, 155, prefix)
+
+        val checksum = hdr.sumBy { it.toInt() and 0xff }
+        put(148, 8, java.lang.Integer.toOctalString(checksum).padStart(6, '0') + "\u0000 ")
+
+        this.out.write(hdr)
+    }
+
+    companion object {
+        private const val BLOCK = 512
+
+        /** Split [path] into the ustar prefix and name fields */
+        internal fun splitPath(path: String): Pair<String, String> {
+            if( path.toByteArray(Charsets.UTF_8).size <= 100 )
+                return Pair("", path)
+
+            // split at a slash so that the name fits 100 bytes and the prefix 155
+            var k = path.indexOf('/')
+            while( k > 0 ) {
+                val prefix = path.substring(0, k)
+                val name = path.substring(k+1)
+                if( prefix.toByteArray(Charsets.UTF_8).size > 155 )
+                    break
+                if( name.isNotEmpty() && name.toByteArray(Charsets.UTF_8).size <= 100 )
+                    return Pair(prefix, name)
+                k = path.indexOf('/', k+1)
+            }
+            throw StatusException(412, "tar: the path is too long: $path")
+        }
+    }
+}
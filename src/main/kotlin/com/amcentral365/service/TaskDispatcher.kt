@@ -0,0 +1,296 @@
+package com.amcentral365.service
+
+import mu.KotlinLogging
+
+import java.io.OutputStream
+import java.sql.Connection
+import java.util.UUID
+import java.util.concurrent.Executors
+import java.util.concurrent.Semaphore
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
+import java.util.concurrent.atomic.AtomicLong
+import java.util.concurrent.locks.ReentrantLock
+import kotlin.concurrent.thread
+import kotlin.concurrent.withLock
+import kotlin.reflect.jvm.jvmName
+
+import com.amcentral365.service.api.Execute
+import com.amcentral365.service.builtins.RoleName
+import com.amcentral365.service.builtins.roles.Script
+import com.amcentral365.service.dao.Task
+import com.amcentral365.service.dao.bytesToUuid
+import com.amcentral365.service.dao.fromDB
+import com.amcentral365.service.dao.uuidToBytes
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Drains the tasks table: claims due tasks and runs them on a pool of [threads].
+ *
+ * Tasks are claimed in batches of up to [batchSize] with <code>SELECT ... FOR UPDATE SKIP LOCKED</code>
+ * and marked Processing by this [workerName] in the same transaction. Several cluster nodes can share the
+ * queue: a row locked by one node is skipped by the others, so each task runs exactly once.
+ *
+ * When the queue has no due tasks, the dispatcher sleeps [pollIntervalMsec] or until [wakeUp] is called.
+ */
+class TaskDispatcher(
+        val workerName: String,
+        private val threads: Int,
+        private val batchSize: Int,
+        private val pollIntervalMsec: Long,
+        private val queue: Queue = DbQueue,
+        private val runTask: (threadId: String, task: Task, outputStream: OutputStream) -> StatusMessage =
+                { threadId, task, outputStream -> runScriptTask(threadId, task, outputStream) }
+) {
+    /** Where the tasks come from, the tasks table by default */
+    interface Queue {
+        /** Claim at most [limit] due Ready tasks, mark them Processing by [workerName] */
+        fun claim(workerName: String, limit: Int): List<Task>
+
+        /** Record the task outcome */
+        fun finish(workerName: String, taskId: UUID, status: Task.Status, progressText: String)
+
+        /** Fail tasks left in Processing by an earlier run of [workerName] */
+        fun failAbandoned(workerName: String): Int
+    }
+
+    private val freeThreads = Semaphore(this.threads)
+    private val threadNo = AtomicInteger()
+    private val executor = Executors.newFixedThreadPool(this.threads) { r ->
+        Thread(r, "task-${this.threadNo.incrementAndGet()}").also { it.isDaemon = true }
+    }
+    private val lock = ReentrantLock()
+    private val wakeUpCalled = this.lock.newCondition()
+    @Volatile private var wakeUpPending = false
+    @Volatile private var running = false
+
+    private val claimedCount  = AtomicLong()
+    private val finishedCount = AtomicLong()
+    private val failedCount   = AtomicLong()
+
+    private var dispatcherThread: Thread? = null
+
+
+    /** Check the queue now, e.g. because a task due right away was submitted */
+    fun wakeUp() = this.lock.withLock {
+        this.wakeUpPending = true
+        this.wakeUpCalled.signal()
+    }
+
+    private fun sleep(msec: Long) = this.lock.withLock {
+        if( !this.wakeUpPending )
+            this.wakeUpCalled.await(msec, TimeUnit.MILLISECONDS)
+        this.wakeUpPending = false
+    }
+
+    fun start() {
+        val abandoned = this.queue.failAbandoned(this.workerName)
+        if( abandoned > 0 )
+            logger.warn { "task dispatcher: failed $abandoned task(s) left in Processing by the previous run of ${this.workerName}" }
+
+        this.running = true
+        this.dispatcherThread = thread(isDaemon = true, name = "task-dispatcher") {
+            logger.info { "task dispatcher ${this.workerName} started with ${this.threads} threads" }
+            while( this.running && keepRunning ) {
+                try {
+                    if( this.dispatchOnce() == 0 )
+                        this.sleep(this.pollIntervalMsec)
+                } catch(x: InterruptedException) {
+                    break
+                } catch(x: Exception) {
+                    logger.warn { "task dispatcher: ${x::class.jvmName} ${x.message}" }
+                    this.sleep(this.pollIntervalMsec)
+                }
+            }
+            logger.info { "task dispatcher ${this.workerName} stopped" }
+        }
+    }
+
+    /** Stop claiming tasks. Running tasks complete. */
+    fun stop() {
+        this.running = false
+        this.wakeUp()
+        this.executor.shutdown()
+    }
+
+    /**
+     * Wait for a free thread, claim as many tasks as there are free threads, and start them.
+     * @return the number of started tasks
+     */
+    internal fun dispatchOnce(): Int {
+        this.freeThreads.acquire()
+        val free = 1 + this.freeThreads.drainPermits()
+        val tasks = try {
+            this.queue.claim(this.workerName, free.coerceAtMost(this.batchSize))
+        } catch(x: Exception) {
+            this.freeThreads.release(free)
+            throw x
+        }
+
+        this.freeThreads.release(free - tasks.size)
+        this.claimedCount.addAndGet(tasks.size.toLong())
+        tasks.forEach { task ->
+            this.executor.execute {
+                try {
+                    this.execute(task)
+                } finally {
+                    this.freeThreads.release()
+                }
+            }
+        }
+
+        return tasks.size
+    }
+
+    private fun execute(task: Task) {
+        val threadId = "${Thread.currentThread().name}/${task.taskId}"
+        logger.info { "$threadId: running task '${task.name}'" }
+
+        val output = TailOutputStream(progressTextMaxChars)
+        val result = try {
+            this.runTask(threadId, task, output)
+        } catch(x: Exception) {
+            logger.warn { "$threadId: ${x::class.jvmName} ${x.message}" }
+            StatusMessage(x)
+        }
+
+        val status = if( result.isOk ) Task.Status.Finished else Task.Status.Failed
+        (if( result.isOk ) this.finishedCount else this.failedCount).incrementAndGet()
+        logger.info { "$threadId: task '${task.name}' ${status.name.toLowerCase()} with code ${result.code}: ${result.msg}" }
+
+        try {
+            this.queue.finish(this.workerName, task.taskId!!, status, "${result.code}: ${result.msg}\n${output.getString()}")
+        } catch(x: Exception) {
+            logger.error { "$threadId: failed to record the outcome of task ${task.taskId}: ${x.message}" }
+        }
+    }
+
+    fun stats(): Map<String, Any> =
+        linkedMapOf(
+              "workerName"    to this.workerName
+            , "threads"       to this.threads
+            , "runningTasks"  to this.threads - this.freeThreads.availablePermits()
+            , "claimedCount"  to this.claimedCount.get()
+            , "finishedCount" to this.finishedCount.get()
+            , "failedCount"   to this.failedCount.get()
+        )
+
+
+    /** Keeps the last [maxChars] of the task output, for tasks.progress_text */
+    private class TailOutputStream(private val maxChars: Int): OutputStream() {
+        private val buffer = StringBuilder()
+
+        override fun write(b: Int) = this.write(byteArrayOf(b.toByte()), 0, 1)
+
+        override fun write(b: ByteArray, off: Int, len: Int) {
+            this.buffer.append(String(b, off, len, config.charSet))
+            if( this.buffer.length > 2*this.maxChars )
+                this.buffer.delete(0, this.buffer.length - this.maxChars)
+        }
+
+        fun getString(): String = this.buffer.takeLast(this.maxChars).toString()
+    }
+
+
+    /** The tasks table */
+    object DbQueue: Queue {
+        private val claimSql = """
+            select task_id, task_name, script_asset_id, target_asset_id, executor_role_name, script_args
+              from tasks
+             where task_status = 'Ready' and scheduled_run_ts <= current_timestamp
+             order by scheduled_run_ts
+             limit ?
+               for update skip locked
+            """.trimIndent()
+
+        private fun <R> inTransaction(body: (Connection) -> R): R =
+            databaseStore.getGoodConnection().use { conn ->
+                try {
+                    val r = body(conn)
+                    conn.commit()
+                    r
+                } catch(x: Exception) {
+                    conn.rollback()
+                    throw x
+                }
+            }
+
+        override fun claim(workerName: String, limit: Int): List<Task> = inTransaction { conn ->
+            val tasks = conn.prepareStatement(claimSql).use { stmt ->
+                stmt.setInt(1, limit)
+                stmt.executeQuery().use { rs ->
+                    val list = mutableListOf<Task>()
+                    while( rs.next() )
+                        list.add(Task().also {
+                            it.taskId           = bytesToUuid(rs.getBytes(1))
+                            it.name             = rs.getString(2)
+                            it.scriptAssetId    = bytesToUuid(rs.getBytes(3))
+                            it.targetAssetId    = bytesToUuid(rs.getBytes(4))
+                            it.executorRoleName = rs.getString(5)
+                            it.scriptArgs       = rs.getString(6)
+                        })
+                    list
+                }
+            }
+
+            if( tasks.isNotEmpty() ) {
+                val sql = """
+                    update tasks
+                       set task_status = 'Processing', task_status_ts = current_timestamp, started_ts = current_timestamp,
+                           execute_worker = ?, progress_curr = 0, progress_total = 1, modified_ts = current_timestamp
+                     where task_id in (${tasks.joinToString(", ") { "?" }})
+                    """.trimIndent()
+                conn.prepareStatement(sql).use { stmt ->
+                    stmt.setString(1, workerName)
+                    tasks.forEachIndexed { k, task -> stmt.setBytes(k+2, uuidToBytes(task.taskId)) }
+                    stmt.executeUpdate()
+                }
+            }
+            tasks
+        }
+
+        override fun finish(workerName: String, taskId: UUID, status: Task.Status, progressText: String) = inTransaction { conn ->
+            val sql = """
+                update tasks
+                   set task_status = ?, task_status_ts = current_timestamp, finished_ts = current_timestamp,
+                       progress_curr = 1, progress_text = ?, modified_ts = current_timestamp
+                 where task_id = ? and execute_worker = ?
+                """.trimIndent()
+            conn.prepareStatement(sql).use { stmt ->
+                stmt.setString(1, status.name)
+                stmt.setString(2, progressText)
+                stmt.setBytes(3, uuidToBytes(taskId))
+                stmt.setString(4, workerName)
+                stmt.executeUpdate()
+            }
+            Unit
+        }
+
+        override fun failAbandoned(workerName: String): Int = inTransaction { conn ->
+            val sql = """
+                update tasks
+                   set task_status = 'Failed', task_status_ts = current_timestamp, finished_ts = current_timestamp,
+                       progress_text = 'abandoned: the worker restarted', modified_ts = current_timestamp
+                 where task_status = 'Processing' and execute_worker = ?
+                """.trimIndent()
+            conn.prepareStatement(sql).use { stmt ->
+                stmt.setString(1, workerName)
+                stmt.executeUpdate()
+            }
+        }
+    }
+
+    companion object {
+        private const val progressTextMaxChars = 64 * 1024
+
+        /** Run the task script on its target, the same way as POST /executes does */
+        fun runScriptTask(threadId: String, task: Task, outputStream: OutputStream): StatusMessage {
+            val script = fromDB<Script>(task.scriptAssetId.toString(), RoleName.Script)
+            val targetAsset = catalogCache.getAssetById(task.targetAssetId!!)
+            val target = Execute.getScriptExecutorImplementation(threadId, task.executorRoleName ?: RoleName.ScriptExecutorSSH, targetAsset)
+            return ScriptExecutor(threadId).run(script, target, outputStream)
+        }
+    }
+}
@@ -4,25 +4,34 @@ import com.amcentral365.service.builtins.roles.ExecutionTarget
 import com.amcentral365.service.builtins.roles.Script
 import com.amcentral365.service.builtins.roles.ScriptLocation
 import com.google.common.base.Preconditions
+import com.google.common.hash.Hashing
 import mu.KotlinLogging
+import java.io.BufferedOutputStream
 import java.io.ByteArrayInputStream
 import java.io.File
 import java.io.FileInputStream
+import java.io.FileOutputStream
 import java.io.InputStream
-import java.net.HttpURLConnection
+import java.io.OutputStream
 import java.net.URL
+import java.nio.file.Files
 import java.security.SecureRandom
 import kotlin.math.abs
 
 
 private val logger = KotlinLogging.logger {}
 
+private val transferDuration = metrics.histogram("amc_script_transfer_duration_seconds",
+        "Time to transfer script files to targets", Metrics.DEFAULT_SECONDS_BUCKETS, "receiver", "outcome")
+private val transferredItems = metrics.counter("amc_script_transfer_items_total", "Script files and directories transferred", "receiver")
+
 class TransferManager(private val threadId: String) {
     data class Item(
             val pathStr:      String,
             val inputStream:  InputStream? = null,
             val isDirectory:  Boolean = false,
-            val verifyPathExists: Boolean = false
+            val verifyPathExists: Boolean = false,
+            val permissions:  Int? = null         // POSIX mode bits of the source file, when known
     )
 
     abstract class Sender {
@@ -30,6 +39,12 @@ class TransferManager(private val threadId: String) {
         open fun end(successful: Boolean) {}
 
         abstract fun getIterator(): Iterator<Item>
+
+        /**
+         * Identifies the version of the items from metadata the sender has, without reading the file content, or
+         * null when there is no such metadata. Differs whenever the items may differ, see [ScriptStaging].
+         */
+        open fun versionKey(): String? = null
     }
 
     abstract class Receiver(val script: Script) {
@@ -37,6 +52,9 @@ class TransferManager(private val threadId: String) {
         open fun end(successful: Boolean) {}
 
         abstract fun apply(item: Item)
+
+        /** Called after the last item was applied. Unlike [end], a failure here fails the transfer. */
+        open fun finish() {}
     }
 
     private fun safeExec(blockName: String, block: () -> Unit): Boolean {
@@ -58,11 +76,16 @@ class TransferManager(private val threadId: String) {
             return false
         }
 
+        val beg = System.nanoTime()
+        val receiverName = receiver::class.simpleName ?: "anonymous"
+        var itemCount = 0L
         var success = true
         try {
             sender.getIterator().forEach { item ->
                 receiver.apply(item)
+                itemCount++
             }
+            receiver.finish()
 
         } catch(x: Exception) {
             logger.warn(x) { "$threadId: ${x::class.qualifiedName}, ${x.message}" }
@@ -71,6 +94,8 @@ class TransferManager(private val threadId: String) {
         } finally {
             safeExec("receiver.end()") { receiver.end(success) }
             safeExec("sender.end()") { sender.end(success) }
+            transferDuration.observe((System.nanoTime() - beg) / 1e9, receiverName, if( success ) "ok" else "failed")
+            transferredItems.add(itemCount, receiverName)
         }
 
         return success
@@ -81,6 +106,7 @@ class TransferManager(private val threadId: String) {
 
 class SenderOfMain: TransferManager.Sender() {
     override fun getIterator(): Iterator<TransferManager.Item> = emptyList<TransferManager.Item>().iterator()
+    override fun versionKey() = ""
 }
 
 
@@ -88,44 +114,35 @@ class SenderOfInlineContent(private val content: String): TransferManager.Sender
     override fun getIterator(): Iterator<TransferManager.Item> = listOf(
             TransferManager.Item(pathStr = "", inputStream = ByteArrayInputStream(content.toByteArray(config.charSet)))
         ).iterator()
+
+    override fun versionKey() = this.content
 }
 
-class SenderOfHttp(val url: String, val fileName: String? = null): TransferManager.Sender() {
+/**
+ * An HTTP(s) get through the [ArtifactCache]: the file is only downloaded when it changed.
+ *
+ * @param version identifies the content when the url doesn't, see [ArtifactCache.open]
+ * @param immutable the content of the url and version never changes, so the cached copy isn't revalidated
+ * @param cache defaults to the global [artifactCache]
+ */
+class SenderOfHttp(
+        val url: String,
+        val fileName: String? = null,
+        val version: String? = null,
+        val immutable: Boolean = false,
+        private val cache: ArtifactCache? = null
+): TransferManager.Sender() {
+    private val filename get() = this.fileName ?: File(URL(this.url).path).toPath().fileName.toString()
+
     override fun getIterator(): Iterator<TransferManager.Item> {
-        val uurl = URL(url)
-        val filename = this.fileName ?: File(uurl.path).toPath().fileName.toString()
-        val stream = this.openStreamFollowingRedirects(uurl)
-        val item = TransferManager.Item(pathStr = filename, inputStream = stream)
+        val stream = (this.cache ?: artifactCache).open(this.url, this.version, this.immutable)
+        val item = TransferManager.Item(pathStr = this.filename, inputStream = stream)
         return listOf(item).iterator()
     }
 
-    val redirectCodes = listOf(307, HttpURLConnection.HTTP_MOVED_PERM, HttpURLConnection.HTTP_MOVED_TEMP, HttpURLConnection.HTTP_SEE_OTHER)
-
-    private fun openStreamFollowingRedirects(url: URL): InputStream {
-        var currUrl = url
-        var cookies: String? = null
-        for(unused in 0..config.httpMaxRedirects) {
-            val conn = currUrl.openConnection()
-            conn.connectTimeout = config.httpConnectTimeoutMsec
-            conn.readTimeout    = config.httpReadTimeoutMsec
-            (conn as? HttpURLConnection)?.instanceFollowRedirects = false
-            if( cookies != null )
-                conn.setRequestProperty("Cookie", cookies)
-
-            if(conn is HttpURLConnection && conn.responseCode in this.redirectCodes) {
-                cookies = conn.getHeaderField("Set-Cookie");
-                val loc = conn.getHeaderField("Location")
-                currUrl = URL(currUrl, loc)
-                logger.info { "redirecting to $currUrl" }
-                continue
-            }
-
-            logger.info { "streaming from $currUrl" }
-            return conn.getInputStream()
-        }
-
-        throw StatusException(417, "the URL redirects more than --http-max-redirects (${config.httpMaxRedirects}) times: $url")
-    }
+    /** The file name and the hash of the cached copy. Only a changed file is downloaded, to the cache. */
+    override fun versionKey() =
+        "${this.filename}\u0000${(this.cache ?: artifactCache).contentHash(this.url, this.version, this.immutable)}"
 }
 
 /**
@@ -136,7 +153,11 @@ class SenderOfHttp(val url: String, val fileName: String? = null): TransferManag
  *   https://repository.sonatype.org/service/local/artifact/maven/redirect?r=public&g=org.mockito&a=mockito-core&v=1.8.5
  */
 class SenderOfNexus(val loc: ScriptLocation.Nexus): TransferManager.Sender() {
-    override fun getIterator(): Iterator<TransferManager.Item> {
+    override fun getIterator(): Iterator<TransferManager.Item> = this.httpSender().getIterator()
+
+    override fun versionKey() = this.httpSender().versionKey()
+
+    private fun httpSender(): SenderOfHttp {
         var urlStr = "${loc.baseUrl}/artifact/maven/redirect?r=${loc.repository}&g=${loc.group}&a=${loc.artifact}&v=${loc.version}"
         if( !loc.classifier.isNullOrBlank() ) urlStr += "&c=${loc.classifier}"
         if( !loc.packaging.isNullOrBlank() ) urlStr += "&p=${loc.packaging}"
@@ -146,8 +167,11 @@ class SenderOfNexus(val loc: ScriptLocation.Nexus): TransferManager.Sender() {
         val filename = "${loc.artifact}-${loc.version}$classifier.${loc.packaging ?: "jar"}"
         // TODO: where does loc.extension belong?
 
+        // released versions never change, snapshots and the LATEST/RELEASE aliases are revalidated
+        val immutable = !loc.version.endsWith("-SNAPSHOT") && loc.version !in listOf("LATEST", "RELEASE")
+
         logger.info { "retrieving file $filename for Nexus URL $urlStr" }
-        return SenderOfHttp(urlStr, filename).getIterator()
+        return SenderOfHttp(urlStr, filename, loc.version, immutable)
     }
 }
 
@@ -167,15 +191,34 @@ class SenderOfLocalPath(pathStr: String): TransferManager.Sender() {
                 TransferManager.Item(pathStr = relativePathStr, isDirectory = true)
             else {
                 val inputStream = FileInputStream(file)
-                TransferManager.Item(pathStr = relativePathStr, isDirectory = false, inputStream = inputStream)
+                TransferManager.Item(pathStr = relativePathStr, isDirectory = false, inputStream = inputStream,
+                                     permissions = posixPermissions(file))
             }
         }
         return seq.iterator()
     }
+
+    /** Paths, sizes, modification times and permissions of the files */
+    override fun versionKey(): String {
+        val hasher = Hashing.sha256().newHasher()
+        File(this.basePath).walkTopDown().forEach { file ->
+            hasher.putString(file.path, Charsets.UTF_8).putByte(0).putBoolean(file.isDirectory)
+            if( file.isFile )
+                hasher.putLong(file.length()).putLong(file.lastModified()).putInt(posixPermissions(file) ?: -1)
+        }
+        return hasher.hash().toString()
+    }
+
+    private fun posixPermissions(file: File): Int? =
+        try {
+            Files.getPosixFilePermissions(file.toPath()).map { 1 shl (8 - it.ordinal) }.sum()
+        } catch(x: UnsupportedOperationException) {
+            null
+        }
 }
 
 
-class ReceiverHost(script: Script, private val targetHost: ExecutionTarget): TransferManager.Receiver(script) {
+open class ReceiverHost(script: Script, private val targetHost: ExecutionTarget): TransferManager.Receiver(script) {
     private var fileCount = 0
 
     companion object {
@@ -186,11 +229,28 @@ class ReceiverHost(script: Script, private val targetHost: ExecutionTarget): Tra
                 middle = 0
             return prefix + abs(middle) + suffix
         }
+
+        const val S_IXUSR = 1 shl 6
+    }
+
+    protected open fun exists(pathStr: String): Boolean = this.targetHost.exists(pathStr)
+
+    protected open fun createDirectories(dirPath: String) = this.targetHost.createDirectories(dirPath)
+
+    protected open fun copyExecutableFile(contentStream: InputStream, fileName: String) {
+        this.targetHost.copyExecutableFile(contentStream, fileName)
+    }
+
+    protected open fun copyFile(contentStream: InputStream, fileName: String, permissions: Int?) {
+        if( permissions != null && (permissions and S_IXUSR) != 0 )
+            this.targetHost.copyExecutableFile(contentStream, fileName)
+        else
+            this.targetHost.copyFile(contentStream, fileName)
     }
 
     override fun apply(item: TransferManager.Item) {
         if( item.verifyPathExists ) {
-            if( !this.targetHost.exists(item.pathStr) )
+            if( !this.exists(item.pathStr) )
                 throw StatusException(404, "Path ${item.pathStr} does not exist on the host")
 
         // When path is a directory, create it and all parent directories on the way
@@ -203,7 +263,7 @@ class ReceiverHost(script: Script, private val targetHost: ExecutionTarget): Tra
                 throw StatusException(412, "Absolute paths are not allowed: ${item.pathStr}")
 
             logger.debug { "Creating directory path ${dirToCreate.path}" }
-            this.targetHost.createDirectories(dirToCreate.path)
+            this.createDirectories(dirToCreate.path)
 
         // When there is no path, we read inputStream into inline content
         } else if( item.pathStr.isBlank() ) {
@@ -214,7 +274,7 @@ class ReceiverHost(script: Script, private val targetHost: ExecutionTarget): Tra
             if( item.inputStream == null )
                 throw StatusException(412, "The path is empty and there is no input")
             val contentFileName = genTempFileName("amc_", "")
-            targetHost.copyExecutableFile(item.inputStream, contentFileName)
+            this.copyExecutableFile(item.inputStream, contentFileName)
             this.script.assignMain(contentFileName)
 
         // Create a file and write inputStream into it
@@ -233,9 +293,82 @@ class ReceiverHost(script: Script, private val targetHost: ExecutionTarget): Tra
 
             logger.debug { "writing ${relFile.path}" }
 
-            targetHost.copyFile(item.inputStream, relFile.path)
+            this.copyFile(item.inputStream, relFile.path, item.permissions)
             logger.debug { "done" }
             this.fileCount++
         }
     }
 }
+
+
+/**
+ * Packs the items into one tar stream and unpacks it on the target with a single command, instead of a remote
+ * round trip for each directory and file. Falls back to the per-item copies of [ReceiverHost] when the target
+ * can't unpack archives.
+ *
+ * The archive is spooled to a temporary file. Each file is first copied to a temporary file of its own to learn
+ * its size for the tar header, so no file is held in memory.
+ */
+class ReceiverHostArchive(script: Script, private val targetHost: ExecutionTarget): ReceiverHost(script, targetHost) {
+    private var spoolFile: File? = null
+    private var spoolStream: OutputStream? = null
+    private var tar: TarArchiveWriter? = null
+    private val packedPaths = mutableSetOf<String>()
+
+    override fun begin() {
+        if( !this.targetHost.canUnpackArchives() ) {
+            logger.info { "${this.targetHost.threadId}: ${this.targetHost.asset?.name} can't unpack archives, copying files one by one" }
+            return
+        }
+
+        val file = File.createTempFile("amc-transfer-", ".tar")
+        this.spoolFile = file
+        this.spoolStream = BufferedOutputStream(FileOutputStream(file)).also { this.tar = TarArchiveWriter(it) }
+    }
+
+    override fun exists(pathStr: String): Boolean =
+        File(pathStr).normalize().path in this.packedPaths || super.exists(pathStr)
+
+    override fun createDirectories(dirPath: String) {
+        val tar = this.tar ?: return super.createDirectories(dirPath)
+        tar.addDirectory(dirPath)
+        this.packedPaths.add(File(dirPath).normalize().path)
+    }
+
+    override fun copyExecutableFile(contentStream: InputStream, fileName: String) {
+        if( this.tar == null )
+            return super.copyExecutableFile(contentStream, fileName)
+        this.pack(contentStream, fileName, 0b111_100_100)
+    }
+
+    override fun copyFile(contentStream: InputStream, fileName: String, permissions: Int?) {
+        if( this.tar == null )
+            return super.copyFile(contentStream, fileName, permissions)
+        this.pack(contentStream, fileName, permissions ?: 0b110_100_100)
+    }
+
+    /** The tar header needs the size up front: the content is spooled to a file first, rather than to the heap */
+    private fun pack(contentStream: InputStream, fileName: String, mode: Int) {
+        val entryFile = File.createTempFile("amc-transfer-", ".entry")
+        try {
+            contentStream.use { input -> entryFile.outputStream().use { input.copyTo(it) } }
+            FileInputStream(entryFile).use { this.tar!!.addFile(fileName, entryFile.length(), it, mode) }
+        } finally {
+            entryFile.delete()
+        }
+        this.packedPaths.add(File(fileName).normalize().path)
+    }
+
+    override fun finish() {
+        val tar = this.tar ?: return
+        tar.close()
+        this.spoolStream!!.close()
+        logger.debug { "${this.targetHost.threadId}: unpacking ${this.packedPaths.size} items, ${this.spoolFile!!.length()} bytes" }
+        FileInputStream(this.spoolFile!!).use { this.targetHost.unpackArchive(it) }
+    }
+
+    override fun end(successful: Boolean) {
+        this.spoolStream?.close()
+        this.spoolFile?.delete()
+    }
+}
@@ -1,72 +1,216 @@
 package com.amcentral365.service
 
+import com.google.common.hash.Hashing
 import com.google.gson.JsonElement
 import com.google.gson.JsonObject
 import com.google.gson.JsonParser
 import mu.KotlinLogging
 import java.io.File
+import java.io.IOException
+import java.io.InputStream
 import java.net.URL
+import java.util.ArrayDeque
 import java.util.Base64
+import java.util.concurrent.Callable
+import java.util.concurrent.CompletableFuture
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.ExecutionException
+import java.util.concurrent.ExecutorService
+import java.util.concurrent.Executors
+import java.util.concurrent.Future
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
 import java.util.regex.Pattern
 
 private val logger = KotlinLogging.logger {}
 
-class SenderOfGitHub(url: String, translate: Boolean = true): TransferManager.Sender() {
+/**
+ * Walks a GitHub file or directory with the contents API.
+ *
+ * Listings and files go through the [ArtifactCache]: listings are revalidated with their ETag, and files are
+ * cached by their git blob sha, so an unchanged file is not downloaded again.
+ *
+ * Fetches are pipelined on [threads] threads: listings of subdirectories are requested as soon as their parent
+ * is listed, and up to [prefetch] files ahead of the receiver are downloaded while it consumes the current one.
+ * Items are still returned in the depth-first order of the listings.
+ *
+ * @param translate convert a browser URL to the contents API URL, see [translateUrlToApi]
+ */
+class SenderOfGitHub(
+        url: String,
+        translate: Boolean = true,
+        private val cache: ArtifactCache? = null,
+        private val threads: Int? = null,
+        private val prefetch: Int? = null
+): TransferManager.Sender() {
     val topUrl: URL
     val prefixToStrip: String
 
+    private var executor: ExecutorService? = null
+    private var prefetcher: Prefetcher? = null
+    private val unconsumed: MutableSet<InputStream> = ConcurrentHashMap.newKeySet()  // fetched, not handed to the receiver
+    @Volatile private var closed = false
+
     init {
-        this.topUrl = translateUrlToApi(URL(url))
+        this.topUrl = if( translate ) translateUrlToApi(URL(url)) else URL(url)
         val path = File(this.topUrl.path).toPath()
         // repos/am-central-365/scripts/contents/am-central-365.com/test/with-dirs/folder-a
         //     0              1       2        3 ------------- strip --------------
         this.prefixToStrip = if( path.nameCount <= 4 ) "" else path.subpath(4, path.nameCount-1).toString() + "/"
     }
 
-    override fun getIterator(): Iterator<TransferManager.Item> = openSequence(this.topUrl).iterator()
+    override fun getIterator(): Iterator<TransferManager.Item> {
+        val threadCount = this.threads ?: config.githubFetchThreads
+        val executor = Executors.newFixedThreadPool(threadCount) { r ->
+            Thread(r, "github-fetch-${threadNo.incrementAndGet()}").also { it.isDaemon = true }
+        }
+        this.executor = executor
+        this.closed = false
+
+        val topListing = executor.submit(Callable { this.loadJsonFromUrl(this.topUrl) })
+        val items = this.walk(executor, topListing).iterator()
+        return Prefetcher(items, this.prefetch ?: 2*threadCount) { item -> item.inputStream?.let { this.unconsumed.remove(it) } }
+            .also { this.prefetcher = it }
+    }
+
+    /**
+     * Stop the prefetcher first, so no more fetches start, then wait for the running ones. The streams fetched,
+     * but not handed to the receiver, are closed, including those of the fetches finishing after this returns.
+     */
+    override fun end(successful: Boolean) {
+        this.closed = true
+        this.prefetcher?.close()
+        this.executor?.let { executor ->
+            executor.shutdown()
+            if( !executor.awaitTermination(FETCH_TERMINATION_WAIT_SEC, TimeUnit.SECONDS) )
+                logger.warn { "fetches of ${this.topUrl} are still running, their files are closed as they finish" }
+        }
+        this.unconsumed.toList().forEach { stream ->
+            if( this.unconsumed.remove(stream) )
+                closeQuietly(stream)
+        }
+    }
 
-    private fun openSequence(url: URL): Sequence<TransferManager.Item> {
-        val elm = loadJsonFromUrl(url)
-        return sequence {
-            val objs = listObjectsInElement(elm)
-            objs.forEach {
-                yieldAll( readObject(it) )
+    /** Track the stream of a fetched [item] until the receiver gets it. Fetches finishing after [end] close it. */
+    private fun fetched(item: TransferManager.Item?): TransferManager.Item? {
+        val stream = item?.inputStream ?: return item
+        this.unconsumed.add(stream)
+        if( this.closed && this.unconsumed.remove(stream) )     // after adding: either end() or this closes it
+            closeQuietly(stream)
+        return item
+    }
+
+    /**
+     * Paths and git blob shas of the files, from the listings alone. The listings are revalidated with their ETag,
+     * so an unchanged directory costs conditional GETs and no file downloads. Null if a file has no sha.
+     */
+    override fun versionKey(): String? {
+        val hasher = Hashing.sha256().newHasher()
+        val pending = ArrayDeque<URL>(listOf(this.topUrl))
+        while( pending.isNotEmpty() ) {
+            listObjectsInElement(this.loadJsonFromUrl(pending.poll())).forEach { obj ->
+                val type = obj["type"]?.asString
+                val sha = obj["sha"]?.takeUnless { it.isJsonNull }?.asString
+                if( type == "file" && sha == null )
+                    return null
+                if( type == "dir" )
+                    pending.add(URL(obj["url"].asString))
+                hasher.putString("$type ${obj["path"]?.asString} $sha\n", Charsets.UTF_8)
             }
         }
+        return hasher.hash().toString()
     }
 
-    private fun loadJsonFromUrl(url: URL): JsonElement = JsonParser().parse(url.readText())
+    /** Depth-first: the items of a listing, each directory followed by its content */
+    private fun walk(executor: ExecutorService, listing: Future<JsonElement>): Sequence<Future<TransferManager.Item?>> = sequence {
+        val objs = listObjectsInElement(getResult(listing))
 
-    private fun listObjectsInElement(elm: JsonElement): List<JsonObject> {
-        if( elm.isJsonObject )
-            return listOf(elm.asJsonObject)
-        if( elm.isJsonArray )
-            return elm.asJsonArray.map { e -> e.asJsonObject }.toList()
-        logger.warn { "unsupported Json element type, expected JsonObject or JsonArray" }
-        return emptyList()
+        val subListings = objs.filter { it["type"]?.asString == "dir" }.associateWith { obj ->
+            executor.submit(Callable { loadJsonFromUrl(URL(obj["url"].asString)) })
+        }
+
+        objs.forEach { obj ->
+            when( val type = obj["type"]?.asString ) {
+                "file" -> yield(executor.submit(Callable { fetched(readFile(obj)) }))
+                "dir"  -> {
+                    yield(CompletableFuture.completedFuture<TransferManager.Item?>(
+                            TransferManager.Item(pathStr = getMassagedPath(obj), isDirectory = true)))
+                    yieldAll(walk(executor, subListings.getValue(obj)))
+                }
+                else -> logger.warn { "unsupported Github object type: '$type'. Expected 'file' or 'dir'" }
+            }
+        }
     }
 
-    private fun readObject(jsonObj: JsonObject): Sequence<TransferManager.Item> {
-        val type = jsonObj["type"]?.asString
-        if( type == "file" ) {
-            val item = readFile(jsonObj)
-            if( item == null )
-                return emptySequence()
-            return sequence<TransferManager.Item> { yield(item) }
+    /**
+     * Keeps up to [window] fetches running ahead of the consumer and returns their items in order.
+     * Fetches yielding null, e.g. malformed elements, are skipped. [consumed] is called with each returned item.
+     */
+    private class Prefetcher(
+            private val source: Iterator<Future<TransferManager.Item?>>,
+            private val window: Int,
+            private val consumed: (TransferManager.Item) -> Unit
+    ): Iterator<TransferManager.Item> {
+        private val ahead = ArrayDeque<Future<TransferManager.Item?>>()
+        private var nextItem: TransferManager.Item? = null
+        private var closed = false
+
+        override fun hasNext(): Boolean {
+            while( this.nextItem == null ) {
+                if( this.closed )
+                    return false
+                while( this.ahead.size < this.window && this.source.hasNext() )
+                    this.ahead.add(this.source.next())
+                val future = this.ahead.pollFirst() ?: return false
+                this.nextItem = getResult(future)
+            }
+            return true
         }
 
-        if( type != "dir" ) {
-            logger.warn { "unsupported Github object type: '$type'. Expected 'file' or 'dir'" }
-            return emptySequence()
+        override fun next(): TransferManager.Item {
+            if( !this.hasNext() )
+                throw NoSuchElementException()
+            return this.nextItem!!.also { this.nextItem = null;  this.consumed(it) }
         }
 
-        val url = URL(jsonObj["url"].asString)
-        return sequence {
-            yield(TransferManager.Item(pathStr = getMassagedPath(jsonObj), isDirectory = true))
-            yieldAll(openSequence(url))
+        /** Stop taking fetches from the source and cancel the queued ones. Their streams are closed by the sender. */
+        fun close() {
+            this.closed = true
+            this.ahead.forEach { it.cancel(true) }
+            this.ahead.clear()
+            this.nextItem = null
         }
     }
 
+    companion object {
+        private val threadNo = AtomicInteger()
+        private const val FETCH_TERMINATION_WAIT_SEC = 30L
+
+        private fun closeQuietly(stream: InputStream) =
+            try { stream.close() } catch(x: IOException) {}
+
+        private fun <T> getResult(future: Future<T>): T =
+            try {
+                future.get()
+            } catch(x: ExecutionException) {
+                throw x.cause ?: x
+            }
+    }
+
+    private val artifacts: ArtifactCache get() = this.cache ?: artifactCache
+
+    private fun loadJsonFromUrl(url: URL): JsonElement =
+        this.artifacts.open(url.toString()).reader(Charsets.UTF_8).use { JsonParser().parse(it) }
+
+    private fun listObjectsInElement(elm: JsonElement): List<JsonObject> {
+        if( elm.isJsonObject )
+            return listOf(elm.asJsonObject)
+        if( elm.isJsonArray )
+            return elm.asJsonArray.map { e -> e.asJsonObject }.toList()
+        logger.warn { "unsupported Json element type, expected JsonObject or JsonArray" }
+        return emptyList()
+    }
+
     private fun getMassagedPath(jsonObj: JsonObject) =
         jsonObj["path"].asString.removePrefix(this.prefixToStrip)
 
@@ -100,8 +244,9 @@ class SenderOfGitHub(url: String, translate: Boolean = true): TransferManager.Se
             return null
         }
 
-        val url = URL(urlElm.asString)
-        val stream = url.openStream()
+        // a blob with the same sha has the same content
+        val sha = jsonObj["sha"]?.takeUnless { it.isJsonNull }?.asString
+        val stream = this.artifacts.open(urlElm.asString, sha, immutable = sha != null)
         return TransferManager.Item(pathStr = filepath, inputStream = stream)
     }
 
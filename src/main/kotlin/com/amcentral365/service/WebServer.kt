@@ -17,15 +17,27 @@ import com.amcentral365.pl4kotlin.closeIfCan
 
 import com.amcentral365.service.api.Execute
 import com.amcentral365.service.api.Tasks
+import com.amcentral365.service.api.catalog.AssetImport
+import com.amcentral365.service.api.catalog.AssetRoleValues
 import com.amcentral365.service.api.catalog.Assets
 import com.amcentral365.service.api.catalog.Roles
 
+import com.amcentral365.service.dao.Asset
+import com.amcentral365.service.dao.AssetRoleValues as AssetRoleValuesDAO
 import com.amcentral365.service.dao.Meta
 import com.amcentral365.service.dao.Role
 
 
 class WebServer {
-    companion object: KLogging()
+    companion object: KLogging() {
+        private const val REQUEST_START_ATTR = "amc.requestStartNanos"
+
+        private val collectionsWithIds = setOf("roles", "assets", "executes")
+        private val fixedSegments = setOf("fanout")
+
+        private val requestDuration = metrics.histogram("amc_http_request_duration_seconds",
+                "Time to serve HTTP requests", Metrics.DEFAULT_SECONDS_BUCKETS, "method", "route", "status")
+    }
 
     private val API_BASE = "/v0.1"   // must match servers.url in src/main/resources/swagger/amcentral365.yml
 
@@ -39,6 +51,15 @@ class WebServer {
             spark.Spark.staticFiles.location("swagger")
 
         handleCORS()
+        handleMetrics()
+
+        // e.g. 503 when no database connection became available in time
+        spark.Spark.exception(StatusException::class.java) { x, _, rsp ->
+            if( x.code == 503 )
+                rsp.header("Retry-After", "1")
+            rsp.type("application/json")
+            rsp.body(formatResponse(rsp, x))
+        }
 
         // TODO: Always gzip responses
         // spark.Spark.after("*", fun(_: Request, rsp: Response) = rsp.header("Content-Encoding", "gzip"))
@@ -61,12 +82,22 @@ class WebServer {
             spark.Spark.delete("$apiBaseForAdminData/$tn", fun(req, rsp) = this.restCallForPersistentObject(req, rsp, it))
         }
 
+        spark.Spark.get("$API_BASE/admin/schemaCache") { _, rsp -> this.getSchemaCacheStats(rsp) }
+        spark.Spark.get("$API_BASE/admin/sshPool")     { _, rsp -> this.getSshPoolStats(rsp) }
+        spark.Spark.get("$API_BASE/admin/tasks")       { _, rsp -> this.getTaskDispatcherStats(rsp) }
+        spark.Spark.get("$API_BASE/admin/artifacts")   { _, rsp -> this.getArtifactCacheStats(rsp) }
+        spark.Spark.get("$API_BASE/admin/dbPool")      { _, rsp -> this.getDbPoolStats(rsp) }
+        spark.Spark.post("$API_BASE/admin/attrIndex")  { _, rsp -> this.rebuildAttrIndex(rsp) }
+
         spark.Spark.get   ("$API_BASE/catalog/roles",           fun(req, rsp) = Roles.listRoles(req, rsp))
         spark.Spark.post  ("$API_BASE/catalog/roles",           fun(req, rsp) = Roles.createRole(req, rsp))
         spark.Spark.get   ("$API_BASE/catalog/roles/:roleName", fun(req, rsp) = Roles.listRoles(req, rsp))
         spark.Spark.post  ("$API_BASE/catalog/roles/:roleName", fun(req, rsp) = Roles.updateRole(req, rsp))
         spark.Spark.delete("$API_BASE/catalog/roles/:roleName", fun(req, rsp) = Roles.deleteRole(req, rsp))
 
+        spark.Spark.post("$API_BASE/catalog/assetRoles/lookup", fun(req, rsp) = AssetRoleValues.lookup(req, rsp))
+        spark.Spark.post("$API_BASE/catalog/import/assets",     fun(req, rsp) = AssetImport.importAssets(req, rsp))
+
         spark.Spark.get("$API_BASE/catalog/assets",                            fun(req, rsp) = Assets.listAssets(req, rsp))
         spark.Spark.get("$API_BASE/catalog/assets/:assetKey",                  fun(req, rsp) = Assets.getAssetById(req, rsp))
         spark.Spark.get("$API_BASE/catalog/assets/:assetKey/roles",            fun(req, rsp) = Assets.listAssetRoles(req, rsp))
@@ -83,6 +114,7 @@ class WebServer {
 
         spark.Spark.get ("$API_BASE/executes",                   fun(req, rsp) = Execute.list(req, rsp))
         spark.Spark.post("$API_BASE/executes",                   fun(req, rsp) = Execute.start(req, rsp))
+        spark.Spark.post("$API_BASE/executes/fanout",            fun(req, rsp) = Execute.fanOut(req, rsp))
         spark.Spark.get ("$API_BASE/executes/:executeId",        fun(req, rsp) = Execute.getInfo(req, rsp))
         spark.Spark.get ("$API_BASE/executes/:executeId/log",    fun(req, rsp) = Execute.getLog(req, rsp))
         spark.Spark.get ("$API_BASE/executes/:executeId/output", fun(req, rsp) = Execute.getOutput(req, rsp))
@@ -91,6 +123,36 @@ class WebServer {
         spark.Spark.post("$API_BASE/tasks",                   fun(req, rsp) = Tasks.submit(req, rsp))
     }
 
+    private fun handleMetrics() {
+        // Prometheus scrapes /metrics by default, so it is outside of API_BASE
+        spark.Spark.get("/metrics") { _, rsp -> this.getMetrics(rsp) }
+
+        spark.Spark.before { req, _ -> req.attribute(REQUEST_START_ATTR, System.nanoTime()) }
+        spark.Spark.afterAfter { req, rsp ->
+            val beg = req.attribute<Long>(REQUEST_START_ATTR) ?: return@afterAfter
+            val status = rsp.raw().status
+            val route = if( status == 404 ) "unmatched" else this.routeLabel(req.pathInfo())
+            requestDuration.observe((System.nanoTime() - beg) / 1e9, req.requestMethod(), route, status.toString())
+        }
+    }
+
+    /**
+     * The request path with ids replaced by :param, e.g. /v0.1/catalog/assets/:param/roles.
+     * Keeps the number of label values bounded.
+     */
+    @VisibleForTesting
+    internal fun routeLabel(path: String): String {
+        if( path == "/metrics" )
+            return path
+        if( !path.startsWith("$API_BASE/") )
+            return "static"
+
+        val segments = path.removePrefix(API_BASE).trimEnd('/').split('/')
+        return API_BASE + segments.mapIndexed { k, segment ->
+            if( k > 0 && segments[k-1] in collectionsWithIds && segment !in fixedSegments ) ":param" else segment
+        }.joinToString("/")
+    }
+
     private fun handleCORS() {
         spark.Spark.after("*", fun(_: Request, rsp: Response) = rsp.header("Access-Control-Allow-Origin", "*"))
 
@@ -115,6 +177,52 @@ class WebServer {
     }
 
 
+    @VisibleForTesting
+    internal fun getSchemaCacheStats(rsp: Response): String {
+        rsp.type("application/json")
+        return gson.toJson(schemaUtils.cacheStats())
+    }
+
+    @VisibleForTesting
+    internal fun getSshPoolStats(rsp: Response): String {
+        rsp.type("application/json")
+        return gson.toJson(sshSessionPool.stats())
+    }
+
+    @VisibleForTesting
+    internal fun getTaskDispatcherStats(rsp: Response): String {
+        rsp.type("application/json")
+        return gson.toJson(taskDispatcher.stats())
+    }
+
+    @VisibleForTesting
+    internal fun getArtifactCacheStats(rsp: Response): String {
+        rsp.type("application/json")
+        return gson.toJson(artifactCache.stats())
+    }
+
+    @VisibleForTesting
+    internal fun getDbPoolStats(rsp: Response): String {
+        rsp.type("application/json")
+        return gson.toJson(databaseStore.stats())
+    }
+
+    @VisibleForTesting
+    internal fun rebuildAttrIndex(rsp: Response): String {
+        rsp.type("application/json")
+        return try {
+            gson.toJson(mapOf("reindexedCount" to AssetRoleValues.rebuildIndex()))
+        } catch(x: Exception) {
+            formatResponse(rsp, x)
+        }
+    }
+
+    @VisibleForTesting
+    internal fun getMetrics(rsp: Response): String {
+        rsp.type(Metrics.CONTENT_TYPE)
+        return metrics.render()
+    }
+
     @VisibleForTesting
     internal fun listDaoEntities() = gson.toJson(Meta.entities.map { Meta.tableName(it) })
 
@@ -130,6 +238,10 @@ class WebServer {
             val inputInstance: Entity = entityClass.primaryConstructor!!.call()
             inputInstance.assignFrom(paramMap)
 
+            if( method != "GET" && (inputInstance is Role || inputInstance is AssetRoleValuesDAO) )
+                return formatResponse(rsp, 405, "${inputInstance.tableName} can only be modified through the catalog API, " +
+                                                "which maintains the attribute index")
+
             when(method) {
                 "GET" -> {
                     val limit = paramMap.getOrDefault("limit", "0").toInt()
@@ -140,11 +252,13 @@ class WebServer {
 
                 "PUT", "POST" -> {
                     val msg = databaseStore.mergeObjectAsRow(inputInstance)
+                    this.invalidateCachesFor(inputInstance)
                     return formatResponse(rsp, msg)
                 }
 
                 "DELETE" -> {
                     val msg = databaseStore.deleteObjectRow(inputInstance)
+                    this.invalidateCachesFor(inputInstance)
                     return formatResponse(rsp, msg)
                 }
 
@@ -158,6 +272,15 @@ class WebServer {
     }
 
 
+    /**
+     * Admin Data API bypasses the catalog API, drop everything cached off the modified table.
+     * Roles and asset role values aren't modified here, see [restCallForPersistentObject].
+     */
+    private fun invalidateCachesFor(entity: Entity) {
+        if( entity is Asset )
+            catalogCache.invalidateAll()
+    }
+
     @VisibleForTesting
     internal fun restCallForRoles(req: Request, rsp: Response): String {
         rsp.type("application/json")
@@ -4,6 +4,12 @@ import com.amcentral365.pl4kotlin.Entity
 import com.google.gson.*
 import spark.Request
 import spark.Response
+import org.eclipse.jetty.server.Response as JettyResponse
+import javax.servlet.ServletResponse
+import javax.servlet.ServletResponseWrapper
+import java.io.BufferedWriter
+import java.io.OutputStreamWriter
+import java.util.Base64
 import java.util.TreeMap
 
 
@@ -118,10 +124,98 @@ internal fun combineRequestParams(req: Request, parseJsonBody: Boolean=false): T
 }
 
 
+/**
+ * Keyset pagination cursors.
+ *
+ * A listing page returns the cursor of the next page in the [NEXT_PAGE_HEADER] response header when the page is full.
+ * The client passes it back as the 'after' parameter. The cursor is opaque to the client, internally it is
+ * the last key of the page, base64-encoded.
+ */
+internal const val NEXT_PAGE_HEADER = "X-Next-After"
+
+internal fun encodePageCursor(lastKey: String): String =
+    Base64.getUrlEncoder().withoutPadding().encodeToString(lastKey.toByteArray(Charsets.UTF_8))
+
+internal fun decodePageCursor(cursor: String): String =
+    try {
+        String(Base64.getUrlDecoder().decode(cursor.trim()), Charsets.UTF_8)
+    } catch(x: IllegalArgumentException) {
+        throw StatusException(400, "parameter 'after' is not a valid page cursor: $cursor")
+    }
+
+
+private fun entityAsJson(ent: Entity, singleItemColumnName: String?): String =
+    if( singleItemColumnName == null )
+        ent.asJsonStr()
+    else
+        ent.allCols.first { it.columnName == singleItemColumnName }.asJsonValue()
+
 internal fun toJsonArray(lst: List<Entity>, singleItemColumnName: String? = null): String =
-    lst.joinToString(", ", prefix = "[", postfix = "]") { ent ->
-        if( singleItemColumnName == null )
-            ent.asJsonStr()
-        else
-            ent.allCols.first { it.columnName == singleItemColumnName }.asJsonValue()
+    lst.joinToString(", ", prefix = "[", postfix = "]") { ent -> entityAsJson(ent, singleItemColumnName) }
+
+
+/**
+ * Streaming of large listings.
+ *
+ * Rather than materializing the list and its JSON string, rows are written to the servlet output stream
+ * as they come from the JDBC cursor. Content-Length isn't known, so the container uses chunked transfer.
+ * With NDJSON each row is a separate line, otherwise the rows are wrapped into a JSON array.
+ */
+internal const val NDJSON_CONTENT_TYPE = "application/x-ndjson"
+private const val STREAM_FLUSH_EVERY_ROWS = 200
+
+/** Rows fetched from the database at a time by streamed listings, see [DatabaseStore.getStreamingConnection] */
+internal const val STREAM_FETCH_SIZE = 500
+
+/** The client asked for NDJSON with either 'Accept: application/x-ndjson' or the 'format=ndjson' parameter. */
+internal fun wantsNdjson(req: Request, paramMap: Map<String, String>): Boolean =
+    paramMap["format"].equals("ndjson", ignoreCase = true) || (req.headers("Accept") ?: "").contains(NDJSON_CONTENT_TYPE)
+
+/**
+ * Write [rows] straight into the response body.
+ *
+ * The first row is flushed immediately, the rest every [STREAM_FLUSH_EVERY_ROWS] rows.
+ * An error before anything was written is rethrown so the caller can respond normally. Once the status
+ * is committed that isn't possible anymore: the error is logged and the connection is aborted without ending
+ * the chunked body, so the client gets a transfer error rather than a body that looks complete.
+ *
+ * @return empty string for Spark to append to the already written body.
+ */
+internal fun streamJsonArray(rsp: Response, rows: Sequence<Entity>, ndjson: Boolean = false, singleItemColumnName: String? = null): String {
+    rsp.type(if( ndjson ) NDJSON_CONTENT_TYPE else "application/json")
+    val out = BufferedWriter(OutputStreamWriter(rsp.raw().outputStream, Charsets.UTF_8))
+    var rowCount = 0
+    try {
+        if( !ndjson ) out.write("[")
+        rows.forEach { ent ->
+            if( !ndjson && rowCount > 0 ) out.write(", ")
+            out.write(entityAsJson(ent, singleItemColumnName))
+            if( ndjson ) out.write("\n")
+            rowCount++
+            if( rowCount == 1 || rowCount % STREAM_FLUSH_EVERY_ROWS == 0 )
+                out.flush()
+        }
+        if( !ndjson ) out.write("]")
+        out.flush()
+    } catch(x: Exception) {
+        if( rowCount == 0 )
+            throw x
+        WebServer.logger.error { "streaming aborted after $rowCount rows: ${x.message}" }
+        abortResponse(rsp, x)
     }
+
+    WebServer.logger.debug { "streamed $rowCount rows" }
+    return ""
+}
+
+
+/** Drop the connection of a committed response, so the client sees the body is incomplete */
+private fun abortResponse(rsp: Response, x: Exception) {
+    var raw: ServletResponse = rsp.raw()
+    while( raw is ServletResponseWrapper )
+        raw = raw.response
+    if( raw is JettyResponse )
+        raw.httpChannel.abort(x)
+    else
+        raw.outputStream.close()
+}
@@ -1,7 +1,9 @@
 package com.amcentral365.service.api
 
+import com.amcentral365.service.ExecutionRegistry
 import com.amcentral365.service.ExecutionTargetLocalHost
 import com.amcentral365.service.ExecutionTargetSSHHost
+import com.amcentral365.service.FanOutExecutor
 import mu.KotlinLogging
 import spark.Request
 import spark.Response
@@ -12,16 +14,23 @@ import com.amcentral365.service.ScriptExecutor
 import com.amcentral365.service.ScriptExecutorFlow
 import com.amcentral365.service.StringOutputStream
 import com.amcentral365.service.api.catalog.AssetRoleValues
-import com.amcentral365.service.api.catalog.Assets
 import com.amcentral365.service.builtins.RoleName
+import com.amcentral365.service.catalogCache
 import com.amcentral365.service.builtins.roles.Script
 import com.amcentral365.service.builtins.roles.TargetSSH
 import com.amcentral365.service.combineRequestParams
+import com.amcentral365.service.config
+import com.amcentral365.service.databaseStore
+import com.amcentral365.service.executionRegistry
+import com.amcentral365.service.fanOutExecutor
+import com.amcentral365.service.gson
 import com.amcentral365.service.dao.Asset
+import com.amcentral365.service.dao.bytesToUuid
 import com.amcentral365.service.dao.fromDB
 import com.amcentral365.service.formatResponse
 import com.google.common.base.Preconditions
-import com.sun.xml.internal.messaging.saaj.util.ByteOutputStream
+import com.google.gson.JsonParseException
+import com.google.gson.JsonParser
 import java.util.UUID
 
 
@@ -29,9 +38,46 @@ private val logger = KotlinLogging.logger {}
 
 class Execute { companion object {
 
+    private const val defaultOutputChunkBytes = 1 shl 20
+
+    /** SQL LIKE pattern to a case insensitive regex */
+    private fun likeToRegex(pattern: String) =
+        Regex(pattern.split('%').joinToString(".*") { part -> part.split('_').joinToString(".") { Regex.escape(it) } },
+              RegexOption.IGNORE_CASE)
+
+    private fun getExecution(req: Request): ExecutionRegistry.Execution {
+        val executeId = try {
+            UUID.fromString(req.params("executeId"))
+        } catch(x: IllegalArgumentException) {
+            throw StatusException(400, "executeId '${req.params("executeId")}' is not a valid UUID")
+        }
+        return executionRegistry.get(executeId)
+    }
+
+    private fun Request.longParam(name: String, default: Long): Long =
+        this.queryParams(name)?.let {
+            it.toLongOrNull() ?: throw StatusException(400, "parameter '$name' must be a number, got '$it'")
+        } ?: default
+
+
     fun list(req: Request, rsp: Response): String {
-        rsp.type("application/json")
-        return """{"text": "not implemented"}"""
+        try {
+            rsp.type("application/json")
+            val scriptNameRegex = req.queryParams("scriptNameLike")?.let { likeToRegex(it) }
+            val targetNameRegex = req.queryParams("targetNameLike")?.let { likeToRegex(it) }
+            val skip  = req.longParam("skip",  0).toInt()
+            val limit = req.longParam("limit", 0).toInt()
+
+            val executions = executionRegistry.list()
+                    .filter { scriptNameRegex?.matches(it.scriptName) ?: true }
+                    .filter { targetNameRegex?.matches(it.targetName) ?: true }
+                    .drop(skip)
+                    .let { if( limit > 0 ) it.take(limit) else it }
+
+            return gson.toJson(executions.map { it.info() })
+        } catch(x: Exception) {
+            return formatResponse(rsp, x)
+        }
     }
 
 
@@ -51,12 +97,25 @@ class Execute { companion object {
             val targetRoleName = script.targetRoleName ?:
                     return formatResponse(rsp, StatusMessage(400, "script ${script.name} has no targetRoleName"))
 
-            val targetAsset = Assets.getAssetByKey(targetKey)
+            val targetAsset = catalogCache.getAssetByKey(targetKey)
             if(!AssetRoleValues.hasRole(targetAsset.assetId!!, targetRoleName))
                 return formatResponse(rsp, StatusMessage(404, "asset $targetKey has no requested target role $targetRoleName"))
 
+            if( paramMap["async"]?.toBoolean() == true ) {
+                if( executeMethod != RoleName.ScriptExecutorAMC && executeMethod != RoleName.ScriptExecutorSSH )
+                    throw unsupportedExecuteMethod(executeMethod)
+
+                val execution = executionRegistry.submit(script.name ?: scriptKey, targetAsset.name ?: targetKey, executeMethod) { threadId, outputStream ->
+                    val target = getScriptExecutorImplementation(threadId, executeMethod, targetAsset)
+                    ScriptExecutor(threadId).run(script, target, outputStream)
+                }
+
+                rsp.header("Location", "${req.pathInfo()}/${execution.executeId}")
+                return formatResponse(rsp, 202, gson.toJson(execution.info()), jsonIfOk = true)
+            }
+
             val scriptExecutorImplementation = getScriptExecutorImplementation(thisThreadId, executeMethod, targetAsset)
-            val outputStream = StringOutputStream()  // FIXME: change to BroadcastOutputStream to send to the log, to the message channel, maybe to more recipients
+            val outputStream = StringOutputStream()
 
             val scriptExecutor = ScriptExecutor(thisThreadId)
             val statusMessage = scriptExecutor.run(script, scriptExecutorImplementation, outputStream)
@@ -72,7 +131,99 @@ class Execute { companion object {
         }
     }
 
-    private fun getScriptExecutorImplementation(thisThreadId: String, executeMethod: String, targetAsset: Asset): ScriptExecutorFlow {
+    /**
+     * Pick the targets of a fan-out: the listed asset keys, or all assets having the role.
+     * The keys, the assets, and their roles are resolved in a few IN queries on one connection.
+     */
+    private fun selectFanOutTargets(targetKeys: List<String>, targetRole: String?, scriptTargetRole: String): List<FanOutExecutor.Target> =
+        databaseStore.getGoodConnection().use { conn ->
+            val assetIds: Map<String, UUID?> =
+                if( targetRole != null ) {
+                    conn.prepareStatement("select asset_id from asset_role_values where role_name = ?").use { stmt ->
+                        stmt.setString(1, targetRole)
+                        stmt.executeQuery().use { rs ->
+                            val ids = mutableListOf<UUID>()
+                            while( rs.next() )
+                                ids.add(bytesToUuid(rs.getBytes(1))!!)
+                            ids.associateBy { it.toString() }
+                        }
+                    }
+                } else {
+                    val resolved = AssetRoleValues.resolveAssetKeys(conn, targetKeys)
+                    targetKeys.distinct().associateWith { resolved[it] }
+                }
+
+            val assets = AssetRoleValues.fetchAssetsWithRole(conn, assetIds.values.filterNotNull(), scriptTargetRole)
+
+            assetIds.map { (key, assetId) ->
+                val (asset, hasRole) = assetId?.let { assets[it] }
+                        ?: return@map FanOutExecutor.Target(key, null, StatusMessage(404, "asset $key not found"))
+                if( hasRole )
+                    FanOutExecutor.Target(key, asset)
+                else
+                    FanOutExecutor.Target(key, null, StatusMessage(404, "asset $key has no requested target role $scriptTargetRole"))
+            }
+        }
+
+    /**
+     * POST /executes/fanout
+     *
+     * Body: <code>{"scriptKey": ..., "targetKeys": [asset ids or names] | "targetRole": role name,
+     * "executeMethod": ..., "maxParallel": n, "withOutput": true}</code>.
+     * The script is resolved once and run on every target. Results are streamed back as NDJSON, one line per target
+     * as it completes, followed by the summary line <code>{"summary": {...}}</code> with the timing statistics.
+     */
+    fun fanOut(req: Request, rsp: Response): String {
+        val thisThreadId = Thread.currentThread().name
+        try {
+            rsp.type("application/json")
+            val body = JsonParser().parse(req.body()).asJsonObject
+            fun str(name: String) = body.get(name)?.takeIf { it.isJsonPrimitive }?.asString?.trim()
+
+            val scriptKey = str("scriptKey") ?: throw StatusException(400, "parameter 'scriptKey' is required")
+            val executeMethod = str("executeMethod") ?: RoleName.ScriptExecutorSSH
+            if( executeMethod != RoleName.ScriptExecutorAMC && executeMethod != RoleName.ScriptExecutorSSH )
+                throw unsupportedExecuteMethod(executeMethod)
+            val maxParallel = str("maxParallel")?.toIntOrNull() ?: config.fanOutMaxParallel
+            val withOutput = str("withOutput")?.toBoolean() ?: true
+
+            val targetRole = str("targetRole")
+            val targetKeys = body.get("targetKeys")?.takeIf { it.isJsonArray }?.asJsonArray?.map { it.asString.trim() } ?: emptyList()
+            if( (targetRole == null) == targetKeys.isEmpty() )
+                throw StatusException(400, "exactly one of 'targetKeys' and 'targetRole' is required")
+
+            val script = fromDB<Script>(scriptKey, RoleName.Script)
+            val scriptTargetRole = script.targetRoleName ?: throw StatusException(400, "script ${script.name} has no targetRoleName")
+            val targets = selectFanOutTargets(targetKeys, targetRole, scriptTargetRole)
+            logger.info { "$thisThreadId: fan-out of script ${script.name} to ${targets.size} targets, at most $maxParallel at a time" }
+
+            rsp.status(200)
+            rsp.type("application/x-ndjson")
+            val out = rsp.raw().outputStream.bufferedWriter(config.charSet)
+
+            val summary = fanOutExecutor.run(scriptTargetRole, targets, maxParallel, withOutput,
+                runOne = { threadId, targetAsset, outputStream ->
+                    val target = getScriptExecutorImplementation(threadId, executeMethod, targetAsset)
+                    ScriptExecutor(threadId).run(script, target, outputStream)
+                },
+                onResult = { result ->
+                    out.write(gson.toJson(result.toMap()))
+                    out.newLine()
+                    out.flush()
+                })
+
+            out.write(gson.toJson(mapOf("summary" to summary.toMap())))
+            out.newLine()
+            out.flush()
+            return ""
+
+        } catch(x: Exception) {
+            logger.error { "$thisThreadId: error in fan-out: ${x.message}" }
+            return formatResponse(rsp, if( x is IllegalStateException || x is JsonParseException ) StatusException(x, 400) else x)
+        }
+    }
+
+    internal fun getScriptExecutorImplementation(thisThreadId: String, executeMethod: String, targetAsset: Asset): ScriptExecutorFlow {
         when(executeMethod) {
             RoleName.ScriptExecutorAMC -> return ExecutionTargetLocalHost(thisThreadId, targetAsset)
 
@@ -95,24 +246,64 @@ class Execute { companion object {
             }
 
             else ->
-                throw StatusException(415, "execute method '$executeMethod' not recognized. Supported methods are: ${RoleName.ScriptExecutorAMC} and ${RoleName.ScriptExecutorSSH}}")
+                throw unsupportedExecuteMethod(executeMethod)
         }
     }
 
+    private fun unsupportedExecuteMethod(executeMethod: String) =
+        StatusException(415, "execute method '$executeMethod' not recognized. Supported methods are: ${RoleName.ScriptExecutorAMC} and ${RoleName.ScriptExecutorSSH}}")
+
     fun getInfo(req: Request, rsp: Response): String {
-        rsp.type("application/json")
-        return """{"text": "not implemented"}"""
+        try {
+            rsp.type("application/json")
+            return gson.toJson(getExecution(req).info())
+        } catch(x: Exception) {
+            return formatResponse(rsp, x)
+        }
     }
 
 
     fun getLog(req: Request, rsp: Response): String {
-        rsp.type("text/plain")
-        return "not implemented"
+        try {
+            val execution = getExecution(req)
+            rsp.type("text/plain")
+            return execution.getLog().joinToString("\n", postfix = "\n")
+        } catch(x: Exception) {
+            rsp.type("application/json")
+            return formatResponse(rsp, x)
+        }
     }
 
 
-    fun getOutput(req: Request, rsp: Response): String {
-        rsp.type("text/plain")
-        return "not implemented"
+    /**
+     * Output of an execute, from byte offset 'offset' (default 0), at most 'maxBytes' of it (default 1 MB).
+     * With 'waitSec', waits for output beyond the offset to arrive, which lets clients tail running executes.
+     *
+     * Response headers tell where the returned bytes start (X-Output-Offset, may be past the requested offset
+     * if that part of the output was already dropped), the offset to ask for next (X-Next-Offset),
+     * and whether all of the output has been read (X-Output-Complete).
+     */
+    fun getOutput(req: Request, rsp: Response): Any {
+        try {
+            val execution = getExecution(req)
+            val offset   = req.longParam("offset", 0)
+            val maxBytes = req.longParam("maxBytes", defaultOutputChunkBytes.toLong())
+            val waitSec  = req.longParam("waitSec", 0).coerceIn(0, config.executeOutputMaxWaitSec.toLong())
+            if( offset < 0 || maxBytes <= 0 )
+                throw StatusException(400, "offset must not be negative and maxBytes must be positive")
+
+            val chunk = execution.output.read(offset, maxBytes.coerceAtMost(Int.MAX_VALUE.toLong()).toInt(), waitSec * 1000)
+
+            rsp.type("text/plain; charset=${config.charSetName}")
+            rsp.header("X-Execute-Status",  execution.status.name.toLowerCase())
+            rsp.header("X-Output-Offset",   chunk.offset.toString())
+            rsp.header("X-Next-Offset",     chunk.nextOffset.toString())
+            rsp.header("X-Output-Complete", chunk.complete.toString())
+            return chunk.data
+
+        } catch(x: Exception) {
+            rsp.type("application/json")
+            return formatResponse(rsp, x)
+        }
     }
 }}
@@ -0,0 +1,314 @@
+package com.amcentral365.service.api
+
+import mu.KotlinLogging
+
+import com.google.gson.JsonArray
+import com.google.gson.JsonElement
+import com.google.gson.JsonObject
+import com.google.gson.JsonPrimitive
+
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.api.SchemaUtils.ElementType
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Tree form of a [CompiledSchema], used to validate asset values.
+ *
+ * [CompiledSchema] is flat and keyed by full attribute paths, so walking a value against it means concatenating
+ * and hashing a path string at every visited element. The tree links each node to its members and to its
+ * element node (array elements and map values, the <code>name[]</code> entries of the compiled schema),
+ * and precomputes the required members, the members with default values, and whether a subtree has
+ * indexed attributes. Validation, default assignment, and index extraction are then single walks
+ * over the value. Paths are only built for error messages.
+ */
+class SchemaTree private constructor(val node: SchemaUtils.ASTNode, val memberName: String) {
+
+    private val members = mutableMapOf<String, SchemaTree>()
+    var element: SchemaTree? = null
+        private set
+
+    private var requiredMembers: List<SchemaTree> = emptyList()
+    private var membersWithDefault: List<SchemaTree> = emptyList()
+    private var hasDefaultsBelow = false
+    private var hasIndexedBelow = false
+
+    val path: String get() = node.attrName
+    val type: SchemaUtils.TypeDef get() = node.type
+
+    fun member(name: String): SchemaTree? = this.members[name]
+
+    companion object {
+        private const val rootName = "\$"
+
+        /** A string of a NUMBER or BOOLEAN as the number or the boolean, see [typeStrings]. Anything else as is. */
+        fun typeString(typeCode: ElementType, prm: JsonPrimitive): JsonPrimitive {
+            if( !prm.isString )
+                return prm
+            val str = prm.asString.trim()
+            return when( typeCode ) {
+                ElementType.NUMBER  -> (str.toLongOrNull() ?: str.toBigDecimalOrNull())?.let { JsonPrimitive(it) } ?: prm
+                ElementType.BOOLEAN -> if( str == "true" || str == "false" ) JsonPrimitive(str == "true") else prm
+                else -> prm
+            }
+        }
+
+        /**
+         * Link nodes of the compiled schema into a tree.
+         *
+         * Nodes without a parent (e.g. leftovers of composite type definitions) can't be reached by
+         * any asset value and are skipped.
+         */
+        fun from(schema: CompiledSchema): SchemaTree {
+            val root = SchemaTree(schema[rootName] ?: SchemaUtils.ASTNode(rootName, SchemaUtils.TypeDef(ElementType.OBJECT)), rootName)
+            val trees = mutableMapOf(rootName to root)
+
+            // parents are shorter than their children
+            for(path in schema.keys.sortedBy { it.length }) {
+                if( path == rootName )
+                    continue
+
+                val isElement = path.endsWith("[]")
+                val parentPath = if( isElement ) path.removeSuffix("[]") else path.substringBeforeLast('.', "")
+                val parent = trees[parentPath]
+                if( parent == null ) {
+                    logger.debug { "schema node $path has no parent, skipping" }
+                    continue
+                }
+
+                val tree = SchemaTree(schema.getValue(path), if( isElement ) "" else path.substringAfterLast('.'))
+                if( isElement )
+                    parent.element = tree
+                else
+                    parent.members[tree.memberName] = tree
+                trees[path] = tree
+            }
+
+            root.precompute()
+            return root
+        }
+    }
+
+    private fun precompute() {
+        this.members.values.forEach { it.precompute() }
+        this.element?.precompute()
+
+        val subtrees = this.members.values + listOfNotNull(this.element)
+        this.requiredMembers    = this.members.values.filter { it.type.required }
+        this.membersWithDefault = this.members.values.filter { it.type.defaultVal != null }
+        this.hasDefaultsBelow   = this.membersWithDefault.isNotEmpty() || subtrees.any { it.hasDefaultsBelow }
+        this.hasIndexedBelow    = this.type.indexed || subtrees.any { it.hasIndexedBelow }
+    }
+
+
+    // ---------------------------------------- Validation
+    /**
+     * Check [elm] against the schema, throw [StatusException] 406 on the first problem found.
+     *
+     * Missing required attributes are collected over the whole value and reported together.
+     */
+    fun validate(roleName: String, elm: JsonElement) {
+        val missing = linkedSetOf<String>()
+        this.check(roleName, elm, missing)
+        if( missing.isNotEmpty() )
+            throw StatusException(406, "missing ${missing.size} required attributes: ${missing.joinToString(", ")}")
+    }
+
+    private fun typeMatches(typeCode: ElementType, elm: JsonElement): Boolean =
+        when(typeCode) {
+            ElementType.STRING  -> elm.isJsonPrimitive && elm.asJsonPrimitive.isString
+            ElementType.BOOLEAN -> elm.isJsonPrimitive && elm.asJsonPrimitive.isBoolean
+            ElementType.NUMBER  -> elm.isJsonPrimitive && elm.asJsonPrimitive.isNumber
+            ElementType.ENUM    -> elm.isJsonPrimitive && elm.asJsonPrimitive.isString
+            ElementType.MAP     -> elm.isJsonObject
+            ElementType.OBJECT  -> elm.isJsonObject
+        }
+
+    private fun checkType(elm: JsonElement) {
+        if( !this.typeMatches(this.type.typeCode, elm) )
+            throw StatusException(406, "type of attribute '${this.path}' isn't ${this.type.typeCode}")
+
+        if( this.type.typeCode == ElementType.ENUM && elm.asString !in this.node.enumValues!! )
+            throw StatusException(406, "value '${elm.asString}' of attribute '${this.path}' isn't valid for the enum")
+    }
+
+    private fun check(roleName: String, elm: JsonElement, missing: MutableSet<String>) {
+        val isMap = this.type.typeCode == ElementType.MAP
+        if( this.type.multiple && !isMap && !(elm.isJsonArray || (!this.type.required && elm.isJsonNull)) )
+            throw StatusException(406, "attribute '${this.path}' must be an array")
+
+        when {
+            elm.isJsonNull ->
+                if( this.type.required )
+                    throw StatusException(406, "attribute '${this.path}' is required, null values are not allowed")
+
+            elm.isJsonPrimitive ->
+                this.checkType(elm)
+
+            elm.isJsonArray -> {
+                val arr = elm.asJsonArray
+                if( !this.type.multiple )
+                    throw StatusException(406, "attribute '${this.path}' shan't be an array")
+                if( this.type.oneplus && arr.size() == 0 )
+                    throw StatusException(406, "attribute '${this.path}': at least one array element is required")
+
+                val elementTree = this.element
+                    ?: throw StatusException(406, "attribute '${this.path}[]' is not defined for role $roleName")
+                arr.forEachIndexed { idx, e ->
+                    try {
+                        elementTree.check(roleName, e, missing)
+                    } catch(x: StatusException) {
+                        throw StatusException(x.code, "${this.path}[$idx]: ${x.message}")
+                    }
+                }
+            }
+
+            elm.isJsonObject -> {
+                val obj = elm.asJsonObject
+                this.checkType(obj)  // ensure it isn't supposed to be an array or a primitive
+
+                if( isMap ) {
+                    if( this.type.oneplus && obj.size() == 0 )
+                        throw StatusException(406, "attribute '${this.path}' is required, empty maps are not allowed")
+
+                    val valueType = this.element!!.type.typeCode
+                    obj.entrySet().forEachIndexed { idx, e ->
+                        if( !this.typeMatches(valueType, e.value) )
+                            throw StatusException(406, "${this.path}[$idx], key '${e.key}': the value type isn't $valueType")
+                    }
+                } else {
+                    this.requiredMembers.forEach {
+                        if( !obj.has(it.memberName) )
+                            missing.add(it.path)
+                    }
+
+                    for(entry in obj.entrySet()) {  // forEach swallows exceptions, use loop
+                        val memberTree = this.members[entry.key]
+                            ?: throw StatusException(406, "attribute '${this.path}.${entry.key}' is not defined for role $roleName")
+                        memberTree.check(roleName, entry.value, missing)
+                    }
+                }
+            }
+        }
+    }
+
+
+    // ---------------------------------------- Untyped values
+    /**
+     * Type the strings of [elm] by the schema, for formats without types, like XML: strings of NUMBER and BOOLEAN
+     * attributes, array elements, and map values, e.g. "22" or "true", become numbers and booleans. Other values,
+     * and strings that don't parse, are kept, for validation to report them.
+     *
+     * @return the typed primitive when [elm] is one, otherwise [elm] changed in place
+     */
+    fun typeStrings(elm: JsonElement): JsonElement =
+        when {
+            elm.isJsonPrimitive -> typeString(this.type.typeCode, elm.asJsonPrimitive)
+
+            elm.isJsonArray -> {
+                val arr = elm.asJsonArray
+                this.element?.let { elementTree -> for(k in 0 until arr.size()) arr.set(k, elementTree.typeStrings(arr[k])) }
+                arr
+            }
+
+            elm.isJsonObject -> {
+                if( this.type.typeCode == ElementType.MAP )
+                    this.element?.let { valueTree ->
+                        elm.asJsonObject.entrySet().forEach { it.setValue(valueTree.typeStrings(it.value)) }
+                    }
+                else
+                    elm.asJsonObject.entrySet().forEach { entry ->
+                        this.members[entry.key]?.let { entry.setValue(it.typeStrings(entry.value)) }
+                    }
+                elm
+            }
+
+            else -> elm
+        }
+
+
+    // ---------------------------------------- Default values
+    /**
+     * Add default values of absent attributes to [elm], in place.
+     *
+     * Defaults are assigned in objects that are present, intermediate objects aren't created.
+     * Elements of arrays of objects get their defaults too.
+     */
+    fun assignDefaults(roleName: String, elm: JsonElement) {
+        if( !this.hasDefaultsBelow || this.type.typeCode == ElementType.MAP )
+            return
+
+        when {
+            elm.isJsonObject -> {
+                val obj = elm.asJsonObject
+                this.membersWithDefault.forEach {
+                    if( !obj.has(it.memberName) )
+                        it.addDefaultTo(roleName, obj)
+                }
+
+                for(entry in obj.entrySet())
+                    this.members[entry.key]?.assignDefaults(roleName, entry.value)
+            }
+
+            elm.isJsonArray ->
+                this.element?.let { elementTree -> elm.asJsonArray.forEach { elementTree.assignDefaults(roleName, it) } }
+        }
+    }
+
+    private fun addDefaultTo(roleName: String, obj: JsonObject) {
+        val defaultVal = this.type.defaultVal
+        val arr = JsonArray()
+        when(this.type.typeCode) {
+            ElementType.STRING, ElementType.ENUM -> {
+                if( this.type.multiple ) (defaultVal as List<*>).forEach { arr.add(it as String?) }
+                else                      obj.addProperty(this.memberName, defaultVal as String?)
+            }
+
+            ElementType.NUMBER  ->  {
+                if( this.type.multiple ) (defaultVal as List<*>).forEach { arr.add(it as Number?) }
+                else                      obj.addProperty(this.memberName, defaultVal as Number?)
+            }
+
+            ElementType.BOOLEAN ->  {
+                if( this.type.multiple ) (defaultVal as List<*>).forEach { arr.add(it as Boolean?) }
+                else                      obj.addProperty(this.memberName, defaultVal as Boolean?)
+            }
+
+            else ->
+                throw StatusException(500, "Role $roleName, attribute ${this.path}: defaults of type ${this.type.typeCode} should have not pass validation, but they have")
+        }
+
+        if( this.type.multiple )
+            obj.add(this.memberName, arr)
+    }
+
+
+    // ---------------------------------------- Indexed attributes
+    /** Collect (attribute path, value) pairs of primitives marked as indexed, see [SchemaUtils.indexedValues] */
+    fun collectIndexed(elm: JsonElement, values: MutableList<Pair<String, String>>) {
+        if( !this.hasIndexedBelow )
+            return
+
+        fun add(prm: JsonPrimitive) = values.add(Pair(this.path, prm.asString.take(INDEXED_VALUE_MAX_LEN)))
+
+        when {
+            elm.isJsonPrimitive ->
+                if( this.type.indexed )
+                    add(elm.asJsonPrimitive)
+
+            elm.isJsonArray ->
+                elm.asJsonArray.forEach { e ->
+                    when {
+                        e.isJsonPrimitive -> if( this.type.indexed ) add(e.asJsonPrimitive)
+                        e.isJsonObject    -> this.element?.collectIndexed(e, values)
+                    }
+                }
+
+            elm.isJsonObject ->
+                if( this.type.typeCode != ElementType.MAP )
+                    for(entry in elm.asJsonObject.entrySet())
+                        this.members[entry.key]?.collectIndexed(entry.value, values)
+        }
+    }
+}
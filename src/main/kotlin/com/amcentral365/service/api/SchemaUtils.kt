@@ -5,6 +5,8 @@ import mu.KotlinLogging
 import kotlin.Exception
 
 import java.util.Arrays
+import java.util.concurrent.ExecutionException
+import java.util.concurrent.atomic.AtomicLong
 
 import com.google.gson.JsonElement
 import com.google.gson.JsonParser
@@ -12,9 +14,12 @@ import com.google.gson.JsonParser
 import com.amcentral365.service.StatusException
 import com.amcentral365.service.dao.Role
 import com.amcentral365.service.databaseStore
+import com.amcentral365.service.metrics
 import com.google.common.annotations.VisibleForTesting
 import com.google.common.cache.CacheBuilder
 import com.google.common.cache.CacheLoader
+import com.google.common.cache.LoadingCache
+import com.google.common.util.concurrent.UncheckedExecutionException
 
 import com.google.gson.JsonArray
 import com.google.gson.JsonObject
@@ -24,6 +29,9 @@ import com.google.gson.JsonPrimitive
 
 private val logger = KotlinLogging.logger {}
 
+private val schemaLoadDuration = metrics.histogram("amc_schema_load_duration_seconds", "Time to load role schemas from the database")
+private val validationDuration = metrics.histogram("amc_schema_validation_duration_seconds", "Time to validate asset values against role schemas")
+
 private val validSchemaDefTypes = mapOf(
       "string"  to SchemaUtils.ElementType.STRING
     , "number"  to SchemaUtils.ElementType.NUMBER
@@ -34,12 +42,45 @@ private val validSchemaDefTypes = mapOf(
 private const val compositeTypeNodeName = "type"
 private const val compositeDefaultNodeName = "default"
 private const val attributeNodeName = "_attr"
+const val INDEXED_VALUE_MAX_LEN = 255   // asset_role_attrs.attr_val
 
 typealias CompiledSchema = Map<String, SchemaUtils.ASTNode>
 fun CompiledSchema.nodesWithDefaultValue(): Iterable<Map.Entry<String, SchemaUtils.ASTNode>> =
     this.entries.filter { it.value.type.defaultVal != null }
 
 
+/**
+ * Names of the roles a schema references with "@roleName", directly, without compiling it.
+ * Follows the rules of SchemaUtils.validateAndCompile: enum arrays and <code>_attr</code> values don't hold
+ * references, and of a composite type definition only the type is looked at.
+ *
+ * @throws JsonParseException if [schemaJson] isn't valid JSON
+ */
+fun directlyReferencedRoles(schemaJson: String): Set<String> {
+    val names = mutableSetOf<String>()
+
+    fun walk(elm: JsonElement) {
+        when {
+            elm.isJsonPrimitive && elm.asJsonPrimitive.isString && elm.asString.startsWith('@') ->
+                SchemaUtils.TypeDef.genericFrom(elm.asString.substring(1)) { roleName, _, _, _, _ ->
+                    if( roleName.isNotBlank() )
+                        names.add(roleName)
+                    null
+                }
+            elm.isJsonObject -> {
+                val obj = elm.asJsonObject
+                if( SchemaUtils.TypeDef.isCompositeTypeDef(obj) )
+                    walk(obj[compositeTypeNodeName])
+                else
+                    obj.entrySet().filter { it.key != attributeNodeName }.forEach { walk(it.value) }
+            }
+        }
+    }
+
+    walk(JsonParser().parse(schemaJson))
+    return names
+}
+
 /**
  * Load schema definition from the database
  *
@@ -47,14 +88,56 @@ fun CompiledSchema.nodesWithDefaultValue(): Iterable<Map.Entry<String, SchemaUti
  */
 fun loadSchemaFromDb(roleName: String): String? {
     val role = Role(roleName)
-    val lst = databaseStore.fetchRowsAsObjects(role, limit = 1)
+    val lst = schemaLoadDuration.time { databaseStore.fetchRowsAsObjects(role, limit = 1) }
     require(lst.size < 2)
     return if( lst.size == 1 ) (lst[0] as Role).roleSchema else null
 }
 
+/**
+ * Load versions of all roles, the version check of the schema cache.
+ *
+ * A version is <code>modified_ts</code> and a checksum of the schema: the timestamp has one second resolution,
+ * and misses a change made within the second the schema was cached.
+ *
+ * @return map of role name to its version
+ */
+fun loadSchemaVersionsFromDb(): Map<String, String> =
+    databaseStore.getGoodConnection().use { conn ->
+        conn.prepareStatement("select name, modified_ts, crc32(role_schema) from roles").use { stmt ->
+            stmt.executeQuery().use { rs ->
+                val versions = mutableMapOf<String, String>()
+                while( rs.next() )
+                    versions[rs.getString(1)] = "${rs.getTimestamp(2).time}:${rs.getLong(3)}"
+                versions
+            }
+        }
+    }
+
+/**
+ * Load all roles with their schemas in one query, used to warm up the schema cache.
+ *
+ * @return roles with populated name, schema, and modification timestamp
+ */
+fun loadAllSchemasFromDb(): List<Role> =
+    databaseStore.getGoodConnection().use { conn ->
+        conn.prepareStatement("select name, role_schema, modified_ts from roles").use { stmt ->
+            stmt.executeQuery().use { rs ->
+                val roles = mutableListOf<Role>()
+                while( rs.next() )
+                    roles.add(Role(rs.getString(1)).apply {
+                        roleSchema = rs.getString(2)
+                        modifiedTs = rs.getTimestamp(3)
+                    })
+                roles
+            }
+        }
+    }
+
 
 open class SchemaUtils(
         maxCacheWeight: Long = 100,
+        private val loadSchemaVersions: () -> Map<String, String> = ::loadSchemaVersionsFromDb,
+        private val loadAllSchemas: () -> List<Role> = ::loadAllSchemasFromDb,
         val loadSchema: (roleName: String) -> String? = ::loadSchemaFromDb
 ) {
 
@@ -208,15 +291,47 @@ open class SchemaUtils(
     }
 
 
+    /**
+     * Validate and compile the role schema, and cache the result.
+     *
+     * [referencedRoles] is only passed when compiling a role referenced by another one. Such schemas
+     * are compiled under the referencing attribute and aren't cached.
+     */
     fun validateAndCompile(roleName: String, jsonStr: String
         , rootElmName: String = "\$"
         , seenRoles: MutableList<Pair<String, String>>? = null
+        , referencedRoles: MutableSet<String>? = null
+    ): CompiledSchema
+    {
+        if( referencedRoles != null )
+            return this.parseAndCompile(roleName, jsonStr, rootElmName, seenRoles, referencedRoles)
+
+        val cached = this.compileForCache(roleName, jsonStr, this.knownVersions)
+        this.schemaCache.put(roleName, cached)
+        logger.info { "successfully validated and cached schema for role $roleName" }
+        return cached.schema
+    }
+
+    /**
+     * Compile a top level role schema and tag it with [knownVersions] of the role and of the roles it references.
+     * The versions must be taken before the schema string was read, see [CachedSchema].
+     */
+    private fun compileForCache(roleName: String, jsonStr: String, knownVersions: Map<String, String>): CachedSchema {
+        val referencedRoles = mutableSetOf<String>()
+        val compiledNodes = this.parseAndCompile(roleName, jsonStr, "\$", null, referencedRoles)
+        return CachedSchema(compiledNodes, (referencedRoles + roleName).associateWith { knownVersions[it] })
+    }
+
+    private fun parseAndCompile(roleName: String, jsonStr: String
+        , rootElmName: String
+        , seenRoles: MutableList<Pair<String, String>>?
+        , referencedRoles: MutableSet<String>
     ): CompiledSchema
     {
         try {
             val elm0 = JsonParser().parse(jsonStr)
             require(elm0.isJsonObject) { "$roleName: role schema must be a Json Object (i.e. the {...} thingy)" }
-            return this.validateAndCompile(roleName, elm0, rootElmName, seenRoles)
+            return this.validateAndCompile(roleName, elm0, referencedRoles, rootElmName, seenRoles)
         } catch(x: JsonParseException) {
             logger.warn { "failed while validating/compiling schema for role $roleName: ${x.message}" }
             throw StatusException(x, 406)
@@ -233,6 +348,7 @@ open class SchemaUtils(
      * Full attribute name comprise of the full path from the root to the node.
      */
     private fun validateAndCompile(roleName: String, rootJsonElm: JsonElement
+      , referencedRoles: MutableSet<String>
       , rootElmName: String = "\$"
       , seenRoles: MutableList<Pair<String, String>>? = null
       , seenNodes: MutableMap<String, ASTNode>? = null
@@ -253,7 +369,7 @@ open class SchemaUtils(
                         var tpd = TypeDef(ElementType.OBJECT)
                         if( attrStr == null ) {
                             if( isComposite )
-                                tpd = this.getCompositeType(roleName, name, elm, seenRoles, compiledNodes)
+                                tpd = this.getCompositeType(roleName, name, elm, seenRoles, compiledNodes, referencedRoles)
                         } else {
                             tpd = TypeDef.fromTypeName(name, attrStr, ElementType.OBJECT)
                         }
@@ -269,7 +385,7 @@ open class SchemaUtils(
                         if( tpd.multiple && elm != rootJsonElm ) {
                             val pluralName = "$name[]"
                             compiledNodes[pluralName] = ASTNode(pluralName, TypeDef(ElementType.OBJECT))
-                            validateAndCompile(roleName, elm, rootElmName = pluralName,
+                            validateAndCompile(roleName, elm, referencedRoles, rootElmName = pluralName,
                                     seenRoles = seenRoles, seenNodes = compiledNodes)
                             return@walkJson false
                         }
@@ -344,7 +460,8 @@ open class SchemaUtils(
                             throw StatusException(406, "$name: cycle in role references. Role $rfRoleName was referenced by ${seeenRoles[prevIdx].first}")
 
                         seeenRoles.add(Pair(name, rfRoleName))
-                        val rfSchemaStr = this.loadSchema(rfRoleName)
+                        referencedRoles.add(rfRoleName)
+                        val rfSchemaStr = this.preloadedSchemas[rfRoleName] ?: this.loadSchema(rfRoleName)
                                 ?: throw StatusException(406, "$name references unknown role '$rfRoleName'")
 
                         // NB: recursive call
@@ -352,7 +469,7 @@ open class SchemaUtils(
                         compiledNodes.put(name, ASTNode(name, typeDef))
                         compiledNodes.putIfAbsent(subAttrRoot, ASTNode(subAttrRoot, TypeDef(typeDef.typeCode)))
                         val rfSchemas = validateAndCompile(rfRoleName, rfSchemaStr,
-                                rootElmName = subAttrRoot, seenRoles = seeenRoles)
+                                rootElmName = subAttrRoot, seenRoles = seeenRoles, referencedRoles = referencedRoles)
                         rfSchemas.forEach { compiledNodes.putIfAbsent(it.key, it.value) }
 
                     } else {
@@ -381,20 +498,19 @@ open class SchemaUtils(
             throw StatusException(x, 406)
         }
 
-        schemaCache.put(roleName, compiledNodes)
-        logger.info { "successfully validated and cached schema for role $roleName" }
         return compiledNodes
     }
 
     private fun getCompositeType(roleName: String, name: String, elm: JsonObject
                   , seenRoles: MutableList<Pair<String, String>>?
                   , seenNodes: MutableMap<String, ASTNode>
+                  , referencedRoles: MutableSet<String>
     ): TypeDef {
         val typeElmJson = elm[compositeTypeNodeName]
         var currNodeName = "$name.$compositeTypeNodeName"
         try {
 
-            validateAndCompile(roleName, typeElmJson, currNodeName, seenRoles, seenNodes)
+            validateAndCompile(roleName, typeElmJson, referencedRoles, currNodeName, seenRoles, seenNodes)
             require(seenNodes.contains(currNodeName))
                 { "code bug: processed node $currNodeName, but didn't store it in compiledNodes" }
             val astNode = seenNodes.remove(currNodeName)!!
@@ -500,6 +616,33 @@ open class SchemaUtils(
         }
     }
 
+    /**
+     * A compiled schema and its tree form, built on first use.
+     *
+     * [versions] are versions of the role and of the roles it references (see [loadSchemaVersionsFromDb]), as
+     * known by the last version check before the schemas were read. A role modified after that has a different
+     * version in the database, and the entry is dropped by the next check. Roles unknown
+     * to the last check have null versions, their entries are dropped and reloaded by the next check.
+     */
+    private class CachedSchema(val schema: CompiledSchema, val versions: Map<String, String?>) {
+        val tree: SchemaTree by lazy { SchemaTree.from(schema) }
+
+        fun isStale(currentVersions: Map<String, String>) =
+            this.versions.any { (roleName, version) -> version == null || currentVersions[roleName] != version }
+    }
+
+    /** Role versions seen by the last [checkVersions] or [warmUp], replaced as a whole */
+    @Volatile private var knownVersions: Map<String, String> = emptyMap()
+
+    /** Role schemas read by [warmUp], so resolving role references doesn't query them one by one */
+    @Volatile private var preloadedSchemas: Map<String, String> = emptyMap()
+
+    private val invalidationCount = AtomicLong()
+    private val versionCheckCount = AtomicLong()
+    @Volatile private var lastVersionCheckTs: Long = 0
+    @Volatile private var warmUpRoleCount = 0
+    @Volatile private var warmUpMsec: Long = 0
+
     /**
      * Guava Cache of compiled role schemas, by role name.
      *
@@ -508,17 +651,120 @@ open class SchemaUtils(
      */
     private val schemaCache = CacheBuilder.newBuilder()
             .maximumWeight(maxCacheWeight)
-            .weigher { _: String, value: CompiledSchema -> value.size }
-            .build(object: CacheLoader<String, CompiledSchema>() {
-                override fun load(roleName: String): CompiledSchema {
+            .weigher { _: String, value: CachedSchema -> value.schema.size }
+            .recordStats()
+            .build(object: CacheLoader<String, CachedSchema>() {
+                override fun load(roleName: String): CachedSchema {
                     logger.info { "caching schema for role $roleName" }
+                    val knownVersions = this@SchemaUtils.knownVersions
                     val roleSchema = this@SchemaUtils.loadSchema(roleName)
                             ?: throw StatusException(404, "role '$roleName' was not found")
-                    return validateAndCompile(roleName, roleSchema)
+                    return compileForCache(roleName, roleSchema, knownVersions)
                 }
             })
 
 
+    /** [LoadingCache.get] rethrowing the loader's [StatusException], e.g. 404 for an unknown role, unwrapped */
+    private fun <K, V> LoadingCache<K, V>.getOrThrow(key: K): V =
+        try {
+            this.get(key)
+        } catch(x: ExecutionException) {
+            throw x.cause as? StatusException ?: x
+        } catch(x: UncheckedExecutionException) {
+            throw x.cause as? StatusException ?: x
+        }
+
+
+    /**
+     * Drop the role schema and schemas of the roles referencing it from the cache.
+     * Called when the role is changed by this process.
+     */
+    fun invalidate(roleName: String) {
+        val stale = this.schemaCache.asMap().filterValues { roleName in it.versions }.keys
+        this.schemaCache.invalidateAll(stale)
+        this.invalidationCount.addAndGet(stale.size.toLong())
+    }
+
+    /**
+     * Compare role versions in the database with the cached ones and drop stale entries.
+     *
+     * Roles may be modified by other cluster nodes or by the merge. The check is a single
+     * query of the role names and their versions, see [loadSchemaVersionsFromDb].
+     *
+     * @return the number of dropped entries
+     */
+    fun checkVersions(): Int {
+        val currentVersions = this.loadSchemaVersions()
+        this.knownVersions = currentVersions   // before invalidating, so reloads are tagged with the current versions
+        this.versionCheckCount.incrementAndGet()
+        this.lastVersionCheckTs = System.currentTimeMillis()
+
+        val stale = this.schemaCache.asMap().filterValues { it.isStale(currentVersions) }.keys
+        if( stale.isNotEmpty() ) {
+            logger.info { "schema cache: dropping ${stale.size} stale role schema(s): ${stale.joinToString(", ")}" }
+            this.schemaCache.invalidateAll(stale)
+            this.invalidationCount.addAndGet(stale.size.toLong())
+        }
+
+        return stale.size
+    }
+
+    /**
+     * Read all role schemas with one query and compile them into the cache.
+     *
+     * Roles failing to compile are logged and skipped, they'll fail again when used.
+     *
+     * @return the number of cached roles
+     */
+    fun warmUp(): Int {
+        val beg = System.currentTimeMillis()
+        this.knownVersions = this.loadSchemaVersions()    // before reading the schemas, see CachedSchema
+        val roles = this.loadAllSchemas()
+
+        this.preloadedSchemas = roles.filter { it.roleSchema != null }.associate { it.roleName!! to it.roleSchema!! }
+
+        var cachedCount = 0
+        try {
+            this.preloadedSchemas.forEach { (roleName, roleSchema) ->
+                try {
+                    this.validateAndCompile(roleName, roleSchema)
+                    cachedCount++
+                } catch(x: Exception) {
+                    logger.warn { "schema cache warm-up: role $roleName failed to compile: ${x.message}" }
+                }
+            }
+        } finally {
+            this.preloadedSchemas = emptyMap()
+        }
+
+        this.warmUpRoleCount = cachedCount
+        this.warmUpMsec = System.currentTimeMillis() - beg
+        logger.info { "schema cache warm-up: cached $cachedCount of ${roles.size} roles in $warmUpMsec msec" }
+        return cachedCount
+    }
+
+    /** Cache statistics: hits, misses, load times, invalidations, and version checks */
+    fun cacheStats(): Map<String, Any> {
+        val stats = this.schemaCache.stats()
+        return linkedMapOf(
+              "size"               to this.schemaCache.size()
+            , "hitCount"           to stats.hitCount()
+            , "missCount"          to stats.missCount()
+            , "hitRate"            to stats.hitRate()
+            , "loadCount"          to stats.loadCount()
+            , "loadExceptionCount" to stats.loadExceptionCount()
+            , "totalLoadTimeMsec"  to stats.totalLoadTime() / 1_000_000.0
+            , "averageLoadMsec"    to stats.averageLoadPenalty() / 1_000_000.0
+            , "evictionCount"      to stats.evictionCount()
+            , "invalidationCount"  to this.invalidationCount.get()
+            , "versionCheckCount"  to this.versionCheckCount.get()
+            , "lastVersionCheckTs" to this.lastVersionCheckTs
+            , "warmUpRoleCount"    to this.warmUpRoleCount
+            , "warmUpMsec"         to this.warmUpMsec
+        )
+    }
+
+
     private fun checkValueType(typeCode: ElementType, elm: JsonElement) {
         when(typeCode) {
             ElementType.STRING  -> require((elm as JsonPrimitive).isString)
@@ -534,7 +780,14 @@ open class SchemaUtils(
     @VisibleForTesting fun isAttributeWithPrefix(attr: String, prefix: String) =
             attr.startsWith("$prefix.") && attr.indexOf('.', prefix.length+1) == -1
 
-    private fun validateAssetValue(roleName: String, elm: JsonElement, roleSchema: CompiledSchema) {
+    /**
+     * Path-keyed validation against the flat [CompiledSchema].
+     *
+     * This is the reference implementation [SchemaTree.validate] replaced. It is kept for equivalence
+     * tests and benchmarks.
+     */
+    @VisibleForTesting
+    internal fun validateAssetValueByPath(roleName: String, elm: JsonElement, roleSchema: CompiledSchema) {
         val unseenRequiredNames = mutableSetOf("$")
 
         fun checkWithThrow(name: String, astn: ASTNode, prm: JsonElement) {
@@ -632,18 +885,41 @@ open class SchemaUtils(
             this.validateAssetValue(roleName, JsonParser().parse(jsonStr))
 
     fun validateAssetValue(roleName: String, elm: JsonElement) {
-        val roleSchema = this.schemaCache.get(roleName)
-        this.validateAssetValue(roleName, elm, roleSchema)
+        validationDuration.time { this.schemaCache.getOrThrow(roleName).tree.validate(roleName, elm) }
+        logger.debug { "successfully validated asset value for role $roleName" }
     }
 
+    @VisibleForTesting
+    internal fun compiledSchema(roleName: String): CompiledSchema = this.schemaCache.getOrThrow(roleName).schema
+
+    /**
+     * An opaque token of the cached role schema. A new token is returned after the role, or a role it references,
+     * was changed by this process or found changed by [checkVersions]. Compare with <code>===</code>.
+     */
+    fun schemaGeneration(roleName: String): Any = this.schemaCache.getOrThrow(roleName)
+
+    /** Type the strings of [elm], a value of the role read from an untyped format, see [SchemaTree.typeStrings] */
+    fun typeStrings(roleName: String, elm: JsonElement): JsonElement = this.schemaCache.getOrThrow(roleName).tree.typeStrings(elm)
+
     // ---------------------------------------- Assigning the default value
     fun assignDefaultValues(roleName: String, assetValStr: String): JsonElement =
         this.assignDefaultValues(roleName, JsonParser().parse(assetValStr))
 
+    /** Copy [assetElm], assign default values to the copy, and validate it */
+    fun assignDefaultValues(roleName: String, assetElm: JsonElement): JsonElement {
+        val tree = this.schemaCache.getOrThrow(roleName).tree
+        val workElm = assetElm.deepCopy()
+        tree.assignDefaults(roleName, workElm)
+        tree.validate(roleName, workElm)
+        return workElm
+    }
 
-    private fun assignDefaultValues(roleName: String, assetElm: JsonElement, roleSchemaP: CompiledSchema? = null): JsonElement {
-        val roleSchema = roleSchemaP ?: this.schemaCache.get(roleName)
-
+    /**
+     * Path-keyed default assignment, the reference implementation for [SchemaTree.assignDefaults].
+     * Unlike the tree, it does not descend into arrays.
+     */
+    @VisibleForTesting
+    internal fun assignDefaultValuesByPath(roleName: String, assetElm: JsonElement, roleSchema: CompiledSchema): JsonElement {
         // Copy
         val workElm = assetElm.deepCopy()
         interestingNodes@ for( (path, node) in roleSchema.nodesWithDefaultValue()) {
@@ -697,11 +973,32 @@ open class SchemaUtils(
 
         }
 
-        this.validateAssetValue(roleName, workElm, roleSchema)
+        this.validateAssetValueByPath(roleName, workElm, roleSchema)
         return workElm
     }
 
 
+    // ---------------------------------------- Indexed attributes
+    /**
+     * Collect values of the attributes marked as indexed ('^') in the role schema.
+     *
+     * Only primitive values are collected, elements of indexed arrays are returned individually.
+     * The attribute names are schema paths, like <code>$.hostname</code> or <code>$.nics[].ip</code>.
+     * The asset value is expected to be already validated.
+     *
+     * @return list of (attribute name, value) pairs, values are truncated to [INDEXED_VALUE_MAX_LEN].
+     */
+    fun indexedValues(roleName: String, assetValStr: String): List<Pair<String, String>> {
+        val values = mutableListOf<Pair<String, String>>()
+        this.schemaCache.getOrThrow(roleName).tree.collectIndexed(JsonParser().parse(assetValStr), values)
+        return values.distinct()
+    }
+
+    /** Names of the attributes marked as indexed ('^') in the role schema, as in [indexedValues] */
+    fun indexedAttributes(roleName: String): Set<String> =
+        this.compiledSchema(roleName).filterValues { it.type.indexed }.keys
+
+
     // ---------------------------------------- Top level
     fun getAssetValue(roleName: String, assetValStr: String): JsonElement = this.assignDefaultValues(roleName, assetValStr)
 }
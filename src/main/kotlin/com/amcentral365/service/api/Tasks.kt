@@ -8,8 +8,8 @@ import spark.Response
 import com.amcentral365.service.StatusException
 import com.amcentral365.service.StatusMessage
 import com.amcentral365.service.api.catalog.AssetRoleValues
-import com.amcentral365.service.api.catalog.Assets
 import com.amcentral365.service.builtins.RoleName
+import com.amcentral365.service.catalogCache
 import com.amcentral365.service.builtins.roles.Script
 import com.amcentral365.service.combineRequestParams
 import com.amcentral365.service.dao.Task
@@ -17,6 +17,7 @@ import com.amcentral365.service.dao.fromDB
 import com.amcentral365.service.dao.stringToTs
 import com.amcentral365.service.databaseStore
 import com.amcentral365.service.formatResponse
+import com.amcentral365.service.taskDispatcher
 
 private val logger = KotlinLogging.logger {}
 
@@ -48,16 +49,19 @@ class Tasks { companion object {
             val script = fromDB<Script>(scriptKey, RoleName.Script)
             val targetRoleName = script.targetRoleName ?:
                     return formatResponse(rsp, StatusMessage(400, "script ${script.name} has no attribute 'targetRoleName'"))
-            val targetAsset = Assets.getAssetByKey(targetKey)
+            val targetAsset = catalogCache.getAssetByKey(targetKey)
             if(!AssetRoleValues.hasRole(targetAsset.assetId!!, targetRoleName))
                 return formatResponse(rsp, StatusMessage(404, "asset $targetKey has no requested target role '$targetRoleName'"))
 
             task.status = Task.Status.Ready
             task.scriptAssetId = script.asset!!.assetId
             task.targetAssetId = targetAsset.assetId
+            task.submitWorker = taskDispatcher.workerName
 
             val msg = databaseStore.insertObjectAsRow(task)
             logger.info { "$thisThreadId: submitted task ${task.taskId}: ${msg.msg}" }
+            if( msg.isOk && task.scheduledRunTs == null )
+                taskDispatcher.wakeUp()    // due now
             formatResponse(rsp, msg, jsonIfOk = true)
 
         } catch(x: Exception) {
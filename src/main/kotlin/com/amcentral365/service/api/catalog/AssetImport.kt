@@ -0,0 +1,322 @@
+package com.amcentral365.service.api.catalog
+
+import mu.KotlinLogging
+
+import java.io.BufferedWriter
+import java.io.OutputStreamWriter
+import java.lang.Exception
+import java.sql.Connection
+import java.sql.SQLException
+import java.util.UUID
+
+import spark.Request
+import spark.Response
+
+import com.google.common.annotations.VisibleForTesting
+import com.google.gson.Gson
+import com.google.gson.JsonObject
+import com.google.gson.JsonParser
+
+import com.amcentral365.service.DBERR_DUP_VAL_ON_INDEX
+import com.amcentral365.service.NDJSON_CONTENT_TYPE
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.StatusMessage
+import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.config
+import com.amcentral365.service.dao.Asset
+import com.amcentral365.service.dao.bytesToUuid
+import com.amcentral365.service.dao.uuidToBytes
+import com.amcentral365.service.databaseStore
+import com.amcentral365.service.formatResponse
+import com.amcentral365.service.catalogCache
+import com.amcentral365.service.schemaUtils
+
+import com.amcentral365.service.api.catalog.AssetRoleValues as AssetRoleValuesApi
+
+private val logger = KotlinLogging.logger {}
+
+
+/**
+ * Bulk import of assets with their role values.
+ *
+ * The input is NDJSON, one asset per line, in the format of the merge files:
+ * <code>{"asset": {"assetId": ..., "name": ..., "description": ...}, "roles": [{"roleName": ..., "values": {...}}, ...]}</code>
+ *
+ * Records are validated against the cached role schemas and written with JDBC batches of --import-batch-size
+ * records, each batch is committed separately. When a batch fails, its records are retried one by one,
+ * so a single bad record doesn't fail its neighbours.
+ * Existing assets (matched by id or name) and role values are updated.
+ */
+class AssetImport { companion object {
+
+    private val gson = Gson()  // thread safe
+
+    data class ImportRole(val roleName: String, val assetVals: String, val indexedValues: List<Pair<String, String>>)
+    class ImportRecord(val lineNo: Int, val asset: Asset, val roles: List<ImportRole>) {
+        var inserted = false
+    }
+
+    data class RecordResult(val line: Int, val name: String?, val assetId: String?, val code: Int, val message: String)
+    data class Summary(val total: Int, val succeeded: Int, val failed: Int)
+
+    /**
+     * Parse and validate an input line.
+     * @throws StatusException when the record is malformed or does not match the role schemas
+     */
+    @VisibleForTesting
+    internal fun parseRecord(lineNo: Int, line: String, schemaUtils: SchemaUtils): ImportRecord {
+        val root = JsonParser().parse(line)
+        if( !root.isJsonObject )
+            throw StatusException(400, "expected a Json object")
+
+        val assetElm = root.asJsonObject["asset"]
+        if( assetElm == null || !assetElm.isJsonObject )
+            throw StatusException(400, "element 'asset' is required and must be an object")
+
+        val asset = gson.fromJson(assetElm, Asset::class.java)
+        if( asset.assetId == null && asset.name.isNullOrBlank() )
+            throw StatusException(400, "neither asset id nor name is present")
+
+        val roles = mutableListOf<ImportRole>()
+        val rolesElm = root.asJsonObject["roles"]
+        if( rolesElm != null && !rolesElm.isJsonNull ) {
+            if( !rolesElm.isJsonArray )
+                throw StatusException(400, "element 'roles' must be an array")
+
+            for(roleElm in rolesElm.asJsonArray) {
+                val roleName = roleElm.asJsonObject["roleName"]?.asString
+                if( roleName.isNullOrBlank() )
+                    throw StatusException(400, "element 'roleName' is blank")
+                if( roles.any { it.roleName == roleName } )
+                    throw StatusException(400, "role $roleName is listed more than once")
+
+                val valuesElm = roleElm.asJsonObject["values"] ?: JsonObject()
+                try {
+                    val assetVals = schemaUtils.getAssetValue(roleName, valuesElm.toString()).toString()
+                    roles.add(ImportRole(roleName, assetVals, schemaUtils.indexedValues(roleName, assetVals)))
+                } catch(x: StatusException) {
+                    throw StatusException(x, x.code, "role $roleName: ${x.message}")
+                }
+            }
+        }
+
+        // sorting roles protects us from deadlocks, as in merge
+        return ImportRecord(lineNo, asset, roles.sortedBy { it.roleName })
+    }
+
+
+    /**
+     * Assign ids to new assets and names to assets given by id, checking them against the database.
+     * @return error messages by record, for records that can't be imported
+     */
+    private fun resolveAssets(conn: Connection, records: List<ImportRecord>): Map<ImportRecord, String> {
+        val dbIdByName = mutableMapOf<String, UUID>()
+        val dbNameById = mutableMapOf<UUID, String>()
+
+        records.mapNotNull { it.asset.name }.distinct().chunked(AssetRoleValuesApi.IN_LIST_CHUNK_SIZE).forEach { chunk ->
+            conn.prepareStatement("select asset_id, name from assets where name in ${AssetRoleValuesApi.inList(chunk.size)}").use { stmt ->
+                chunk.forEachIndexed { k, name -> stmt.setString(k+1, name) }
+                stmt.executeQuery().use { rs -> while( rs.next() ) dbIdByName[rs.getString(2)] = bytesToUuid(rs.getBytes(1))!! }
+            }
+        }
+
+        records.mapNotNull { it.asset.assetId }.distinct().chunked(AssetRoleValuesApi.IN_LIST_CHUNK_SIZE).forEach { chunk ->
+            conn.prepareStatement("select asset_id, name from assets where asset_id in ${AssetRoleValuesApi.inList(chunk.size)}").use { stmt ->
+                chunk.forEachIndexed { k, id -> stmt.setBytes(k+1, uuidToBytes(id)) }
+                stmt.executeQuery().use { rs -> while( rs.next() ) dbNameById[bytesToUuid(rs.getBytes(1))!!] = rs.getString(2) }
+            }
+        }
+
+        val errors = mutableMapOf<ImportRecord, String>()
+        val batchIdByName = mutableMapOf<String, UUID>()   // the same new asset may occur more than once in the batch
+        for(rec in records) {
+            val asset = rec.asset
+            when {
+                asset.assetId != null && !asset.name.isNullOrBlank() -> {
+                    val dbId = dbIdByName[asset.name!!]
+                    if( dbId != null && dbId != asset.assetId ) {
+                        errors[rec] = "database id $dbId of asset ${asset.name} does not match the supplied ${asset.assetId}"
+                        continue
+                    }
+                    rec.inserted = asset.assetId !in dbNameById
+                }
+
+                asset.assetId != null -> {
+                    asset.name = dbNameById[asset.assetId!!]
+                    if( asset.name == null ) {
+                        errors[rec] = "asset ${asset.assetId} needs to be inserted, but its name was not provided"
+                        continue
+                    }
+                }
+
+                else -> {
+                    val knownId = dbIdByName[asset.name!!] ?: batchIdByName[asset.name!!]
+                    rec.inserted = knownId == null
+                    asset.assetId = knownId ?: UUID.randomUUID()
+                }
+            }
+            batchIdByName.putIfAbsent(asset.name!!, asset.assetId!!)
+        }
+
+        return errors
+    }
+
+
+    /** Write the records with three JDBC batches: assets, role values, and the attribute index */
+    private fun writeRecords(conn: Connection, records: List<ImportRecord>) {
+        // NB: modified_ts is assigned first, while the old column values are still visible
+        conn.prepareStatement(
+                "insert into assets(asset_id, name, description) values(?, ?, ?)" +
+                "  on duplicate key update" +
+                "     modified_ts = if(name <=> values(name) and description <=> values(description), modified_ts, current_timestamp)" +
+                "   , name = values(name), description = values(description)"
+        ).use { stmt ->
+            records.forEach { rec ->
+                stmt.setBytes(1, uuidToBytes(rec.asset.assetId))
+                stmt.setString(2, rec.asset.name)
+                stmt.setString(3, rec.asset.description)
+                stmt.addBatch()
+            }
+            stmt.executeBatch()
+        }
+
+        val roles = records.flatMap { rec -> rec.roles.map { Pair(rec.asset.assetId!!, it) } }
+        if( roles.isEmpty() )
+            return
+
+        conn.prepareStatement(
+                "insert into asset_role_values(asset_id, role_name, asset_vals) values(?, ?, ?)" +
+                "  on duplicate key update" +
+                "     modified_ts = if(asset_vals <=> values(asset_vals), modified_ts, current_timestamp)" +
+                "   , asset_vals = values(asset_vals)"
+        ).use { stmt ->
+            roles.forEach { (assetId, role) ->
+                stmt.setBytes(1, uuidToBytes(assetId))
+                stmt.setString(2, role.roleName)
+                stmt.setString(3, role.assetVals)
+                stmt.addBatch()
+            }
+            stmt.executeBatch()
+        }
+
+        AssetRoleValuesApi.reindex(conn, roles.map { (assetId, role) -> Triple(assetId, role.roleName, role.indexedValues) })
+    }
+
+
+    private fun resultOf(rec: ImportRecord, code: Int, message: String) =
+        RecordResult(rec.lineNo, rec.asset.name, rec.asset.assetId?.toString(), code, message)
+
+    private fun resultOf(rec: ImportRecord) =
+        if( rec.inserted ) resultOf(rec, 201, "inserted") else resultOf(rec, 200, "updated")
+
+    /**
+     * Write a batch in a single transaction. On failure, fall back to one transaction per record.
+     * @return result of every record of the batch
+     */
+    private fun importBatch(conn: Connection, records: List<ImportRecord>): List<RecordResult> {
+        if( records.isEmpty() )
+            return emptyList()
+
+        val results = mutableListOf<RecordResult>()
+        try {
+            val errors = this.resolveAssets(conn, records)
+            errors.forEach { (rec, msg) -> results.add(resultOf(rec, 412, msg)) }
+
+            val goodRecords = records.filter { it !in errors }
+            this.writeRecords(conn, goodRecords)
+            conn.commit()
+            goodRecords.forEach { rec ->
+                catalogCache.invalidateAsset(rec.asset.assetId!!)
+                rec.roles.forEach { catalogCache.invalidateRoleValues(rec.asset.assetId!!, it.roleName) }
+            }
+            goodRecords.forEach { results.add(resultOf(it)) }
+            logger.info { "import: committed batch of ${goodRecords.size} assets, ${errors.size} rejected" }
+
+        } catch(x: SQLException) {
+            conn.rollback()
+            if( records.size == 1 ) {
+                val code = if( x.errorCode == DBERR_DUP_VAL_ON_INDEX ) 409 else StatusMessage(x).code
+                return listOf(resultOf(records[0], code, x.message ?: x.javaClass.name))
+            }
+
+            logger.warn { "import: batch of ${records.size} assets failed, retrying them one by one: ${x.message}" }
+            return records.flatMap { this.importBatch(conn, listOf(it)) }
+        }
+
+        return results.sortedBy { it.line }
+    }
+
+
+    /**
+     * POST /catalog/import/assets
+     *
+     * Streams back NDJSON: a result line per input record, as batches get committed, and a summary line.
+     */
+    fun importAssets(req: Request, rsp: Response): String {
+        val batchSize = req.queryParams("batchSize")?.toIntOrNull()?.takeIf { it > 0 } ?: config.importBatchSize
+        logger.info { "import: starting bulk import of assets with batch size $batchSize" }
+
+        var total = 0
+        var failed = 0
+        val conn: Connection
+        try {
+            conn = databaseStore.getGoodConnection()
+        } catch(x: Exception) {
+            rsp.type("application/json")
+            return formatResponse(rsp, x)
+        }
+
+        rsp.type(NDJSON_CONTENT_TYPE)
+        val out = BufferedWriter(OutputStreamWriter(rsp.raw().outputStream, Charsets.UTF_8))
+        fun report(results: List<RecordResult>) {
+            results.forEach {
+                out.write(gson.toJson(it))
+                out.write("\n")
+                if( it.code >= 300 ) failed++
+            }
+            out.flush()
+        }
+
+        try {
+            conn.use {
+                val batch = mutableListOf<ImportRecord>()
+                var lineNo = 0
+                req.raw().inputStream.bufferedReader(config.charSet).useLines { lines ->
+                    for(line in lines) {
+                        lineNo++
+                        if( line.isBlank() )
+                            continue
+
+                        total++
+                        try {
+                            batch.add(this.parseRecord(lineNo, line, schemaUtils))
+                        } catch(x: Exception) {
+                            val code = (x as? StatusException)?.code ?: 400
+                            report(listOf(RecordResult(lineNo, null, null, code, x.message ?: x.javaClass.name)))
+                            continue
+                        }
+
+                        if( batch.size >= batchSize ) {
+                            report(this.importBatch(conn, batch))
+                            batch.clear()
+                        }
+                    }
+                }
+
+                report(this.importBatch(conn, batch))
+            }
+        } catch(x: Exception) {
+            // the status is already sent, all we can do is to tell about the problem in the body
+            logger.error(x) { "import: aborted after $total records" }
+            out.write(gson.toJson(mapOf("code" to 500, "message" to "import aborted: ${x.message}")))
+            out.write("\n")
+        }
+
+        out.write(gson.toJson(mapOf("summary" to Summary(total, total - failed, failed))))
+        out.write("\n")
+        out.flush()
+        logger.info { "import: finished, $total records, ${total - failed} succeeded, $failed failed" }
+        return ""
+    }
+
+}}
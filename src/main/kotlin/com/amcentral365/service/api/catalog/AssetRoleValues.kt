@@ -1,23 +1,359 @@
 package com.amcentral365.service.api.catalog
 
+import mu.KotlinLogging
+
+import java.lang.Exception
+import java.sql.Connection
+import java.util.ArrayDeque
+import java.util.UUID
+
+import spark.Request
+import spark.Response
+
+import com.google.gson.JsonArray
+import com.google.gson.JsonObject
+import com.google.gson.JsonParseException
+import com.google.gson.JsonParser
+
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.api.directlyReferencedRoles
+import com.amcentral365.service.catalogCache
+import com.amcentral365.service.dao.Asset
+import com.amcentral365.service.dao.bytesToUuid
 import com.amcentral365.service.dao.uuidToBytes
 import com.amcentral365.service.databaseStore
-import java.util.UUID
+import com.amcentral365.service.formatResponse
+import com.amcentral365.service.gson
+import com.amcentral365.service.schemaUtils
+import com.amcentral365.service.toJsonArray
+
+import com.amcentral365.service.dao.AssetRoleValues as AssetRoleValuesDAO
+
+private val logger = KotlinLogging.logger {}
+
 
 class AssetRoleValues { companion object {
 
-    fun hasRole(assetId: UUID, roleName: String): Boolean {
-        databaseStore.getGoodConnection().use { conn ->
-            conn.prepareStatement("select null from asset_role_values where asset_id = ? and role_name = ?").use { stmt ->
+    /** Max number of binds in a single IN list, larger lists are queried in chunks */
+    internal const val IN_LIST_CHUNK_SIZE = 500
+
+    fun hasRole(assetId: UUID, roleName: String): Boolean = catalogCache.hasRole(assetId, roleName)
+
+    internal fun inList(size: Int) = List(size) { "?" }.joinToString(", ", prefix = "(", postfix = ")")
+
+    /**
+     * Map asset keys (ids or names) to asset ids.
+     *
+     * Keys are looked up with <code>name in (...) or asset_id in (...)</code> queries, one per [IN_LIST_CHUNK_SIZE]
+     * keys, so ids are checked to exist in the same round trip as names are resolved. A key parsing as UUID is
+     * taken as an id when an asset has it, as a name otherwise. Keys that were not found are absent from the
+     * returned map.
+     */
+    internal fun resolveAssetKeys(conn: Connection, assetKeys: Collection<String>): Map<String, UUID> {
+        val resolved = mutableMapOf<String, UUID>()
+
+        assetKeys.distinct().chunked(IN_LIST_CHUNK_SIZE).forEach { chunk ->
+            val names = chunk.toHashSet()
+            val keysById = mutableMapOf<UUID, MutableList<String>>()    // "1-2-3-4-5" parses, it isn't canonical
+            chunk.forEach { key ->
+                try {
+                    keysById.getOrPut(UUID.fromString(key)) { mutableListOf() }.add(key)
+                } catch(x: IllegalArgumentException) {
+                    // a name
+                }
+            }
+
+            val idFilter = if( keysById.isEmpty() ) "" else " or asset_id in ${inList(keysById.size)}"
+            conn.prepareStatement("select asset_id, name from assets where name in ${inList(chunk.size)}$idFilter").use { stmt ->
+                var bindPos = 1
+                chunk.forEach { stmt.setString(bindPos++, it) }
+                keysById.keys.forEach { stmt.setBytes(bindPos++, uuidToBytes(it)) }
+
+                val byName = mutableMapOf<String, UUID>()
+                stmt.executeQuery().use { rs ->
+                    while( rs.next() ) {
+                        val assetId = bytesToUuid(rs.getBytes(1))!!
+                        val name = rs.getString(2)
+                        if( name in names )     // not when found by its id only
+                            byName[name] = assetId
+                        keysById[assetId]?.forEach { resolved[it] = assetId }
+                    }
+                }
+                byName.forEach { (name, assetId) -> resolved.putIfAbsent(name, assetId) }   // ids take precedence
+            }
+        }
+
+        return resolved
+    }
+
+    /**
+     * Fetch assets by their ids, and whether each has the role [roleName]. One query per [IN_LIST_CHUNK_SIZE] ids.
+     *
+     * @return found assets, with true when the asset has the role
+     */
+    internal fun fetchAssetsWithRole(conn: Connection, assetIds: Collection<UUID>, roleName: String): Map<UUID, Pair<Asset, Boolean>> {
+        val found = mutableMapOf<UUID, Pair<Asset, Boolean>>()
+        assetIds.distinct().chunked(IN_LIST_CHUNK_SIZE).forEach { chunk ->
+            val sql = "select a.asset_id, a.name, a.description, a.created_by, a.modified_by, a.created_ts, a.modified_ts," +
+                      "       exists(select 1 from asset_role_values v where v.asset_id = a.asset_id and v.role_name = ?)" +
+                      "  from assets a where a.asset_id in ${inList(chunk.size)}"
+            conn.prepareStatement(sql).use { stmt ->
+                stmt.setString(1, roleName)
+                chunk.forEachIndexed { k, assetId -> stmt.setBytes(k+2, uuidToBytes(assetId)) }
+                stmt.executeQuery().use { rs ->
+                    while( rs.next() ) {
+                        val asset = Asset(bytesToUuid(rs.getBytes(1)), rs.getString(2))
+                        asset.description = rs.getString(3)
+                        asset.createdBy   = rs.getString(4)
+                        asset.modifiedBy  = rs.getString(5)
+                        asset.createdTs   = rs.getTimestamp(6)
+                        asset.modifiedTs  = rs.getTimestamp(7)
+                        found[asset.assetId!!] = Pair(asset, rs.getBoolean(8))
+                    }
+                }
+            }
+        }
+
+        return found
+    }
+
+    /**
+     * Fetch role values of many assets at once.
+     *
+     * @param roleNames when empty, all roles of the assets are returned.
+     */
+    internal fun fetchRoleValues(conn: Connection, assetIds: Collection<UUID>, roleNames: Collection<String>): List<AssetRoleValuesDAO> {
+        val roleFilter = if( roleNames.isEmpty() ) "" else " and role_name in ${inList(roleNames.size)}"
+        val values = mutableListOf<AssetRoleValuesDAO>()
+
+        assetIds.distinct().chunked(IN_LIST_CHUNK_SIZE).forEach { chunk ->
+            val sql = "select asset_id, role_name, asset_vals, created_by, modified_by, created_ts, modified_ts" +
+                      "  from asset_role_values where asset_id in ${inList(chunk.size)}$roleFilter"
+            conn.prepareStatement(sql).use { stmt ->
+                var bindPos = 1
+                chunk.forEach { stmt.setBytes(bindPos++, uuidToBytes(it)) }
+                roleNames.forEach { stmt.setString(bindPos++, it) }
+                stmt.executeQuery().use { rs ->
+                    while( rs.next() ) {
+                        val arv = AssetRoleValuesDAO(bytesToUuid(rs.getBytes(1))!!, rs.getString(2), rs.getString(3))
+                        arv.createdBy  = rs.getString(4)
+                        arv.modifiedBy = rs.getString(5)
+                        arv.createdTs  = rs.getTimestamp(6)
+                        arv.modifiedTs = rs.getTimestamp(7)
+                        values.add(arv)
+                    }
+                }
+            }
+        }
+
+        return values
+    }
+
+    /**
+     * Replace indexed attribute values of an asset role in table ASSET_ROLE_ATTRS.
+     *
+     * Runs in the caller's transaction, so the index is committed together with the role values.
+     * @param values (attribute name, value) pairs as returned by [com.amcentral365.service.api.SchemaUtils.indexedValues]
+     */
+    internal fun reindex(conn: Connection, assetId: UUID, roleName: String, values: List<Pair<String, String>>) =
+        this.reindex(conn, listOf(Triple(assetId, roleName, values)))
+
+    /** Batched [reindex] of many asset roles: one batch of deletes and one of inserts. */
+    internal fun reindex(conn: Connection, items: List<Triple<UUID, String, List<Pair<String, String>>>>) {
+        if( items.isEmpty() )
+            return
+
+        conn.prepareStatement("delete from asset_role_attrs where asset_id = ? and role_name = ?").use { stmt ->
+            items.forEach { (assetId, roleName, _) ->
                 stmt.setBytes(1, uuidToBytes(assetId))
                 stmt.setString(2, roleName)
+                stmt.addBatch()
+            }
+            stmt.executeBatch()
+        }
+
+        if( items.all { it.third.isEmpty() } )
+            return
+
+        var valueCount = 0
+        conn.prepareStatement("insert into asset_role_attrs(asset_id, role_name, attr_name, attr_val) values(?, ?, ?, ?)").use { stmt ->
+            items.forEach { (assetId, roleName, values) ->
+                val assetIdBytes = uuidToBytes(assetId)
+                values.distinct().forEach { (attrName, attrVal) ->
+                    stmt.setBytes(1, assetIdBytes)
+                    stmt.setString(2, roleName)
+                    stmt.setString(3, attrName)
+                    stmt.setString(4, attrVal)
+                    stmt.addBatch()
+                    valueCount++
+                }
+            }
+            stmt.executeBatch()
+        }
+        logger.debug { "indexed $valueCount attribute values of ${items.size} asset roles" }
+    }
+
+    /** The indexed attributes of [roleName], see [com.amcentral365.service.api.SchemaUtils.indexedAttributes]. Empty for unknown roles. */
+    internal fun indexedAttributes(roleName: String): Set<String> =
+        try {
+            schemaUtils.indexedAttributes(roleName)
+        } catch(x: StatusException) {
+            if( x.code != 404 )
+                throw x
+            emptySet()
+        }
+
+    /**
+     * Rebuild the attribute index after the schema of [roleName] was changed, if its indexed attributes ('^') differ
+     * from [indexedBefore]. The index of the roles referencing [roleName] is rebuilt too, as their attributes
+     * include those of [roleName]. Call after the role was invalidated in the schema cache.
+     *
+     * @return the number of reindexed asset roles
+     */
+    internal fun reindexIfChanged(roleName: String, indexedBefore: Set<String>): Int {
+        if( this.indexedAttributes(roleName) == indexedBefore )
+            return 0
+
+        return databaseStore.getGoodConnection().use { conn ->
+            val roleNames = this.referencingRoles(conn, roleName)
+            logger.info { "indexed attributes of role $roleName changed, reindexing roles ${roleNames.joinToString(", ")}" }
+            roleNames.map { this.reindexRole(conn, it) }.sum()
+        }
+    }
+
+    /**
+     * Rebuild the attribute index of all roles with indexed attributes, e.g. after values were written before the
+     * attributes were marked as indexed, or before the index existed. Roles whose schema fails to load are skipped.
+     *
+     * @return the number of reindexed asset roles
+     */
+    fun rebuildIndex(): Int =
+        databaseStore.getGoodConnection().use { conn ->
+            val roleNames = mutableListOf<String>()
+            conn.prepareStatement("select distinct role_name from asset_role_values").use { stmt ->
                 stmt.executeQuery().use { rs ->
-                    return rs.next() && !rs.next()
+                    while( rs.next() )
+                        roleNames.add(rs.getString(1))
                 }
             }
+
+            roleNames.map { roleName ->
+                try {
+                    if( this.indexedAttributes(roleName).isEmpty() ) 0 else this.reindexRole(conn, roleName)
+                } catch(x: StatusException) {
+                    logger.warn { "not indexing role $roleName: ${x.message}" }
+                    0
+                }
+            }.sum()
         }
+
+    /** [roleName] and the roles referencing it, directly or through other roles */
+    private fun referencingRoles(conn: Connection, roleName: String): Set<String> {
+        val referencedBy = mutableMapOf<String, MutableSet<String>>()
+        conn.prepareStatement("select name, role_schema from roles").use { stmt ->
+            stmt.executeQuery().use { rs ->
+                while( rs.next() ) {
+                    val referencing = rs.getString(1)
+                    val referenced = try {
+                        directlyReferencedRoles(rs.getString(2))
+                    } catch(x: JsonParseException) {
+                        emptySet<String>()      // can't be saved, see SchemaUtils.validateAndCompile
+                    }
+                    referenced.forEach { referencedBy.getOrPut(it) { mutableSetOf() }.add(referencing) }
+                }
+            }
+        }
+
+        val found = mutableSetOf(roleName)
+        val pending = ArrayDeque(listOf(roleName))
+        while( pending.isNotEmpty() )
+            referencedBy[pending.poll()].orEmpty().filter { found.add(it) }.forEach { pending.add(it) }
+        return found
+    }
+
+    /** Rebuild the index of all values of [roleName], committing every [IN_LIST_CHUNK_SIZE] asset roles */
+    private fun reindexRole(conn: Connection, roleName: String): Int {
+        var count = 0
+        var afterAssetId: UUID? = null
+        while( true ) {
+            val sql = "select asset_id, asset_vals from asset_role_values where role_name = ?" +
+                      (if( afterAssetId == null ) "" else " and asset_id > ?") +
+                      " order by asset_id limit $IN_LIST_CHUNK_SIZE"
+            val chunk = mutableListOf<Pair<UUID, String>>()
+            conn.prepareStatement(sql).use { stmt ->
+                stmt.setString(1, roleName)
+                afterAssetId?.let { stmt.setBytes(2, uuidToBytes(it)) }
+                stmt.executeQuery().use { rs ->
+                    while( rs.next() )
+                        chunk.add(Pair(bytesToUuid(rs.getBytes(1))!!, rs.getString(2)))
+                }
+            }
+            if( chunk.isEmpty() )
+                break
+
+            this.reindex(conn, chunk.map { (assetId, assetVals) -> Triple(assetId, roleName, schemaUtils.indexedValues(roleName, assetVals)) })
+            conn.commit()
+            count += chunk.size
+            afterAssetId = chunk.last().first
+        }
+
+        logger.info { "reindexed $count values of role $roleName" }
+        return count
+    }
+
+    /** Attribute names are schema paths, allow callers to omit the root: 'hostname' means '$.hostname' */
+    internal fun normalizeAttrName(attrName: String): String =
+        if( attrName == "$" || attrName.startsWith("$.") ) attrName else "$.$attrName"
+
+    /**
+     * SQL condition on <code>asset_id</code> selecting assets by an indexed role attribute.
+     *
+     * @param attrLike when true, [attrVal] is a LIKE pattern, otherwise an exact value.
+     * @return the condition and its bind values
+     */
+    internal fun attrFilter(roleName: String, attrName: String, attrVal: String, attrLike: Boolean): Pair<String, List<Any>> =
+        Pair("asset_id in (select asset_id from asset_role_attrs where role_name = ? and attr_name = ? and attr_val ${if( attrLike ) "like" else "="} ?)",
+             listOf(roleName, normalizeAttrName(attrName), attrVal))
+
+    private fun jsonStringList(body: JsonObject, name: String, required: Boolean): List<String> {
+        val elm = body.get(name)
+        if( elm == null || elm.isJsonNull ) {
+            if( required )
+                throw StatusException(400, "parameter '$name' is required")
+            return emptyList()
+        }
+        if( !elm.isJsonArray || !elm.asJsonArray.all { it.isJsonPrimitive } )
+            throw StatusException(400, "parameter '$name' must be an array of strings")
+        return (elm as JsonArray).map { it.asString.trim() }.filter { it.isNotEmpty() }
     }
 
+    /**
+     * POST /catalog/assetRoles/lookup
+     *
+     * Body: <code>{"assetKeys": [id or name, ...], "roleNames": [...]}</code>, roleNames is optional.
+     * Everything is resolved on a single connection with a few IN queries, rather than a request per asset.
+     * Returns <code>{"assetRoleValues": [...], "notFound": [asset keys]}</code>.
+     */
+    fun lookup(req: Request, rsp: Response): String {
+        rsp.type("application/json")
+        return try {
+            val body = JsonParser().parse(req.body()).asJsonObject
+            val assetKeys = jsonStringList(body, "assetKeys", true)
+            val roleNames = jsonStringList(body, "roleNames", false)
+            logger.info { "bulk lookup of ${assetKeys.size} assets, roles: ${if( roleNames.isEmpty() ) "all" else roleNames.joinToString(", ")}" }
+
+            databaseStore.getGoodConnection().use { conn ->
+                val assetIds = this.resolveAssetKeys(conn, assetKeys)
+                val values = this.fetchRoleValues(conn, assetIds.values, roleNames)
+                val notFound = assetKeys.filter { !assetIds.containsKey(it) }.distinct()
+                logger.info { "bulk lookup returned ${values.size} values, ${notFound.size} assets were not found" }
 
+                """{"assetRoleValues": ${toJsonArray(values)}, "notFound": ${gson.toJson(notFound)}}"""
+            }
+        } catch(x: Exception) {
+            logger.info { "error in bulk lookup of asset roles: ${x.message}" }
+            formatResponse(rsp, if( x is IllegalStateException || x is JsonParseException ) StatusException(x, 400) else x)
+        }
+    }
 
 }}
@@ -14,13 +14,21 @@ import com.amcentral365.pl4kotlin.closeIfCan
 
 import com.amcentral365.service.StatusException
 import com.amcentral365.service.StatusMessage
+import com.amcentral365.service.NEXT_PAGE_HEADER
 import com.amcentral365.service.combineRequestParams
+import com.amcentral365.service.decodePageCursor
+import com.amcentral365.service.encodePageCursor
 import com.amcentral365.service.dao.Asset
 import com.amcentral365.service.dao.AssetRoleValues
 import com.amcentral365.service.formatResponse
 import com.amcentral365.service.toJsonArray
+import com.amcentral365.service.streamJsonArray
+import com.amcentral365.service.STREAM_FETCH_SIZE
+import com.amcentral365.service.wantsNdjson
+import com.amcentral365.service.catalogCache
 import com.amcentral365.service.databaseStore
 import com.amcentral365.service.schemaUtils
+import com.amcentral365.service.api.catalog.AssetRoleValues as AssetRoleValuesApi
 import java.lang.IllegalArgumentException
 
 private val logger = KotlinLogging.logger {}
@@ -49,6 +57,14 @@ class Assets { companion object {
 
     /**
      * /catalog/assets
+     *
+     * Pages are fetched by key: the 'after' cursor (see [NEXT_PAGE_HEADER]) is pushed into the SQL as
+     * <code>name > ?</code>, so each page costs O(limit). The 'skip' parameter is the legacy way of paging,
+     * it reads and discards all skipped rows.
+     * The rows are streamed to the client as they are fetched, as a JSON array or as NDJSON.
+     *
+     * Assets can be filtered by a role attribute with 'role', 'attr', and 'attrValue' or 'attrLike'.
+     * Only attributes marked as indexed ('^') in the role schema are searchable, others are rejected with 400.
      */
     fun listAssets(req: Request, rsp: Response): String {
         val asset = Asset()
@@ -60,20 +76,73 @@ class Assets { companion object {
             val nameLike  = paramMap.getOrDefault("nameLike", "").trim()
             val skipCount = paramMap.getOrDefault("skip",  "0").toInt()
             val limit     = paramMap.getOrDefault("limit", "0").toInt()
+            val afterName = paramMap["after"]?.let { decodePageCursor(it) }
+            val ndjson    = wantsNdjson(req, paramMap)
             val fetchLimit = if( limit > 0 ) limit else Int.MAX_VALUE
-            logger.debug { "name pattern '$nameLike', skipCount $skipCount, limit: $limit, fetchLimit: $fetchLimit" }
+            logger.debug { "name pattern '$nameLike', after '$afterName', skipCount $skipCount, limit: $limit, fetchLimit: $fetchLimit" }
+
+            if( afterName != null && skipCount > 0 )
+                return formatResponse(rsp, 400, "parameters 'after' and 'skip' are mutually exclusive")
+
+            // the filters are shared by the page key query and the row query
+            val filters = mutableListOf<String>()
+            val filterBinds = mutableListOf<Any?>()
+            if( nameLike.isNotEmpty() ) {
+                filters.add("name like ?")
+                filterBinds.add(nameLike)
+            }
+
+            val attrRole = paramMap["role"]
+            val attrName = paramMap["attr"]
+            val attrValue = paramMap["attrValue"]
+            val attrLike  = paramMap["attrLike"]
+            if( attrRole != null || attrName != null || attrValue != null || attrLike != null ) {
+                if( attrRole == null || attrName == null )
+                    return formatResponse(rsp, 400, "attribute search requires both 'role' and 'attr' parameters")
+                if( (attrValue == null) == (attrLike == null) )
+                    return formatResponse(rsp, 400, "attribute search requires exactly one of 'attrValue' or 'attrLike'")
+                if( AssetRoleValuesApi.normalizeAttrName(attrName) !in AssetRoleValuesApi.indexedAttributes(attrRole) )
+                    return formatResponse(rsp, 400, "attribute '$attrName' of role $attrRole is not indexed, " +
+                                                    "only attributes marked with '^' in the role schema are searchable")
+                val (attrFilter, attrBinds) = AssetRoleValuesApi.attrFilter(attrRole, attrName, attrValue ?: attrLike!!, attrLike != null)
+                filters.add(attrFilter)
+                filterBinds.addAll(attrBinds)
+                logger.debug { "attribute search: role $attrRole, attr $attrName, ${if( attrLike != null ) "like '$attrLike'" else "value '$attrValue'"}" }
+            }
 
             val selStmt = SelectStatement(asset, databaseStore::getGoodConnection)
                     .select(Asset::assetId)
                     .select(Asset::name)
                     .select(Asset::modifiedTs)
                     .orderBy(Asset::name)
-            if( nameLike.isNotEmpty() )
-                selStmt.by("name like ?", nameLike)
 
-            conn = databaseStore.getGoodConnection()
-            val defs = selStmt.iterate(conn).asSequence().filterIndexed{k, _ -> k >= skipCount}.take(fetchLimit).toList()
-            return toJsonArray(defs)
+            fun selectBy(keyCondition: String?, vararg keyBinds: Any?) {
+                val conditions = listOfNotNull(keyCondition) + filters
+                if( conditions.isNotEmpty() )
+                    selStmt.by(conditions.joinToString(" and "), *(keyBinds.toList() + filterBinds).toTypedArray())
+            }
+
+            conn = databaseStore.getStreamingConnection(STREAM_FETCH_SIZE)
+
+            if( skipCount > 0 || (afterName == null && limit <= 0) ) {   // legacy or unlimited listing
+                selectBy(null)
+                return streamJsonArray(rsp, selStmt.iterate(conn).asSequence().filterIndexed{k, _ -> k >= skipCount}.take(fetchLimit), ndjson)
+            }
+
+            if( limit <= 0 ) {  // everything after the cursor
+                selectBy("name > ?", afterName)
+                return streamJsonArray(rsp, selStmt.iterate(conn).asSequence(), ndjson)
+            }
+
+            val pageNames = databaseStore.fetchPageKeys(conn, asset.tableName, "name", afterName, limit,
+                                    if( filters.isEmpty() ) null else filters.joinToString(" and "), *filterBinds.toTypedArray())
+            if( pageNames.isEmpty() )
+                return streamJsonArray(rsp, emptySequence(), ndjson)
+
+            selectBy("name between ? and ?", pageNames.first(), pageNames.last())
+            if( pageNames.size == limit )
+                rsp.header(NEXT_PAGE_HEADER, encodePageCursor(pageNames.last()))
+            return streamJsonArray(rsp, selStmt.iterate(conn).asSequence().take(limit), ndjson)
 
         } catch(x: Exception) {
             logger.error { "error querying assets: ${x.message}" }
@@ -192,6 +261,7 @@ class Assets { companion object {
                 return formatResponse(rsp, 400, "parameter 'name' is required")
 
             val msg = databaseStore.insertObjectAsRow(asset)
+            asset.assetId?.let { catalogCache.invalidateAsset(it) }   // may have been cached as absent
             logger.info { "create asset ${asset.name}: ${msg.msg}" }
             formatResponse(rsp, msg, jsonIfOk = true)
 
@@ -212,6 +282,7 @@ class Assets { companion object {
             logger.info { "updating asset '${asset.assetId}', name '${asset.name}'" }
 
             val msg = databaseStore.updateObjectAsRow(asset)
+            catalogCache.invalidateAsset(asset.assetId!!)
             logger.info { "update asset ${asset.assetId}, name '${asset.name}' succeeded: $msg" }
 
             formatResponse(rsp, msg, jsonIfOk = true)
@@ -238,8 +309,12 @@ class Assets { companion object {
                 return formatResponse(rsp, 400, "parameter 'assetVals' is required")
 
             schemaUtils.validateAssetValue(assetRoleValues.roleName!!, assetRoleValues.assetVals!!)
+            val indexedValues = schemaUtils.indexedValues(assetRoleValues.roleName!!, assetRoleValues.assetVals!!)
 
-            val msg = databaseStore.insertObjectAsRow(assetRoleValues)
+            val msg = databaseStore.insertObjectAsRow(assetRoleValues) { conn ->
+                AssetRoleValuesApi.reindex(conn, assetRoleValues.assetId!!, assetRoleValues.roleName!!, indexedValues)
+            }
+            catalogCache.invalidateRoleValues(assetRoleValues.assetId!!, assetRoleValues.roleName)
             logger.info { "add asset role ${assetRoleValues.roleName}: ${msg.msg}" }
             formatResponse(rsp, msg, jsonIfOk = true)
 
@@ -264,9 +339,13 @@ class Assets { companion object {
                 return formatResponse(rsp, 400, "parameter 'assetVals' is required")
 
             schemaUtils.validateAssetValue(assetRoleValues.roleName!!, assetRoleValues.assetVals!!)
+            val indexedValues = schemaUtils.indexedValues(assetRoleValues.roleName!!, assetRoleValues.assetVals!!)
             logger.info { "updating role ${assetRoleValues.roleName} of asset ${assetRoleValues.assetId}" }
 
-            val msg = databaseStore.updateObjectAsRow(assetRoleValues)
+            val msg = databaseStore.updateObjectAsRow(assetRoleValues) { conn ->
+                AssetRoleValuesApi.reindex(conn, assetRoleValues.assetId!!, assetRoleValues.roleName!!, indexedValues)
+            }
+            catalogCache.invalidateRoleValues(assetRoleValues.assetId!!, assetRoleValues.roleName)
             logger.info { "updating role ${assetRoleValues.roleName} of asset ${assetRoleValues.assetId} succeeded: $msg" }
 
             formatResponse(rsp, msg, jsonIfOk = true)
@@ -300,6 +379,8 @@ class Assets { companion object {
             }
 
             val cnt = DeleteStatement(asset).by(asset::assetId).run(conn)
+            catalogCache.invalidateAsset(asset.assetId!!)
+            catalogCache.invalidateRoleValues(asset.assetId!!)
             if( cnt == 0 )
                 return formatResponse(rsp, 400, "asset with id ${asset.assetId} and modifyTs ${asset.modifiedTs} was not found")
 
@@ -325,6 +406,7 @@ class Assets { companion object {
             logger.info { "deleting roles of asset '${assetRoleValues.assetId}'" }
 
             val cnt = DeleteStatement(assetRoleValues, databaseStore::getGoodConnection).by(assetRoleValues::assetId).run()
+            catalogCache.invalidateRoleValues(assetRoleValues.assetId!!)
             if( cnt == 0 )
                 return formatResponse(rsp, 404, "no roles were deleted: either asset '${assetRoleValues.assetId}' does not exist, or has no roles")
 
@@ -350,6 +432,7 @@ class Assets { companion object {
             logger.info { "deleting $msgRoleOf" }
 
             val msg = databaseStore.deleteObjectRow(assetRoleValues)
+            catalogCache.invalidateRoleValues(assetRoleValues.assetId!!, assetRoleValues.roleName)
             logger.info { "deleting $msgRoleOf succeeded: $msg" }
             formatResponse(rsp, msg)
         } catch(x: Exception) {
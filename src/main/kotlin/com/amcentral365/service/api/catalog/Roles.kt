@@ -10,9 +10,16 @@ import com.amcentral365.pl4kotlin.SelectStatement
 import com.amcentral365.pl4kotlin.closeIfCan
 import com.amcentral365.service.formatResponse
 import com.amcentral365.service.combineRequestParams
+import com.amcentral365.service.NEXT_PAGE_HEADER
+import com.amcentral365.service.decodePageCursor
+import com.amcentral365.service.encodePageCursor
 import com.amcentral365.service.StatusException
 import com.amcentral365.service.toJsonArray
+import com.amcentral365.service.streamJsonArray
+import com.amcentral365.service.STREAM_FETCH_SIZE
+import com.amcentral365.service.wantsNdjson
 import com.amcentral365.service.databaseStore
+import com.amcentral365.service.catalogCache
 import com.amcentral365.service.schemaUtils
 
 import com.amcentral365.service.dao.Role
@@ -24,6 +31,12 @@ class Roles { companion object {
 
     private val restToColDef = Role().allCols.map { it.restParamName to it }.toMap()
 
+    /**
+     * /catalog/roles
+     *
+     * Supports keyset paging by role name with the 'after' cursor, see [NEXT_PAGE_HEADER].
+     * 'skip' is kept for compatibility, it reads and discards the skipped rows.
+     */
     fun listRoles(req: Request, rsp: Response): String {
         rsp.type("application/json")
         val paramMap = combineRequestParams(req)
@@ -38,11 +51,17 @@ class Roles { companion object {
         val skipCount = paramMap.getOrDefault("skip", "0").toInt()
         val limit = paramMap.getOrDefault("limit", "0").toInt()
         val fetchLimit = if( limit > 0 ) limit else Int.MAX_VALUE
-        logger.debug { "skipCount $skipCount, limit: $limit, fetchLimit: $fetchLimit" }
+        val afterName = try { paramMap["after"]?.let { decodePageCursor(it) } } catch(x: StatusException) { return formatResponse(rsp, x) }
+        logger.debug { "skipCount $skipCount, limit: $limit, fetchLimit: $fetchLimit, after: $afterName" }
+        if( afterName != null && skipCount > 0 )
+            return formatResponse(rsp, 400, "parameters 'after' and 'skip' are mutually exclusive")
 
         role.assignFrom(paramMap)
         logger.debug { "roleName: ${role.roleName}" }
-        val selStmt = SelectStatement(role).byPresentValues()
+        val selStmt = SelectStatement(role).byPresentValues().orderBy(Role::roleName)
+        val keysetPaging = role.roleName == null && skipCount == 0 && (afterName != null || limit > 0)
+        if( keysetPaging && afterName != null )
+            selStmt.by("name > ?", afterName)
 
         when {
             field.isNotEmpty() -> {
@@ -62,13 +81,23 @@ class Roles { companion object {
             else -> selStmt.select(role.allCols)
         }
 
+        // the next page cursor is built from the role name, make sure it is fetched
+        if( keysetPaging && (field.isNotEmpty() || fields.isNotEmpty()) && field != "roleName" && !fields.split(',').contains("roleName") )
+            selStmt.select(Role::roleName)
+
         logger.debug { "roleName ${role.roleName}, stmt: ${selStmt.build()}" }
         var conn: Connection? = null
         return try {
 
-            conn = databaseStore.getGoodConnection()
-            val defs = selStmt.iterate(conn).asSequence().filterIndexed { k, _ -> k >= skipCount }.take(fetchLimit).toList()
+            conn = databaseStore.getStreamingConnection(STREAM_FETCH_SIZE)
+            val rows = selStmt.iterate(conn).asSequence().filterIndexed { k, _ -> k >= skipCount }.take(fetchLimit)
+            if( role.roleName == null && limit <= 0 ) {  // unbounded listing, don't materialize it
+                logger.info { "roleName: ${role.roleName}, streaming all items" }
+                return streamJsonArray(rsp, rows, wantsNdjson(req, paramMap),
+                                       if( field.isNotEmpty() ) this.restToColDef.getValue(field).columnName else null)
+            }
 
+            val defs = rows.toList()
             if( role.roleName != null ) {  // A concrete role GET
                 if( defs.isEmpty() )
                     return formatResponse(rsp, 404, "role '${role.roleName}' was not found")
@@ -77,6 +106,8 @@ class Roles { companion object {
             }
 
             logger.info { "roleName: ${role.roleName}, returning ${defs.size} items" }
+            if( keysetPaging && limit > 0 && defs.size == limit )
+                rsp.header(NEXT_PAGE_HEADER, encodePageCursor((defs.last() as Role).roleName!!))
             return toJsonArray(defs, if( field.isNotEmpty() ) this.restToColDef.getValue(field).columnName else null)
 
         } catch(x: Exception) {
@@ -103,11 +134,13 @@ class Roles { companion object {
                 schemaUtils.validateAndCompile(role.roleName!!, role.roleSchema!!)
 
             val msg = databaseStore.insertObjectAsRow(role)
+            schemaUtils.invalidate(role.roleName!!)   // the cached role and roles referencing it, saved or not
             logger.info { "created role ${role.roleName}: ${msg.msg}" }
             return formatResponse(rsp, msg, jsonIfOk = true)
 
         } catch(x: Exception) {
             logger.error { "error creating role ${role.roleName}: ${x.message}" }
+            role.roleName?.let { schemaUtils.invalidate(it) }
             return formatResponse(rsp, x)
         }
     }
@@ -123,15 +156,21 @@ class Roles { companion object {
 
             if( role.roleName == null )
                 return formatResponse(rsp, 400, "parameter 'roleName' is required")
+            val indexedBefore = role.roleSchema?.let { AssetRoleValues.indexedAttributes(role.roleName!!) }    // before caching the new schema
             if( role.roleSchema != null )
                 schemaUtils.validateAndCompile(role.roleName!!, role.roleSchema!!)
 
             val msg = databaseStore.updateObjectAsRow(role)
+            schemaUtils.invalidate(role.roleName!!)   // the cached role and roles referencing it, saved or not
+            catalogCache.invalidateRole(role.roleName!!)  // defaults of the role values may have changed
+            if( indexedBefore != null && msg.isOk )
+                AssetRoleValues.reindexIfChanged(role.roleName!!, indexedBefore)
             logger.info { "update role ${role.roleName} succeeded: $msg" }
             return formatResponse(rsp, msg, jsonIfOk = true)
 
         } catch(x: Exception) {
             logger.error { "error updating role ${role.roleName}: ${x.message}" }
+            role.roleName?.let { schemaUtils.invalidate(it) }
             return formatResponse(rsp, x)
         }
     }
@@ -148,6 +187,8 @@ class Roles { companion object {
 
             logger.info { "deleting role '${role.roleName}'" }
             val msg = databaseStore.deleteObjectRow(role)
+            schemaUtils.invalidate(role.roleName!!)
+            catalogCache.invalidateRole(role.roleName!!)
             logger.info { "delete role ${role.roleName} succeeded: $msg" }
             return formatResponse(rsp, msg)
         } catch(x: Exception) {
@@ -0,0 +1,238 @@
+package com.amcentral365.service.dao
+
+import mu.KotlinLogging
+
+import java.sql.Timestamp
+import java.util.UUID
+import java.util.concurrent.TimeUnit
+
+import com.google.common.cache.CacheBuilder
+import com.google.common.cache.CacheLoader
+import com.google.common.cache.LoadingCache
+import com.google.common.util.concurrent.Futures
+import com.google.common.util.concurrent.ListenableFuture
+import com.google.common.util.concurrent.UncheckedExecutionException
+
+import com.google.gson.JsonElement
+import com.google.gson.JsonParser
+
+import com.amcentral365.pl4kotlin.SelectStatement
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.databaseStore
+import com.amcentral365.service.schemaUtils
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Read-through cache of assets and their role values, used to resolve scripts and targets of executions.
+ *
+ * Entries are refreshed when they are older than [ttlSec]. Refresh reads just <code>modified_ts</code>
+ * of the row and keeps the entry when it hasn't changed. Catalog write endpoints invalidate the entries
+ * they modify, so the TTL only matters for changes made by other cluster nodes. Role values with defaults
+ * follow the schema cache instead: they are redone when their role schema is reloaded, see [SchemaUtils.invalidate]
+ * and [SchemaUtils.checkVersions].
+ *
+ * Cached objects aren't handed out: assets are returned as copies, role values as JSON to deserialize.
+ * Absent assets and role values are cached too, so [hasRole] checks don't go to the database either.
+ *
+ * @param maxSize how many assets and, separately, how many asset role values are cached. 0 disables caching.
+ */
+class CatalogCache(maxSize: Long, ttlSec: Long, private val source: Source = DbSource) {
+
+    /** Where the cache loads data from, the database by default */
+    interface Source {
+        fun asset(assetId: UUID): Asset?
+        fun assetByName(name: String): Asset?
+        fun assetModifiedTs(assetId: UUID): Timestamp?
+        fun roleValues(assetId: UUID, roleName: String): AssetRoleValues?
+        fun roleValuesModifiedTs(assetId: UUID, roleName: String): Timestamp?
+    }
+
+    private data class RoleKey(val assetId: UUID, val roleName: String)
+
+    /** An asset, or its absence */
+    private class CachedAsset(val asset: Asset?)
+
+    /** Role values of an asset, or their absence when [assetVals] is null */
+    class CachedRoleValues(val roleName: String, val assetVals: String?, val modifiedTs: Timestamp?) {
+        /** The stored values */
+        val parsed: JsonElement? by lazy { this.assetVals?.let { JsonParser().parse(it) } }
+
+        /** The defaults-assigned values and the [SchemaUtils.schemaGeneration] they were assigned with */
+        @Volatile private var defaults: Pair<Any, JsonElement>? = null
+
+        /**
+         * The stored values with defaults of absent attributes assigned. The defaults come from the role schema,
+         * and are assigned again when the schema, or a schema it references, has changed since.
+         */
+        val withDefaults: JsonElement? get() {
+            val parsed = this.parsed ?: return null
+            val generation = schemaUtils.schemaGeneration(this.roleName)    // before assigning: a newer schema only causes a redo
+            this.defaults?.let { (assignedWith, values) -> if( assignedWith === generation ) return values }
+            return schemaUtils.assignDefaultValues(this.roleName, parsed).also { this.defaults = Pair(generation, it) }
+        }
+    }
+
+    private fun <K, V> newCache(maxSize: Long, ttlSec: Long, loader: (K) -> V, isCurrent: (K, V) -> Boolean): LoadingCache<K, V> =
+        CacheBuilder.newBuilder()
+            .maximumSize(maxSize)
+            .refreshAfterWrite(maxOf(ttlSec, 1), TimeUnit.SECONDS)
+            .recordStats()
+            .build(object: CacheLoader<K, V>() {
+                override fun load(key: K): V = loader(key)
+
+                // NB: runs on the reading thread, which gets the old value if the refresh fails
+                override fun reload(key: K, oldValue: V): ListenableFuture<V> =
+                    Futures.immediateFuture(if( isCurrent(key, oldValue) ) oldValue else loader(key))
+            })
+
+    private val assets: LoadingCache<UUID, CachedAsset> = newCache(maxSize, ttlSec,
+        loader = { assetId -> CachedAsset(this.source.asset(assetId)) },
+        isCurrent = { assetId, cached -> this.source.assetModifiedTs(assetId) == cached.asset?.modifiedTs }
+    )
+
+    private val roleValues: LoadingCache<RoleKey, CachedRoleValues> = newCache(maxSize, ttlSec,
+        loader = { key ->
+            val dao = this.source.roleValues(key.assetId, key.roleName)
+            CachedRoleValues(key.roleName, dao?.assetVals, dao?.modifiedTs)
+        },
+        isCurrent = { key, vals -> this.source.roleValuesModifiedTs(key.assetId, key.roleName) == vals.modifiedTs }
+    )
+
+    /** Asset names to ids. Checked against the asset name on every use, see [getAssetByKey] */
+    private val assetIdsByName = CacheBuilder.newBuilder()
+            .maximumSize(maxSize)
+            .expireAfterWrite(maxOf(ttlSec, 1), TimeUnit.SECONDS)
+            .build<String, UUID>()
+
+
+    private fun <K, V> LoadingCache<K, V>.getOrThrow(key: K): V =
+        try {
+            this.getUnchecked(key)
+        } catch(x: UncheckedExecutionException) {
+            throw x.cause as? StatusException ?: x
+        }
+
+    private fun copyOf(asset: Asset) = Asset(asset.assetId, asset.name).also {
+        it.description = asset.description
+        it.createdBy   = asset.createdBy
+        it.modifiedBy  = asset.modifiedBy
+        it.createdTs   = asset.createdTs
+        it.modifiedTs  = asset.modifiedTs
+    }
+
+    /** Find asset by its id, throw [StatusException] 404 if it doesn't exist */
+    fun getAssetById(assetId: UUID): Asset =
+        this.assets.getOrThrow(assetId).asset?.let { this.copyOf(it) } ?: throw StatusException(404, "Asset '$assetId' not found")
+
+    /** Find asset by its id or name, throw [StatusException] 404 if it doesn't exist */
+    fun getAssetByKey(assetKey: String): Asset {
+        try {
+            return this.getAssetById(UUID.fromString(assetKey))
+        } catch(x: IllegalArgumentException) {
+            // not an id, a name
+        }
+
+        val cachedId = this.assetIdsByName.getIfPresent(assetKey)
+        if( cachedId != null ) {
+            val asset = this.assets.getOrThrow(cachedId).asset
+            if( asset != null && asset.name == assetKey )
+                return this.copyOf(asset)
+            this.assetIdsByName.invalidate(assetKey)   // renamed by another node
+        }
+
+        val asset = this.source.assetByName(assetKey) ?: throw StatusException(404, "Asset '$assetKey' not found")
+        this.assets.put(asset.assetId!!, CachedAsset(asset))
+        this.assetIdsByName.put(assetKey, asset.assetId!!)
+        return this.copyOf(asset)
+    }
+
+    /** Role values of the asset, or null when the asset has no such role */
+    fun getRoleValues(assetId: UUID, roleName: String): CachedRoleValues? =
+        this.roleValues.getOrThrow(RoleKey(assetId, roleName)).takeIf { it.assetVals != null }
+
+    fun hasRole(assetId: UUID, roleName: String): Boolean = this.getRoleValues(assetId, roleName) != null
+
+
+    // ---------------------------------------- Invalidation
+    fun invalidateAsset(assetId: UUID) {
+        this.assets.invalidate(assetId)
+        this.assetIdsByName.invalidateAll(this.assetIdsByName.asMap().filterValues { it == assetId }.keys)
+    }
+
+    /** Drop cached values of the asset role, or of all roles of the asset when [roleName] is null */
+    fun invalidateRoleValues(assetId: UUID, roleName: String? = null) =
+        this.roleValues.invalidateAll(
+            this.roleValues.asMap().keys.filter { it.assetId == assetId && (roleName == null || it.roleName == roleName) })
+
+    /** Drop cached values of the role for all assets: the role schema, and so the defaults, may have changed */
+    fun invalidateRole(roleName: String) =
+        this.roleValues.invalidateAll(this.roleValues.asMap().keys.filter { it.roleName == roleName })
+
+    fun invalidateAll() {
+        logger.info { "dropping all cached assets and role values" }
+        this.assets.invalidateAll()
+        this.assetIdsByName.invalidateAll()
+        this.roleValues.invalidateAll()
+    }
+
+    /** Hit/miss/load statistics of the asset and role values caches */
+    fun cacheStats(): Map<String, Any> =
+        linkedMapOf(
+              "assets"     to this.assets
+            , "roleValues" to this.roleValues
+        ).mapValues { (_, cache) ->
+            val stats = cache.stats()
+            linkedMapOf<String, Any>(
+                  "size"            to cache.size()
+                , "hitCount"        to stats.hitCount()
+                , "missCount"       to stats.missCount()
+                , "hitRate"         to stats.hitRate()
+                , "loadCount"       to stats.loadCount()
+                , "averageLoadMsec" to stats.averageLoadPenalty() / 1_000_000.0
+                , "evictionCount"   to stats.evictionCount()
+            )
+        }
+
+
+    /** Loads assets and their role values with separate connections */
+    object DbSource: Source {
+        private fun fetchAsset(init: (asset: Asset) -> Unit): Asset? =
+            databaseStore.getGoodConnection().use { conn ->
+                val asset = Asset()
+                init(asset)
+                val cnt = SelectStatement(asset).select(asset.allCols).byPresentValues().run(conn)
+                if( cnt == 1 ) asset else null
+            }
+
+        private fun fetchModifiedTs(sql: String, vararg binds: Any): Timestamp? =
+            databaseStore.getGoodConnection().use { conn ->
+                conn.prepareStatement(sql).use { stmt ->
+                    binds.forEachIndexed { k, v -> stmt.setObject(k+1, v) }
+                    stmt.executeQuery().use { rs ->
+                        if( rs.next() ) rs.getTimestamp(1) else null
+                    }
+                }
+            }
+
+        override fun asset(assetId: UUID): Asset? = fetchAsset { it.assetId = assetId }
+
+        override fun assetByName(name: String): Asset? = fetchAsset { it.name = name }
+
+        override fun assetModifiedTs(assetId: UUID): Timestamp? =
+            fetchModifiedTs("select modified_ts from assets where asset_id = ?", uuidToBytes(assetId)!!)
+
+        override fun roleValues(assetId: UUID, roleName: String): AssetRoleValues? =
+            databaseStore.getGoodConnection().use { conn ->
+                val dao = AssetRoleValues(assetId, roleName)
+                val cnt = SelectStatement(dao).select(dao.allCols).byPk().run(conn)
+                if( cnt == 1 ) dao else null
+            }
+
+        override fun roleValuesModifiedTs(assetId: UUID, roleName: String): Timestamp? =
+            fetchModifiedTs("select modified_ts from asset_role_values where asset_id = ? and role_name = ?",
+                            uuidToBytes(assetId)!!, roleName)
+    }
+}
@@ -25,6 +25,14 @@ class Task(): Entity() {
     @Column("script_args", restParamName = "scriptArgs")   var scriptArgs:  String? = null
     @Column("description")                                 var description: String? = null
 
+    @Column("started_ts",     restParamName = "startedTs")     var startedTs:     Timestamp? = null
+    @Column("finished_ts",    restParamName = "finishedTs")    var finishedTs:    Timestamp? = null
+    @Column("submit_worker",  restParamName = "submitWorker")  var submitWorker:  String? = null
+    @Column("execute_worker", restParamName = "executeWorker") var executeWorker: String? = null
+    @Column("progress_text",  restParamName = "progressText")  var progressText:  String? = null
+    @Column("progress_curr",  restParamName = "progressCurr")  var progressCurr:  Int? = null
+    @Column("progress_total", restParamName = "progressTotal") var progressTotal: Int? = null
+
     @Column("created_by",  restParamName = "createdBy")  var createdBy:  String? = null
     @Column("modified_by", restParamName = "modifiedBy") var modifiedBy: String? = null
     @Column("created_ts",  restParamName = "createdTs",  onInsert = Generated.OnTheDbAlways)                          var createdTs:  Timestamp? = null
@@ -1,55 +1,43 @@
 package com.amcentral365.service.dao
 
+import com.google.gson.Gson
 import com.google.gson.GsonBuilder
-import java.sql.Connection
 import java.util.UUID
 import java.nio.ByteBuffer
 
-import com.amcentral365.pl4kotlin.SelectStatement
-import com.amcentral365.service.databaseStore
+import com.amcentral365.service.catalogCache
 import com.amcentral365.service.StatusException
-import com.amcentral365.service.api.catalog.Assets
-import com.amcentral365.service.builtins.RoleName
 import com.amcentral365.service.builtins.roles.AnAsset
-import com.amcentral365.service.schemaUtils
 import java.sql.Timestamp
 import java.time.Instant
-import java.time.format.DateTimeFormatter
 
-inline fun <reified T> getAssetObjectForRole(assetId: UUID, roleName: String, conn: Connection): T? {
-    val dao = AssetRoleValues(assetId, roleName)
-    val cnt = SelectStatement(dao).select(dao.allCols).byPk().run(conn)
-    if( cnt != 1 )
-        return null
+/** Deserializes role values into role objects */
+@PublishedApi internal val roleObjectGson: Gson = GsonBuilder().create()  // thread safe
+
 
-    return GsonBuilder().create().fromJson<T>(dao.assetVals, T::class.java)
+/** The role values as stored, without defaults. Null when the asset has no such role */
+inline fun <reified T> getAssetObjectForRole(assetId: UUID, roleName: String): T? {
+    val vals = catalogCache.getRoleValues(assetId, roleName) ?: return null
+    return roleObjectGson.fromJson<T>(vals.parsed, T::class.java)
 }
 
 
 inline fun <reified T> loadRoleObjectFromDB(asset: Asset, roleName: String, Initializer: (obj: T)-> Unit): T {
-    databaseStore.getGoodConnection().use { conn ->
-        val obj = getAssetObjectForRole<T>(asset.assetId!!, roleName, conn)
-            ?: throw StatusException(404, "Asset ${asset.assetId} has no role '$roleName'")
-        Initializer(obj) //obj.asset = asset
-        return obj
-    }
+    val obj = getAssetObjectForRole<T>(asset.assetId!!, roleName)
+        ?: throw StatusException(404, "Asset ${asset.assetId} has no role '$roleName'")
+    Initializer(obj) //obj.asset = asset
+    return obj
 }
 
 
 inline fun <reified T: AnAsset> fromDB(assetId: UUID, roleName: String): T {
-    databaseStore.getGoodConnection().use { conn ->
-        val dao = AssetRoleValues(assetId, roleName)
-        val cnt = SelectStatement(dao).select(dao.allCols).byPk().run(conn)
-        if( cnt != 1 )
-            throw StatusException(404, "Asset ${assetId} has no role '$roleName'")
-
-        val elm = schemaUtils.assignDefaultValues(roleName, dao.assetVals!!)
-        return GsonBuilder().create().fromJson<T>(elm, T::class.java)
-    }
+    val vals = catalogCache.getRoleValues(assetId, roleName)
+        ?: throw StatusException(404, "Asset ${assetId} has no role '$roleName'")
+    return roleObjectGson.fromJson<T>(vals.withDefaults, T::class.java)
 }
 
 inline fun <reified T: AnAsset> fromDB(assetIdOrKey: String, roleName: String): T {
-    val asset = Assets.getAssetByKey(assetIdOrKey)
+    val asset = catalogCache.getAssetByKey(assetIdOrKey)
     val obj = fromDB<T>(asset.assetId!!, roleName)
     obj.asset = asset
     return obj;
@@ -65,6 +53,13 @@ fun uuidToBytes(uuid: UUID?): ByteArray? {
     return bb.array()
 }
 
+fun bytesToUuid(bytes: ByteArray?): UUID? {
+    if(bytes == null)
+        return null
+    val bb = ByteBuffer.wrap(bytes)
+    return UUID(bb.long, bb.long)
+}
+
 /**
  * Converts string in (almost) RFC 3339 format to Timestamp
  *
@@ -0,0 +1,257 @@
+package com.amcentral365.service.mergedata
+
+import com.google.gson.JsonParser
+
+import java.io.File
+import java.sql.Connection
+import java.util.UUID
+
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.api.catalog.AssetRoleValues as AssetRoleValuesApi
+import com.amcentral365.service.dao.Asset
+import com.amcentral365.service.dao.AssetRoleValues
+import com.amcentral365.service.dao.bytesToUuid
+import com.amcentral365.service.dao.uuidToBytes
+
+
+/**
+ * The rows of <code>ASSETS</code> and <code>ASSET_ROLE_VALUES</code> a merge may touch, read in bulk:
+ * a query per [CHUNK_SIZE] assets instead of a few queries per merged row.
+ */
+internal class AssetSnapshot {
+    val assets         = mutableMapOf<UUID, Asset>()
+    val assetIdsByName = mutableMapOf<String, UUID>()
+    val roleValues     = mutableMapOf<Pair<UUID, String>, AssetRoleValues>()
+
+    fun add(asset: Asset) {
+        this.assets[asset.assetId!!] = asset
+        this.assetIdsByName[asset.name!!] = asset.assetId!!
+    }
+
+    fun add(arv: AssetRoleValues) {
+        this.roleValues[Pair(arv.assetId!!, arv.roleName!!)] = arv
+    }
+
+    companion object {
+        const val CHUNK_SIZE = 500
+
+        /** The assets with [ids] or [names], and all of their role values */
+        fun load(conn: Connection, ids: Collection<UUID>, names: Collection<String>): AssetSnapshot {
+            val snapshot = AssetSnapshot()
+            ids.chunked(CHUNK_SIZE).forEach { chunk -> snapshot.selectAssets(conn, "asset_id", chunk.map { uuidToBytes(it) }) }
+            names.chunked(CHUNK_SIZE).forEach { chunk -> snapshot.selectAssets(conn, "name", chunk) }
+            snapshot.assets.keys.chunked(CHUNK_SIZE).forEach { chunk -> snapshot.selectRoleValues(conn, chunk) }
+            return snapshot
+        }
+
+        private fun placeholders(n: Int) = List(n) { "?" }.joinToString(", ")
+    }
+
+    private fun selectAssets(conn: Connection, byColumn: String, keys: List<Any?>) =
+        conn.prepareStatement("select asset_id, name, description, modified_ts from assets where $byColumn in (${placeholders(keys.size)})").use { stmt ->
+            keys.forEachIndexed { k, key -> stmt.setObject(k+1, key) }
+            stmt.executeQuery().use { rs ->
+                while( rs.next() )
+                    this.add(Asset(bytesToUuid(rs.getBytes(1)), rs.getString(2)).also {
+                        it.description = rs.getString(3)
+                        it.modifiedTs  = rs.getTimestamp(4)
+                    })
+            }
+        }
+
+    private fun selectRoleValues(conn: Connection, assetIds: List<UUID>) =
+        conn.prepareStatement("select asset_id, role_name, asset_vals, modified_ts from asset_role_values where asset_id in (${placeholders(assetIds.size)})").use { stmt ->
+            assetIds.forEachIndexed { k, assetId -> stmt.setBytes(k+1, uuidToBytes(assetId)) }
+            stmt.executeQuery().use { rs ->
+                while( rs.next() )
+                    this.add(AssetRoleValues(bytesToUuid(rs.getBytes(1))!!, rs.getString(2), rs.getString(3)).also {
+                        it.modifiedTs = rs.getTimestamp(4)
+                    })
+            }
+        }
+}
+
+
+/**
+ * The changes a bulk merge of [files] makes to the database: the rows to insert, the rows to update, and the count
+ * of rows already as in the files. Computed in memory with [of], applied with JDBC batches in one transaction.
+ *
+ * Files sharing an asset are planned together, so each row is written once and by one transaction.
+ * When an asset or one of its roles is in several files, the last one wins, as when the files are merged one
+ * by one; the earlier occurrences count as unchanged.
+ */
+internal class AssetMergePlan(val files: List<File>) {
+    val assetInserts = mutableListOf<Asset>()
+    val assetUpdates = mutableListOf<Asset>()             // modifiedTs is the database one, for the optimistic lock
+    val valueInserts = mutableListOf<AssetRoleValues>()
+    val valueUpdates = mutableListOf<AssetRoleValues>()   // ditto
+    var unchanged = 0
+
+    val changed: Int get() = assetInserts.size + assetUpdates.size + valueInserts.size + valueUpdates.size
+
+    companion object {
+        /**
+         * @param resolve completes the id or the name of a merged asset given the database id of its name and
+         *        the database name of its id, see [MergeAssets.checkMergeAssetAgainstDb]. Returns the problem, or null.
+         * @return the plans, in the order of their first file, and the problems of the files that can't be merged
+         */
+        fun of(records: List<Pair<File, List<MergeAssets.AssetWithRoles>>>, snapshot: AssetSnapshot,
+               resolve: (asset: Asset, dbIdFromName: UUID?, dbNameFromId: String?) -> String?
+        ): Pair<List<AssetMergePlan>, Map<File, String>> {
+            val problems = linkedMapOf<File, String>()
+            val newIdsByName = mutableMapOf<String, UUID>()     // assets inserted by this merge
+            val newNamesById = mutableMapOf<UUID, String>()
+            val mergedRecords = mutableListOf<Pair<File, List<MergeAssets.AssetWithRoles>>>()
+
+            for((file, fileRecords) in records) {
+                val fileNewIds = mutableMapOf<String, UUID>()
+                val problem = fileRecords.asSequence().mapNotNull { (asset, _) ->
+                    val name = asset.name
+                    val dbIdFromName = if( name.isNullOrBlank() ) null else snapshot.assetIdsByName[name] ?: newIdsByName[name] ?: fileNewIds[name]
+                    val dbNameFromId = asset.assetId?.let { snapshot.assets[it]?.name ?: newNamesById[it] ?: fileNewIds.entries.find { e -> e.value == it }?.key }
+                    resolve(asset, dbIdFromName, dbNameFromId).also {
+                        if( it == null && asset.assetId!! !in snapshot.assets )
+                            fileNewIds[asset.name!!] = asset.assetId!!
+                    }
+                }.firstOrNull()
+
+                if( problem != null )
+                    problems[file] = problem
+                else {
+                    mergedRecords.add(Pair(file, fileRecords))
+                    fileNewIds.forEach { (name, id) -> newIdsByName[name] = id;  newNamesById[id] = name }
+                }
+            }
+
+            return Pair(group(mergedRecords).map { plan(it, snapshot) }, problems)
+        }
+
+        /** Groups of files sharing assets, transitively */
+        private fun group(records: List<Pair<File, List<MergeAssets.AssetWithRoles>>>): List<List<Pair<File, List<MergeAssets.AssetWithRoles>>>> {
+            val parent = IntArray(records.size) { it }
+            fun root(k: Int): Int = if( parent[k] == k ) k else root(parent[k]).also { parent[k] = it }
+
+            val fileOfAsset = mutableMapOf<UUID, Int>()
+            records.forEachIndexed { k, (_, fileRecords) ->
+                fileRecords.forEach { (asset, _) ->
+                    val other = fileOfAsset.putIfAbsent(asset.assetId!!, k)
+                    if( other != null )
+                        parent[root(k)] = root(other)
+                }
+            }
+
+            return records.indices.groupBy(::root).values.map { group -> group.map { records[it] } }
+        }
+
+        private fun plan(records: List<Pair<File, List<MergeAssets.AssetWithRoles>>>, snapshot: AssetSnapshot): AssetMergePlan {
+            val plan = AssetMergePlan(records.map { it.first })
+            val all = records.flatMap { it.second }
+
+            val lastAssets = all.associateBy { it.asset.assetId!! }     // associate keeps the last
+            val lastValues = all.flatMap { rec -> rec.roles.map { Pair(rec.asset.assetId!!, it) } }.associateBy { (id, rv) -> Pair(id, rv.roleName) }
+            plan.unchanged += all.size - lastAssets.size + all.sumBy { it.roles.size } - lastValues.size
+
+            lastAssets.values.forEach { (asset, _) ->
+                val dbAsset = snapshot.assets[asset.assetId!!]
+                when {
+                    dbAsset == null -> plan.assetInserts.add(asset)
+                    dbAsset.name != asset.name || dbAsset.description != asset.description ->
+                        plan.assetUpdates.add(asset.also { it.modifiedTs = dbAsset.modifiedTs })
+                    else -> plan.unchanged++
+                }
+            }
+
+            lastValues.values.forEach { (assetId, rv) ->
+                val arv = AssetRoleValues(assetId, rv.roleName, rv.valuesAsJsonStr)
+                val dbArv = snapshot.roleValues[Pair(assetId, rv.roleName)]
+                when {
+                    dbArv == null -> plan.valueInserts.add(arv)
+                    !jsonsMatch(dbArv.assetVals!!, arv.assetVals!!) -> plan.valueUpdates.add(arv.also { it.modifiedTs = dbArv.modifiedTs })
+                    else -> plan.unchanged++
+                }
+            }
+
+            return plan
+        }
+
+        private fun jsonsMatch(js1: String, js2: String) = JsonParser().parse(js1) == JsonParser().parse(js2)
+
+        private fun checkBatch(counts: IntArray, what: (k: Int) -> String) =
+            counts.forEachIndexed { k, cnt ->
+                if( cnt == 0 )
+                    throw StatusException(409, "optlock failure updating ${what(k)}: 0 rows updated")
+            }
+    }
+
+    /** The planned changes, a line each */
+    fun describe(): List<String> =
+        assetInserts.map { "insert asset ${it.name}, id ${it.assetId}" } +
+        assetUpdates.map { "update asset ${it.name}, id ${it.assetId}" } +
+        valueInserts.map { "insert role values (${it.assetId}, ${it.roleName}): ${it.assetVals}" } +
+        valueUpdates.map { "update role values (${it.assetId}, ${it.roleName}): ${it.assetVals}" }
+
+    fun count(stats: MergeDirectory.Companion.Stats) {
+        stats.inserted.addAndGet(assetInserts.size + valueInserts.size)
+        stats.updated.addAndGet(assetUpdates.size + valueUpdates.size)
+        stats.unchanged.addAndGet(unchanged)
+    }
+
+    /**
+     * Write the changes in the transaction of [conn], without committing it. The written role values are reindexed.
+     *
+     * @param indexedValues the indexed attributes of role values, see SchemaUtils.indexedValues
+     */
+    fun apply(conn: Connection, indexedValues: (roleName: String, assetVals: String) -> List<Pair<String, String>>) {
+        if( assetInserts.isNotEmpty() )
+            conn.prepareStatement("insert into assets(asset_id, name, description, created_by, modified_by) values(?, ?, ?, ?, ?)").use { stmt ->
+                assetInserts.forEach {
+                    stmt.setBytes(1, uuidToBytes(it.assetId))
+                    stmt.setString(2, it.name)
+                    stmt.setString(3, it.description)
+                    stmt.setString(4, it.createdBy)
+                    stmt.setString(5, it.modifiedBy)
+                    stmt.addBatch()
+                }
+                stmt.executeBatch()
+            }
+
+        if( assetUpdates.isNotEmpty() )
+            conn.prepareStatement("update assets set name = ?, description = ?, modified_ts = current_timestamp where asset_id = ? and modified_ts = ?").use { stmt ->
+                assetUpdates.forEach {
+                    stmt.setString(1, it.name)
+                    stmt.setString(2, it.description)
+                    stmt.setBytes(3, uuidToBytes(it.assetId))
+                    stmt.setTimestamp(4, it.modifiedTs)
+                    stmt.addBatch()
+                }
+                checkBatch(stmt.executeBatch()) { k -> "asset ${assetUpdates[k].name} with id ${assetUpdates[k].assetId}" }
+            }
+
+        if( valueInserts.isNotEmpty() )
+            conn.prepareStatement("insert into asset_role_values(asset_id, role_name, asset_vals) values(?, ?, ?)").use { stmt ->
+                valueInserts.forEach {
+                    stmt.setBytes(1, uuidToBytes(it.assetId))
+                    stmt.setString(2, it.roleName)
+                    stmt.setString(3, it.assetVals)
+                    stmt.addBatch()
+                }
+                stmt.executeBatch()
+            }
+
+        if( valueUpdates.isNotEmpty() )
+            conn.prepareStatement("update asset_role_values set asset_vals = ?, modified_ts = current_timestamp where asset_id = ? and role_name = ? and modified_ts = ?").use { stmt ->
+                valueUpdates.forEach {
+                    stmt.setString(1, it.assetVals)
+                    stmt.setBytes(2, uuidToBytes(it.assetId))
+                    stmt.setString(3, it.roleName)
+                    stmt.setTimestamp(4, it.modifiedTs)
+                    stmt.addBatch()
+                }
+                checkBatch(stmt.executeBatch()) { k -> "assetRoleVals (${valueUpdates[k].assetId}, ${valueUpdates[k].roleName})" }
+            }
+
+        AssetRoleValuesApi.reindex(conn, (valueInserts + valueUpdates).map {
+            Triple(it.assetId!!, it.roleName!!, indexedValues(it.roleName!!, it.assetVals!!))
+        })
+    }
+}
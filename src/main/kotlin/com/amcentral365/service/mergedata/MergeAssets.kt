@@ -6,6 +6,7 @@ import com.amcentral365.pl4kotlin.UpdateStatement
 import com.amcentral365.pl4kotlin.closeIfCan
 import com.amcentral365.service.StatusException
 import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.api.catalog.AssetRoleValues as AssetRoleValuesApi
 import mu.KotlinLogging
 
 import com.google.gson.Gson
@@ -14,8 +15,6 @@ import com.google.gson.JsonSyntaxException
 import java.io.File
 import java.io.IOException
 
-import java.lang.UnsupportedOperationException
-
 import com.amcentral365.service.config
 import com.amcentral365.service.dao.Asset
 import com.amcentral365.service.dao.AssetRoleValues
@@ -24,11 +23,15 @@ import com.amcentral365.service.databaseStore
 import com.google.common.annotations.VisibleForTesting
 import com.google.common.base.Preconditions
 import com.google.gson.JsonElement
-import com.google.gson.JsonParser
+import com.google.gson.JsonObject
 import java.sql.Connection
 
 import java.sql.SQLException
+import java.util.ArrayDeque
 import java.util.UUID
+import java.util.concurrent.Callable
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.ForkJoinTask
 import java.util.concurrent.locks.ReentrantReadWriteLock
 import kotlin.concurrent.getOrSet
 import kotlin.concurrent.write
@@ -38,6 +41,10 @@ private val logger = KotlinLogging.logger {}
 
 
 open class MergeAssets(private val baseDirName: String) {
+    companion object {
+        /** Role schemas supply the default values, so a role change may change the merged assets */
+        private val MANIFEST_TABLES = listOf("roles", "assets", "asset_role_values")
+    }
 
     // All variables are shared between threads
     private val gson = Gson()  // thread safe
@@ -57,35 +64,31 @@ open class MergeAssets(private val baseDirName: String) {
      * Read asset definition files under the specified directory (defaulting to mergedata/roles),
      * and merge (add or update) assets into the database table <code>ASSETS</code>.
      *
-     * The files are processed with parallelism --merge-threads.
+     * The files are processed with parallelism --merge-threads. With --merge-bulk, see [mergeBulk].
      *
      * @return the number of failures
      */
     fun merge(): Int {
         this.files = MergeDirectory.list(baseDirName)
-        val stats = MergeDirectory.process(this.files) { file, stats ->
+        val manifest = MergeManifest.open(baseDirName, MANIFEST_TABLES)
+        val stats = if( config.mergeBulk || config.mergeDryRun ) this.mergeBulk(manifest) else MergeDirectory.processChanged(this.files, manifest, MANIFEST_TABLES) { file, stats ->
             // This code may execute in parallel
-            // It is the onluy code responsible for managing the transaction state
 
-            if( file in processedFiles )
+            if( file in processedFiles ) {
                 logger.info { "skipping already processed ${file.path}" }
-            else {
-                this.conn.getOrSet { initThreadConnection() }
-                this.conn.get().rollback()      // promote code quality by discarding uncommitted changes
-
+                true
+            } else {
                 logger.debug { "starting processing ${file.path}" }
                 val succeeded = this.process(file, stats)
 
                 logger.debug { "finished processing ${file.path} with ${if(succeeded) "success" else "failure"}" }
                 this.processedFiles.add(file)
 
-                if( succeeded ) {
-                    this.conn.get().commit()
+                if( succeeded )
                     stats.processed.incrementAndGet()
-                } else {
-                    this.conn.get().rollback()
+                else
                     stats.failed.incrementAndGet()
-                }
+                succeeded
             }
         }
 
@@ -98,27 +101,146 @@ open class MergeAssets(private val baseDirName: String) {
             logger.info { "Merge completed for $totalConsidered assets and role values with $processed processed successfully and $failed failed" }
             logger.info { "  process stats: added $inserted, updated $updated, and skipped $unchanged unchanged" }
             logger.info { "  (this low level stats treats Assets and each of their AssetRoleValues individually)" }
+            logger.info { "  $skipped files were unchanged since the last merge and weren't read" }
         }
 
         return stats.failed.get()
     }
 
+    /**
+     * Read all changed files, load the database rows they may touch with a few bulk queries, compute the diff
+     * in memory, and write it with JDBC batches, a transaction per [AssetMergePlan]. With --merge-dry-run,
+     * the diff is logged and nothing is written.
+     */
+    private fun mergeBulk(manifest: MergeManifest): MergeDirectory.Companion.Stats {
+        val stats = MergeDirectory.Companion.Stats(this.files.size)
+        val changedFiles = MergeDirectory.skipUnchanged(this.files, manifest, stats)
+
+        val records = ConcurrentHashMap<File, List<AssetWithRoles>>()
+        MergeDirectory.process(changedFiles, stats) { file, stats ->
+            logger.info { "reading ${file.path}" }
+            val assetsFromFile = catchFileErrors(file) { readAssetObjectsFromFile(file, checkIdAndName = false) }
+            if( assetsFromFile == null )
+                stats.failed.incrementAndGet()
+            else
+                records[file] = assetsFromFile
+        }
+
+        val readFiles = changedFiles.filter { it in records }   // in the merge order
+        val assets = readFiles.flatMap { file -> records.getValue(file).map { it.asset } }
+        val snapshot = databaseStore.getGoodConnection().use { conn ->
+            AssetSnapshot.load(conn, assets.mapNotNull { it.assetId }.toSet(), assets.mapNotNull { it.name?.takeIf(String::isNotBlank) }.toSet())
+        }
+        logger.info { "loaded ${snapshot.assets.size} assets and ${snapshot.roleValues.size} role values to diff ${assets.size} merged assets against" }
+
+        val (plans, problems) = AssetMergePlan.of(readFiles.map { Pair(it, records.getValue(it)) }, snapshot, ::checkMergeAssetAgainstDb)
+        problems.forEach { (file, problem) -> logger.error { "  error processing ${file.path}: $problem" } }
+        stats.failed.addAndGet(problems.size)
+
+        val plansByFile = plans.associateBy { it.files.first() }
+        MergeDirectory.process(plans.map { it.files.first() }, stats) { file, stats ->
+            val plan = plansByFile.getValue(file)
+            if( config.mergeDryRun ) {
+                plan.describe().forEach { logger.info { "dry run: $it" } }
+                plan.count(stats)
+                stats.processed.addAndGet(plan.files.size)
+            } else if( this.apply(plan, stats) ) {
+                stats.processed.addAndGet(plan.files.size)
+                plan.files.forEach(manifest::merged)
+            } else
+                stats.failed.addAndGet(plan.files.size)
+        }
+
+        if( config.mergeDryRun )
+            logger.info { "--merge-dry-run: nothing was written" }
+        else
+            manifest.save(MergeManifest.currentDbState(MANIFEST_TABLES))
+
+        return stats
+    }
+
+    // Called from threads. Manages transaction state
+    private fun apply(plan: AssetMergePlan, stats: MergeDirectory.Companion.Stats): Boolean {
+        val conn = this.conn.getOrSet { initThreadConnection() }
+        conn.rollback()
+
+        try {
+            plan.apply(conn) { roleName, assetVals -> this.schemaUtils.indexedValues(roleName, assetVals) }
+            conn.commit()
+        } catch(x: Exception) {
+            conn.rollback()
+            logger.error(x) { "  error merging ${plan.files.joinToString { it.path }}:\n  $x" }
+            return false
+        }
+
+        plan.count(stats)
+        logger.info { "merged ${plan.changed} changes from ${plan.files.joinToString { it.path }}" }
+        return true
+    }
+
     // Called from threads. Should not write the object state unless protected by a lock
-    // Manages transaction state
     private fun process(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        return when(val ext = file.extension.toLowerCase()) {
-            "jsn", "json" -> processJson(file, stats)
-            "yml", "yaml" -> processYaml(file, stats)
-            "xml"         -> processXml(file, stats)
-            else -> {
-                logger.info { "unsupported extension $ext, supported extensions are: jsn, json, yml, yaml, xml" }
-                false
+        logger.info { "processing file ${file.path}" }
+        return catchFileErrors(file) {
+            MergeRecords.read(file) { records ->
+                if( config.mergeChunkRecords == 0 )
+                    this.mergeRecords(file, records, stats)
+                else
+                    this.mergeChunks(file, records.chunked(config.mergeChunkRecords), stats)
             }
-        }
+        } ?: false
+    }
+
+    /**
+     * Merge the [records] of [file] in a transaction, one record at a time.
+     * It is the only code responsible for managing the transaction state.
+     */
+    private fun mergeRecords(file: File, records: Sequence<JsonElement>, stats: MergeDirectory.Companion.Stats): Boolean {
+        val conn = this.conn.getOrSet { initThreadConnection() }
+        conn.rollback()      // promote code quality by discarding uncommitted changes
+
+        val succeeded = catchFileErrors(file) {
+            records.forEach { jsonElm ->
+                val assetFromFile = readAssetObjectFromElement(jsonElm, file, checkIdAndName = true)
+                mergeAssetObjIntoDb(assetFromFile.asset, stats)
+
+                // the roles were sorted by name to protect from deadlocks when multiple workers are trying to merge the same asset
+                for(role in assetFromFile.roles)
+                    mergeAssetRoleValuesIntoDb(assetFromFile, role, stats)
+            }
+            true
+        } ?: false
+
+        if( succeeded )
+            conn.commit()
+        else
+            conn.rollback()
+        return succeeded
     }
 
+    /**
+     * Merge the [chunks] of a big [file] in parallel, a transaction each, reading at most --merge-threads chunks ahead.
+     * A failed chunk stops the file. The chunks merged by then stay: the file isn't recorded in the merge manifest,
+     * and merging it again is harmless.
+     */
+    private fun mergeChunks(file: File, chunks: Sequence<List<JsonElement>>, stats: MergeDirectory.Companion.Stats): Boolean {
+        if( !ForkJoinTask.inForkJoinPool() )    // --merge-threads 1
+            return chunks.all { this.mergeRecords(file, it.asSequence(), stats) }
+
+        val inFlight = ArrayDeque<ForkJoinTask<Boolean>>()
+        var succeeded = true
+        for(chunk in chunks) {
+            if( inFlight.size >= config.mergeThreads && !inFlight.removeFirst().join() )
+                succeeded = false
+            if( !succeeded )
+                break
+            inFlight.addLast(ForkJoinTask.adapt(Callable { this.mergeRecords(file, chunk.asSequence(), stats) }).fork())
+        }
+
+        inFlight.forEach { if( !it.join() ) succeeded = false }
+        return succeeded
+    }
 
-    private fun readFile(file: File): String = file.readText(config.charSet)
 
     private fun parseJson(content: String): Map<String, Any> = gson.fromJson<Map<String, Any>>(content, Map::class.java)
 
@@ -154,32 +276,20 @@ open class MergeAssets(private val baseDirName: String) {
     data class RoleValues(val roleName: String, val valuesAsJsonStr: String)
     data class AssetWithRoles(val asset: Asset, val roles: List<RoleValues>)
 
-    private fun readAssetObjectsFromFile(file: File): List<AssetWithRoles> {
-        val fileText = readFile(file)
-        val rootElm = JsonParser().parse(fileText)
-        val displayFilePath = file.path
-
-        if( rootElm.isJsonObject ) {
-            val singleAsset = readAssetObjectFromElement(rootElm, displayFilePath)
-            return listOf(singleAsset)
-        }
-
-        if( !rootElm.isJsonArray )
-            throw StatusException(400, "Bad data, expected Json Object or Array")
-
-        val assetsWithRoles = mutableListOf<AssetWithRoles>()
-        for(jsonElm in rootElm.asJsonArray) {
-            val fileAsset = readAssetObjectFromElement(jsonElm, displayFilePath)
-            assetsWithRoles.add(fileAsset)
-        }
+    private fun readAssetObjectsFromFile(file: File, checkIdAndName: Boolean): List<AssetWithRoles> =
+        MergeRecords.read(file) { records -> records.map { readAssetObjectFromElement(it, file, checkIdAndName) }.toList() }
 
-        return assetsWithRoles
-    }
+    /** With [checkIdAndName], the id or the name of the asset is completed from the database, see [checkMergeAssetAgainstDb] */
+    private fun readAssetObjectFromElement(jsonElm: JsonElement, file: File, checkIdAndName: Boolean): AssetWithRoles {
+        val displayFilePath = file.path
+        if( !jsonElm.isJsonObject )
+            throw StatusException(400, "Bad data in $displayFilePath, expected an asset object or an array of them")
+        if( !MergeRecords.isTyped(file) )
+            this.typeRoleValues(jsonElm.asJsonObject, displayFilePath)
 
-    private fun readAssetObjectFromElement(jsonElm: JsonElement, displayFilePath: String): AssetWithRoles {
         val fileAsset = gson.fromJson(jsonElm, PermissiveAssetWithRoles::class.java)
 
-        val problem = checkAssetIdAndName(fileAsset.asset)
+        val problem = if( checkIdAndName ) checkAssetIdAndName(fileAsset.asset) else null
         if(problem != null)
             throw StatusException(412, problem)
 
@@ -211,6 +321,20 @@ open class MergeAssets(private val baseDirName: String) {
     }
 
 
+    /** Values of untyped formats are strings: type the role values by their role schemas */
+    private fun typeRoleValues(record: JsonObject, displayFilePath: String) {
+        val roles = record["roles"]?.takeIf { it.isJsonArray }?.asJsonArray ?: return
+        for(role in roles.filter { it.isJsonObject }.map { it.asJsonObject }) {
+            val roleName = role["roleName"]?.takeIf { it.isJsonPrimitive }?.asString ?: continue
+            val values = role["values"] ?: continue
+            try {
+                role.add("values", this.schemaUtils.typeStrings(roleName, values))
+            } catch(x: StatusException) {
+                throw StatusException(x, x.code, "in file $displayFilePath, role $roleName: ${x.message}")
+            }
+        }
+    }
+
     private fun checkAssetIdAndName(mergeAsset: Asset): String? {
         val mergeAssetIdIsPresent = mergeAsset.assetId != null
         val mergeAssetNameIsPresent = !mergeAsset.name.isNullOrBlank()
@@ -280,40 +404,21 @@ open class MergeAssets(private val baseDirName: String) {
     }
 
 
-    private fun processJson(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        logger.info { "processing JSON file ${file.path}" }
+    /** Run [body] processing [file], or log its error and return null */
+    private inline fun <T> catchFileErrors(file: File, body: () -> T): T? =
         try {
-            val assetsFromFile = readAssetObjectsFromFile(file)
-
-            if( file in this.processedFiles )
-                return true
-
-            for(assetFromFile in assetsFromFile) {
-                mergeAssetObjIntoDb(assetFromFile.asset, stats)
-
-                // the roles were sorted by name to protect from deadlocks when multiple workers are trying to merge the same asset
-                for(role in assetFromFile.roles) {
-                    if(file in this.processedFiles)
-                        return true
-
-                    mergeAssetRoleValuesIntoDb(assetFromFile, role, stats)
-                }
-            }
-
+            body()
         } catch(x: IOException) {
             logger.error { "  couldn't read ${file.path}: ${x.javaClass.name} ${x.message}" }
-            return false
+            null
         } catch(x: JsonSyntaxException) {
             logger.error { "  json parse error in ${file.path}:\n  $x" }
-            return false
+            null
         } catch(x: Exception) {
             logger.error(x) { "  error processing ${file.path}:\n  $x" }
-            return false
+            null
         }
 
-        return true
-    }
-
     // merge into ASSETS
     private fun mergeAssetObjIntoDb(asset: Asset, stats: MergeDirectory.Companion.Stats) {
         Preconditions.checkNotNull(asset)
@@ -399,6 +504,7 @@ open class MergeAssets(private val baseDirName: String) {
             try {
                 cnt = InsertStatement(mmARV).run(conn.get())
                 if( cnt == 1) {
+                    reindexAssetRoleValues(mmARV)
                     stats.inserted.incrementAndGet()
                     logger.info { "inserted into db: asset id ${mmARV.assetId}, role name ${mmARV.roleName}" }
                     return
@@ -423,19 +529,15 @@ open class MergeAssets(private val baseDirName: String) {
             cnt = UpdateStatement(mmARV).update(mmARV::assetVals).byPkAndOptLock().run(this.conn.get())
             if( cnt != 1 )
                 throw StatusException(409, "optlock failure updating assetRoleVals (${mmARV.assetId}, ${mmARV.roleName}): $cnt rows updated")
+            reindexAssetRoleValues(mmARV)
             stats.updated.incrementAndGet()
             logger.info { "updated assetRoleVals with PK (${mmARV.assetId}, ${mmARV.roleName})" }
         }
     }
 
 
-    private fun processYaml(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        stats.unchanged.incrementAndGet()
-        throw UnsupportedOperationException("extension ${file.extension} will be supported later")
-    }
-
-    private fun processXml(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        stats.unchanged.incrementAndGet()
-        throw UnsupportedOperationException("extension ${file.extension} will be supported later")
-    }
+    // maintain ASSET_ROLE_ATTRS in the file transaction
+    private fun reindexAssetRoleValues(arv: AssetRoleValues) =
+        AssetRoleValuesApi.reindex(this.conn.get(), arv.assetId!!, arv.roleName!!,
+                                   this.schemaUtils.indexedValues(arv.roleName!!, arv.assetVals!!))
 }
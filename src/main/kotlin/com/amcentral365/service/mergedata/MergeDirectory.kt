@@ -1,6 +1,8 @@
 package com.amcentral365.service.mergedata
 
 import com.amcentral365.service.config
+import com.amcentral365.service.metrics
+import mu.KotlinLogging
 import java.nio.file.Paths
 
 import java.io.File
@@ -14,6 +16,12 @@ import java.util.concurrent.atomic.AtomicInteger
 const val MERGE_DATA_ROOT_DIR = "mergedata"
 private const val PRIORITY_LIST_FILE_NAME = "_priority_list.txt"
 
+private val logger = KotlinLogging.logger {}
+
+private val mergeDuration = metrics.histogram("amc_merge_duration_seconds", "Time to merge a directory of files")
+private val fileDuration  = metrics.histogram("amc_merge_file_duration_seconds", "Time to merge a file")
+private val mergedFiles   = metrics.counter("amc_merge_files_total", "Merged files by outcome", "outcome")
+
 class MergeDirectory { companion object {
 
     fun list(baseDirName: String): List<File> = this.list(Paths.get(MERGE_DATA_ROOT_DIR, baseDirName))
@@ -28,30 +36,30 @@ class MergeDirectory { companion object {
         if( priorityList.isEmpty() )
             return files
 
-        val baseDirPrefixRx = Regex("^$baseDirPrefix/")
-        val combinedList = mutableListOf<File>()
-        for(pattern in priorityList) {                // O(priorityList size * files size)
-            val matchedFileIndexes = matchFiles(files, Regex(pattern), baseDirPrefixRx )
-            combinedList.addAll(matchedFileIndexes.map { idx -> files[idx] })       // scan forward, preserve the order
-            matchedFileIndexes.asReversed().forEach { idx -> files.removeAt(idx) }  // reversed, so previous indexes do not shift
-        }
+        // A file goes with the first pattern it matches, classify each file once and keep the order within a pattern
+        val patterns = PriorityPatterns(priorityList)
+        val relativePath = relativePathOf(baseDirPrefix)
+        val buckets = List(priorityList.size + 1) { mutableListOf<File>() }    // the last one is for the remaining
+        files.forEach { buckets[patterns.firstMatch(relativePath(it.path))].add(it) }
 
-        combinedList.addAll(files)      // the remaining
-        return combinedList
+        return buckets.flatten()
     }
 
-    private fun matchFiles(files: List<File>, patternRx: Regex, baseDirPrefixRx : Regex): List<Int> =
-            files.withIndex()
-                 .filter { patternRx.find((it.value.path.replace(baseDirPrefixRx , ""))) != null }
-                 .map { it.index }
+    /** Strips "[baseDirPrefix]/" from paths. The prefix is a regex, but usually has no special characters */
+    private fun relativePathOf(baseDirPrefix: String): (String) -> String {
+        if( baseDirPrefix.none { it in PriorityPatterns.REGEX_META_CHARS } )
+            return { path -> path.removePrefix("$baseDirPrefix/") }
+
+        val baseDirPrefixRx = Regex("^$baseDirPrefix/")
+        return { path -> path.replace(baseDirPrefixRx, "") }
+    }
 
     private fun readDirTree(baseDirPath: Path): Sequence<File> {
         //val priorityFilePathStr = baseDirPath.resolve(PRIORITY_LIST_FILE_NAME).toFile().path
-        val interestingExtensions = setOf("jsn", "json", "yml", "yaml", "xml")
         return baseDirPath.toFile()
             .walkTopDown()
             .filter { it.isFile }
-            .filter { it.extension.toLowerCase() in interestingExtensions }
+            .filter { it.extension.toLowerCase() in MergeRecords.EXTENSIONS }
         }
 
 
@@ -83,27 +91,71 @@ class MergeDirectory { companion object {
         val updated   = AtomicInteger(0)
         val unchanged = AtomicInteger(0)
 
+        val skipped   = AtomicInteger(0)  // files not processed, as the manifest shows them unchanged since the last merge
+
         val totalConsidered: Int get() = failed.get() + processed.get()
         val totalMerged:     Int get() = inserted.get() + updated.get()
     }
 
-    fun process(files: List<File>, processFile: (file: File, stats: Stats) -> Unit ): Stats {
-        val stats = Stats(files.size)
+    /**
+     * Run [processFile] for each of [files] with --merge-threads parallelism.
+     * Pass [stats] to accumulate the results of several calls.
+     */
+    fun process(files: List<File>, stats: Stats = Stats(files.size), processFile: (file: File, stats: Stats) -> Unit ): Stats {
         if( files.isEmpty() )
             return stats
 
+        val before = listOf(stats.inserted.get(), stats.updated.get(), stats.unchanged.get(), stats.failed.get())
         val pool = ForkJoinPool(Math.min(config.mergeThreads, files.size))
-        val filetask = { file: File -> processFile(file, stats) }
-
-        if( config.mergeThreads == 1 )
-            files.forEach(filetask)
-        else {
-            if( config.mergeTimeLimitSec <= 0 )
-                pool.submit { files.parallelStream().forEach(filetask)}.get()
-            else
-                pool.submit { files.parallelStream().forEach(filetask)}.get(config.mergeTimeLimitSec, TimeUnit.SECONDS)
+        val filetask = { file: File -> fileDuration.time { processFile(file, stats) } }
+
+        try {
+            mergeDuration.time {
+                if( config.mergeThreads == 1 )
+                    files.forEach(filetask)
+                else {
+                    if( config.mergeTimeLimitSec <= 0 )
+                        pool.submit { files.parallelStream().forEach(filetask)}.get()
+                    else
+                        pool.submit { files.parallelStream().forEach(filetask)}.get(config.mergeTimeLimitSec, TimeUnit.SECONDS)
+                }
             }
+        } finally {
+            pool.shutdown()
+        }
+
+        mergedFiles.add(stats.inserted.get().toLong()  - before[0], "inserted")
+        mergedFiles.add(stats.updated.get().toLong()   - before[1], "updated")
+        mergedFiles.add(stats.unchanged.get().toLong() - before[2], "unchanged")
+        mergedFiles.add(stats.failed.get().toLong()    - before[3], "failed")
+        return stats
+    }
+
+    /** [files] less the ones the [manifest] shows as unchanged since their last merge, counted in [Stats.skipped] */
+    fun skipUnchanged(files: List<File>, manifest: MergeManifest, stats: Stats): List<File> {
+        val unchanged = manifest.unchanged(files)
+        if( unchanged.isNotEmpty() )
+            logger.info { "skipping ${unchanged.size} of ${files.size} files unchanged since the last merge" }
+        stats.skipped.addAndGet(unchanged.size)
+        mergedFiles.add(unchanged.size.toLong(), "skipped")
+        return files.filter { it !in unchanged }
+    }
+
+    /**
+     * Like [process], but files the [manifest] shows as unchanged since their last merge are skipped.
+     * The successfully processed files are recorded, and the manifest is saved along with the state of [tables].
+     *
+     * @param processFile returns success
+     */
+    fun processChanged(files: List<File>, manifest: MergeManifest, tables: List<String>,
+                       processFile: (file: File, stats: Stats) -> Boolean): Stats {
+        val stats = Stats(files.size)
+        process(skipUnchanged(files, manifest, stats), stats) { file, stats ->
+            if( processFile(file, stats) )
+                manifest.merged(file)
+        }
 
+        manifest.save(MergeManifest.currentDbState(tables))
         return stats
     }
 
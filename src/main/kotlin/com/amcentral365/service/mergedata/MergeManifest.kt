@@ -0,0 +1,162 @@
+package com.amcentral365.service.mergedata
+
+import com.google.common.hash.Hashing
+import com.google.common.io.Files as GuavaFiles
+import mu.KotlinLogging
+
+import java.io.File
+import java.io.IOException
+import java.nio.file.Files
+import java.nio.file.StandardCopyOption
+import java.sql.Connection
+import java.util.Properties
+import java.util.concurrent.ConcurrentHashMap
+
+import com.amcentral365.service.config
+import com.amcentral365.service.databaseStore
+
+
+private val logger = KotlinLogging.logger {}
+
+/**
+ * Fingerprints of the merge files (size, modification time, and content hash) as of their last successful merge,
+ * and the state of the database tables right after it.
+ *
+ * If the tables are still in that state, nobody changed them since, and files with the same content can't change
+ * them either: [unchanged] lists such files, so the merge skips them without reading or touching the database.
+ * Any change of the tables, e.g. by the API or by another node's merge, invalidates all fingerprints.
+ *
+ * The table state is the row count, the latest modification time, and the content checksum of each table.
+ * <code>modified_ts</code> has one second resolution, so the checksum catches changes made within the second
+ * of the merge. <code>CHECKSUM TABLE</code> reads the whole table.
+ */
+class MergeManifest(private val file: File, private val dbState: String, private val dbUrl: String = config.dbUrl) {
+
+    data class Fingerprint(val size: Long, val mtime: Long, val sha256: String) {
+        override fun toString() = "$size,$mtime,$sha256"
+
+        companion object {
+            fun parse(s: String): Fingerprint? =
+                s.split(',').takeIf { it.size == 3 }?.let { (size, mtime, sha) ->
+                    val sz = size.toLongOrNull()
+                    val mt = mtime.toLongOrNull()
+                    if( sz == null || mt == null ) null else Fingerprint(sz, mt, sha)
+                }
+
+            fun of(file: File) = Fingerprint(file.length(), file.lastModified(), sha256(file))
+        }
+    }
+
+    companion object {
+        private const val DB_STATE_KEY = "dbState"
+        private const val DB_URL_KEY   = "dbUrl"
+        private const val ROOT_KEY     = "root"
+        private const val FILE_PREFIX  = "file."
+
+        /**
+         * The manifest of mergedata/[baseDirName]. With --merge-full, the previous fingerprints are ignored,
+         * all files are merged, and the manifest is recreated.
+         *
+         * @param tables the tables the merge writes, or whose content affects it
+         */
+        fun open(baseDirName: String, tables: List<String>): MergeManifest {
+            val manifest = MergeManifest(File(config.mergeManifestDir, "$baseDirName.manifest"), currentDbState(tables))
+            if( config.mergeFull )
+                logger.info { "--merge-full: merging all files of $baseDirName" }
+            else
+                manifest.load()
+            return manifest
+        }
+
+        fun currentDbState(tables: List<String>): String = databaseStore.getGoodConnection().use { readDbState(it, tables) }
+
+        internal fun readDbState(conn: Connection, tables: List<String>): String =
+            tables.joinToString(";") { table ->
+                conn.createStatement().use { stmt ->
+                    val countAndTs = stmt.executeQuery("select count(*), max(modified_ts) from $table").use { rs ->
+                        rs.next()
+                        "${rs.getLong(1)}:${rs.getTimestamp(2)?.time ?: 0}"
+                    }
+                    val checksum = stmt.executeQuery("checksum table $table").use { rs ->
+                        rs.next()
+                        rs.getLong(2)    // Table, Checksum
+                    }
+                    "$table:$countAndTs:$checksum"
+                }
+            }
+
+        internal fun sha256(file: File): String = GuavaFiles.asByteSource(file).hash(Hashing.sha256()).toString()
+
+        private fun key(file: File) = file.invariantSeparatorsPath
+        private val rootPath get() = File(MERGE_DATA_ROOT_DIR).absoluteFile.invariantSeparatorsPath
+    }
+
+    private val previous = mutableMapOf<String, Fingerprint>()          // as loaded; read only after load()
+    private val current  = ConcurrentHashMap<String, Fingerprint>()     // skipped and merged files of this run
+
+    internal fun load() {
+        if( !this.file.exists() )
+            return
+
+        val props = Properties()
+        try {
+            this.file.inputStream().use { props.load(it) }
+        } catch(x: IOException) {
+            logger.warn { "ignoring unreadable merge manifest ${this.file.path}: ${x.message}" }
+            return
+        }
+
+        val stale = when {
+            props.getProperty(ROOT_KEY)     != rootPath     -> "the mergedata directory has moved"
+            props.getProperty(DB_URL_KEY)   != this.dbUrl   -> "the database has changed"
+            props.getProperty(DB_STATE_KEY) != this.dbState -> "the database was modified since the last merge"
+            else -> null
+        }
+        if( stale != null ) {
+            logger.info { "merge manifest ${this.file.path} is stale, $stale; merging all files" }
+            return
+        }
+
+        props.stringPropertyNames().filter { it.startsWith(FILE_PREFIX) }.forEach { name ->
+            Fingerprint.parse(props.getProperty(name))?.let { this.previous[name.removePrefix(FILE_PREFIX)] = it }
+        }
+        logger.info { "loaded merge manifest ${this.file.path} with ${this.previous.size} files" }
+    }
+
+    /**
+     * Files with the content they had when last merged. Files with a different size or modification time
+     * are hashed, so a touched but otherwise unmodified file is still recognized.
+     */
+    fun unchanged(files: List<File>): Set<File> =
+        files.filter { file ->
+            val prev = this.previous[key(file)] ?: return@filter false
+            val fp = if( file.length() == prev.size && file.lastModified() == prev.mtime ) prev
+                     else Fingerprint.of(file).takeIf { it.sha256 == prev.sha256 } ?: return@filter false
+            this.current[key(file)] = fp
+            true
+        }.toSet()
+
+    /** Record a successful merge of [file]. Thread safe. */
+    fun merged(file: File) {
+        this.current[key(file)] = Fingerprint.of(file)
+    }
+
+    /** Persist the recorded files, along with [dbStateAfterMerge], the state of the tables after the merge */
+    fun save(dbStateAfterMerge: String) {
+        val props = Properties()
+        props.setProperty(ROOT_KEY, rootPath)
+        props.setProperty(DB_URL_KEY, this.dbUrl)
+        props.setProperty(DB_STATE_KEY, dbStateAfterMerge)
+        this.current.forEach { (path, fp) -> props.setProperty(FILE_PREFIX + path, fp.toString()) }
+
+        try {
+            this.file.parentFile?.mkdirs()
+            val tmp = File(this.file.path + ".tmp")
+            tmp.outputStream().use { props.store(it, "merge manifest, see MergeManifest.kt") }
+            Files.move(tmp.toPath(), this.file.toPath(), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+            logger.info { "saved merge manifest ${this.file.path} with ${this.current.size} files" }
+        } catch(x: IOException) {
+            logger.warn { "couldn't save merge manifest ${this.file.path}, the next merge will process all files: ${x.message}" }
+        }
+    }
+}
@@ -0,0 +1,206 @@
+package com.amcentral365.service.mergedata
+
+import com.google.gson.JsonArray
+import com.google.gson.JsonElement
+import com.google.gson.JsonNull
+import com.google.gson.JsonObject
+import com.google.gson.JsonParser
+import com.google.gson.JsonPrimitive
+import com.google.gson.JsonSyntaxException
+import com.google.gson.stream.JsonReader
+import com.google.gson.stream.JsonToken
+
+import java.io.BufferedReader
+import java.io.EOFException
+import java.io.File
+import java.io.InputStream
+import java.io.Reader
+import javax.xml.stream.XMLInputFactory
+import javax.xml.stream.XMLStreamConstants
+import javax.xml.stream.XMLStreamException
+import javax.xml.stream.XMLStreamReader
+
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.config
+
+
+/**
+ * Streaming readers of the merge files. A file holds records: its documents, or, when a document is an array,
+ * each of its items. The records are read one at a time, so a file takes no more memory than its biggest record.
+ *
+ * Supported formats, by the file extension:
+ *  - jsn, json: a JSON value. Comments are allowed.
+ *  - ndjson, jsonl: a JSON value per line.
+ *  - yml, yaml: YAML documents separated with <code>---</code>, see [YamlReader] for the supported subset.
+ *  - xml: the root element. Elements with child elements are objects, and a repeated child becomes an array.
+ *    An element whose children are all named <code>item</code> is an array. Attributes are object members.
+ *    XML has no types: texts and attributes are strings, and the readers type them by the role schema,
+ *    see [isTyped].
+ */
+class MergeRecords { companion object {
+
+    val EXTENSIONS = setOf("jsn", "json", "ndjson", "jsonl", "yml", "yaml", "xml")
+
+    /** Whether values of [file] have types. When not, e.g. in XML, all values are strings. */
+    fun isTyped(file: File) = file.extension.toLowerCase() != "xml"
+
+    /** Call [body] with the records of [file], which is open until [body] returns */
+    fun <T> read(file: File, body: (records: Sequence<JsonElement>) -> T): T =
+        when(val ext = file.extension.toLowerCase()) {
+            "jsn", "json"     -> file.bufferedReader(config.charSet).use { body(json(it, file.path)) }
+            "ndjson", "jsonl" -> file.bufferedReader(config.charSet).use { body(ndjson(it, file.path)) }
+            "yml", "yaml"     -> file.bufferedReader(config.charSet).use { body(YamlReader(it, file.path).records()) }
+            "xml"             -> file.inputStream().buffered().use { body(xml(it, file.path)) }  // XML declares its encoding
+            else -> throw UnsupportedOperationException("unsupported extension $ext, supported extensions are: ${EXTENSIONS.joinToString(", ")}")
+        }
+
+    internal fun json(input: Reader, sourceName: String): Sequence<JsonElement> = sequence {
+        val reader = JsonReader(input)
+        reader.isLenient = true     // allow comments
+        val parser = JsonParser()
+
+        val first = try {
+            reader.peek()
+        } catch(x: EOFException) {
+            throw StatusException(400, "$sourceName is empty")
+        }
+
+        if( first == JsonToken.BEGIN_ARRAY ) {
+            reader.beginArray()
+            while( reader.hasNext() )
+                yield(parser.parse(reader))
+            reader.endArray()
+        } else
+            yield(parser.parse(reader))
+
+        if( reader.peek() != JsonToken.END_DOCUMENT )
+            throw JsonSyntaxException("$sourceName: unexpected content after the JSON value at ${reader.path}")
+    }
+
+    internal fun ndjson(input: BufferedReader, sourceName: String): Sequence<JsonElement> = sequence {
+        val parser = JsonParser()
+        var lineNo = 0
+        while( true ) {
+            val line = input.readLine() ?: break
+            lineNo++
+            if( line.isBlank() )
+                continue
+
+            val elm = try {
+                parser.parse(line)
+            } catch(x: JsonSyntaxException) {
+                throw JsonSyntaxException("$sourceName line $lineNo: ${x.message}", x)
+            }
+
+            if( elm.isJsonArray )
+                yieldAll(elm.asJsonArray)
+            else
+                yield(elm)
+        }
+    }
+
+    internal fun xml(input: InputStream, sourceName: String): Sequence<JsonElement> = sequence {
+        val factory = XMLInputFactory.newInstance()
+        factory.setProperty(XMLInputFactory.SUPPORT_DTD, false)
+        factory.setProperty(XMLInputFactory.IS_SUPPORTING_EXTERNAL_ENTITIES, false)
+
+        val reader = factory.createXMLStreamReader(input)
+        val xml = XmlElements(reader, sourceName)
+        try {
+            reader.nextTag()    // the root
+
+            // Stream the items of a root array. Anything else is read whole.
+            val root = xml.begin()
+            while( reader.hasNext() ) {
+                val event = reader.next()
+                if( event == XMLStreamConstants.END_ELEMENT )
+                    break
+                if( event == XMLStreamConstants.START_ELEMENT && reader.localName == XmlElements.ITEM && root.children.isEmpty() && root.attributes.isEmpty() ) {
+                    root.items++
+                    yield(xml.element())
+                } else
+                    xml.add(root, event)
+            }
+
+            if( root.items == 0 || root.children.isNotEmpty() )
+                yield(xml.end(root))
+
+        } catch(x: XMLStreamException) {
+            throw StatusException(400, "$sourceName line ${x.location?.lineNumber ?: reader.location.lineNumber}: ${x.message}")
+        } finally {
+            reader.close()
+        }
+    }
+}}
+
+
+/** Conversion of XML elements to JSON, see [MergeRecords] */
+private class XmlElements(private val reader: XMLStreamReader, private val sourceName: String) {
+    companion object {
+        const val ITEM = "item"
+    }
+
+    class Element(val name: String, val line: Int) {
+        val attributes = mutableListOf<Pair<String, String>>()
+        val children = mutableListOf<Pair<String, JsonElement>>()
+        val text = StringBuilder()
+        var items = 0   // streamed items of the root
+    }
+
+    private fun error(elm: Element, msg: String): Nothing =
+        throw StatusException(400, "$sourceName line ${elm.line}: element <${elm.name}> $msg")
+
+    /** Start the element the reader is at */
+    fun begin(): Element {
+        val elm = Element(reader.localName, reader.location.lineNumber)
+        for(k in 0 until reader.attributeCount)
+            elm.attributes.add(Pair(reader.getAttributeLocalName(k), reader.getAttributeValue(k)))
+        return elm
+    }
+
+    /** Add the content at the reader's [event] to [elm] */
+    fun add(elm: Element, event: Int) {
+        when( event ) {
+            XMLStreamConstants.START_ELEMENT -> {
+                if( elm.items > 0 )
+                    error(elm, "mixes <$ITEM> with other elements")
+                val name = reader.localName
+                elm.children.add(Pair(name, this.element()))
+            }
+            XMLStreamConstants.CHARACTERS, XMLStreamConstants.CDATA, XMLStreamConstants.SPACE ->
+                elm.text.append(reader.text)
+        }
+    }
+
+    /** The element the reader is at, read through its end */
+    fun element(): JsonElement {
+        val elm = this.begin()
+        while( true ) {
+            val event = reader.next()
+            if( event == XMLStreamConstants.END_ELEMENT )
+                break
+            this.add(elm, event)
+        }
+        return this.end(elm)
+    }
+
+    fun end(elm: Element): JsonElement {
+        val text = elm.text.trim().toString()
+        if( elm.children.isEmpty() && elm.attributes.isEmpty() )
+            return if( text.isEmpty() ) JsonNull.INSTANCE else JsonPrimitive(text)
+        if( text.isNotEmpty() )
+            error(elm, "mixes text with ${if( elm.children.isEmpty() ) "attributes" else "elements"}")
+
+        if( elm.attributes.isEmpty() && elm.children.all { it.first == ITEM } )
+            return JsonArray().also { arr -> elm.children.forEach { arr.add(it.second) } }
+
+        val obj = JsonObject()
+        elm.attributes.forEach { (name, value) -> obj.addProperty(name, value) }
+        elm.children.groupBy({ it.first }, { it.second }).forEach { (name, values) ->
+            if( obj.has(name) )
+                error(elm, "has both an attribute and an element $name")
+            obj.add(name, if( values.size == 1 ) values[0] else JsonArray().also { arr -> values.forEach { arr.add(it) } })
+        }
+        return obj
+    }
+}
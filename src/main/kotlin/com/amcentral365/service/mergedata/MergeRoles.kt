@@ -3,37 +3,49 @@ package com.amcentral365.service.mergedata
 import com.amcentral365.pl4kotlin.InsertStatement
 import com.amcentral365.pl4kotlin.SelectStatement
 import com.amcentral365.pl4kotlin.UpdateStatement
+import com.amcentral365.service.api.SchemaTree
 import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.api.directlyReferencedRoles
 import com.amcentral365.service.api.loadSchemaFromDb
 import mu.KotlinLogging
 
 import com.google.gson.Gson
+import com.google.gson.JsonElement
+import com.google.gson.JsonParseException
 import com.google.gson.JsonSyntaxException
 
 import java.io.File
 import java.io.IOException
 
-import java.lang.UnsupportedOperationException
-
-import com.amcentral365.service.config
 import com.amcentral365.service.dao.Role
 import com.amcentral365.service.databaseStore
+import com.amcentral365.service.schemaUtils
+import com.amcentral365.service.api.catalog.AssetRoleValues as AssetRoleValuesApi
+import com.amcentral365.service.StatusException
 
 import com.google.common.annotations.VisibleForTesting
 
 import java.sql.SQLException
-import java.util.Stack
+import java.util.ArrayDeque
+import java.util.concurrent.ConcurrentHashMap
 
 
 private val logger = KotlinLogging.logger {}
 
 
 open class MergeRoles(private val baseDirName: String) {
+    companion object {
+        /** A role merge only depends on the roles */
+        private val MANIFEST_TABLES = listOf("roles")
+    }
 
     // All variables are shared between threads
     private val gson = Gson()  // thread safe
-    private var processedFiles = mutableSetOf<File>()   // read and updated by all threads
-    private lateinit var files: List<File>   // set and populated by `merge` once, read by all threads
+    private lateinit var files: List<File>                      // set and populated by `merge` once, read by all threads
+    private lateinit var filesByRoleName: Map<String, File>     // ditto, the index of `files`
+    private val roles = mutableMapOf<String, Role>()            // ditto, the roles read from the changed files
+    private val unchangedSchemas = mutableMapOf<String, String>()   // ditto, schemas of the unchanged roles they reference
+    private val failedRoles: MutableSet<String> = ConcurrentHashMap.newKeySet()  // read and updated by all threads
 
     /**
      * Merge role definitions into the database
@@ -41,54 +53,166 @@ open class MergeRoles(private val baseDirName: String) {
      * Read role definition files under the specified directory (defaulting to mergedata/roles),
      * and merge (add or update) roles into the database table <code>ROLES</code>.
      *
-     * The files are processed with parallelism --merge-threads.
+     * A role can only be validated once the roles it references are known, so all changed files are read up front,
+     * and the roles are merged in waves: a role is merged in the wave after the roles it references. The roles of
+     * a wave are merged with parallelism --merge-threads. Reference cycles are reported before anything is written,
+     * and the roles on them, or referencing a failed role, fail.
      *
      * @return the number of failures
      */
     fun merge(): Int {
         this.files = MergeDirectory.list(baseDirName)
-        val stats = MergeDirectory.process(this.files) { file, stats ->
-            if( file in processedFiles )
-                logger.info { "skipping already processed ${file.path}" }
-            else {
-                //logger.info { "starting processing ${file.path}" }
-                val succeeded = this.process(file, stats)
+        this.filesByRoleName = this.indexRoleFiles(this.files)
+        val manifest = MergeManifest.open(baseDirName, MANIFEST_TABLES)
+        val stats = MergeDirectory.Companion.Stats(this.files.size)
+
+        val roleFiles = mutableMapOf<String, File>()
+        for(file in MergeDirectory.skipUnchanged(this.files, manifest, stats)) {
+            val role = this.readRole(file)
+            if( role == null ) {
+                this.failedRoles.add(fileNameToRoleName(file))
+                stats.failed.incrementAndGet()
+            } else {
+                this.roles[role.roleName!!] = role
+                roleFiles[role.roleName!!] = file
+            }
+        }
+
+        val references = this.roles.mapValues { (roleName, role) ->
+            try {
+                directlyReferencedRoles(role.roleSchema!!)
+            } catch(x: JsonParseException) {
+                logger.error { "  json parse error in the schema of role $roleName: ${x.javaClass.name} ${x.message}" }
+                this.failedRoles.add(roleName)
+                emptySet<String>()
+            }
+        }
+
+        this.readUnchangedReferencedRoles(references.values.flatten())
 
-                //logger.info { "finished processing ${file.path}" }
-                this.processedFiles.add(file)
+        val graph = RoleGraph(references)
+        graph.cyclic.sorted().forEach { roleName ->
+            val cycle = graph.cycleThrough(roleName, references)
+            if( cycle != null )
+                logger.error { "  role $roleName is on a reference cycle: ${cycle.joinToString(" -> ")}" }
+            else
+                logger.error { "  role $roleName references a role on a reference cycle" }
+            this.failedRoles.add(roleName)
+        }
+        stats.failed.addAndGet(graph.cyclic.size)
 
-                if( succeeded )
+        graph.waves.forEachIndexed { k, wave ->
+            logger.info { "merging wave ${k+1} of ${graph.waves.size} with ${wave.size} roles" }
+            MergeDirectory.process(wave.map { roleFiles.getValue(it) }, stats) { file, stats ->
+                val role = this.roles.getValue(fileNameToRoleName(file))
+                if( this.process(role, references.getValue(role.roleName!!), stats) ) {
                     stats.processed.incrementAndGet()
-                else
+                    manifest.merged(file)
+                } else {
+                    this.failedRoles.add(role.roleName!!)
                     stats.failed.incrementAndGet()
+                }
             }
         }
 
+        manifest.save(MergeManifest.currentDbState(MANIFEST_TABLES))
+
         with(stats) {
             logger.info { "Merge completed for $totalConsidered roles with $processed merged successfully and $failed failed" }
             logger.info { "  process stats: added $inserted, updated $updated, and skipped $unchanged unchanged" }
+            logger.info { "  $skipped files were unchanged since the last merge and weren't read" }
         }
 
         return stats.failed.get()
     }
 
 
-    // Called from different threads. Should not write the object state
-    private fun process(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        return when(val ext = file.extension.toLowerCase()) {
-            "jsn", "json" -> processJson(file, stats)
-            "yml", "yaml" -> processYaml(file, stats)
-            "xml"         -> processXml(file, stats)
-            else -> {
-                logger.info { "unsupported extension $ext, supported extensions are: jsn, json, yml, yaml, xml" }
-                false
+    /** Read the role of [file], or log the error and return null */
+    private fun readRole(file: File): Role? {
+        logger.info { "reading ${file.path}" }
+        try {
+            val role = readRoleObjectFromFile(file)
+
+            val roleNameFromFile = fileNameToRoleName(file)
+            if( roleNameFromFile != role.roleName )
+                throw Exception("file name '$roleNameFromFile' does not match the role name '${role.roleName}'")
+
+            if( role.roleName in this.roles )
+                throw Exception("role ${role.roleName} is also defined by another file")
+
+            return role
+
+        } catch(x: IOException) {
+            logger.error { "  couldn't read ${file.path}: ${x.javaClass.name} ${x.message}" }
+        } catch(x: JsonSyntaxException) {
+            logger.error { "  json parse error in ${file.path}: ${x.javaClass.name} ${x.message}" }
+        } catch(x: Exception) {
+            logger.error { "  error processing ${file.path}: ${x.javaClass.name} ${x.message}" }
+        }
+        return null
+    }
+
+
+    /**
+     * Read the schemas of the unchanged roles in [roleNames], and of the unchanged roles they reference, into
+     * [unchangedSchemas]. Each file is read once, rather than by every role referencing it. A role whose file
+     * can't be read is added to the failed roles, failing the roles referencing it.
+     */
+    private fun readUnchangedReferencedRoles(roleNames: Collection<String>) {
+        val queue = ArrayDeque<String>(roleNames)
+        while( queue.isNotEmpty() ) {
+            val roleName = queue.poll()
+            if( roleName in this.roles || roleName in this.unchangedSchemas || roleName in this.failedRoles )
+                continue
+            val roleFile = this.filesByRoleName[roleName] ?: continue      // not in the files, looked up in the DB
+
+            logger.debug { "  reading referenced role $roleName from unchanged file ${roleFile.path}" }
+            try {
+                val roleSchema = readRoleObjectFromFile(roleFile).roleSchema!!
+                queue.addAll(directlyReferencedRoles(roleSchema))
+                this.unchangedSchemas[roleName] = roleSchema
+            } catch(x: Exception) {
+                logger.error { "  error reading referenced role $roleName from ${roleFile.path}: ${x.javaClass.name} ${x.message}" }
+                this.failedRoles.add(roleName)
             }
         }
     }
 
-    // Move basic ops out to protected methods so we can test process() by overriding them
 
-    private fun readFile(file: File): String = file.readText(config.charSet)
+    // Called from different threads. Should not write the object state.
+    // The referenced roles are either merged by the previous waves, or aren't being merged.
+    private fun process(role: Role, referencedRoles: Set<String>, stats: MergeDirectory.Companion.Stats): Boolean {
+        logger.info { "processing role ${role.roleName}" }
+        referencedRoles.find { it in this.failedRoles }?.let { failedRole ->
+            logger.error { "  role ${role.roleName} references role $failedRole, which failed" }
+            return false
+        }
+
+        try {
+            SchemaUtils { roleName ->
+                val parsedRole = this.roles[roleName]
+                when {
+                    parsedRole != null -> parsedRole.roleSchema
+                    roleName in this.unchangedSchemas -> this.unchangedSchemas[roleName]
+                    roleName in this.failedRoles -> throw StatusException(500, "role $roleName failed")
+                    else -> {
+                        logger.debug { "  role file was not deteced for $roleName, attempting to find in the DB" }
+                        loadSchemaFromDb(roleName)      // the role isn't known, but may be loaded by other means
+                    }
+                }
+            }.validateAndCompile(role.roleName!!, role.roleSchema!!)
+
+            mergeRoleIntoDB(role, true, stats)
+
+        } catch(x: Exception) {
+            logger.error { "  error processing role ${role.roleName}: ${x.javaClass.name} ${x.message}" }
+            return false
+        }
+
+        return true
+    }
+
+    // Move basic ops out to protected methods so we can test process() by overriding them
 
     private fun parseJson(content: String): Map<String, Any> = gson.fromJson<Map<String, Any>>(content, Map::class.java)
 
@@ -99,19 +223,15 @@ open class MergeRoles(private val baseDirName: String) {
             .replace('/', '.')
 
 
-    private fun roleNameToInvariantPath(roleName: String) =
-            "$MERGE_DATA_ROOT_DIR/$baseDirName/" + roleName.replace('.', '/')
-
-
-    @VisibleForTesting fun findRoleFile(roleName: String, files: List<File>): File? =
-        this.roleNameToInvariantPath(roleName).let { rolePath ->
-            files.find {
-                it.invariantSeparatorsPath.substring(0, it.invariantSeparatorsPath.lastIndexOf('.')) == rolePath
-            }
-        }
+    /** Role name to its file. When several files define a role, e.g. a.json and a.yml, the first one wins */
+    private fun indexRoleFiles(files: List<File>): Map<String, File> {
+        val index = mutableMapOf<String, File>()
+        files.forEach { index.putIfAbsent(fileNameToRoleName(it), it) }
+        return index
+    }
 
 
-    private fun findRoleFile(roleName: String): File? = findRoleFile(roleName, this.files)
+    @VisibleForTesting fun findRoleFile(roleName: String, files: List<File>): File? = indexRoleFiles(files)[roleName]
 
     private fun readRoleFromDb(roleName: String): Role? {
         val role = Role(roleName = roleName)
@@ -129,9 +249,15 @@ open class MergeRoles(private val baseDirName: String) {
             parseJson(fileSchema) == parseJson(dbSchema)
 
 
-    private fun readRoleObjectFromFile(file: File, parser: (fileText: String) -> Map<String, Any>): Role {
-        val fileText = readFile(file)
-        val fileObj = parser(fileText)
+    private fun readRoleObjectFromFile(file: File): Role {
+        val fileObj = MergeRecords.read(file) { records ->
+            val elms = records.take(2).toList()
+            if( elms.size != 1 || !elms[0].isJsonObject )
+                throw Exception("expected a single role object")
+            if( !MergeRecords.isTyped(file) )
+                elms[0].asJsonObject["roleSchema"]?.let { typeCompositeDefaults(it) }
+            gson.fromJson<Map<String, Any>>(elms[0], Map::class.java)
+        }
         val roleSchemaMap = fileObj["roleSchema"]
                 ?: throw Exception("element 'roleSchema' is missing, roles must have schema")
 
@@ -152,66 +278,34 @@ open class MergeRoles(private val baseDirName: String) {
         return role
     }
 
-    data class RoleAndItsFile(val role: Role, val file: File)
-
 
-    private fun processJson(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        logger.info { "processing JSON file ${file.path}" }
-        try {
-            val role = readRoleObjectFromFile(file, ::parseJson)
-
-            val roleNameFromFile = fileNameToRoleName(file)
-            if( roleNameFromFile != role.roleName )
-                throw Exception("file name '$roleNameFromFile' does not match the role name '${role.roleName}'")
+    /** Values of untyped formats are strings: type the defaults of composite type definitions by their types */
+    private fun typeCompositeDefaults(schemaElm: JsonElement) {
+        if( !schemaElm.isJsonObject )
+            return
+        val obj = schemaElm.asJsonObject
+        if( !SchemaUtils.TypeDef.isCompositeTypeDef(obj) ) {
+            obj.entrySet().forEach { typeCompositeDefaults(it.value) }
+            return
+        }
 
-            val dbMergeObjs = Stack<RoleAndItsFile>()
-            dbMergeObjs.push(RoleAndItsFile(role, file))
+        val typeElm = obj["type"]
+        val defaultElm = obj["default"]
+        if( defaultElm == null || !typeElm.isJsonPrimitive )
+            return typeCompositeDefaults(typeElm)
 
-            SchemaUtils { roleName ->
-                logger.debug { "processing referenced role $roleName" }
-                val roleFile = findRoleFile(roleName)
-                if( roleFile == null ) {
-                    logger.debug { "  role file was not deteced for $roleName, attempting to find in the DB" }
-                    loadSchemaFromDb(roleName)      // the role isn't known, but may be loaded by other means
-                } else {
-                    logger.info { "  file for role $roleName is ${roleFile.path}" }
-                    if( roleFile in this.processedFiles ) {
-                        logger.debug { "  $roleName is already processed, loading from the DB" }
-                        loadSchemaFromDb(roleName)    // already loaded by us or another thread
-                    } else {
-                        logger.debug { "  reading and processing $roleName from file $roleFile" }
-                        val roleFromFile = readRoleObjectFromFile(roleFile, ::parseJson)
-                        dbMergeObjs.push(RoleAndItsFile(roleFromFile, roleFile))
-                        roleFromFile.roleSchema     // return
-                    }
-                }
-            }.validateAndCompile(role.roleName!!, role.roleSchema!!)
-
-            logger.info { "considering ${dbMergeObjs.size} roles for DB merge" }
-            while(dbMergeObjs.isNotEmpty()) {
-                val (validatedRole, roleFile) = dbMergeObjs.pop()
-                if( roleFile in this.processedFiles )
-                    logger.info { "  skipping already processed role ${validatedRole.roleName}" }
-                else {
-                    val dbChanged = mergeRoleIntoDB(validatedRole, dbMergeObjs.isEmpty(), stats)
-                    if(dbChanged) {
-                        this.processedFiles.add(roleFile)
-                    }
-                }
+        val typeCode = try {
+            SchemaUtils.TypeDef.fromTypeName("default", typeElm.asString).typeCode
+        } catch(x: StatusException) {
+            return      // reported by the validation
+        }
+        when {
+            defaultElm.isJsonPrimitive -> obj.add("default", SchemaTree.typeString(typeCode, defaultElm.asJsonPrimitive))
+            defaultElm.isJsonArray     -> defaultElm.asJsonArray.let { arr ->
+                for(k in 0 until arr.size())
+                    arr[k].takeIf { it.isJsonPrimitive }?.let { arr.set(k, SchemaTree.typeString(typeCode, it.asJsonPrimitive)) }
             }
-
-        } catch(x: IOException) {
-            logger.error { "  couldn't read ${file.path}: ${x.javaClass.name} ${x.message}" }
-            return false
-        } catch(x: JsonSyntaxException) {
-            logger.error { "  json parse error in ${file.path}: ${x.javaClass.name} ${x.message}" }
-            return false
-        } catch(x: Exception) {
-            logger.error { "  error processing ${file.path}: ${x.javaClass.name} ${x.message}" }
-            return false
         }
-
-        return true
     }
 
 
@@ -248,12 +342,14 @@ open class MergeRoles(private val baseDirName: String) {
             val stmt = UpdateStatement(role).byPkAndOptLock()
 
             var hasUpdates = false
+            var indexedBefore: Set<String>? = null    // of the updated schema
 
             if( schemasMatch(role.roleSchema!!, dbRole.roleSchema!!) ) {
                 logger.info("    the schemas match")
             } else {
                 stmt.update(role::roleSchema)
                 logger.info("    updating role schema")
+                indexedBefore = AssetRoleValuesApi.indexedAttributes(role.roleName!!)
                 hasUpdates = true
             }
 
@@ -286,6 +382,11 @@ open class MergeRoles(private val baseDirName: String) {
                     }
                 }
 
+                if( indexedBefore != null ) {
+                    schemaUtils.invalidate(role.roleName!!)
+                    AssetRoleValuesApi.reindexIfChanged(role.roleName!!, indexedBefore)
+                }
+
             } else {
                 logger.info("  skipping matching role ${role.roleName}")
                 if( isTopLevelRole )
@@ -296,15 +397,4 @@ open class MergeRoles(private val baseDirName: String) {
 
         return false
     }
-
-
-    private fun processYaml(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        stats.unchanged.incrementAndGet()
-        throw UnsupportedOperationException("extension ${file.extension} will be supported later")
-    }
-
-    private fun processXml(file: File, stats: MergeDirectory.Companion.Stats): Boolean {
-        stats.unchanged.incrementAndGet()
-        throw UnsupportedOperationException("extension ${file.extension} will be supported later")
-    }
 }
@@ -0,0 +1,192 @@
+package com.amcentral365.service.mergedata
+
+import java.util.ArrayDeque
+import java.util.BitSet
+
+
+/**
+ * The patterns of a priority list, compiled to find the first one matching a path in one pass over the path.
+ *
+ * Most patterns contain a literal every match must contain, e.g. <code>b.yml</code> needs "yml", and
+ * <code>^com/p1\.json$</code> needs "com/p1.json". The literals are combined into an Aho-Corasick automaton,
+ * so one scan of the path yields the candidate patterns. Only candidates are tried, in the priority order, with
+ * their regex, unless the pattern is a plain literal. Patterns without such a literal, e.g. with alternations or
+ * inline flags, are always tried.
+ */
+internal class PriorityPatterns(patterns: List<String>) {
+
+    companion object {
+        const val REGEX_META_CHARS = "\\^$.|?*+()[]{}"
+        private const val CHAR_CLASS_ESCAPES = "dDsSwWhHvVbBAGZzRXntrfae"    // escapes that take no more characters
+
+        /**
+         * The longest run of literal characters every match of [pattern] contains, and whether the pattern is that
+         * literal and nothing else. Conservative: an empty literal when unsure.
+         */
+        fun requiredLiteral(pattern: String): Pair<String, Boolean> {
+            if( '|' in pattern || "(?" in pattern || "\\Q" in pattern )
+                return Pair("", false)
+
+            val runs = mutableListOf<String>()
+            val run = StringBuilder()
+            var plain = true
+            fun endRun() {
+                if( run.isNotEmpty() )
+                    runs.add(run.toString())
+                run.setLength(0)
+            }
+
+            var k = 0
+            while( k < pattern.length ) {
+                val c = pattern[k]
+                var literal: Char? = null
+                k = when {
+                    c == '\\' && k+1 < pattern.length && !pattern[k+1].isLetterOrDigit() -> { literal = pattern[k+1];  k + 2 }
+                    c == '\\' && pattern.getOrNull(k+1)?.let { it in CHAR_CLASS_ESCAPES } == true -> k + 2
+                    c == '\\' -> return Pair("", false)     // \x41, \p{L}, back references, ...
+                    c == '['  -> skipClass(pattern, k)
+                    c == '('  -> skipGroup(pattern, k)
+                    c in ".^$?*+{" -> k + 1
+                    else -> { literal = c;  k + 1 }
+                }
+
+                val q = pattern.getOrNull(k)
+                if( q == '?' || q == '*' || q == '+' || q == '{' ) {
+                    val optional = when( q ) {
+                        '?', '*' -> true
+                        '+'      -> false
+                        else     -> (pattern.substring(k+1).takeWhile { it.isDigit() }.toIntOrNull() ?: 0) == 0
+                    }
+                    k = if( q == '{' ) pattern.indexOf('}', k).let { if( it < 0 ) pattern.length else it + 1 } else k + 1
+                    if( pattern.getOrNull(k) == '?' || pattern.getOrNull(k) == '+' )    // lazy or possessive
+                        k++
+
+                    if( literal != null && !optional )
+                        run.append(literal)     // required once, but may repeat
+                    endRun()
+                    plain = false
+                } else if( literal != null )
+                    run.append(literal)
+                else {
+                    endRun()
+                    plain = false
+                }
+            }
+            endRun()
+
+            return Pair(runs.maxBy { it.length } ?: "", plain && runs.size == 1)
+        }
+
+        /** The index past the character class at [start] */
+        private fun skipClass(pattern: String, start: Int): Int {
+            var k = start + 1
+            if( pattern.getOrNull(k) == '^' ) k++
+            if( pattern.getOrNull(k) == ']' ) k++      // a literal ]
+            var depth = 1
+            while( k < pattern.length ) {
+                when( pattern[k] ) {
+                    '\\' -> k++
+                    '['  -> depth++
+                    ']'  -> if( --depth == 0 ) return k + 1
+                }
+                k++
+            }
+            return pattern.length
+        }
+
+        /** The index past the group at [start] */
+        private fun skipGroup(pattern: String, start: Int): Int {
+            var k = start + 1
+            var depth = 1
+            while( k < pattern.length ) {
+                when( pattern[k] ) {
+                    '\\' -> k++
+                    '['  -> { k = skipClass(pattern, k);  continue }
+                    '('  -> depth++
+                    ')'  -> if( --depth == 0 ) return k + 1
+                }
+                k++
+            }
+            return pattern.length
+        }
+    }
+
+    /** Aho-Corasick automaton of the literals: nodes are indexes, the root is 0 */
+    private class Literals(literals: List<Pair<String, Int>>) {
+        private val next = mutableListOf(HashMap<Char, Int>())
+        private val fail = mutableListOf(0)
+        private val out  = mutableListOf(mutableListOf<Int>())     // pattern indexes of the literals ending at the node
+
+        init {
+            literals.forEach { (literal, patternIdx) ->
+                var node = 0
+                for(c in literal)
+                    node = this.next[node][c] ?: this.newNode().also { this.next[node][c] = it }
+                this.out[node].add(patternIdx)
+            }
+
+            val queue = ArrayDeque<Int>(this.next[0].values)
+            while( queue.isNotEmpty() ) {
+                val node = queue.poll()
+                for((c, child) in this.next[node]) {
+                    var f = this.fail[node]
+                    while( f != 0 && c !in this.next[f] )
+                        f = this.fail[f]
+                    this.fail[child] = this.next[f][c]?.takeIf { it != child } ?: 0
+                    this.out[child].addAll(this.out[this.fail[child]])
+                    queue.add(child)
+                }
+            }
+        }
+
+        private fun newNode(): Int {
+            this.next.add(HashMap())
+            this.fail.add(0)
+            this.out.add(mutableListOf())
+            return this.next.size - 1
+        }
+
+        fun scan(text: String, found: BitSet) {
+            var node = 0
+            for(c in text) {
+                while( node != 0 && c !in this.next[node] )
+                    node = this.fail[node]
+                node = this.next[node][c] ?: 0
+                this.out[node].forEach { found.set(it) }
+            }
+        }
+    }
+
+    private val regexes = patterns.map { Regex(it) }
+    private val plain = BooleanArray(patterns.size)
+    private val alwaysTried = BitSet(patterns.size)
+    private val literals: Literals
+
+    init {
+        val required = mutableListOf<Pair<String, Int>>()
+        patterns.forEachIndexed { k, pattern ->
+            val (literal, isPlain) = requiredLiteral(pattern)
+            if( literal.isEmpty() )
+                this.alwaysTried.set(k)
+            else {
+                required.add(Pair(literal, k))
+                this.plain[k] = isPlain
+            }
+        }
+        this.literals = Literals(required)
+    }
+
+    /** The index of the first pattern found in [path], or the number of patterns if none is */
+    fun firstMatch(path: String): Int {
+        val candidates = this.alwaysTried.clone() as BitSet
+        this.literals.scan(path, candidates)
+
+        var k = candidates.nextSetBit(0)
+        while( k >= 0 ) {
+            if( this.plain[k] || this.regexes[k].containsMatchIn(path) )
+                return k
+            k = candidates.nextSetBit(k + 1)
+        }
+        return this.regexes.size
+    }
+}
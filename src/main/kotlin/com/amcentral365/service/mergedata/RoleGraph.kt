@@ -0,0 +1,49 @@
+package com.amcentral365.service.mergedata
+
+
+/**
+ * Roles to merge and the roles each of them references, ordered into waves: a role is in the wave after
+ * the last of the roles it references. All roles of a wave can be merged in parallel once the previous
+ * waves are done. References to roles outside of the graph, e.g. already in the database, are ignored.
+ *
+ * Roles on a reference cycle, and the roles referencing them, are in [cyclic] instead.
+ */
+internal class RoleGraph(references: Map<String, Set<String>>) {
+    val waves: List<List<String>>
+    val cyclic: Set<String>
+
+    init {
+        val deps = references.mapValues { (name, refs) -> refs.filter { it in references && it != name }.toSet() }
+        val dependents = mutableMapOf<String, MutableList<String>>()
+        deps.forEach { (name, refs) -> refs.forEach { dependents.getOrPut(it) { mutableListOf() }.add(name) } }
+
+        // Kahn's algorithm, one level at a time
+        val pending = deps.mapValuesTo(mutableMapOf()) { it.value.size }
+        val waves = mutableListOf<List<String>>()
+        var wave = pending.filterValues { it == 0 }.keys.sorted()
+        while( wave.isNotEmpty() ) {
+            waves.add(wave)
+            wave.forEach { pending.remove(it) }
+            wave = wave.flatMap { dependents[it] ?: mutableListOf() }
+                       .filter { name -> pending.computeIfPresent(name) { _, n -> n - 1 } == 0 }
+                       .distinct().sorted()
+        }
+
+        this.waves = waves
+        this.cyclic = pending.keys.toSet()
+    }
+
+    /** A reference cycle through [roleName], e.g. a -> b -> a, or null if the role isn't on one */
+    fun cycleThrough(roleName: String, references: Map<String, Set<String>>): List<String>? {
+        fun find(path: List<String>): List<String>? {
+            for(ref in references[path.last()].orEmpty().filter { it in this.cyclic }.sorted()) {
+                if( ref == roleName )
+                    return path + ref
+                if( ref !in path )
+                    find(path + ref)?.let { return it }
+            }
+            return null
+        }
+        return if( roleName in this.cyclic ) find(listOf(roleName)) else null
+    }
+}
@@ -0,0 +1,157 @@
+package com.amcentral365.service.mergedata
+
+import com.google.gson.JsonArray
+import com.google.gson.JsonElement
+import com.google.gson.JsonNull
+import com.google.gson.JsonObject
+import com.google.gson.JsonPrimitive
+
+import org.yaml.snakeyaml.Yaml
+import org.yaml.snakeyaml.error.Mark
+import org.yaml.snakeyaml.error.MarkedYAMLException
+import org.yaml.snakeyaml.error.YAMLException
+import org.yaml.snakeyaml.events.AliasEvent
+import org.yaml.snakeyaml.events.CollectionStartEvent
+import org.yaml.snakeyaml.events.DocumentEndEvent
+import org.yaml.snakeyaml.events.DocumentStartEvent
+import org.yaml.snakeyaml.events.Event
+import org.yaml.snakeyaml.events.MappingEndEvent
+import org.yaml.snakeyaml.events.MappingStartEvent
+import org.yaml.snakeyaml.events.NodeEvent
+import org.yaml.snakeyaml.events.ScalarEvent
+import org.yaml.snakeyaml.events.SequenceEndEvent
+import org.yaml.snakeyaml.events.SequenceStartEvent
+import org.yaml.snakeyaml.events.StreamEndEvent
+import org.yaml.snakeyaml.events.StreamStartEvent
+
+import java.io.Reader
+import java.math.BigInteger
+
+import com.amcentral365.service.StatusException
+
+
+/**
+ * A streaming reader of YAML merge files, on top of the SnakeYAML event parser. Anchors, aliases, and tags aren't
+ * supported, nor are keys that aren't scalars. Plain scalars are typed by the YAML 1.2 core schema, see [plainScalar].
+ *
+ * The documents are read one at a time. A document that is a sequence is read one item at a time, so
+ * a file of one huge sequence takes no more memory than its biggest item, like a JSON array.
+ */
+internal class YamlReader(private val input: Reader, private val sourceName: String) {
+
+    companion object {
+        private val intRx   = Regex("[-+]?[0-9]+")
+        private val octRx   = Regex("0o[0-7]+")
+        private val hexRx   = Regex("0x[0-9a-fA-F]+")
+        private val floatRx = Regex("[-+]?(\\.[0-9]+|[0-9]+(\\.[0-9]*)?)([eE][-+]?[0-9]+)?")
+
+        /**
+         * The value of a plain (unquoted) scalar by the YAML 1.2 core schema: null, a boolean, an integer, a float,
+         * or else the string itself. Infinities and NaN stay strings, JSON can't hold them.
+         */
+        fun plainScalar(s: String): JsonElement = when {
+            s.isEmpty() || s == "~" || s == "null" || s == "Null" || s == "NULL" -> JsonNull.INSTANCE
+            s == "true"  || s == "True"  || s == "TRUE"  -> JsonPrimitive(true)
+            s == "false" || s == "False" || s == "FALSE" -> JsonPrimitive(false)
+            intRx.matches(s)   -> integer(s.removePrefix("+"), 10)
+            octRx.matches(s)   -> integer(s.substring(2), 8)
+            hexRx.matches(s)   -> integer(s.substring(2), 16)
+            floatRx.matches(s) -> JsonPrimitive(s.toDouble())
+            else -> JsonPrimitive(s)
+        }
+
+        private fun integer(digits: String, radix: Int): JsonPrimitive {
+            val n = BigInteger(digits, radix)
+            return if( n.bitLength() < 64 ) JsonPrimitive(n.toLong()) else JsonPrimitive(n)
+        }
+    }
+
+    private val events: Iterator<Event> by lazy { Yaml().parse(this.input).iterator() }    // lazy: parses as iterated
+
+    /** Each document, or, if it is a sequence, each of its items */
+    fun records(): Sequence<JsonElement> = sequence {
+        while( true ) {
+            when( val event = this@YamlReader.next() ) {
+                is StreamStartEvent, is DocumentEndEvent -> {}
+                is StreamEndEvent -> return@sequence
+                is DocumentStartEvent -> {
+                    val root = this@YamlReader.next()
+                    if( root is SequenceStartEvent ) {
+                        this@YamlReader.checkNode(root)
+                        while( true ) {
+                            val item = this@YamlReader.next()
+                            if( item is SequenceEndEvent )
+                                break
+                            yield(this@YamlReader.node(item))
+                        }
+                    } else {
+                        val doc = this@YamlReader.node(root)
+                        if( !doc.isJsonNull )     // an empty document
+                            yield(doc)
+                    }
+                }
+                else -> this@YamlReader.error(event.startMark, "unexpected ${event.javaClass.simpleName}")
+            }
+        }
+    }
+
+    private fun next(): Event =
+        try {
+            this.events.next()
+        } catch(x: MarkedYAMLException) {
+            error(x.problemMark ?: x.contextMark, listOfNotNull(x.context, x.problem).joinToString(", "))
+        } catch(x: YAMLException) {
+            throw StatusException(x, 400, "$sourceName: ${x.message}")
+        }
+
+    private fun error(mark: Mark?, msg: String): Nothing =
+        throw StatusException(400, "$sourceName line ${mark?.let { it.line + 1 } ?: "<eof>"}: $msg")
+
+    private fun checkNode(event: NodeEvent) {
+        if( event is AliasEvent || event.anchor != null )
+            error(event.startMark, "anchors and aliases aren't supported")
+        val tag = when( event ) {
+            is ScalarEvent          -> event.tag
+            is CollectionStartEvent -> event.tag
+            else -> null
+        }
+        if( tag != null )
+            error(event.startMark, "tags aren't supported")
+    }
+
+    /** The node starting with [event], read through its end */
+    private fun node(event: Event): JsonElement {
+        if( event !is NodeEvent )
+            error(event.startMark, "unexpected ${event.javaClass.simpleName}")
+        this.checkNode(event)
+
+        return when( event ) {
+            is ScalarEvent -> if( event.isPlain ) plainScalar(event.value) else JsonPrimitive(event.value)
+
+            is SequenceStartEvent -> JsonArray().also { arr ->
+                while( true ) {
+                    val item = this.next()
+                    if( item is SequenceEndEvent )
+                        break
+                    arr.add(this.node(item))
+                }
+            }
+
+            is MappingStartEvent -> JsonObject().also { obj ->
+                while( true ) {
+                    val key = this.next()
+                    if( key is MappingEndEvent )
+                        break
+                    if( key !is ScalarEvent )
+                        error(key.startMark, "only scalars are supported as keys")
+                    this.checkNode(key)
+                    if( obj.has(key.value) )
+                        error(key.startMark, "duplicate key ${key.value}")
+                    obj.add(key.value, this.node(this.next()))
+                }
+            }
+
+            else -> error(event.startMark, "unexpected ${event.javaClass.simpleName}")
+        }
+    }
+}
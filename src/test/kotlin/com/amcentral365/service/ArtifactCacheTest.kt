@@ -0,0 +1,141 @@
+package com.amcentral365.service
+
+import com.sun.net.httpserver.HttpServer
+import java.io.File
+import java.net.InetSocketAddress
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.atomic.AtomicInteger
+import kotlin.concurrent.thread
+
+import org.junit.jupiter.api.AfterEach
+import org.junit.jupiter.api.BeforeEach
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertNotEquals
+import org.junit.jupiter.api.io.TempDir
+
+
+internal class ArtifactCacheTest {
+
+    @TempDir lateinit var tempDir: File
+
+    /** Serves files with an ETag, answers 304 to a matching If-None-Match */
+    private class FakeServer {
+        val files = ConcurrentHashMap<String, String>()
+        val downloads = AtomicInteger()
+        val notModified = AtomicInteger()
+        @Volatile var delayMsec = 0L
+
+        private val server = HttpServer.create(InetSocketAddress("127.0.0.1", 0), 0).also { srv ->
+            srv.createContext("/") { exchange ->
+                Thread.sleep(this.delayMsec)
+                val body = this.files[exchange.requestURI.path]
+                val etag = "\"${body?.hashCode()}\""
+                when {
+                    body == null -> exchange.sendResponseHeaders(404, -1)
+                    exchange.requestHeaders.getFirst("If-None-Match") == etag -> {
+                        this.notModified.incrementAndGet()
+                        exchange.sendResponseHeaders(304, -1)
+                    }
+                    else -> {
+                        this.downloads.incrementAndGet()
+                        val bytes = body.toByteArray()
+                        exchange.responseHeaders.add("ETag", etag)
+                        exchange.sendResponseHeaders(200, bytes.size.toLong())
+                        exchange.responseBody.use { it.write(bytes) }
+                    }
+                }
+                exchange.close()
+            }
+            srv.executor = java.util.concurrent.Executors.newCachedThreadPool()
+            srv.start()
+        }
+
+        fun url(path: String) = "http://127.0.0.1:${this.server.address.port}$path"
+        fun stop() = this.server.stop(0)
+    }
+
+    private lateinit var server: FakeServer
+
+    @BeforeEach fun startServer() { server = FakeServer() }
+    @AfterEach  fun stopServer()  { server.stop() }
+
+    private fun cache(maxBytes: Long = 1L shl 20, revalidateMsec: Long = 0) =
+        ArtifactCache(tempDir, maxBytes, revalidateMsec, connectTimeoutMsec = 5000, readTimeoutMsec = 5000, maxRedirects = 2)
+
+    private fun ArtifactCache.read(url: String, version: String? = null, immutable: Boolean = false) =
+        this.open(url, version, immutable).use { String(it.readBytes()) }
+
+    @Test fun `unchanged file is revalidated, not downloaded`() {
+        server.files["/a.sh"] = "echo a"
+        val cache = cache()
+
+        assertEquals("echo a", cache.read(server.url("/a.sh")))
+        assertEquals("echo a", cache.read(server.url("/a.sh")))
+        assertEquals(1, server.downloads.get())
+        assertEquals(1, server.notModified.get())
+
+        server.files["/a.sh"] = "echo b"
+        assertEquals("echo b", cache.read(server.url("/a.sh")))
+        assertEquals(2, server.downloads.get())
+    }
+
+    @Test fun `fresh and immutable entries skip the network`() {
+        server.files["/a.sh"] = "echo a"
+        val fresh = cache(revalidateMsec = 60_000)
+        fresh.read(server.url("/a.sh"))
+        fresh.read(server.url("/a.sh"))
+
+        val pinned = cache()   // same directory, loads the entries back
+        pinned.read(server.url("/a.sh"), "v1", immutable = true)
+        pinned.read(server.url("/a.sh"), "v1", immutable = true)
+
+        assertEquals(2, server.downloads.get())
+        assertEquals(0, server.notModified.get())
+        assertEquals(1L, pinned.stats()["hitCount"])
+    }
+
+    @Test fun `content hash is served from the cache`() {
+        server.files["/a.sh"] = "echo a"
+        val cache = cache(revalidateMsec = 60_000)
+
+        val hash = cache.contentHash(server.url("/a.sh"))
+        assertEquals(hash, cache.contentHash(server.url("/a.sh")))
+        assertEquals("echo a", cache.read(server.url("/a.sh")))
+        assertEquals(1, server.downloads.get())
+
+        server.files["/a.sh"] = "echo b"
+        assertNotEquals(hash, cache(revalidateMsec = 0).contentHash(server.url("/a.sh")))
+        assertEquals(2, server.downloads.get())
+    }
+
+    @Test fun `concurrent requests share one download`() {
+        server.files["/big.tar"] = "x".repeat(10_000)
+        server.delayMsec = 200
+        val cache = cache()
+
+        val results = ConcurrentHashMap<Int, String>()
+        (1..5).map { k -> thread { results[k] = cache.read(server.url("/big.tar")) } }.forEach { it.join(10_000) }
+
+        assertEquals(5, results.size)
+        assertEquals(setOf("x".repeat(10_000)), results.values.toSet())
+        assertEquals(1, server.downloads.get())
+    }
+
+    @Test fun `least recently used entries are evicted`() {
+        (1..3).forEach { server.files["/f$it"] = "$it".repeat(100) }
+        val cache = cache(maxBytes = 250, revalidateMsec = 60_000)
+
+        cache.read(server.url("/f1"))
+        cache.read(server.url("/f2"))
+        cache.read(server.url("/f1"))    // f2 is now the least recently used
+        cache.read(server.url("/f3"))
+
+        assertEquals(2, cache.stats()["entries"])
+        assertEquals(1L, cache.stats()["evictedCount"])
+        cache.read(server.url("/f1"))
+        assertEquals(3, server.downloads.get())
+        cache.read(server.url("/f2"))
+        assertEquals(4, server.downloads.get())
+    }
+}
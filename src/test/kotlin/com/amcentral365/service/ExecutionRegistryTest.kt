@@ -0,0 +1,83 @@
+package com.amcentral365.service
+
+import java.io.File
+import java.io.OutputStream
+import java.util.concurrent.CountDownLatch
+import java.util.concurrent.TimeUnit
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertFalse
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+import org.junit.jupiter.api.io.TempDir
+
+
+internal class ExecutionRegistryTest {
+
+    @TempDir lateinit var tempDir: File
+
+    private fun registry(threads: Int = 2, queueSize: Int = 10, retentionSec: Long = 3600) =
+        ExecutionRegistry(threads, queueSize, tempDir, segmentBytes = 1024, maxSegments = 4, retentionSec = retentionSec)
+
+    private fun ExecutionRegistry.Execution.awaitFinish() {
+        val deadline = System.currentTimeMillis() + 5000
+        while( !this.isFinished && System.currentTimeMillis() < deadline )
+            Thread.sleep(10)
+        assertTrue(this.isFinished)
+    }
+
+    @Test fun `runs in the background and keeps the output`() {
+        val reg = registry()
+        val release = CountDownLatch(1)
+        val execution = reg.submit("script1", "host1", "ssh") { _, out ->
+            out.write("hello\n".toByteArray())
+            release.await(5, TimeUnit.SECONDS)
+            out.write("bye\n".toByteArray())
+            StatusMessage.OK
+        }
+
+        assertEquals("hello\n", String(execution.output.read(0, 100, waitMsec = 5000).data))
+        assertEquals(ExecutionRegistry.Status.Running, execution.status)
+
+        release.countDown()
+        execution.awaitFinish()
+        assertEquals(ExecutionRegistry.Status.Succeeded, execution.status)
+        assertEquals("hello\nbye\n", String(execution.output.read(0, 100).data))
+        assertEquals(3, execution.getLog().size)
+        assertEquals(execution, reg.get(execution.executeId))
+    }
+
+    @Test fun `failures are recorded`() {
+        val reg = registry()
+        val execution = reg.submit("script1", "host1", "ssh") { _, _ -> throw StatusException(404, "no such file") }
+        execution.awaitFinish()
+
+        assertEquals(ExecutionRegistry.Status.Failed, execution.status)
+        assertEquals(404, execution.result!!.code)
+        assertTrue(execution.output.read(0, 100).complete)
+    }
+
+    @Test fun `full queue is rejected`() {
+        val reg = registry(threads = 1, queueSize = 1)
+        val release = CountDownLatch(1)
+        val block: (String, OutputStream) -> StatusMessage = { _, _ -> release.await(5, TimeUnit.SECONDS); StatusMessage.OK }
+
+        reg.submit("s", "t", "ssh", block)
+        reg.submit("s", "t", "ssh", block)
+        assertEquals(503, assertThrows<StatusException> { reg.submit("s", "t", "ssh", block) }.code)
+        assertEquals(2, reg.list().size)
+        release.countDown()
+    }
+
+    @Test fun `finished executions are purged`() {
+        val reg = registry(retentionSec = 0)
+        val execution = reg.submit("s", "t", "ssh") { _, out -> out.write(1); StatusMessage.OK }
+        execution.awaitFinish()
+        Thread.sleep(5)
+
+        assertEquals(1, reg.purgeFinished())
+        assertFalse(tempDir.resolve(execution.executeId.toString()).exists())
+        assertEquals(404, assertThrows<StatusException> { reg.get(execution.executeId) }.code)
+    }
+}
@@ -0,0 +1,89 @@
+package com.amcentral365.service
+
+import java.util.UUID
+import java.util.concurrent.CountDownLatch
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
+import kotlin.concurrent.thread
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+
+import com.amcentral365.service.dao.Asset
+
+
+internal class FanOutExecutorTest {
+
+    private fun targets(count: Int) = (1..count).map { FanOutExecutor.Target("h$it", Asset(UUID.randomUUID(), "h$it")) }
+
+    private class Concurrency {
+        private val running = AtomicInteger()
+        val max = AtomicInteger()
+
+        fun <T> track(body: () -> T): T {
+            max.accumulateAndGet(running.incrementAndGet()) { a, b -> maxOf(a, b) }
+            try {
+                return body()
+            } finally {
+                running.decrementAndGet()
+            }
+        }
+    }
+
+    @Test fun `runs every target and reports as they complete`() {
+        val fanOut = FanOutExecutor(maxParallel = 10, maxParallelPerRole = 10)
+        val concurrency = Concurrency()
+        val results = mutableListOf<FanOutExecutor.TargetResult>()
+
+        val summary = fanOut.run("host", targets(20) + FanOutExecutor.Target("nope", null), 4, false,
+            runOne = { _, target, _ ->
+                concurrency.track {
+                    Thread.sleep(10)
+                    if( target.name == "h5" ) StatusMessage(500, "rc 1") else StatusMessage.OK
+                }
+            },
+            onResult = { results.add(it) })
+
+        assertEquals(21, results.size)
+        assertEquals(21, summary.targetCount)
+        assertEquals(19, summary.succeededCount)
+        assertEquals(404, results.first { it.targetKey == "nope" }.code)
+        assertEquals(500, results.first { it.targetKey == "h5" }.code)
+        assertTrue(concurrency.max.get() <= 4)
+        assertTrue(summary.p95Msec >= summary.p50Msec && summary.maxMsec >= summary.p95Msec)
+    }
+
+    @Test fun `per-role cap is shared by requests`() {
+        val fanOut = FanOutExecutor(maxParallel = 100, maxParallelPerRole = 3)
+        val concurrency = Concurrency()
+        val runOne = { _: String, _: Asset, _: java.io.OutputStream -> concurrency.track { Thread.sleep(20); StatusMessage.OK } }
+
+        val threads = (1..3).map {
+            thread { fanOut.run("db", targets(10), 10, false, runOne, onResult = {}) }
+        }
+        threads.forEach { it.join(10_000) }
+
+        assertEquals(3, concurrency.max.get())
+        assertEquals(30L, fanOut.stats()["targetCount"])
+    }
+
+    @Test fun `global cap`() {
+        val fanOut = FanOutExecutor(maxParallel = 2, maxParallelPerRole = 10)
+        val release = CountDownLatch(1)
+        val started = AtomicInteger()
+
+        val t = thread {
+            fanOut.run("host", targets(5), 5, false,
+                runOne = { _, _, _ -> started.incrementAndGet(); release.await(5, TimeUnit.SECONDS); StatusMessage.OK },
+                onResult = {})
+        }
+        Thread.sleep(200)
+        assertEquals(2, started.get())
+        assertEquals(2, fanOut.stats()["runningTargets"])
+
+        release.countDown()
+        t.join(5000)
+        assertEquals(5, started.get())
+    }
+}
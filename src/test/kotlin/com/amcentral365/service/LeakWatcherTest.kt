@@ -0,0 +1,79 @@
+package com.amcentral365.service
+
+import java.util.concurrent.Executors
+import java.util.concurrent.TimeUnit
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+
+
+internal class LeakWatcherTest {
+
+    @Test fun `full mode tracks every allocation with its stack`() {
+        val w = LeakWatcher(LeakWatcher.Mode.FULL)
+        val a = Any(); val b = Any()
+        w.allocated(a); w.allocated(b)
+        assertEquals(2, w.allocateCount)
+        assertEquals(2L, w.stats()["stackCount"])
+
+        assertThrows<StatusException> { w.allocated(a) }
+        w.released(a)
+        assertThrows<StatusException> { w.released(a) }
+        assertEquals(1, w.allocateCount)
+    }
+
+    @Test fun `sampled mode captures some stacks`() {
+        val w = LeakWatcher(LeakWatcher.Mode.SAMPLED, sampleEvery = 10)
+        val resources = List(10_000) { Any() }
+        resources.forEach { w.allocated(it) }
+
+        assertEquals(10_000, w.allocateCount)
+        val stacks = w.stats()["stackCount"] as Long
+        assertTrue(stacks in 500..1500, "$stacks stacks")
+        resources.forEach { w.released(it) }
+        assertEquals(0, w.allocateCount)
+    }
+
+    @Test fun `off mode tracks nothing`() {
+        val w = LeakWatcher(LeakWatcher.Mode.OFF)
+        val a = Any()
+        w.allocated(a); w.allocated(a)
+        w.released(a)
+        assertEquals(0, w.allocateCount)
+    }
+
+    @Test fun `concurrent allocations and releases`() {
+        val w = LeakWatcher(LeakWatcher.Mode.SAMPLED, sampleEvery = 100)
+        val pool = Executors.newFixedThreadPool(8)
+        repeat(8) {
+            pool.submit {
+                repeat(20_000) {
+                    val r = Any()
+                    w.allocated(r)
+                    w.released(r)
+                }
+            }
+        }
+        pool.shutdown()
+        assertTrue(pool.awaitTermination(30, TimeUnit.SECONDS))
+        assertEquals(0, w.allocateCount)
+    }
+
+    @Test fun `reaper reports long held resources by age`() {
+        val w = LeakWatcher(LeakWatcher.Mode.SAMPLED, sampleEvery = 1000)
+        val held = Any()
+        w.allocated(held)
+        Thread.sleep(60)
+        w.allocated(Any())    // young
+
+        assertEquals(1, w.reap(thresholdMsec = 50))
+        assertEquals(1, w.reap(thresholdMsec = 50))
+        assertEquals(1L, w.stats()["reportedCount"])    // the details are reported once
+
+        val histogram = w.ageHistogram(thresholdMsec = 25)
+        assertEquals(0, histogram["<2x"])     // held for 60+ msec
+        assertEquals(1, histogram.values.sum())
+    }
+}
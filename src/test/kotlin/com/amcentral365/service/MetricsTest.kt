@@ -0,0 +1,103 @@
+package com.amcentral365.service
+
+import java.util.concurrent.Executors
+import java.util.concurrent.TimeUnit
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertFalse
+import org.junit.jupiter.api.Assertions.assertSame
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+
+
+internal class MetricsTest {
+
+    private fun lines(m: Metrics) = m.render().lines().filter { it.isNotBlank() && !it.startsWith("#") }
+
+    @Test fun `counters by label`() {
+        val m = Metrics()
+        val c = m.counter("x_requests_total", "requests", "method")
+        c.inc("GET"); c.inc("GET"); c.add(5, "POST")
+
+        assertEquals(2, c.get("GET"))
+        assertTrue(m.render().contains("# TYPE x_requests_total counter"))
+        assertEquals(setOf("""x_requests_total{method="GET"} 2""", """x_requests_total{method="POST"} 5"""), lines(m).toSet())
+        assertThrows<IllegalArgumentException> { c.inc() }
+    }
+
+    @Test fun `histogram buckets are cumulative`() {
+        val m = Metrics()
+        val h = m.histogram("x_seconds", "duration", doubleArrayOf(0.25, 1.0))
+        listOf(0.125, 0.25, 0.5, 3.0).forEach { h.observe(it) }
+
+        assertEquals(listOf(
+                """x_seconds_bucket{le="0.25"} 2"""
+              , """x_seconds_bucket{le="1"} 3"""
+              , """x_seconds_bucket{le="+Inf"} 4"""
+              , """x_seconds_sum 3.875"""
+              , """x_seconds_count 4"""
+            ), lines(m))
+        assertEquals(mapOf("0.25" to 2L, "1" to 3L, "+Inf" to 4L), h.buckets())
+    }
+
+    @Test fun `stats maps become gauges`() {
+        val m = Metrics()
+        m.stats("x_cache", "cache") { linkedMapOf("hitCount" to 7, "ratio" to 0.5, "enabled" to true, "name" to "lru") }
+        m.stats("x_broken", "not initialized") { throw UninitializedPropertyAccessException() }
+        m.gauge("x_size_bytes", "size") { 1024 }
+
+        assertEquals(listOf("x_cache_hit_count 7", "x_cache_ratio 0.5", "x_cache_enabled 1", "x_size_bytes 1024"), lines(m))
+    }
+
+    @Test fun `nested stats maps are flattened`() {
+        val m = Metrics()
+        m.stats("x_cache", "cache") {
+            linkedMapOf(
+                "assets"     to linkedMapOf("hitRate" to 0.5, "size" to 3, "name" to "lru"),
+                "roleValues" to linkedMapOf("hitRate" to 0.25),
+                "waitSecondsHistogram" to linkedMapOf("0.001" to 2L, "+Inf" to 5L)
+            )
+        }
+
+        assertEquals(listOf(
+                "x_cache_assets_hit_rate 0.5"
+              , "x_cache_assets_size 3"
+              , "x_cache_role_values_hit_rate 0.25"
+              , """x_cache_wait_seconds_histogram{key="0.001"} 2"""
+              , """x_cache_wait_seconds_histogram{key="+Inf"} 5"""
+            ), lines(m))
+    }
+
+    @Test fun `registering again returns the same metric`() {
+        val m = Metrics()
+        assertSame(m.counter("x_total", "x"), m.counter("x_total", "x"))
+        assertThrows<IllegalArgumentException> { m.counter("x-total", "x") }
+    }
+
+    @Test fun `label values are escaped`() {
+        val m = Metrics()
+        m.counter("x_total", "x", "path").inc("a\"b\\c\nd")
+        assertEquals(listOf("""x_total{path="a\"b\\c\nd"} 1"""), lines(m))
+    }
+
+    @Test fun `concurrent recording loses nothing`() {
+        val m = Metrics()
+        val h = m.histogram("x_seconds", "x", Metrics.DEFAULT_SECONDS_BUCKETS, "route")
+        val pool = Executors.newFixedThreadPool(8)
+        repeat(8) { pool.submit { repeat(100_000) { h.observe(0.002, "r") } } }
+        pool.shutdown()
+        assertTrue(pool.awaitTermination(30, TimeUnit.SECONDS))
+        assertEquals(800_000, h.count("r"))
+    }
+
+    @Test fun `routes are labeled without ids`() {
+        val ws = WebServer()
+        assertEquals("/v0.1/catalog/assets/:param/roles/:param", ws.routeLabel("/v0.1/catalog/assets/3f2a-77/roles/web"))
+        assertEquals("/v0.1/executes/fanout", ws.routeLabel("/v0.1/executes/fanout"))
+        assertEquals("/v0.1/executes/:param/log", ws.routeLabel("/v0.1/executes/42/log"))
+        assertEquals("/v0.1/catalog/roles", ws.routeLabel("/v0.1/catalog/roles/"))
+        assertEquals("static", ws.routeLabel("/index.html"))
+        assertFalse(ws.routeLabel("/metrics").contains(":param"))
+    }
+}
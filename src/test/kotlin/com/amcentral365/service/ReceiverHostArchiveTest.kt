@@ -0,0 +1,122 @@
+package com.amcentral365.service
+
+import java.io.File
+import java.io.InputStream
+import java.io.OutputStream
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.Assumptions.assumeTrue
+import org.junit.jupiter.api.assertThrows
+import org.junit.jupiter.api.io.TempDir
+
+import com.amcentral365.service.builtins.roles.ExecutionTarget
+import com.amcentral365.service.builtins.roles.Script
+import com.amcentral365.service.builtins.roles.ScriptMain
+
+
+internal class ReceiverHostArchiveTest {
+
+    @TempDir lateinit var tempDir: File
+
+    /**
+     * Stands in for an SSH host: each remote operation costs a round trip of [latencyMsec],
+     * and the files land in [dir]. Archives are unpacked with the local tar.
+     */
+    private class SlowHost(val dir: File, val latencyMsec: Long, val hasTar: Boolean): ExecutionTarget("threadX", null) {
+        var roundTrips = 0
+
+        private fun roundTrip() { roundTrips++; Thread.sleep(latencyMsec) }
+
+        override fun exists(pathStr: String): Boolean { roundTrip(); return dir.resolve(pathStr).exists() }
+        override fun createDirectories(dirPath: String) { roundTrip(); dir.resolve(dirPath).mkdirs() }
+
+        override fun copyFile(contentStream: InputStream, fileName: String): Long {
+            roundTrip()
+            return dir.resolve(fileName).outputStream().use { contentStream.copyTo(it) }
+        }
+
+        override fun copyExecutableFile(contentStream: InputStream, fileName: String): Long {
+            val size = copyFile(contentStream, fileName)
+            roundTrip()   // stat and chmod
+            dir.resolve(fileName).setExecutable(true, true)
+            return size
+        }
+
+        override fun canUnpackArchives() = hasTar
+
+        override fun unpackArchive(archive: InputStream) {
+            roundTrip()
+            val process = ProcessBuilder("tar", "-x", "-p", "-f", "-", "-C", dir.path).redirectErrorStream(true).start()
+            process.outputStream.use { archive.copyTo(it) }
+            process.inputStream.readBytes()
+            assertEquals(0, process.waitFor())
+        }
+
+        // not needed
+        override fun realExec(commands: List<String>, inputStream: InputStream?, outputStream: OutputStream): StatusMessage = StatusMessage.OK
+        override fun connect(): Boolean = false
+        override fun prepare(script: Script): Boolean = false
+        override fun disconnect() {}
+        override fun cleanup(script: Script) {}
+        override fun execute(script: Script, outputStream: OutputStream, inputStream: InputStream?): StatusMessage = StatusMessage.OK
+    }
+
+    /** A script directory: [dirCount] directories of [filesPerDir] files, and an executable main */
+    private class ScriptTree(val dirCount: Int, val filesPerDir: Int): TransferManager.Sender() {
+        override fun getIterator(): Iterator<TransferManager.Item> = sequence {
+            yield(TransferManager.Item("main.sh", "echo main\n".byteInputStream(), permissions = 0b111_101_101))
+            for(d in 1..dirCount) {
+                yield(TransferManager.Item("dir$d", isDirectory = true))
+                for(f in 1..filesPerDir)
+                    yield(TransferManager.Item("dir$d/file$f.txt", "content $d/$f".byteInputStream(), permissions = 0b110_100_100))
+            }
+        }.iterator()
+    }
+
+    private fun tarInstalled() =
+        try { ProcessBuilder("tar", "--version").start().waitFor() == 0 } catch(x: java.io.IOException) { false }
+
+    private fun transfer(receiver: TransferManager.Receiver): Long {
+        val beg = System.currentTimeMillis()
+        assertTrue(TransferManager("threadX").transfer(ScriptTree(5, 20), receiver))
+        return System.currentTimeMillis() - beg
+    }
+
+    private fun script() = Script(targetRoleName = "roleX", location = null, scriptMain = ScriptMain("main.sh"), scriptArgs = null)
+
+    private fun assertTree(dir: File) {
+        assertEquals("echo main\n", dir.resolve("main.sh").readText())
+        assertTrue(dir.resolve("main.sh").canExecute())
+        assertEquals("content 5/20", dir.resolve("dir5/file20.txt").readText())
+        assertEquals(100, dir.walkTopDown().count { it.name.endsWith(".txt") })
+    }
+
+    @Test fun `one round trip instead of one per item`() {
+        assumeTrue(tarInstalled(), "tar is not installed")
+
+        val perItemHost = SlowHost(tempDir.resolve("per-item").also { it.mkdirs() }, latencyMsec = 2, hasTar = false)
+        val perItemMsec = transfer(ReceiverHostArchive(script(), perItemHost))
+
+        val archiveHost = SlowHost(tempDir.resolve("archive").also { it.mkdirs() }, latencyMsec = 2, hasTar = true)
+        val archiveMsec = transfer(ReceiverHostArchive(script(), archiveHost))
+
+        println("106 items at 2 msec per round trip: per item $perItemMsec msec, ${perItemHost.roundTrips} round trips; " +
+                "archive $archiveMsec msec, ${archiveHost.roundTrips} round trip")
+
+        assertTree(perItemHost.dir)
+        assertTree(archiveHost.dir)
+        assertEquals(107, perItemHost.roundTrips)   // 5 dirs, 101 files, and a chmod of main.sh
+        assertEquals(1, archiveHost.roundTrips)
+    }
+
+    @Test fun `failed unpack fails the transfer`() {
+        val receiver = object: TransferManager.Receiver(script()) {
+            override fun apply(item: TransferManager.Item) {}
+            override fun finish() { throw StatusException(500, "tar: Error is not recoverable") }
+        }
+        val e = assertThrows<StatusException> { transfer(receiver) }
+        assertEquals(500, e.code)
+    }
+}
@@ -0,0 +1,107 @@
+package com.amcentral365.service
+
+import io.mockk.Runs
+import io.mockk.every
+import io.mockk.just
+import io.mockk.mockk
+import io.mockk.verify
+
+import com.jcraft.jsch.Session
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertNotSame
+import org.junit.jupiter.api.Assertions.assertSame
+import org.junit.jupiter.api.assertThrows
+
+
+internal class SSHSessionPoolTest {
+
+    private val key1 = SSHSessionPool.Key("host1", 22, "amc")
+    private val key2 = SSHSessionPool.Key("host2", 22, "amc")
+
+    private class TestPool(maxSessionsPerHost: Int = 2, idleTimeoutMsec: Long = 0, keepAliveMsec: Int = 0):
+            SSHSessionPool(maxSessionsPerHost, idleTimeoutMsec, keepAliveMsec, acquireWaitMsec = 50, connectTimeoutMsec = 1000) {
+        val opened = mutableListOf<Session>()
+
+        override fun openSession(key: Key): Session {
+            val session = mockk<Session>()
+            var connected = true
+            every { session.isConnected } answers { connected }
+            every { session.host } returns key.host
+            every { session.disconnect() } answers { connected = false }
+            every { session.sendKeepAliveMsg() } just Runs
+            opened.add(session)
+            return session
+        }
+    }
+
+    @Test fun `sessions are reused per key`() {
+        val pool = TestPool()
+
+        val s1 = pool.acquire(key1)
+        pool.release(s1)
+        assertSame(s1, pool.acquire(key1))
+        assertNotSame(s1, pool.acquire(key2))
+
+        val stats = pool.stats()
+        assertEquals(3L, stats["acquireCount"])
+        assertEquals(1L, stats["reuseCount"])
+        assertEquals(2L, stats["handshakeCount"])
+        assertEquals(2, stats["leasedSessions"])
+    }
+
+    @Test fun `max sessions per host`() {
+        val pool = TestPool(maxSessionsPerHost = 2)
+        val s1 = pool.acquire(key1)
+        pool.acquire(key1)
+
+        val x = assertThrows<StatusException> { pool.acquire(key1) }
+        assertEquals(503, x.code)
+        pool.acquire(key2)   // other hosts aren't affected
+
+        pool.release(s1)
+        assertSame(s1, pool.acquire(key1))
+    }
+
+    @Test fun `broken sessions are replaced`() {
+        val pool = TestPool()
+        val s1 = pool.acquire(key1)
+        pool.release(s1, reusable = false)
+        verify { s1.disconnect() }
+
+        val s2 = pool.acquire(key1)
+        assertNotSame(s1, s2)
+        pool.release(s2)
+
+        every { s2.isConnected } returns false   // dropped while idle
+        val s3 = pool.acquire(key1)
+        assertNotSame(s2, s3)
+        assertEquals(3, pool.opened.size)
+        assertEquals(2L, pool.stats()["brokenCount"])
+    }
+
+    @Test fun `keepalive probe before reusing an idle session`() {
+        val pool = TestPool(keepAliveMsec = 1)
+        val s1 = pool.acquire(key1)
+        pool.release(s1)
+        Thread.sleep(5)
+
+        every { s1.sendKeepAliveMsg() } throws Exception("broken pipe")
+        assertNotSame(s1, pool.acquire(key1))
+    }
+
+    @Test fun `idle eviction`() {
+        val pool = TestPool(idleTimeoutMsec = 10)
+        val s1 = pool.acquire(key1)
+        val s2 = pool.acquire(key1)
+        pool.release(s1)
+        Thread.sleep(20)
+        pool.release(s2)
+
+        assertEquals(1, pool.evictIdle())
+        verify { s1.disconnect() }
+        assertSame(s2, pool.acquire(key1))
+        pool.close()
+    }
+}
@@ -0,0 +1,121 @@
+package com.amcentral365.service
+
+import java.io.ByteArrayInputStream
+import java.io.ByteArrayOutputStream
+import java.io.PipedInputStream
+import java.io.PipedOutputStream
+import java.util.concurrent.CountDownLatch
+import java.util.concurrent.TimeUnit
+import kotlin.concurrent.thread
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertNull
+import org.junit.jupiter.api.Assertions.assertTrue
+
+
+internal class ScriptOutputPumpTest {
+
+    @Test fun `copies everything`() {
+        val data = ByteArray(100_000) { (it % 251).toByte() }
+        val output = ByteArrayOutputStream()
+        val pump = ScriptOutputPump("t", 10, 10, bufferSize = 4096) {}
+
+        assertEquals(data.size.toLong(), pump.pump(ByteArrayInputStream(data), output))
+        pump.cancelTimers()
+        assertNull(pump.abortReason)
+        assertTrue(data.contentEquals(output.toByteArray()))
+    }
+
+    @Test fun `output is passed on as it arrives`() {
+        val scriptOut = PipedOutputStream()
+        val input = PipedInputStream(scriptOut)
+        val gotChunk = CountDownLatch(1)
+        val output = object: ByteArrayOutputStream() {
+            override fun flush() = gotChunk.countDown()
+        }
+
+        val pump = ScriptOutputPump("t", 0, 0, bufferSize = 4096) {}
+        val pumpThread = thread { pump.pump(input, output) }
+
+        scriptOut.write("line 1\n".toByteArray())
+        scriptOut.flush()
+        assertTrue(gotChunk.await(500, TimeUnit.MILLISECONDS))   // while the script still runs
+        assertEquals("line 1\n", output.toString())
+
+        scriptOut.close()
+        pumpThread.join(1000)
+        pump.cancelTimers()
+    }
+
+    @Test fun `input is fed while the output is read`() {
+        // a script echoing its input: neither pipe holds all of the data, so the input can't be copied up front
+        val stdin = PipedOutputStream()
+        val scriptIn = PipedInputStream(stdin)
+        val scriptOut = PipedOutputStream()
+        val input = PipedInputStream(scriptOut)
+        thread(isDaemon = true) { scriptOut.use { scriptIn.copyTo(it) } }
+
+        val data = ByteArray(100_000) { (it % 251).toByte() }
+        val output = ByteArrayOutputStream()
+        val pump = ScriptOutputPump("t", 10, 10, bufferSize = 4096) { scriptOut.close() }
+        pump.feedInput(ByteArrayInputStream(data), stdin)
+
+        assertEquals(data.size.toLong(), pump.pump(input, output))
+        pump.cancelTimers()
+        assertNull(pump.abortReason)
+        assertTrue(data.contentEquals(output.toByteArray()))
+    }
+
+    @Test fun `idle timeout aborts`() {
+        val scriptOut = PipedOutputStream()
+        val input = PipedInputStream(scriptOut)
+        val pump = ScriptOutputPump("t", 0, 1, bufferSize = 4096) { scriptOut.close() }
+
+        val beg = System.currentTimeMillis()
+        thread(isDaemon = true) {
+            scriptOut.write("working\n".toByteArray())  // resets the idle timer once
+            Thread.sleep(500)
+            scriptOut.write("still working\n".toByteArray())
+            Thread.sleep(5000)  // the pipe breaks when the writer thread exits
+        }
+        pump.pump(input, ByteArrayOutputStream())
+        pump.cancelTimers()
+
+        assertTrue(pump.abortReason!!.startsWith("idle time"))
+        assertTrue(System.currentTimeMillis() - beg >= 1500)
+    }
+
+    @Test fun `exec timeout aborts`() {
+        val scriptOut = PipedOutputStream()
+        val input = PipedInputStream(scriptOut)
+        val pump = ScriptOutputPump("t", 1, 0, bufferSize = 4096) { scriptOut.close() }
+
+        pump.pump(input, ByteArrayOutputStream())
+        pump.cancelTimers()
+        assertTrue(pump.abortReason!!.startsWith("execution time"))
+    }
+
+    @Test fun `a hung abort doesn't delay other timeouts`() {
+        val release = CountDownLatch(1)
+        val hungOut = PipedOutputStream()
+        val hungInput = PipedInputStream(hungOut)
+        val hung = ScriptOutputPump("hung", 1, 0, bufferSize = 4096) { release.await();  hungOut.close() }
+        val hungThread = thread(isDaemon = true) { hung.pump(hungInput, ByteArrayOutputStream()) }
+
+        val scriptOut = PipedOutputStream()
+        val input = PipedInputStream(scriptOut)
+        val pump = ScriptOutputPump("t", 2, 0, bufferSize = 4096) { scriptOut.close() }
+
+        val beg = System.currentTimeMillis()
+        pump.pump(input, ByteArrayOutputStream())
+        pump.cancelTimers()
+        assertTrue(pump.abortReason!!.startsWith("execution time"))
+        assertTrue(System.currentTimeMillis() - beg < 5000)
+
+        release.countDown()
+        hungThread.join(5000)
+        hung.cancelTimers()
+        assertTrue(hung.abortReason!!.startsWith("execution time"))
+    }
+}
@@ -0,0 +1,112 @@
+package com.amcentral365.service
+
+import java.io.File
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertFalse
+import org.junit.jupiter.api.Assertions.assertNotEquals
+import org.junit.jupiter.api.Assertions.assertNull
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.io.TempDir
+
+import com.amcentral365.service.builtins.roles.Script
+import com.amcentral365.service.builtins.roles.ScriptMain
+
+
+internal class ScriptStagingTest {
+
+    @TempDir lateinit var tempDir: File
+
+    private open class Files(vararg val items: Pair<String, String?>): TransferManager.Sender() {
+        override fun getIterator(): Iterator<TransferManager.Item> = this.items.map { (path, content) ->
+            if( content == null ) TransferManager.Item(path, isDirectory = true)
+            else                  TransferManager.Item(path, content.byteInputStream())
+        }.iterator()
+    }
+
+    /** Files with a version key, counting how many times they were read */
+    private class Versioned(val key: String, vararg items: Pair<String, String?>): Files(*items) {
+        var reads = 0
+        override fun getIterator(): Iterator<TransferManager.Item> { reads++; return super.getIterator() }
+        override fun versionKey() = this.key
+    }
+
+    private var transfers = 0
+
+    /** Writes the items to the directory, like ReceiverHost does through the target */
+    private fun copy(dirName: String, sender: TransferManager.Sender): Boolean {
+        transfers++
+        sender.getIterator().forEach { item ->
+            val file = File(dirName, item.pathStr)
+            if( item.isDirectory ) file.mkdirs() else file.writeBytes(item.inputStream!!.readBytes())
+        }
+        return true
+    }
+
+    private fun script(main: String? = "main.sh") =
+        Script(targetRoleName = "roleX", location = null, scriptMain = main?.let { ScriptMain(it) }, scriptArgs = null)
+
+    private fun staging(maxAgeSec: Long = 3600) =
+        ScriptStaging("threadX", ExecutionTargetLocalHost.stagingOps, maxAgeSec, gcIntervalMsec = 0)
+
+    private val base get() = tempDir.resolve("staged").path
+
+    @Test fun `staged once, reused after`() {
+        val files = { Files("main.sh" to "echo hi", "lib" to null, "lib/util.sh" to "true") }
+
+        val dir1 = staging().stage(script(), files(), base, this::copy)!!
+        val dir2 = staging().stage(script(), files(), base, this::copy)!!
+
+        assertEquals(dir1, dir2)
+        assertEquals(1, transfers)
+        assertEquals("true", File(dir1, "lib/util.sh").readText())
+        assertEquals(listOf(File(dir1).name), File(base).list()!!.toList())   // no temporary directories left
+
+        val dir3 = staging().stage(script(), Files("main.sh" to "echo bye"), base, this::copy)!!
+        assertNotEquals(dir1, dir3)
+        assertEquals(2, transfers)
+    }
+
+    @Test fun `a staged version is found by its key, without reading the files`() {
+        val v1 = Versioned("v1", "main.sh" to "echo hi")
+        val dir1 = staging().stage(script(), v1, base, this::copy)!!
+        assertEquals(1, v1.reads)
+        assertEquals("echo hi", File(dir1, "main.sh").readText())
+
+        val again = Versioned("v1", "main.sh" to "echo hi")
+        assertEquals(dir1, staging().stage(script(), again, base, this::copy))
+        assertEquals(0, again.reads)
+
+        val v2 = Versioned("v2", "main.sh" to "echo bye")
+        assertNotEquals(dir1, staging().stage(script(), v2, base, this::copy))
+        assertEquals(2, transfers)
+    }
+
+    @Test fun `inline content gets a fixed name`() {
+        val first = script(main = null)
+        val dir = staging().stage(first, Files("" to "echo inline"), base, this::copy)!!
+        assertEquals(ScriptStaging.INLINE_MAIN_NAME, first.scriptMain?.main)
+        assertEquals("echo inline", File(dir, ScriptStaging.INLINE_MAIN_NAME).readText())
+
+        val second = script(main = null)
+        staging().stage(second, Files("" to "echo inline"), base, this::copy)
+        assertEquals(ScriptStaging.INLINE_MAIN_NAME, second.scriptMain?.main)
+        assertEquals(1, transfers)
+    }
+
+    @Test fun `failed transfer leaves nothing behind`() {
+        assertNull(staging().stage(script(), Files("main.sh" to "echo hi"), base) { _, _ -> false })
+        assertEquals(0, File(base).list()!!.size)
+    }
+
+    @Test fun `unused versions are removed`() {
+        val old = File(base, "0ld").also { it.mkdirs() }
+        old.setLastModified(System.currentTimeMillis() - 7200_000)
+
+        val dir = staging(maxAgeSec = 3600).stage(script(), Files("main.sh" to "echo hi"), base, this::copy)!!
+
+        assertFalse(old.exists())
+        assertTrue(File(dir).isDirectory)
+    }
+}
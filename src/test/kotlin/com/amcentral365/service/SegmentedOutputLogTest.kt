@@ -0,0 +1,70 @@
+package com.amcentral365.service
+
+import java.io.File
+import java.util.concurrent.TimeUnit
+import kotlin.concurrent.thread
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertFalse
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.io.TempDir
+
+
+internal class SegmentedOutputLogTest {
+
+    @TempDir lateinit var tempDir: File
+
+    @Test fun `range reads across segments`() {
+        val log = SegmentedOutputLog(tempDir.resolve("x"), segmentBytes = 10, maxSegments = 100)
+        log.write("0123456789abcdefghijABCDE".toByteArray())
+        assertEquals(3, tempDir.resolve("x").list()!!.size)
+
+        val chunk = log.read(8, 10)
+        assertEquals("89abcdefgh", String(chunk.data))
+        assertEquals(8, chunk.offset)
+        assertEquals(18, chunk.nextOffset)
+        assertFalse(chunk.complete)
+
+        log.close()
+        val tail = log.read(18, 100)
+        assertEquals("ijABCDE", String(tail.data))
+        assertTrue(tail.complete)
+    }
+
+    @Test fun `old segments are dropped`() {
+        val log = SegmentedOutputLog(tempDir.resolve("x"), segmentBytes = 10, maxSegments = 2)
+        log.write("0123456789abcdefghijABCDE".toByteArray())
+
+        assertEquals(10, log.firstOffset)
+        val chunk = log.read(0, 100)
+        assertEquals(10, chunk.offset)   // the gap is reported
+        assertEquals("abcdefghijABCDE", String(chunk.data))
+
+        log.delete()
+        assertFalse(tempDir.resolve("x").exists())
+    }
+
+    @Test fun `long poll`() {
+        val log = SegmentedOutputLog(tempDir.resolve("x"), segmentBytes = 1024, maxSegments = 2)
+        log.write("first".toByteArray())
+
+        val beg = System.nanoTime()
+        assertEquals(0, log.read(5, 100, waitMsec = 100).data.size)   // nothing new, waits
+        assertTrue(TimeUnit.NANOSECONDS.toMillis(System.nanoTime() - beg) >= 100)
+
+        thread {
+            Thread.sleep(50)
+            log.write("second".toByteArray())
+        }
+        assertEquals("second", String(log.read(5, 100, waitMsec = 5000).data))
+
+        thread {
+            Thread.sleep(50)
+            log.close()
+        }
+        val last = log.read(11, 100, waitMsec = 5000)
+        assertEquals(0, last.data.size)
+        assertTrue(last.complete)
+    }
+}
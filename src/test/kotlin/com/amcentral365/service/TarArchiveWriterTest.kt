@@ -0,0 +1,68 @@
+package com.amcentral365.service
+
+import java.io.ByteArrayOutputStream
+import java.io.File
+import java.nio.file.Files
+import java.nio.file.attribute.PosixFilePermission
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertFalse
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.Assumptions.assumeTrue
+import org.junit.jupiter.api.assertThrows
+import org.junit.jupiter.api.io.TempDir
+
+
+internal class TarArchiveWriterTest {
+
+    @TempDir lateinit var tempDir: File
+
+    private fun untar(archive: ByteArray) {
+        val process = try {
+            ProcessBuilder("tar", "-x", "-p", "-f", "-", "-C", tempDir.path).redirectErrorStream(true).start()
+        } catch(x: java.io.IOException) {
+            null
+        }
+        assumeTrue(process != null, "tar is not installed")
+        process!!.outputStream.use { it.write(archive) }
+        val output = process.inputStream.bufferedReader().readText()
+        assertEquals(0, process.waitFor(), output)
+    }
+
+    @Test fun `the archive unpacks with tar`() {
+        val longDir = (1..8).joinToString("/") { "directory-number-$it" }
+        val buffer = ByteArrayOutputStream()
+        TarArchiveWriter(buffer).use { tar ->
+            tar.addDirectory("bin")
+            tar.addFile("bin/run.sh", 13, "echo running\n".byteInputStream(), 0b111_101_101)
+            tar.addFile("README", 0, "".byteInputStream())
+            tar.addDirectory(longDir)
+            tar.addFile("$longDir/data.txt", 3, "abc".byteInputStream())
+        }
+        assertEquals(0, buffer.size() % 512)
+
+        untar(buffer.toByteArray())
+
+        assertEquals("echo running\n", tempDir.resolve("bin/run.sh").readText())
+        assertEquals("", tempDir.resolve("README").readText())
+        assertEquals("abc", tempDir.resolve("$longDir/data.txt").readText())
+
+        val perms = Files.getPosixFilePermissions(tempDir.resolve("bin/run.sh").toPath())
+        assertTrue(PosixFilePermission.OWNER_EXECUTE in perms)
+        assertFalse(PosixFilePermission.OWNER_EXECUTE in Files.getPosixFilePermissions(tempDir.resolve("README").toPath()))
+    }
+
+    @Test fun `size mismatch`() {
+        val e = assertThrows<StatusException> {
+            TarArchiveWriter(ByteArrayOutputStream()).addFile("f", 10, "short".byteInputStream())
+        }
+        assertEquals(500, e.code)
+    }
+
+    @Test fun `long paths`() {
+        assertEquals(Pair("", "a/b"), TarArchiveWriter.splitPath("a/b"))
+        assertEquals(Pair("p".repeat(60), "n".repeat(90)), TarArchiveWriter.splitPath("p".repeat(60) + "/" + "n".repeat(90)))
+        assertEquals(412, assertThrows<StatusException> { TarArchiveWriter.splitPath("x".repeat(120)) }.code)
+    }
+}
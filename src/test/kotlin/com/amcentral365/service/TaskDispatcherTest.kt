@@ -0,0 +1,96 @@
+package com.amcentral365.service
+
+import java.util.UUID
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.atomic.AtomicInteger
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+
+import com.amcentral365.service.dao.Task
+
+
+internal class TaskDispatcherTest {
+
+    /** The tasks table: claim() takes due tasks off the list, like SKIP LOCKED does for concurrent claims */
+    private class FakeQueue(taskCount: Int): TaskDispatcher.Queue {
+        val ready = (1..taskCount).map { k -> Task().also { it.taskId = UUID.randomUUID(); it.name = "task$k" } }.toMutableList()
+        val claimedBy = ConcurrentHashMap<UUID, String>()
+        val finished  = ConcurrentHashMap<UUID, Task.Status>()
+        val claimSizes = mutableListOf<Int>()
+
+        @Synchronized override fun claim(workerName: String, limit: Int): List<Task> {
+            claimSizes.add(limit)
+            val batch = ready.take(limit)
+            ready.removeAll(batch)
+            batch.forEach { claimedBy[it.taskId!!] = workerName }
+            return batch
+        }
+
+        override fun finish(workerName: String, taskId: UUID, status: Task.Status, progressText: String) {
+            assertEquals(claimedBy[taskId], workerName)
+            assertEquals(null, finished.put(taskId, status))
+        }
+
+        override fun failAbandoned(workerName: String) = 0
+    }
+
+    private fun awaitFinished(queue: FakeQueue, count: Int) {
+        val deadline = System.currentTimeMillis() + 10_000
+        while( queue.finished.size < count && System.currentTimeMillis() < deadline )
+            Thread.sleep(10)
+        assertEquals(count, queue.finished.size)
+    }
+
+    @Test fun `runs each task once, at most threads at a time`() {
+        val queue = FakeQueue(30)
+        val running = AtomicInteger()
+        val maxRunning = AtomicInteger()
+
+        val dispatcher = TaskDispatcher("w1", threads = 3, batchSize = 10, pollIntervalMsec = 50, queue = queue) { _, task, _ ->
+            maxRunning.accumulateAndGet(running.incrementAndGet()) { a, b -> maxOf(a, b) }
+            Thread.sleep(10)
+            running.decrementAndGet()
+            if( task.name == "task7" ) StatusMessage(500, "failed") else StatusMessage.OK
+        }
+        dispatcher.start()
+        awaitFinished(queue, 30)
+        dispatcher.stop()
+
+        assertTrue(maxRunning.get() <= 3)
+        assertTrue(queue.claimSizes.all { it <= 3 })
+        assertEquals(29, queue.finished.values.count { it == Task.Status.Finished })
+        assertEquals(1L, dispatcher.stats()["failedCount"])
+    }
+
+    @Test fun `nodes share the queue`() {
+        val queue = FakeQueue(40)
+        val ranOn = ConcurrentHashMap<UUID, String>()
+        val dispatchers = listOf("w1", "w2").map { name ->
+            TaskDispatcher(name, threads = 2, batchSize = 2, pollIntervalMsec = 50, queue = queue) { _, task, _ ->
+                assertEquals(null, ranOn.put(task.taskId!!, name))
+                Thread.sleep(5)
+                StatusMessage.OK
+            }
+        }
+        dispatchers.forEach { it.start() }
+        awaitFinished(queue, 40)
+        dispatchers.forEach { it.stop() }
+
+        assertEquals(40, ranOn.size)
+        assertEquals(setOf("w1", "w2"), ranOn.values.toSet())
+    }
+
+    @Test fun `wakeUp cuts the poll interval`() {
+        val queue = FakeQueue(0)
+        val dispatcher = TaskDispatcher("w1", threads = 1, batchSize = 1, pollIntervalMsec = 60_000, queue = queue) { _, _, _ -> StatusMessage.OK }
+        dispatcher.start()
+        Thread.sleep(50)   // the queue was empty, the dispatcher sleeps
+
+        synchronized(queue) { queue.ready.add(Task().also { it.taskId = UUID.randomUUID(); it.name = "late" }) }
+        dispatcher.wakeUp()
+        awaitFinished(queue, 1)
+        dispatcher.stop()
+    }
+}
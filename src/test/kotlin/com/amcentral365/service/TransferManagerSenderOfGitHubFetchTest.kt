@@ -0,0 +1,133 @@
+package com.amcentral365.service
+
+import com.sun.net.httpserver.HttpExchange
+import com.sun.net.httpserver.HttpServer
+import java.io.File
+import java.net.InetSocketAddress
+import java.util.Base64
+import java.util.concurrent.Executors
+import java.util.concurrent.atomic.AtomicInteger
+
+import org.junit.jupiter.api.AfterEach
+import org.junit.jupiter.api.BeforeEach
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+import org.junit.jupiter.api.io.TempDir
+
+
+internal class TransferManagerSenderOfGitHubFetchTest {
+
+    @TempDir lateinit var tempDir: File
+
+    /**
+     * The contents API of repo o/r, ref dev, folder scripts/app:
+     *   a1..a5, lib/ (l1..l10, embedded), a6..a10
+     * Raw files take [rawDelayMsec] to download.
+     */
+    private class FakeGitHub(val rawDelayMsec: Long = 50) {
+        val running = AtomicInteger()
+        val maxRunning = AtomicInteger()
+        val rawRequests = AtomicInteger()
+        val missing = mutableSetOf<String>()
+
+        private val server = HttpServer.create(InetSocketAddress("127.0.0.1", 0), 0)
+        val base get() = "http://127.0.0.1:${this.server.address.port}"
+
+        private fun fileObj(path: String, embedded: Boolean = false): String {
+            val name = path.substringAfterLast('/')
+            val content = if( embedded ) """, "content": "${Base64.getEncoder().encodeToString("content of $name".toByteArray())}", "encoding": "base64"""" else ""
+            return """{ "name": "$name", "path": "$path", "sha": "sha-$path", "type": "file",
+                        "download_url": "$base/raw/$path" $content }"""
+        }
+
+        private fun dirObj(path: String) =
+            """{ "name": "${path.substringAfterLast('/')}", "path": "$path", "type": "dir",
+                 "url": "$base/repos/o/r/contents/$path?ref=dev", "download_url": null }"""
+
+        private fun listing(path: String): String? = when( path ) {
+            "scripts/app"     -> ((1..5).map { fileObj("scripts/app/a$it") } + dirObj("scripts/app/lib")
+                                 + (6..10).map { fileObj("scripts/app/a$it") })
+            "scripts/app/lib" -> (1..9).map { fileObj("scripts/app/lib/l$it") } + fileObj("scripts/app/lib/l10", embedded = true)
+            else -> null
+        }?.joinToString(",", "[", "]")
+
+        private fun reply(exchange: HttpExchange, code: Int, body: String?) {
+            if( body == null ) {
+                exchange.sendResponseHeaders(code, -1)
+            } else {
+                val bytes = body.toByteArray()
+                exchange.sendResponseHeaders(code, bytes.size.toLong())
+                exchange.responseBody.use { it.write(bytes) }
+            }
+            exchange.close()
+        }
+
+        init {
+            server.createContext("/repos/o/r/contents/") { exchange ->
+                val body = listing(exchange.requestURI.path.removePrefix("/repos/o/r/contents/"))
+                reply(exchange, if( body == null ) 404 else 200, body)
+            }
+            server.createContext("/raw/") { exchange ->
+                rawRequests.incrementAndGet()
+                maxRunning.accumulateAndGet(running.incrementAndGet()) { a, b -> maxOf(a, b) }
+                Thread.sleep(rawDelayMsec)
+                running.decrementAndGet()
+                val path = exchange.requestURI.path.removePrefix("/raw/")
+                if( path in missing )
+                    reply(exchange, 404, null)
+                else
+                    reply(exchange, 200, "content of ${path.substringAfterLast('/')}")
+            }
+            server.executor = Executors.newCachedThreadPool()
+            server.start()
+        }
+
+        fun stop() = server.stop(0)
+    }
+
+    private lateinit var github: FakeGitHub
+
+    @BeforeEach fun startServer() { github = FakeGitHub() }
+    @AfterEach  fun stopServer()  { github.stop() }
+
+    private fun sender(threads: Int) =
+        SenderOfGitHub("${github.base}/repos/o/r/contents/scripts/app?ref=dev", translate = false, threads = threads,
+                       cache = ArtifactCache(tempDir, 1L shl 20, 0, 5000, 5000, 2))
+
+    private fun readAll(sender: SenderOfGitHub): List<Pair<String, String?>> =
+        try {
+            sender.getIterator().asSequence().map { Pair(it.pathStr, it.inputStream?.use { s -> String(s.readBytes()) }) }.toList()
+                .also { sender.end(true) }
+        } catch(x: Exception) {
+            sender.end(false)
+            throw x
+        }
+
+    @Test fun `items come in listing order, files are fetched in parallel`() {
+        val beg = System.currentTimeMillis()
+        val items = readAll(sender(threads = 8))
+        val elapsed = System.currentTimeMillis() - beg
+        println("20 files, 19 downloads of ${github.rawDelayMsec} msec each: $elapsed msec, ${github.maxRunning.get()} in parallel")
+
+        val expected = (1..5).map { "app/a$it" } + "app/lib" + (1..10).map { "app/lib/l$it" } + (6..10).map { "app/a$it" }
+        assertEquals(expected, items.map { it.first })
+        assertEquals(null, items.first { it.first == "app/lib" }.second)
+        assertEquals("content of a7", items.first { it.first == "app/a7" }.second)
+        assertEquals("content of l10", items.first { it.first == "app/lib/l10" }.second)
+
+        assertEquals(19, github.rawRequests.get())    // l10 is embedded
+        assertTrue(github.maxRunning.get() > 1)
+    }
+
+    @Test fun `one thread fetches sequentially`() {
+        readAll(sender(threads = 1))
+        assertEquals(1, github.maxRunning.get())
+    }
+
+    @Test fun `a failed download fails the iteration`() {
+        github.missing.add("scripts/app/a3")
+        assertThrows<java.io.IOException> { readAll(sender(threads = 4)) }
+    }
+}
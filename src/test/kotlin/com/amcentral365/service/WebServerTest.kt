@@ -11,8 +11,16 @@ import io.mockk.Runs
 import com.google.common.io.Resources
 import org.junit.jupiter.api.Assertions.assertNotNull
 import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
 import spark.Request
 import spark.Response
+import java.io.ByteArrayOutputStream
+import javax.servlet.ServletOutputStream
+import javax.servlet.WriteListener
+import javax.servlet.http.HttpServletResponse
+
+import com.amcentral365.service.dao.AssetRoleValues
+import com.amcentral365.service.dao.Role
 
 internal class WebServerTest {
 
@@ -36,4 +44,57 @@ internal class WebServerTest {
         assertTrue(daos.length > 0)
         assertTrue(daos.indexOf("asset_role_values") >= 0)
     }
+
+    @Test
+    fun pageCursor() {
+        for( key in listOf("a", "web-server-01", "имя/с пробелом?&=") ) {
+            val cursor = encodePageCursor(key)
+            assertTrue(cursor.all { it.isLetterOrDigit() || it == '-' || it == '_' }, "cursor '$cursor' is not url-safe")
+            assertEquals(key, decodePageCursor(cursor))
+        }
+
+        val x = assertThrows<StatusException> { decodePageCursor("not a cursor!") }
+        assertEquals(400, x.code)
+    }
+
+    private fun streamRoles(roles: List<Role>, ndjson: Boolean): String {
+        val buf = ByteArrayOutputStream()
+        val servletStream = object: ServletOutputStream() {
+            override fun write(b: Int) = buf.write(b)
+            override fun isReady() = true
+            override fun setWriteListener(writeListener: WriteListener?) {}
+        }
+        val rawMock = mockk<HttpServletResponse>()
+        val rspMock = mockk<Response>()
+        every { rawMock.outputStream } returns servletStream
+        every { rspMock.raw() } returns rawMock
+        every { rspMock.type(any()) } just Runs
+
+        assertEquals("", streamJsonArray(rspMock, roles.asSequence(), ndjson))
+        return String(buf.toByteArray(), Charsets.UTF_8)
+    }
+
+    @Test
+    fun streamJsonArray() {
+        val roles = listOf(Role("r1"), Role("r2"), Role("r3"))
+        assertEquals(toJsonArray(roles), streamRoles(roles, false))
+        assertEquals(toJsonArray(emptyList()), streamRoles(emptyList(), false))
+
+        val lines = streamRoles(roles, true).lines().filter { it.isNotEmpty() }
+        assertEquals(roles.map { it.asJsonStr() }, lines)
+    }
+
+    @Test
+    fun adminDataWritesOfIndexedTables() {
+        for( entityClass in listOf(Role::class, AssetRoleValues::class) ) {
+            val reqMock = mockk<Request>()
+            val rspMock = mockk<Response>(relaxed = true)
+            every { reqMock.requestMethod() } returns "PUT"
+            every { reqMock.params() } returns emptyMap()
+            every { reqMock.queryParams() } returns emptySet()
+
+            val rsp = WebServer().restCallForPersistentObject(reqMock, rspMock, entityClass)
+            assertTrue(rsp.contains("\"code\": 405"), rsp)
+        }
+    }
 }
@@ -3,8 +3,12 @@ package com.amcentral365.service.api
 import com.amcentral365.service.Configuration
 import com.amcentral365.service.StatusException
 import com.amcentral365.service.config
+import com.amcentral365.service.dao.Role
 
 import com.google.gson.Gson
+import com.google.gson.JsonElement
+
+import java.sql.Timestamp
 
 import org.junit.jupiter.api.Assertions.assertDoesNotThrow
 
@@ -535,6 +539,58 @@ internal class SchemaUtilsTest {
         check("""{ "map1+": {"a": "q"} }""",   nonRequiredElementPassedMsg)
     }
 
+    @Test fun `asset - validate - tree matches path-keyed validation`() {
+        val compiled = this.schemaUtils2.compiledSchema("compute")
+        fun outcome(validate: () -> Unit): String =
+            try { validate(); "ok" } catch(x: StatusException) { "${x.code}: ${x.message}" }
+
+        listOf(
+            """{ "hdds": [ {} ] }""",
+            """{ "bogus": null }""",
+            """{ "hostname": null }""",
+            """{ "hostname": [] }""",
+            """{ "video": "sight" }""",
+            """{ "hdds": {"x": 1} }""",
+            """{ "hdds": [ {"size_mb": "44"} ] }""",
+            """{ "watchers": [ {} ] }""",
+            """{ "array1+": [3,5,"x"] }""",
+            """{ "map0*": {"a": 51} }""",
+            """{ "map1+": {} }""",
+            """{ "hostname": "h", "ram_mb": 1, "video": "radeon", "hdds": [{"size_mb": 1}],
+                 "nested": { "name1": "x1", "n2": [ { "name2": "a", "n3": { "name3": "b", "val3": [1] } }, { "name2": "c" } ] } }""",
+            """{ "hostname": "h", "ram_mb": 1, "video": "radeon", "hdds": [{"size_mb": 1}], "map1+": {"k": "v"} }"""
+        ).forEach { assetJsonStr ->
+            val elm = com.google.gson.JsonParser().parse(assetJsonStr)
+            assertEquals(
+                outcome { this.schemaUtils2.validateAssetValueByPath("compute", elm, compiled) },
+                outcome { this.schemaUtils2.validateAssetValue("compute", elm) },
+                assetJsonStr
+            )
+        }
+    }
+
+    @Test fun `asset - default - in array elements`() {
+        val su = object : SchemaUtils(loadSchema = { _ -> """{ "disks": { "_attr": "*", "size": "number!", "fs": { "type": "string", "default": "ext4" } } }""" }) {}
+        val v = su.getAssetValue("r", """{ "disks": [ {"size": 1}, {"size": 2, "fs": "xfs"} ] }""")
+        val disks = v.asJsonObject["disks"].asJsonArray
+        assertEquals("ext4", disks[0].asJsonObject["fs"].asString)
+        assertEquals("xfs",  disks[1].asJsonObject["fs"].asString)
+    }
+
+    @Test fun `asset - strings typed by the schema`() {
+        val su = object : SchemaUtils(loadSchema = { _ -> """{ "name": "string", "port": "number", "tls": "boolean", "ids": "number+", "tags": "map" }""" }) {}
+        val v = su.typeStrings("r", Gson().fromJson(
+            """{ "name": "0042", "port": "22", "tls": "true", "ids": ["1", "1.10"], "tags": {"a": "7"}, "other": "9" }""",
+            JsonElement::class.java)).asJsonObject
+        assertEquals("0042", v["name"].asString)
+        assertTrue(v["port"].asJsonPrimitive.isNumber)
+        assertEquals(22, v["port"].asInt)
+        assertEquals(true, v["tls"].asJsonPrimitive.isBoolean && v["tls"].asBoolean)
+        assertEquals("1.10", v["ids"].asJsonArray[1].asBigDecimal.toPlainString())
+        assertEquals("7", v["tags"].asJsonObject["a"].asString)
+        assertEquals("9", v["other"].asString)
+    }
+
     @Test fun `asset - validate - simple`() {
         val assetJsonStr = """{
             "hostname": "compute-1",
@@ -655,4 +711,114 @@ internal class SchemaUtilsTest {
         check(null, """{ "a": "this-is-a", "b": null }""")                          // null should not be substituted
     }
 
+    @Test fun `asset - indexed values`() {
+        val schemaStr = """{
+            |  "hostname": "string!^",
+            |  "port":     "number^",
+            |  "comment":  "string",
+            |  "aliases":  "string*^",
+            |  "nics":     { "_attr": "*", "ip": "string^", "mac": "string" },
+            |  "tags":     "map"
+            |}""".trimMargin()
+        val schemaUtils = object : SchemaUtils(loadSchema = { _ -> schemaStr }) {}
+
+        val values = schemaUtils.indexedValues("a-test-role-with-index", """{
+            |  "hostname": "h1", "port": 22, "comment": "not indexed",
+            |  "aliases": ["h1a", "h1b", "h1a"],
+            |  "nics": [{"ip": "10.0.0.1", "mac": "m1"}, {"ip": "10.0.0.2", "mac": "m2"}],
+            |  "tags": {"hostname": "not indexed either"}
+            |}""".trimMargin())
+
+        assertEquals(listOf(
+                Pair("$.hostname",  "h1"),
+                Pair("$.port",      "22"),
+                Pair("$.aliases",   "h1a"),
+                Pair("$.aliases",   "h1b"),
+                Pair("$.nics[].ip", "10.0.0.1"),
+                Pair("$.nics[].ip", "10.0.0.2")
+            ), values)
+
+        assertEquals(setOf("$.hostname", "$.port", "$.aliases", "$.nics[].ip"),
+                     schemaUtils.indexedAttributes("a-test-role-with-index"))
+    }
+
+
+    private class FakeRolesTable {
+        val schemas = mutableMapOf(
+            "r1" to """{ "a": "string" }""",
+            "r2" to """{ "b": "@r1" }""",
+            "r3" to """{ "c": "number" }"""
+        )
+        val versions = mutableMapOf("r1" to "1000:1", "r2" to "1000:2", "r3" to "1000:3")
+        var schemaLoads = 0
+
+        val schemaUtils = object : SchemaUtils(
+            loadSchemaVersions = { versions.toMap() },
+            loadAllSchemas = { schemas.map { (name, schema) -> Role(name).apply { roleSchema = schema; modifiedTs = Timestamp(1000) } } },
+            loadSchema = { roleName -> schemaLoads++; schemas[roleName] }
+        ) {}
+
+        /** Within the same second: only the checksum part of the version changes */
+        fun modify(roleName: String, schema: String) {
+            schemas[roleName] = schema
+            versions[roleName] = "1000:${schema.hashCode()}"
+        }
+    }
+
+    @Test fun `cache - warm-up and version checks`() {
+        val roles = FakeRolesTable()
+        val su = roles.schemaUtils
+
+        assertEquals(3, su.warmUp())
+        assertEquals(0, roles.schemaLoads)   // the reference to r1 was resolved from the preloaded schemas
+        assertEquals(0, su.checkVersions())
+
+        roles.modify("r1", """{ "a": "number" }""")
+        assertEquals(2, su.checkVersions())  // r1 and r2 referencing it
+        su.validateAssetValue("r2", """{ "b": { "a": 5 } }""")
+        su.validateAssetValue("r3", """{ "c": 5 }""")
+        assertEquals(2, roles.schemaLoads)   // r2 and r1 it references
+        assertEquals(0, su.checkVersions())
+
+        roles.versions.remove("r3")          // deleted by another node
+        assertEquals(1, su.checkVersions())
+
+        val stats = su.cacheStats()
+        assertEquals(1L, stats["hitCount"])
+        assertEquals(1L, stats["missCount"])
+        assertEquals(3L, stats["invalidationCount"])
+        assertEquals(4L, stats["versionCheckCount"])
+        assertEquals(3,  stats["warmUpRoleCount"])
+    }
+
+    @Test fun `cache - roles unknown to the last check are reloaded`() {
+        val roles = FakeRolesTable()
+        val su = roles.schemaUtils
+
+        su.validateAssetValue("r3", """{ "c": 5 }""")  // loaded before any version check
+        assertEquals(1, su.checkVersions())
+        su.validateAssetValue("r3", """{ "c": 5 }""")
+        assertEquals(0, su.checkVersions())
+    }
+
+    @Test fun `cache - invalidate drops referencing roles`() {
+        val roles = FakeRolesTable()
+        val su = roles.schemaUtils
+        su.warmUp()
+
+        su.invalidate("r1")
+        assertEquals(2L, su.cacheStats()["invalidationCount"])
+        assertEquals(1L, su.cacheStats()["size"])
+    }
+
+    @Test fun `directly referenced roles`() {
+        assertEquals(setOf("r2", "r3", "r4"), directlyReferencedRoles("""{
+            "a": "@r2!+",
+            "b": { "c": "@r3*", "d": "string" },
+            "e": { "type": "@r4", "default": "@not_a_role" },
+            "f": ["@an_enum_value"],
+            "_attr": "@not_a_role_either"
+        }"""))
+        assertEquals(emptySet<String>(), directlyReferencedRoles("""{"a": "string"}"""))
+    }
 }
@@ -0,0 +1,118 @@
+package com.amcentral365.service.api
+
+import com.google.gson.JsonArray
+import com.google.gson.JsonElement
+import com.google.gson.JsonObject
+import com.google.gson.JsonParser
+
+import org.junit.jupiter.api.Tag
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.condition.EnabledIfEnvironmentVariable
+
+import com.amcentral365.service.Configuration
+import com.amcentral365.service.config
+
+
+/**
+ * Compares [SchemaTree] validation and default assignment with the path-keyed implementation.
+ *
+ * Modelled after JMH: warm-up iterations, then measured iterations of a fixed duration, reporting
+ * the mean time per operation and its deviation. It is slow, so it only runs with AMC_BENCHMARK=true:
+ *
+ * <code>AMC_BENCHMARK=true gradle test --tests '*SchemaValidationBenchmark*'</code>
+ */
+@Tag("benchmark")
+@EnabledIfEnvironmentVariable(named = "AMC_BENCHMARK", matches = "true")
+internal class SchemaValidationBenchmark {
+
+    private val warmupIterations  = 5
+    private val measureIterations = 10
+    private val iterationMsec     = 500L
+
+    private val width = 12  // attributes per object
+    private val depth = 3   // levels of nested objects
+    private val arraySize = 20
+
+    init {
+        config = Configuration(emptyArray())
+    }
+
+    /** An object of [width] attributes of assorted types, each level nesting an object and an array of objects */
+    private fun schemaLevel(level: Int): JsonObject {
+        val obj = JsonObject()
+        for(k in 0 until width) {
+            when(k % 4) {
+                0 -> obj.addProperty("s$k", "string!")
+                1 -> obj.addProperty("n$k", "number")
+                2 -> obj.add("d$k", JsonParser().parse("""{ "type": "boolean", "default": true }"""))
+                3 -> obj.add("e$k", JsonParser().parse("""["!", "red", "green", "blue"]"""))
+            }
+        }
+        if( level < depth ) {
+            obj.add("child", schemaLevel(level+1))
+            val arrElm = schemaLevel(level+1)
+            arrElm.addProperty("_attr", "*")
+            obj.add("items", arrElm)
+        }
+        return obj
+    }
+
+    private fun valueLevel(level: Int, withArrays: Boolean = true): JsonObject {
+        val obj = JsonObject()
+        for(k in 0 until width) {
+            when(k % 4) {
+                0 -> obj.addProperty("s$k", "value $level/$k")
+                1 -> obj.addProperty("n$k", level * 100 + k)
+                2 -> if( k % 8 == 2 ) obj.addProperty("d$k", false)   // leave half of them to the default
+                3 -> obj.addProperty("e$k", "green")
+            }
+        }
+        if( level < depth ) {
+            obj.add("child", valueLevel(level+1, withArrays))
+            if( withArrays ) {
+                val arr = JsonArray()
+                repeat(arraySize) { arr.add(valueLevel(level+1)) }
+                obj.add("items", arr)
+            }
+        }
+        return obj
+    }
+
+    private fun measure(name: String, op: () -> Unit) {
+        fun iteration(): Double {
+            var ops = 0L
+            val beg = System.nanoTime()
+            val end = beg + iterationMsec * 1_000_000
+            var now = beg
+            while( now < end ) {
+                op()
+                ops++
+                now = System.nanoTime()
+            }
+            return (now - beg).toDouble() / ops
+        }
+
+        repeat(warmupIterations) { iteration() }
+        val samples = List(measureIterations) { iteration() }
+        val mean = samples.average()
+        val stdDev = Math.sqrt(samples.map { (it - mean) * (it - mean) }.sum() / (samples.size - 1))
+        println("%-40s %12.0f ns/op  ± %8.0f".format(name, mean, stdDev))
+    }
+
+    @Test fun validation() {
+        val schemaStr = schemaLevel(1).toString()
+        val su = object : SchemaUtils(maxCacheWeight = 1_000_000, loadSchema = { _ -> schemaStr }) {}
+        val compiled = su.compiledSchema("bench")
+
+        val value = su.assignDefaultValues("bench", valueLevel(1))
+        println("schema nodes: ${compiled.size}, value size: ${value.toString().length} chars")
+
+        measure("validate: path-keyed")  { su.validateAssetValueByPath("bench", value, compiled) }
+        measure("validate: tree")        { su.validateAssetValue("bench", value) }
+
+        // the path-keyed implementation fails on arrays of objects with defaults, compare on nested objects only
+        val noArraysValue: JsonElement = valueLevel(1, withArrays = false)
+        measure("defaults: path-keyed")  { su.assignDefaultValuesByPath("bench", noArraysValue, compiled) }
+        measure("defaults: tree")        { su.assignDefaultValues("bench", noArraysValue) }
+    }
+}
@@ -0,0 +1,67 @@
+package com.amcentral365.service.api.catalog
+
+import java.util.UUID
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertNull
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+
+import com.google.gson.JsonParser
+
+import com.amcentral365.service.Configuration
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.config
+
+
+internal class AssetImportTest {
+
+    private val schemas = mapOf(
+        "host" to """{ "hostname": "string!^", "port": { "type": "number", "default": 22 } }""",
+        "web"  to """{ "url": "string!" }"""
+    )
+    private val schemaUtils: SchemaUtils
+
+    init {
+        config = Configuration(emptyArray())
+        schemaUtils = SchemaUtils { roleName -> schemas[roleName] }
+    }
+
+    @Test fun `parse - asset with roles`() {
+        val rec = AssetImport.parseRecord(7,
+            """{"asset": {"name": "h1"}, "roles": [{"roleName": "web", "values": {"url": "http://h1"}}, {"roleName": "host", "values": {"hostname": "h1.local"}}]}""",
+            schemaUtils)
+
+        assertEquals(7, rec.lineNo)
+        assertEquals("h1", rec.asset.name)
+        assertNull(rec.asset.assetId)
+        assertEquals(listOf("host", "web"), rec.roles.map { it.roleName })   // sorted
+
+        val hostVals = JsonParser().parse(rec.roles[0].assetVals).asJsonObject
+        assertEquals(22, hostVals["port"].asInt)   // the default was assigned
+        assertEquals(listOf(Pair("$.hostname", "h1.local")), rec.roles[0].indexedValues)
+        assertTrue(rec.roles[1].indexedValues.isEmpty())
+    }
+
+    @Test fun `parse - asset by id without roles`() {
+        val id = UUID.randomUUID()
+        val rec = AssetImport.parseRecord(1, """{"asset": {"assetId": "$id"}}""", schemaUtils)
+        assertEquals(id, rec.asset.assetId)
+        assertTrue(rec.roles.isEmpty())
+    }
+
+    @Test fun `parse - bad records`() {
+        fun check(line: String, expectedCode: Int) {
+            val x = assertThrows<StatusException> { AssetImport.parseRecord(1, line, schemaUtils) }
+            assertEquals(expectedCode, x.code, x.message)
+        }
+
+        check("""["not", "an", "object"]""", 400)
+        check("""{"roles": []}""", 400)
+        check("""{"asset": {"description": "no id, no name"}}""", 400)
+        check("""{"asset": {"name": "h1"}, "roles": [{"roleName": "web", "values": {"url": "u"}}, {"roleName": "web"}]}""", 400)
+        check("""{"asset": {"name": "h1"}, "roles": [{"roleName": "web", "values": {}}]}""", 406)   // url is required
+    }
+}
@@ -0,0 +1,162 @@
+package com.amcentral365.service.api.catalog
+
+import java.sql.Connection
+import java.sql.PreparedStatement
+import java.sql.ResultSet
+import java.util.UUID
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+
+import io.mockk.mockk
+import io.mockk.every
+import io.mockk.just
+import io.mockk.Runs
+
+import spark.Request
+import spark.Response
+
+import com.google.gson.JsonParser
+
+import com.amcentral365.service.Configuration
+import com.amcentral365.service.DatabaseStore
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.config
+import com.amcentral365.service.dao.bytesToUuid
+import com.amcentral365.service.dao.uuidToBytes
+import com.amcentral365.service.databaseStore
+import com.amcentral365.service.schemaUtils
+
+
+internal class AssetRoleValuesTest {
+
+    private val h1Id = UUID.randomUUID()
+    private val h2Id = UUID.randomUUID()
+    private val assets = mapOf(h1Id to "h1", h2Id to "h2")
+    private val roleValues = listOf(
+        Triple(h1Id, "host", """{"hostname": "h1.local"}"""),
+        Triple(h1Id, "web",  """{"url": "http://h1"}"""),
+        Triple(h2Id, "host", """{"hostname": "h2.local"}""")
+    )
+
+    private val queries = mutableListOf<String>()
+
+    /** Rows of [rows] as a forward-only result set, columns numbered from 1 */
+    private fun resultSet(rows: List<List<Any?>>): ResultSet {
+        val rs = mockk<ResultSet>()
+        var k = -1
+        every { rs.next() } answers { ++k < rows.size }
+        every { rs.getBytes(any<Int>()) } answers { rows[k][firstArg<Int>()-1] as ByteArray? }
+        every { rs.getString(any<Int>()) } answers { rows[k][firstArg<Int>()-1] as String? }
+        every { rs.getTimestamp(any<Int>()) } returns null
+        every { rs.close() } just Runs
+        return rs
+    }
+
+    /** Answers the assets and asset_role_values queries of the lookup from [assets] and [roleValues] */
+    private fun query(sql: String, binds: Collection<Any>): List<List<Any?>> = when {
+        sql.startsWith("select asset_id, name from assets") ->
+            this.assets.filter { (id, name) -> id in binds || name in binds }.map { (id, name) -> listOf(uuidToBytes(id), name) }
+
+        sql.startsWith("select asset_id, role_name, asset_vals") -> {
+            val roleNames = binds.filterIsInstance<String>()
+            this.roleValues.filter { (id, roleName, _) -> id in binds && (roleNames.isEmpty() || roleName in roleNames) }
+                           .map { (id, roleName, vals) -> listOf(uuidToBytes(id), roleName, vals, "test", "test") }
+        }
+
+        else -> throw AssertionError("unexpected query: $sql")
+    }
+
+    private fun connection(): Connection {
+        val conn = mockk<Connection>()
+        every { conn.close() } just Runs
+        every { conn.prepareStatement(any()) } answers {
+            val sql = firstArg<String>()
+            queries.add(sql)
+
+            val binds = sortedMapOf<Int, Any>()
+            val stmt = mockk<PreparedStatement>()
+            every { stmt.setString(any(), any()) } answers { binds[firstArg()] = secondArg<String>() }
+            every { stmt.setBytes(any(), any()) } answers { binds[firstArg()] = bytesToUuid(secondArg<ByteArray>())!! }
+            every { stmt.executeQuery() } answers { resultSet(query(sql, binds.values)) }
+            every { stmt.close() } just Runs
+            stmt
+        }
+        return conn
+    }
+
+    private fun lookup(body: String): Pair<List<Pair<String, String>>, List<String>> {
+        val conn = this.connection()
+        databaseStore = mockk<DatabaseStore>()
+        every { databaseStore.getGoodConnection(any()) } returns conn
+
+        val reqMock = mockk<Request>()
+        val rspMock = mockk<Response>()
+        every { reqMock.body() } returns body
+        every { rspMock.type("application/json") } just Runs
+
+        val rsp = JsonParser().parse(AssetRoleValues.lookup(reqMock, rspMock)).asJsonObject
+        val values = rsp["assetRoleValues"].asJsonArray.map { it.asJsonObject }
+                                           .map { Pair(it["assetId"].asString, it["roleName"].asString) }
+        return Pair(values, rsp["notFound"].asJsonArray.map { it.asString })
+    }
+
+    @Test fun `lookup - names and ids`() {
+        val missingId = UUID.randomUUID()
+        val (values, notFound) = lookup("""{"assetKeys": ["h1", "$h2Id", "$missingId", "nosuch", "h1"]}""")
+
+        assertEquals(
+            setOf(Pair("$h1Id", "host"), Pair("$h1Id", "web"), Pair("$h2Id", "host")),
+            values.toSet()
+        )
+        assertEquals(listOf("$missingId", "nosuch"), notFound)
+        assertEquals(1, queries.count { it.startsWith("select asset_id, name from assets") })   // ids and names together
+    }
+
+    @Test fun `lookup - selected roles`() {
+        val (values, notFound) = lookup("""{"assetKeys": ["$h1Id", "h2"], "roleNames": ["host"]}""")
+
+        assertEquals(setOf(Pair("$h1Id", "host"), Pair("$h2Id", "host")), values.toSet())
+        assertEquals(emptyList<String>(), notFound)
+    }
+
+    @Test fun `lookup - keys must be strings`() {
+        for( body in listOf("""{"assetKeys": ["h1", {"name": "h2"}]}""", """{"assetKeys": [["h1"]]}""", """{"assetKeys": ["h1"], "roleNames": [null]}""") ) {
+            val reqMock = mockk<Request>()
+            val rspMock = mockk<Response>(relaxed = true)
+            every { reqMock.body() } returns body
+
+            val rsp = JsonParser().parse(AssetRoleValues.lookup(reqMock, rspMock)).asJsonObject
+            assertEquals(400, rsp["code"].asInt, body)
+        }
+    }
+
+    @Test fun `resolve keys - ids in any case and names`() {
+        val keys = listOf("h2", "$h1Id", "$h1Id".toUpperCase())
+        val resolved = AssetRoleValues.resolveAssetKeys(this.connection(), keys)
+        assertEquals(mapOf("h2" to h2Id, "$h1Id" to h1Id, "$h1Id".toUpperCase() to h1Id), resolved)
+    }
+
+    @Test fun `indexed attributes - unknown role`() {
+        config = Configuration(emptyArray())
+        schemaUtils = SchemaUtils { roleName -> if( roleName == "host" ) """{ "hostname": "string!^" }""" else null }
+
+        assertEquals(404, assertThrows<StatusException> { schemaUtils.indexedAttributes("nosuch") }.code)
+        assertTrue(AssetRoleValues.indexedAttributes("nosuch").isEmpty())
+        assertEquals(setOf("$.hostname"), AssetRoleValues.indexedAttributes("host"))
+
+        val reqMock = mockk<Request>()
+        val rspMock = mockk<Response>(relaxed = true)
+        val query = mapOf("role" to "nosuch", "attr" to "hostname", "attrValue" to "h1")
+        every { reqMock.params() } returns emptyMap()
+        every { reqMock.queryParams() } returns query.keys
+        every { reqMock.queryParamsValues(any()) } answers { arrayOf(query.getValue(firstArg())) }
+        every { reqMock.headers("Accept") } returns null
+
+        val rsp = JsonParser().parse(Assets.listAssets(reqMock, rspMock)).asJsonObject
+        assertEquals(400, rsp["code"].asInt)
+    }
+}
@@ -0,0 +1,150 @@
+package com.amcentral365.service.dao
+
+import java.sql.Timestamp
+import java.util.UUID
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertFalse
+import org.junit.jupiter.api.Assertions.assertNotSame
+import org.junit.jupiter.api.Assertions.assertSame
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+
+import com.amcentral365.service.StatusException
+import com.amcentral365.service.api.SchemaUtils
+import com.amcentral365.service.schemaUtils
+
+
+internal class CatalogCacheTest {
+
+    private class FakeSource: CatalogCache.Source {
+        val assets = mutableMapOf<UUID, Asset>()
+        val roleValues = mutableMapOf<Pair<UUID, String>, AssetRoleValues>()
+        val calls = mutableMapOf<String, Int>()
+
+        private fun called(what: String) { calls[what] = (calls[what] ?: 0) + 1 }
+
+        fun addAsset(name: String): Asset {
+            val asset = Asset(UUID.randomUUID(), name).also { it.modifiedTs = Timestamp(1000) }
+            assets[asset.assetId!!] = asset
+            return asset
+        }
+
+        fun setRole(assetId: UUID, roleName: String, vals: String, ts: Long) {
+            roleValues[Pair(assetId, roleName)] = AssetRoleValues(assetId, roleName, vals).also { it.modifiedTs = Timestamp(ts) }
+        }
+
+        private fun rowOf(asset: Asset?) = asset?.let { Asset(it.assetId, it.name).also { row -> row.modifiedTs = it.modifiedTs } }
+
+        override fun asset(assetId: UUID): Asset? { called("asset"); return rowOf(assets[assetId]) }
+        override fun assetByName(name: String): Asset? { called("assetByName"); return rowOf(assets.values.find { it.name == name }) }
+        override fun assetModifiedTs(assetId: UUID): Timestamp? { called("assetModifiedTs"); return assets[assetId]?.modifiedTs }
+        override fun roleValues(assetId: UUID, roleName: String): AssetRoleValues? { called("roleValues"); return roleValues[Pair(assetId, roleName)] }
+        override fun roleValuesModifiedTs(assetId: UUID, roleName: String): Timestamp? {
+            called("roleValuesModifiedTs")
+            return roleValues[Pair(assetId, roleName)]?.modifiedTs
+        }
+    }
+
+    @Test fun `assets - read through`() {
+        val source = FakeSource()
+        val cache = CatalogCache(100, 60, source)
+        val h1 = source.addAsset("h1")
+
+        repeat(3) { assertEquals(h1.assetId, cache.getAssetByKey("h1").assetId) }
+        repeat(3) { assertEquals("h1", cache.getAssetByKey(h1.assetId.toString()).name) }
+        assertEquals(1, source.calls["assetByName"])
+        assertEquals(null, source.calls["asset"])   // cached by the name lookup
+
+        val a1 = cache.getAssetById(h1.assetId!!)
+        a1.name = "changed by the caller"
+        assertNotSame(a1, cache.getAssetById(h1.assetId!!))
+        assertEquals("h1", cache.getAssetById(h1.assetId!!).name)
+
+        val x = assertThrows<StatusException> { cache.getAssetByKey("nope") }
+        assertEquals(404, x.code)
+    }
+
+    @Test fun `assets - invalidation`() {
+        val source = FakeSource()
+        val cache = CatalogCache(100, 60, source)
+        val h1 = source.addAsset("h1")
+
+        cache.getAssetByKey("h1")
+        source.assets[h1.assetId!!]!!.name = "h2"
+        assertEquals("h1", cache.getAssetByKey("h1").name)   // not invalidated yet
+
+        cache.invalidateAsset(h1.assetId!!)
+        assertEquals(404, assertThrows<StatusException> { cache.getAssetByKey("h1") }.code)
+        assertEquals("h2", cache.getAssetByKey("h2").name)
+    }
+
+    @Test fun `role values - present and absent`() {
+        val source = FakeSource()
+        val cache = CatalogCache(100, 60, source)
+        val h1 = source.addAsset("h1")
+        source.setRole(h1.assetId!!, "host", """{"hostname": "h1.local"}""", 1000)
+
+        repeat(3) {
+            assertTrue(cache.hasRole(h1.assetId!!, "host"))
+            assertFalse(cache.hasRole(h1.assetId!!, "web"))
+        }
+        assertEquals("h1.local", cache.getRoleValues(h1.assetId!!, "host")!!.parsed!!.asJsonObject["hostname"].asString)
+        assertEquals(2, source.calls["roleValues"])
+
+        source.setRole(h1.assetId!!, "web", """{"url": "http://h1"}""", 1000)
+        cache.invalidateRoleValues(h1.assetId!!, "web")
+        assertTrue(cache.hasRole(h1.assetId!!, "web"))
+        assertEquals(3, source.calls["roleValues"])
+    }
+
+    @Test fun `role values - refresh checks modified_ts`() {
+        val source = FakeSource()
+        val cache = CatalogCache(100, 1, source)
+        val h1 = source.addAsset("h1")
+        source.setRole(h1.assetId!!, "host", """{"hostname": "h1.local"}""", 1000)
+
+        cache.getRoleValues(h1.assetId!!, "host")
+        Thread.sleep(1100)
+        cache.getRoleValues(h1.assetId!!, "host")   // unchanged, kept
+        assertEquals(1, source.calls["roleValues"])
+        assertEquals(1, source.calls["roleValuesModifiedTs"])
+
+        source.setRole(h1.assetId!!, "host", """{"hostname": "h1.example.com"}""", 2000)
+        Thread.sleep(1100)
+        assertEquals("h1.example.com", cache.getRoleValues(h1.assetId!!, "host")!!.parsed!!.asJsonObject["hostname"].asString)
+        assertEquals(2, source.calls["roleValues"])
+    }
+
+    @Test fun `role values - defaults follow the role schema`() {
+        val schemas = mutableMapOf(
+            "ssh" to """{"port": {"type": "number", "default": 22}}""",
+            "web" to """{"url": "string", "ssh": "@ssh"}"""
+        )
+        val versions = mutableMapOf("ssh" to "1000:1", "web" to "1000:2")
+        schemaUtils = SchemaUtils(loadSchemaVersions = { versions.toMap() }, loadSchema = { schemas[it] })
+        schemaUtils.checkVersions()
+
+        val source = FakeSource()
+        val cache = CatalogCache(100, 60, source)
+        val h1 = source.addAsset("h1")
+        source.setRole(h1.assetId!!, "ssh", """{}""", 1000)
+
+        val port = { cache.getRoleValues(h1.assetId!!, "ssh")!!.withDefaults!!.asJsonObject["port"].asInt }
+        assertEquals(22, port())
+        assertSame(cache.getRoleValues(h1.assetId!!, "ssh")!!.withDefaults, cache.getRoleValues(h1.assetId!!, "ssh")!!.withDefaults)
+
+        // changed by another node: the row is the same, the schema is not
+        schemas["ssh"] = """{"port": {"type": "number", "default": 2222}}"""
+        versions["ssh"] = "2000:3"
+        schemaUtils.checkVersions()
+        assertEquals(2222, port())
+        assertEquals(1, source.calls["roleValues"])
+
+        // roles referencing a changed role get a new schema generation too
+        val webGeneration = schemaUtils.schemaGeneration("web")
+        schemaUtils.invalidate("ssh")
+        assertNotSame(webGeneration, schemaUtils.schemaGeneration("web"))
+    }
+}
@@ -0,0 +1,78 @@
+package com.amcentral365.service.mergedata
+
+import java.io.File
+import java.sql.Timestamp
+import java.util.UUID
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+
+import com.amcentral365.service.dao.Asset
+import com.amcentral365.service.dao.AssetRoleValues
+
+
+internal class AssetMergePlanTest {
+
+    private val mergeAssets = MergeAssets(".")
+    private val uuid1 = UUID.fromString("deadbeef-aced-acdc-cafe-111111111111")
+    private val uuid2 = UUID.fromString("deadbeef-aced-acdc-cafe-222222222222")
+    private val dbTs  = Timestamp(1_000_000)
+
+    private val snapshot = AssetSnapshot().apply {
+        add(Asset(uuid1, "host1").also { it.description = "a host"; it.modifiedTs = dbTs })
+        add(AssetRoleValues(uuid1, "host", """{"cpus": 4}""").also { it.modifiedTs = dbTs })
+        add(AssetRoleValues(uuid1, "disk", """{"size": 100}""").also { it.modifiedTs = dbTs })
+    }
+
+    private fun asset(id: UUID?, name: String?, description: String? = null, vararg roles: Pair<String, String>) =
+        MergeAssets.AssetWithRoles(Asset(id, name).also { it.description = description },
+                                   roles.map { MergeAssets.RoleValues(it.first, it.second) })
+
+    private fun plan(vararg records: Pair<String, List<MergeAssets.AssetWithRoles>>) =
+        AssetMergePlan.of(records.map { Pair(File(it.first), it.second) }, snapshot, mergeAssets::checkMergeAssetAgainstDb)
+
+    @Test fun `rows are diffed against the snapshot`() {
+        val (plans, problems) = plan("a.json" to listOf(
+            asset(null, "host1", "a host", "host" to """{"cpus":4}""", "disk" to """{"size": 200}""", "nic" to "{}"),
+            asset(null, "host2", "another host")
+        ))
+
+        assertTrue(problems.isEmpty())
+        val plan = plans.single()
+
+        assertEquals(listOf("host2"), plan.assetInserts.map { it.name })
+        assertEquals(emptyList<Asset>(), plan.assetUpdates)
+        assertEquals(listOf("nic"),  plan.valueInserts.map { it.roleName })
+        assertEquals(listOf("disk"), plan.valueUpdates.map { it.roleName })
+        assertEquals(dbTs, plan.valueUpdates[0].modifiedTs)
+        assertEquals(2, plan.unchanged)      // host1 and its host role values
+        assertEquals(3, plan.changed)
+    }
+
+    @Test fun `files sharing an asset are planned together, the last one wins`() {
+        val (plans, problems) = plan(
+            "a.json" to listOf(asset(null, "host3", "first", "host" to """{"cpus": 1}""")),
+            "b.json" to listOf(asset(uuid2, "other")),
+            "c.json" to listOf(asset(null, "host3", "last",  "host" to """{"cpus": 2}"""))
+        )
+
+        assertTrue(problems.isEmpty())
+        assertEquals(listOf(listOf("a.json", "c.json"), listOf("b.json")), plans.map { plan -> plan.files.map { it.path } })
+
+        val host3 = plans[0]
+        assertEquals(listOf("last"), host3.assetInserts.map { it.description })
+        assertEquals(listOf("""{"cpus": 2}"""), host3.valueInserts.map { it.assetVals })
+        assertEquals(2, host3.unchanged)      // superseded by c.json
+    }
+
+    @Test fun `files with conflicting ids fail alone`() {
+        val (plans, problems) = plan(
+            "a.json" to listOf(asset(uuid2, "host1")),      // host1 is uuid1 in the database
+            "b.json" to listOf(asset(uuid1, "host1", "described"))
+        )
+
+        assertEquals(setOf(File("a.json")), problems.keys)
+        assertEquals(listOf(uuid1), plans.single().assetUpdates.map { it.assetId })
+    }
+}
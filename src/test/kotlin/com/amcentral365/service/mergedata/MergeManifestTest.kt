@@ -0,0 +1,70 @@
+package com.amcentral365.service.mergedata
+
+import java.io.File
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertNull
+import org.junit.jupiter.api.io.TempDir
+
+
+internal class MergeManifestTest {
+
+    @TempDir lateinit var tempDir: File
+
+    private val manifestFile get() = tempDir.resolve("roles.manifest")
+
+    private fun manifest(dbState: String = "roles:3:1000") =
+        MergeManifest(manifestFile, dbState, dbUrl = "jdbc:mariadb://db/amc").also { it.load() }
+
+    private fun mergeFile(name: String, content: String) = tempDir.resolve(name).also { it.writeText(content) }
+
+    @Test fun `unchanged files are skipped by the next merge`() {
+        val a = mergeFile("a.json", """{"roleName": "a"}""")
+        val b = mergeFile("b.json", """{"roleName": "b"}""")
+
+        val first = manifest()
+        assertEquals(emptySet<File>(), first.unchanged(listOf(a, b)))
+        first.merged(a)
+        first.merged(b)
+        first.save("roles:3:1000")
+
+        b.writeText("""{"roleName": "B"}""")
+        assertEquals(setOf(a), manifest().unchanged(listOf(a, b)))
+    }
+
+    @Test fun `touched files are compared by content`() {
+        val a = mergeFile("a.json", "{}")
+        manifest().apply { merged(a); save("roles:3:1000") }
+
+        a.setLastModified(a.lastModified() - 60_000)
+        val second = manifest()
+        assertEquals(setOf(a), second.unchanged(listOf(a)))
+
+        second.save("roles:3:1000")   // with the new modification time, no hashing next time
+        assertEquals(setOf(a), manifest().unchanged(listOf(a)))
+    }
+
+    @Test fun `database changes invalidate the manifest`() {
+        val a = mergeFile("a.json", "{}")
+        manifest().apply { merged(a); save("roles:3:1000") }
+
+        assertEquals(emptySet<File>(), manifest(dbState = "roles:4:2000").unchanged(listOf(a)))
+        assertEquals(emptySet<File>(), MergeManifest(manifestFile, "roles:3:1000", dbUrl = "jdbc:mariadb://other/amc")
+                                           .also { it.load() }.unchanged(listOf(a)))
+    }
+
+    @Test fun `failed files are not recorded`() {
+        val a = mergeFile("a.json", "{}")
+        val b = mergeFile("b.json", "{ broken")
+        manifest().apply { merged(a); save("roles:3:1000") }   // b failed
+
+        assertEquals(setOf(a), manifest().unchanged(listOf(a, b)))
+    }
+
+    @Test fun `fingerprints round trip`() {
+        val fp = MergeManifest.Fingerprint(12, 34, "abc")
+        assertEquals(fp, MergeManifest.Fingerprint.parse(fp.toString()))
+        assertNull(MergeManifest.Fingerprint.parse("12,x,abc"))
+    }
+}
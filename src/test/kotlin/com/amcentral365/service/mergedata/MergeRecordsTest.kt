@@ -0,0 +1,68 @@
+package com.amcentral365.service.mergedata
+
+import com.google.gson.JsonParser
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.assertThrows
+
+import com.amcentral365.service.StatusException
+
+
+internal class MergeRecordsTest {
+
+    private fun json(s: String) = JsonParser().parse(s)
+
+    private val host1 = json("""{"asset": {"name": "host-1", "description": "first"},
+                                 "roles": [{"roleName": "linux"}, {"roleName": "ssh", "values": {"port": 22, "loginUser": "app"}}]}""")
+    private val host2 = json("""{"asset": {"name": "host-2"}}""")
+
+    @Test fun `json array with comments`() {
+        val text = """
+            // hosts
+            [ $host1, /* the second one */ $host2 ]
+        """
+        assertEquals(listOf(host1, host2), MergeRecords.json(text.reader(), "test.json").toList())
+        assertEquals(listOf(host2), MergeRecords.json("$host2".reader(), "test.json").toList())
+    }
+
+    @Test fun `json must not be empty`() {
+        assertThrows<StatusException> { MergeRecords.json("  ".reader(), "test.json").toList() }
+    }
+
+    @Test fun `ndjson is read a line at a time`() {
+        val text = "$host1\n\n$host2\n"
+        assertEquals(listOf(host1, host2), MergeRecords.ndjson(text.reader().buffered(), "test.ndjson").toList())
+    }
+
+    @Test fun `xml items`() {
+        val xml = """<?xml version="1.0"?>
+            <assets>
+              <item>
+                <asset name="host-1"><description>first</description></asset>
+                <roles>
+                  <item><roleName>linux</roleName></item>
+                  <item><roleName>ssh</roleName><values><port>22</port><loginUser>app</loginUser></values></item>
+                </roles>
+              </item>
+              <item>
+                <asset><name>host-2</name></asset>
+              </item>
+            </assets>
+        """.trim()
+
+        val xmlHost1 = json(host1.toString().replace("\"port\":22", "\"port\":\"22\""))     // XML values are strings
+        assertEquals(listOf(xmlHost1, host2), MergeRecords.xml(xml.byteInputStream(), "test.xml").toList())
+    }
+
+    @Test fun `xml root object`() {
+        val xml = """<role><roleName>r1</roleName><class>c</class><roleSchema><tag>string</tag><tag>string+</tag></roleSchema></role>"""
+        assertEquals(listOf(json("""{"roleName": "r1", "class": "c", "roleSchema": {"tag": ["string", "string+"]}}""")),
+                     MergeRecords.xml(xml.byteInputStream(), "test.xml").toList())
+    }
+
+    @Test fun `xml mixing items with other elements is an error`() {
+        val xml = """<assets><item><a>1</a></item><other/></assets>"""
+        assertThrows<StatusException> { MergeRecords.xml(xml.byteInputStream(), "test.xml").toList() }
+    }
+}
@@ -0,0 +1,80 @@
+package com.amcentral365.service.mergedata
+
+import java.io.File
+import java.util.regex.PatternSyntaxException
+import kotlin.random.Random
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+
+
+internal class PriorityPatternsTest {
+
+    /** The original implementation of [MergeDirectory.combineLists], matching every pattern against every file */
+    private fun referenceCombineLists(priorityList: List<String>, files: MutableList<File>, baseDirPrefix: String = ""): List<File> {
+        if( priorityList.isEmpty() )
+            return files
+
+        val baseDirPrefixRx = Regex("^$baseDirPrefix/")
+        val combinedList = mutableListOf<File>()
+        for(pattern in priorityList) {
+            val patternRx = Regex(pattern)
+            val matchedFileIndexes = files.withIndex()
+                                          .filter { patternRx.find((it.value.path.replace(baseDirPrefixRx, ""))) != null }
+                                          .map { it.index }
+            combinedList.addAll(matchedFileIndexes.map { idx -> files[idx] })
+            matchedFileIndexes.asReversed().forEach { idx -> files.removeAt(idx) }
+        }
+
+        combinedList.addAll(files)
+        return combinedList
+    }
+
+    private fun assertSameOrder(patterns: List<String>, files: List<File>, baseDirPrefix: String = "") =
+        assertEquals(
+            referenceCombineLists(patterns, files.toMutableList(), baseDirPrefix),
+            MergeDirectory.combineLists(patterns, files.toMutableList(), baseDirPrefix),
+            "patterns $patterns, prefix '$baseDirPrefix'"
+        )
+
+    @Test fun `required literals`() {
+        assertEquals(Pair("yml", false),         PriorityPatterns.requiredLiteral("b.yml"))
+        assertEquals(Pair("b.yml", true),        PriorityPatterns.requiredLiteral("b\\.yml"))
+        assertEquals(Pair("com/p1.json", false), PriorityPatterns.requiredLiteral("^com/p1\\.json$"))
+        assertEquals(Pair("host-", false),       PriorityPatterns.requiredLiteral("host-x?\\d+"))
+        assertEquals(Pair("ab", false),          PriorityPatterns.requiredLiteral("x{0,2}ab+c*"))
+        assertEquals(Pair("", false),            PriorityPatterns.requiredLiteral("a|b"))
+        assertEquals(Pair("", false),            PriorityPatterns.requiredLiteral("(?i)linux"))
+        assertEquals(Pair("", false),            PriorityPatterns.requiredLiteral("\\x41bc"))
+    }
+
+    @Test fun `optional and case-insensitive parts`() {
+        val files = listOf("b.json", "ab.json", "AB.json", "c.yml", "x/b.json", "bb.yml").map { File(it) }
+        for(pattern in listOf("a?b", "x{0,2}b", "a*b", "b+", "(?i)ab", "a|c", "[ab]\\.json", "b\\.json$", "^c", "^x/", "", "b{2}"))
+            assertSameOrder(listOf(pattern, "json"), files)
+    }
+
+    @Test fun `same order as matching every pattern`() {
+        val pieces = listOf(
+            "a", "b", "ab", "p1", "com", "com/", "/", ".", "\\.", "yml", "json", "^", "$", "^com", "json$", "^mergedata",
+            "a?", "b*", "p+", "[ab]", "[^a]", "(p|L)1", "a|b", "(?i)B", "\\d", "\\w+", "x{0,2}", "1{1,2}", "L1/", "host-", "-"
+        )
+        val segments = listOf("com", "amc", "p1", "L1", "a", "b", "ab", "B", "x.y", "host-1", "host-22", "mergedata")
+        val extensions = listOf("json", "yml", "yaml", "xml", "jsn")
+        val prefixes = listOf("", "mergedata/roles", "merge.data/roles")
+
+        val rnd = Random(365)
+        repeat(1000) {
+            val patterns = List(rnd.nextInt(0, 9)) { List(rnd.nextInt(1, 4)) { pieces.random(rnd) }.joinToString("") }
+                .filter { try { Regex(it); true } catch(x: PatternSyntaxException) { false } }
+            val prefix = prefixes.random(rnd)
+            val files = List(rnd.nextInt(0, 40)) {
+                val dir = if( rnd.nextBoolean() ) "mergedata/roles/" else ""
+                val name = List(rnd.nextInt(1, 5)) { segments.random(rnd) }.joinToString("/")
+                File("$dir$name.${extensions.random(rnd)}")
+            }.distinct()
+
+            assertSameOrder(patterns, files, prefix)
+        }
+    }
+}
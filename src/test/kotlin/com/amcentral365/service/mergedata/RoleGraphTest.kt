@@ -0,0 +1,44 @@
+package com.amcentral365.service.mergedata
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertNull
+
+
+internal class RoleGraphTest {
+
+    @Test fun `roles are merged after the roles they reference`() {
+        val graph = RoleGraph(mapOf(
+            "host"    to setOf("disk", "nic"),
+            "disk"    to setOf("vendor"),
+            "nic"     to setOf("vendor"),
+            "vendor"  to emptySet(),
+            "cluster" to setOf("host")
+        ))
+
+        assertEquals(listOf(listOf("vendor"), listOf("disk", "nic"), listOf("host"), listOf("cluster")), graph.waves)
+        assertEquals(emptySet<String>(), graph.cyclic)
+    }
+
+    @Test fun `references outside of the graph and to self are ignored`() {
+        val graph = RoleGraph(mapOf("a" to setOf("in_db", "a"), "b" to setOf("a")))
+        assertEquals(listOf(listOf("a"), listOf("b")), graph.waves)
+    }
+
+    @Test fun `cycles and the roles referencing them are excluded`() {
+        val references = mapOf(
+            "a" to setOf("b"),
+            "b" to setOf("c"),
+            "c" to setOf("a"),
+            "d" to setOf("c"),
+            "e" to emptySet()
+        )
+        val graph = RoleGraph(references)
+
+        assertEquals(listOf(listOf("e")), graph.waves)
+        assertEquals(setOf("a", "b", "c", "d"), graph.cyclic)
+        assertEquals(listOf("a", "b", "c", "a"), graph.cycleThrough("a", references))
+        assertNull(graph.cycleThrough("d", references))
+        assertNull(graph.cycleThrough("e", references))
+    }
+}
@@ -0,0 +1,130 @@
+package com.amcentral365.service.mergedata
+
+import com.google.gson.JsonNull
+import com.google.gson.JsonParser
+import com.google.gson.JsonPrimitive
+
+import org.junit.jupiter.api.Test
+import org.junit.jupiter.api.Assertions.assertEquals
+import org.junit.jupiter.api.Assertions.assertTrue
+import org.junit.jupiter.api.assertThrows
+
+import com.amcentral365.service.StatusException
+
+
+internal class YamlReaderTest {
+
+    private fun records(yaml: String) = YamlReader(yaml.trimIndent().reader().buffered(), "test.yml").records()
+
+    private fun json(s: String) = JsonParser().parse(s)
+
+    @Test fun `multi-document stream`() {
+        val docs = records("""
+            # inventory
+            ---
+            asset:
+              name: host-1
+              description: "the first host"
+            roles:
+              - roleName: linux
+              - roleName: ssh   # a comment
+                values: {hostname: 127.0.0.1, port: 22, loginUser: app}
+            ---
+            asset: {name: host-2}
+            roles: []
+            ...
+        """).toList()
+
+        assertEquals(listOf(
+            json("""{"asset": {"name": "host-1", "description": "the first host"},
+                     "roles": [{"roleName": "linux"}, {"roleName": "ssh", "values": {"hostname": "127.0.0.1", "port": 22, "loginUser": "app"}}]}"""),
+            json("""{"asset": {"name": "host-2"}, "roles": []}""")
+        ), docs)
+    }
+
+    @Test fun `sequence items are read one at a time`() {
+        val items = records("""
+            - name: a
+              tags:
+              - x
+              - 'y'
+            - name: b
+              n: [unterminated
+        """).iterator()
+
+        assertEquals(json("""{"name": "a", "tags": ["x", "y"]}"""), items.next())
+        val x = assertThrows<StatusException> { items.next() }
+        assertTrue(x.message!!.startsWith("test.yml line 6:"), x.message)
+    }
+
+    @Test fun `block and multi-line scalars`() {
+        val doc = records("""
+            literal: |
+              line 1
+               indented
+              line 3
+
+            folded: >-
+              one
+              two
+
+              three
+            kept: |+
+              x
+
+            quoted: "a long
+              description"
+            plain: a long
+              description
+        """).single().asJsonObject
+
+        assertEquals("line 1\n indented\nline 3\n", doc["literal"].asString)
+        assertEquals("one two\nthree", doc["folded"].asString)
+        assertEquals("x\n\n", doc["kept"].asString)
+        assertEquals("a long description", doc["quoted"].asString)
+        assertEquals("a long description", doc["plain"].asString)
+    }
+
+    @Test fun `plain scalars are typed`() {
+        assertEquals(JsonPrimitive(42L),   YamlReader.plainScalar("042"))
+        assertEquals(JsonPrimitive(-3L),   YamlReader.plainScalar("-3"))
+        assertEquals(JsonPrimitive(31L),   YamlReader.plainScalar("0x1F"))
+        assertEquals(JsonPrimitive(1.5),   YamlReader.plainScalar("1.5"))
+        assertEquals(JsonPrimitive(true),  YamlReader.plainScalar("true"))
+        assertEquals(JsonNull.INSTANCE,    YamlReader.plainScalar("~"))
+        assertEquals(JsonPrimitive("yes"), YamlReader.plainScalar("yes"))
+        assertEquals(JsonPrimitive(".inf"), YamlReader.plainScalar(".inf"))
+        assertEquals(JsonPrimitive("10.0.0.1"), YamlReader.plainScalar("10.0.0.1"))
+    }
+
+    @Test fun `quoted scalars and flow collections`() {
+        val doc = records("""
+            id: "0042"
+            version: '1.10'
+            empty: ""
+            nothing:
+            flow: {a: [1, "2", {b: null}], 'c d': x}
+            ? explicit key
+            : 3
+            url: http://host:8080/a#b
+        """).single()
+
+        assertEquals(json("""{"id": "0042", "version": "1.10", "empty": "", "nothing": null,
+                              "flow": {"a": [1, "2", {"b": null}], "c d": "x"}, "explicit key": 3,
+                              "url": "http://host:8080/a#b"}"""), doc)
+    }
+
+    @Test fun `empty documents are skipped`() {
+        assertEquals(listOf(json("""{"a": 1}""")), records("---\n# nothing\n---\na: 1\n---\n").toList())
+        assertEquals(emptyList<Any>(), records("# only a comment").toList())
+    }
+
+    @Test fun `unsupported syntax is an error`() {
+        assertThrows<StatusException> { records("a:\n\tb: 1").toList() }
+        assertThrows<StatusException> { records("a: &anchor 1").toList() }
+        assertThrows<StatusException> { records("a: &anchor 1\nb: *anchor").toList() }
+        assertThrows<StatusException> { records("a: !!str 1").toList() }
+        assertThrows<StatusException> { records("? [a, b]\n: 1").toList() }
+        assertThrows<StatusException> { records("a: 1\na: 2").toList() }
+    }
+}